@@ -0,0 +1,33 @@
+from abc import ABC, abstractmethod
+from typing import Optional
+
+
+class CacheBackend(ABC):
+    """Base class for all cache tiers. Values are opaque bytes."""
+
+    name: str
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        """Returns the value stored under the key, or None if it is missing or expired."""
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None):
+        """Stores the value under the key, for `ttl_seconds` if given."""
+        pass
+
+    @abstractmethod
+    async def delete(self, key: str):
+        """Removes the key, if present."""
+        pass
+
+    @property
+    @abstractmethod
+    def bytes_stored(self) -> Optional[int]:
+        """The size of the stored values, or None if the backend cannot tell cheaply."""
+        pass
+
+    async def close(self):
+        """Releases the resources held by the backend."""
+        pass
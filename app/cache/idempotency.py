@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from enum import StrEnum
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+from app.exceptions.exception import IdempotencyConflict
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+IDEMPOTENCY_STORE_PATH = os.environ.get(
+    "IDEMPOTENCY_STORE_PATH",
+    os.path.join(tempfile.gettempdir(), "brain-idempotency.sqlite"),
+)
+# How long the response of a completed request is replayed to the retries using its key
+IDEMPOTENCY_RETENTION_SECONDS = float(
+    os.environ.get("IDEMPOTENCY_RETENTION_SECONDS", 24 * 3600)
+)
+# A request that has been running for longer is assumed to belong to a worker that died, and can be taken over
+IDEMPOTENCY_LOCK_TIMEOUT_SECONDS = float(
+    os.environ.get("IDEMPOTENCY_LOCK_TIMEOUT_SECONDS", 600)
+)
+IDEMPOTENCY_COMPACTION_INTERVAL_SECONDS = float(
+    os.environ.get("IDEMPOTENCY_COMPACTION_INTERVAL_SECONDS", 3600)
+)
+# How often a retry polls for a request that is running in another worker
+IDEMPOTENCY_POLL_SECONDS = 0.5
+
+
+class RequestStatus(StrEnum):
+    RUNNING = "running"
+    COMPLETED = "completed"
+
+
+class IdempotentResponse(NamedTuple):
+    status_code: int
+    body: bytes
+    # An incomplete response, e.g. notes with failed chunks, is not stored, so that a retry completes it
+    complete: bool = True
+
+
+class _Record(NamedTuple):
+    fingerprint: str
+    status: RequestStatus
+    response: Optional[IdempotentResponse]
+
+
+class IdempotencyStore:
+    """The requests made with an idempotency key and the responses they completed with, stored in a SQLite file shared by the workers on the host.
+
+    Claiming a key is a single write transaction, so only one worker runs the request of a key while the others wait for its response. The calls block on the write lock of other workers, so async callers run them in a thread. The connection is used by one thread at a time.
+    """
+
+    _connection: sqlite3.Connection
+    _lock: threading.Lock
+    _retention_seconds: float
+    _lock_timeout_seconds: float
+
+    def __init__(
+        self,
+        path: str,
+        retention_seconds: float = IDEMPOTENCY_RETENTION_SECONDS,
+        lock_timeout_seconds: float = IDEMPOTENCY_LOCK_TIMEOUT_SECONDS,
+    ):
+        self._retention_seconds = retention_seconds
+        self._lock_timeout_seconds = lock_timeout_seconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        # Must be set before the first table is created to take effect
+        self._connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS requests (key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, status TEXT NOT NULL, status_code INTEGER, body BLOB, updated_at REAL NOT NULL)"
+        )
+
+    def claim(self, key: str, fingerprint: str) -> Optional[_Record]:
+        """Marks the request of the key as running in this worker, unless another request already holds the key.
+
+        Args:
+            key (str): The idempotency key sent by the client.
+            fingerprint (str): The fingerprint of the request body.
+
+        Returns:
+            Optional[_Record]: None if the key was claimed, or the request that holds the key.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                now: float = time.time()
+                row = self._connection.execute(
+                    "SELECT fingerprint, status, status_code, body, updated_at FROM requests WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None:
+                    fingerprint_, status, status_code, body, updated_at = row
+                    expired: bool = (
+                        status == RequestStatus.COMPLETED
+                        and updated_at <= now - self._retention_seconds
+                    ) or (
+                        status == RequestStatus.RUNNING
+                        and updated_at <= now - self._lock_timeout_seconds
+                    )
+                    if not expired:
+                        self._connection.execute("COMMIT")
+                        return _Record(
+                            fingerprint=fingerprint_,
+                            status=RequestStatus(status),
+                            response=(
+                                IdempotentResponse(status_code=status_code, body=body)
+                                if status == RequestStatus.COMPLETED
+                                else None
+                            ),
+                        )
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO requests (key, fingerprint, status, status_code, body, updated_at) VALUES (?, ?, ?, NULL, NULL, ?)",
+                    (key, fingerprint, RequestStatus.RUNNING.value, now),
+                )
+                self._connection.execute("COMMIT")
+                return None
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def complete(self, key: str, response: IdempotentResponse):
+        """Stores the response of the request of the key, to be replayed to its retries."""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE requests SET status = ?, status_code = ?, body = ?, updated_at = ? WHERE key = ?",
+                (
+                    RequestStatus.COMPLETED.value,
+                    response.status_code,
+                    response.body,
+                    time.time(),
+                    key,
+                ),
+            )
+
+    def release(self, key: str):
+        """Frees the key of a request that failed, so that a retry runs it again."""
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM requests WHERE key = ? AND status = ?",
+                (key, RequestStatus.RUNNING.value),
+            )
+
+    def compact(self) -> int:
+        """Deletes the expired requests and returns their pages to the file system.
+
+        Returns:
+            int: The number of requests deleted.
+        """
+        now: float = time.time()
+        with self._lock:
+            deleted: int = self._connection.execute(
+                "DELETE FROM requests WHERE (status = ? AND updated_at <= ?) OR (status = ? AND updated_at <= ?)",
+                (
+                    RequestStatus.COMPLETED.value,
+                    now - self._retention_seconds,
+                    RequestStatus.RUNNING.value,
+                    now - self._lock_timeout_seconds,
+                ),
+            ).rowcount
+            self._connection.execute("PRAGMA incremental_vacuum")
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return deleted
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class IdempotentExecutor:
+    """Runs every request with an idempotency key at most once, and replays its response to the retries using the same key.
+
+    A retry that arrives while the request is still running waits for it, whether it runs in this worker or in another one on the host. The request runs in a task of its own, so it completes and stores its response even if the client that sent it has disconnected. A request that fails, or completes only partly, does not store its response, so that a retry runs it again.
+    """
+
+    _store: IdempotencyStore
+    _jobs: dict[str, tuple[str, asyncio.Task[IdempotentResponse]]]
+
+    def __init__(self, store: IdempotencyStore):
+        self._store = store
+        self._jobs = {}
+
+    async def run(
+        self,
+        key: str,
+        fingerprint: str,
+        fn: Callable[[], Awaitable[IdempotentResponse]],
+    ) -> tuple[IdempotentResponse, bool]:
+        """Returns the response of the request of the key, running `fn` if no request holds the key.
+
+        Args:
+            key (str): The idempotency key sent by the client.
+            fingerprint (str): The fingerprint of the request body, which must match the one of the request that holds the key.
+            fn (Callable[[], Awaitable[IdempotentResponse]]): Runs the request.
+
+        Raises:
+            IdempotencyConflict: If the key is held by a request with a different body.
+
+        Returns:
+            tuple[IdempotentResponse, bool]: The response, and whether it was replayed from an earlier request.
+        """
+        while True:
+            job: Optional[tuple[str, asyncio.Task[IdempotentResponse]]] = (
+                self._jobs.get(key)
+            )
+            if job is not None:
+                self._check_fingerprint(key=key, expected=job[0], actual=fingerprint)
+                metrics.increment("idempotency_requests", result="waited")
+                return await asyncio.shield(job[1]), True
+
+            record: Optional[_Record] = await asyncio.to_thread(
+                self._store.claim, key=key, fingerprint=fingerprint
+            )
+            if record is None:
+                task: asyncio.Task[IdempotentResponse] = asyncio.create_task(
+                    self._run_job(key=key, fn=fn)
+                )
+                self._jobs[key] = (fingerprint, task)
+                task.add_done_callback(lambda _: self._jobs.pop(key, None))
+                metrics.increment("idempotency_requests", result="started")
+                return await asyncio.shield(task), False
+
+            self._check_fingerprint(
+                key=key, expected=record.fingerprint, actual=fingerprint
+            )
+            if record.response is not None:
+                metrics.increment("idempotency_requests", result="replayed")
+                return record.response, True
+            # The request was started in this worker while the key was being claimed
+            if key in self._jobs:
+                continue
+            # The request is running in another worker
+            await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+    async def _run_job(
+        self, key: str, fn: Callable[[], Awaitable[IdempotentResponse]]
+    ) -> IdempotentResponse:
+        try:
+            response: IdempotentResponse = await fn()
+        except BaseException:
+            # Shielded, so that a cancelled request still frees its key
+            await asyncio.shield(asyncio.to_thread(self._store.release, key=key))
+            raise
+        if response.status_code < 400 and response.complete:
+            await asyncio.to_thread(self._store.complete, key=key, response=response)
+        else:
+            await asyncio.to_thread(self._store.release, key=key)
+        return response
+
+    def _check_fingerprint(self, key: str, expected: str, actual: str):
+        if expected != actual:
+            log.error(f"Idempotency key {key} was reused with a different request")
+            raise IdempotencyConflict(
+                f"Idempotency key {key} was already used with a different request."
+            )
+
+    async def compact_periodically(
+        self, interval_seconds: float = IDEMPOTENCY_COMPACTION_INTERVAL_SECONDS
+    ):
+        """Compacts the store every `interval_seconds` until cancelled. Runs in the background for the lifetime of the application."""
+        while True:
+            try:
+                deleted: int = await asyncio.to_thread(self._store.compact)
+                log.info(f"Deleted {deleted} expired idempotency keys")
+            except Exception as e:
+                log.error(f"Error while compacting the idempotency store: {e}")
+            await asyncio.sleep(interval_seconds)
+
+    def close(self):
+        self._store.close()
+
+
+_executor: Optional[IdempotentExecutor] = None
+
+
+def open_idempotent_executor() -> IdempotentExecutor:
+    """Creates the process-wide executor. Called once in the application lifespan."""
+    global _executor
+    if _executor is None:
+        _executor = IdempotentExecutor(
+            store=IdempotencyStore(path=IDEMPOTENCY_STORE_PATH)
+        )
+    return _executor
+
+
+def close_idempotent_executor():
+    """Closes the process-wide executor on shutdown."""
+    global _executor
+    if _executor is not None:
+        _executor.close()
+        _executor = None
+
+
+def get_idempotent_executor() -> IdempotentExecutor:
+    """Returns the process-wide executor, creating it if the application lifespan has not run."""
+    return open_idempotent_executor()
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import unicodedata
+from typing import Any
+
+from app.llm.base import LLMConfig
+from app.llm.model import LLMType
+from app.models.content import Content
+
+
+def _normalise_text(text: str) -> str:
+    """Normalises the unicode form, the line endings and the surrounding whitespace, which do not change the notes."""
+    return unicodedata.normalize("NFC", text).replace("\r\n", "\n").strip()
+
+
+def conversation_fingerprint(conversation: dict[str, Any]) -> str:
+    """Returns a hash of the conversation that does not depend on the order of its keys or on insignificant whitespace."""
+    normalised: dict[str, Any] = {
+        key: _normalise_text(value) if isinstance(value, str) else value
+        for key, value in conversation.items()
+    }
+    return hashlib.sha256(
+        json.dumps(normalised, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+def notes_cache_key(
+    conversation: dict[str, Any],
+    content_lst: list[Content],
+    llm_type: LLMType,
+    model_config: LLMConfig,
+    prompt_version: str,
+) -> str:
+    """Returns the content address of the notes generated for a conversation.
+
+    Args:
+        conversation (dict[str, Any]): The conversation to be summarised.
+        content_lst (list[Content]): The content types that the user wants to generate notes for. Their order does not matter.
+        llm_type (LLMType): The model that generates the notes.
+        model_config (LLMConfig): The config of the model.
+        prompt_version (str): The fingerprint of the prompts sent along with the conversation.
+
+    Returns:
+        str: The cache key.
+    """
+    components: list[str] = [
+        conversation_fingerprint(conversation),
+        ",".join(sorted({content.value for content in content_lst})),
+        llm_type.value,
+        model_config.model_dump_json(),
+        prompt_version,
+    ]
+    return hashlib.sha256("\n".join(components).encode()).hexdigest()
+
+
+def combined_cache_key(cache_keys: list[str]) -> str:
+    """Returns a cache key that changes with any of the given keys, e.g. for the notes of a conversation whose chunks may be generated by any of several models. A single key is returned as is."""
+    if len(cache_keys) == 1:
+        return cache_keys[0]
+    return hashlib.sha256("\n".join(cache_keys).encode()).hexdigest()
@@ -0,0 +1,55 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.cache.base import CacheBackend
+
+
+class MemoryCache(CacheBackend):
+    """In-process LRU tier bounded by the size of the stored values."""
+
+    name = "memory"
+
+    _max_bytes: int
+    _entries: OrderedDict[str, tuple[bytes, Optional[float]]]
+    _bytes_stored: int
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes_stored = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry: Optional[tuple[bytes, Optional[float]]] = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None):
+        if len(value) > self._max_bytes:
+            return
+        self._remove(key)
+        expires_at: Optional[float] = (
+            time.time() + ttl_seconds if ttl_seconds is not None else None
+        )
+        self._entries[key] = (value, expires_at)
+        self._bytes_stored += len(value)
+        while self._bytes_stored > self._max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    async def delete(self, key: str):
+        self._remove(key)
+
+    def _remove(self, key: str):
+        entry: Optional[tuple[bytes, Optional[float]]] = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes_stored -= len(entry[0])
+
+    @property
+    def bytes_stored(self) -> int:
+        return self._bytes_stored
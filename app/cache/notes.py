@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+from typing import Any, Optional
+
+from app.cache.base import CacheBackend
+from app.cache.memory import MemoryCache
+from app.cache.redis import RedisCache
+from app.cache.sqlite import SQLiteCache
+from app.cache.tiered import TieredCache
+from app.llm.token_count import TokenCount
+
+log = logging.getLogger(__name__)
+
+NOTES_CACHE_ENABLED = os.environ.get("NOTES_CACHE_ENABLED", "true").lower() == "true"
+NOTES_CACHE_TTL_SECONDS = float(
+    os.environ.get("NOTES_CACHE_TTL_SECONDS", 7 * 24 * 3600)
+)
+NOTES_CACHE_MEMORY_MAX_BYTES = int(
+    os.environ.get("NOTES_CACHE_MEMORY_MAX_BYTES", 64 * 1024 * 1024)
+)
+# The persistent tier is only used when a path is set
+NOTES_CACHE_PATH = os.environ.get("NOTES_CACHE_PATH", "")
+NOTES_CACHE_MAX_BYTES = int(os.environ.get("NOTES_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+# e.g. redis://localhost:6379/0. Needs the optional redis package.
+NOTES_CACHE_REDIS_URL = os.environ.get("NOTES_CACHE_REDIS_URL", "")
+
+# Notes of whole conversations
+NOTES_CACHE = "notes"
+# Notes of single conversation chunks, which survive messages being appended to the conversation
+CHUNK_NOTES_CACHE = "chunk_notes"
+
+
+def create_notes_cache(name: str) -> TieredCache:
+    """Returns a notes cache with the tiers enabled in the environment: memory, then SQLite, then Redis."""
+    tiers: list[CacheBackend] = []
+    if NOTES_CACHE_ENABLED:
+        tiers.append(MemoryCache(max_bytes=NOTES_CACHE_MEMORY_MAX_BYTES))
+        if NOTES_CACHE_PATH:
+            tiers.append(
+                SQLiteCache(path=NOTES_CACHE_PATH, max_bytes=NOTES_CACHE_MAX_BYTES)
+            )
+        if NOTES_CACHE_REDIS_URL:
+            tiers.append(RedisCache.from_url(NOTES_CACHE_REDIS_URL))
+    return TieredCache(name=name, tiers=tiers, ttl_seconds=NOTES_CACHE_TTL_SECONDS)
+
+
+def encode_notes(notes: list[dict[str, Any]], token_sum: TokenCount) -> bytes:
+    return json.dumps(
+        {
+            "notes": notes,
+            "token_sum": token_sum.tokens,
+            "token_sum_error": token_sum.error,
+        }
+    ).encode()
+
+
+def decode_notes(value: bytes) -> tuple[list[dict[str, Any]], TokenCount]:
+    cached: dict[str, Any] = json.loads(value)
+    return cached["notes"], TokenCount(
+        tokens=cached["token_sum"], error=cached["token_sum_error"]
+    )
+
+
+_notes_caches: dict[str, TieredCache] = {}
+
+
+def open_notes_caches():
+    """Creates the process-wide notes caches. Called once in the application lifespan."""
+    for name in (NOTES_CACHE, CHUNK_NOTES_CACHE):
+        get_notes_cache(name=name)
+
+
+async def close_notes_caches():
+    """Closes the process-wide notes caches on shutdown."""
+    while _notes_caches:
+        _, notes_cache = _notes_caches.popitem()
+        await notes_cache.close()
+
+
+def get_notes_cache(name: str = NOTES_CACHE) -> TieredCache:
+    """Returns a process-wide notes cache, creating it if the application lifespan has not run (e.g. in scripts)."""
+    if name not in _notes_caches:
+        _notes_caches[name] = create_notes_cache(name=name)
+    return _notes_caches[name]
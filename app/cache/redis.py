@@ -0,0 +1,49 @@
+from typing import Any, Optional
+
+from app.cache.base import CacheBackend
+
+
+class RedisCache(CacheBackend):
+    """Tier backed by any client with the redis.asyncio interface (`get`, `set` with `ex`, `delete`), e.g. Redis, Valkey or KeyDB.
+
+    The client is passed in, so that the redis package stays optional. Use `from_url` to build one when redis is installed.
+    """
+
+    name = "redis"
+
+    _client: Any
+    _prefix: str
+
+    def __init__(self, client: Any, prefix: str = "brain:"):
+        self._client = client
+        self._prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str = "brain:") -> "RedisCache":
+        try:
+            import redis.asyncio
+        except ImportError as e:
+            raise ImportError(
+                "The redis package is required for a Redis cache tier: pip install redis"
+            ) from e
+        return cls(client=redis.asyncio.from_url(url), prefix=prefix)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._client.get(self._prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None):
+        await self._client.set(
+            self._prefix + key,
+            value,
+            ex=int(ttl_seconds) if ttl_seconds is not None else None,
+        )
+
+    async def delete(self, key: str):
+        await self._client.delete(self._prefix + key)
+
+    @property
+    def bytes_stored(self) -> Optional[int]:
+        return None
+
+    async def close(self):
+        await self._client.aclose()
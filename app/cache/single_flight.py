@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Generic, TypeVar
+
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class _Flight(Generic[T]):
+    task: asyncio.Task[T]
+    callers: int = 0
+
+
+class SingleFlight(Generic[T]):
+    """Runs at most one call per key at a time. Callers that arrive while a call with the same key is in flight wait for its result instead of starting their own.
+
+    The callers of a flight are reference-counted: a caller that is cancelled (e.g. because its client disconnected) only leaves the flight, and the call itself is only cancelled once every caller has left.
+    """
+
+    _name: str
+    _flights: dict[str, _Flight[T]]
+
+    def __init__(self, name: str):
+        self._name = name
+        self._flights = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """Returns the result of `fn`, or of the call with the same key that is already in flight.
+
+        Args:
+            key (str): The fingerprint of the call.
+            fn (Callable[[], Awaitable[T]]): The call to be made if none is in flight.
+
+        Returns:
+            T: The result of the call. An exception raised by the call is raised to every caller.
+        """
+        flight: _Flight[T] | None = self._flights.get(key)
+        if flight is None:
+
+            async def _call() -> T:
+                return await fn()
+
+            flight = _Flight(task=asyncio.create_task(_call()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(
+                lambda _: self._forget(key=key, flight=flight)
+            )
+        else:
+            log.info(f"Coalescing {self._name} request with the one in flight")
+            metrics.increment("single_flight_coalesced", flight=self._name)
+
+        flight.callers += 1
+        try:
+            # The task is shielded, so that cancelling one caller does not cancel the others
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.callers -= 1
+            if not flight.callers and not flight.task.done():
+                log.info(
+                    f"Every caller left the {self._name} request. Cancelling it..."
+                )
+                self._forget(key=key, flight=flight)
+                flight.task.cancel()
+
+    def _forget(self, key: str, flight: _Flight[T]):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        metrics.set_gauge(
+            "single_flight_in_flight", len(self._flights), flight=self._name
+        )
+
+    def in_flight(self) -> int:
+        return len(self._flights)
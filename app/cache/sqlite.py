@@ -0,0 +1,130 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from app.cache.base import CacheBackend
+
+
+class SQLiteCache(CacheBackend):
+    """Persistent tier in a SQLite file, with a time to live per entry and least recently used eviction once the stored values exceed `max_bytes`.
+
+    The queries run in a thread, since they block on the disk and on the write lock of other workers. The connection is used by one thread at a time.
+    """
+
+    name = "sqlite"
+
+    _connection: sqlite3.Connection
+    _max_bytes: int
+    _bytes_stored: int
+    _lock: threading.Lock
+
+    def __init__(self, path: str, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+        )
+        self._bytes_stored = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._get, key)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        now: float = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                self._delete(key)
+                return None
+            self._connection.execute(
+                "UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            return value
+
+    async def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None):
+        if len(value) > self._max_bytes:
+            return
+        await asyncio.to_thread(self._set, key, value, ttl_seconds)
+
+    def _set(self, key: str, value: bytes, ttl_seconds: Optional[float]):
+        now: float = time.time()
+        expires_at: Optional[float] = (
+            now + ttl_seconds if ttl_seconds is not None else None
+        )
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute(
+                    "INSERT INTO entries (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size, expires_at = excluded.expires_at, accessed_at = excluded.accessed_at",
+                    (key, value, len(value), expires_at, now),
+                )
+                self._evict(now=now)
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _evict(self, now: float):
+        """Drops the expired entries, then the least recently used ones until the stored values fit into `max_bytes`."""
+        self._connection.execute(
+            "DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?",
+            (now,),
+        )
+        self._bytes_stored = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        if self._bytes_stored <= self._max_bytes:
+            return
+        excess: int = self._bytes_stored - self._max_bytes
+        freed: int = 0
+        evicted_keys: list[str] = []
+        for key, size in self._connection.execute(
+            "SELECT key, size FROM entries ORDER BY accessed_at"
+        ):
+            evicted_keys.append(key)
+            freed += size
+            if freed >= excess:
+                break
+        self._connection.executemany(
+            "DELETE FROM entries WHERE key = ?", [(key,) for key in evicted_keys]
+        )
+        self._bytes_stored -= freed
+
+    async def delete(self, key: str):
+        def _locked_delete():
+            with self._lock:
+                self._delete(key)
+
+        await asyncio.to_thread(_locked_delete)
+
+    def _delete(self, key: str):
+        """Deletes the entry. The caller holds the lock."""
+        row = self._connection.execute(
+            "DELETE FROM entries WHERE key = ? RETURNING size", (key,)
+        ).fetchone()
+        if row is not None:
+            self._bytes_stored -= row[0]
+
+    @property
+    def bytes_stored(self) -> int:
+        return self._bytes_stored
+
+    async def close(self):
+        with self._lock:
+            self._connection.close()
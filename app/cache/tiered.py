@@ -0,0 +1,84 @@
+import logging
+from typing import Optional
+
+from app.cache.base import CacheBackend
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class TieredCache:
+    """Looks a key up in each tier in order, from the fastest to the slowest, and copies a hit into the faster tiers that missed it.
+
+    The cache is best-effort: a tier that fails is logged and counted as a miss, so an unavailable backend never fails a request. Keys are prefixed with the name of the cache, so several caches can share a persistent tier.
+    """
+
+    _name: str
+    _tiers: list[CacheBackend]
+    _ttl_seconds: Optional[float]
+    _hits: int
+    _lookups: int
+
+    def __init__(
+        self, name: str, tiers: list[CacheBackend], ttl_seconds: Optional[float] = None
+    ):
+        self._name = name
+        self._tiers = tiers
+        self._ttl_seconds = ttl_seconds
+        self._hits = 0
+        self._lookups = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """Returns the cached value of the key, or None on a miss in every tier."""
+        key = f"{self._name}:{key}"
+        value: Optional[bytes] = None
+        missed_tiers: list[CacheBackend] = []
+        for tier in self._tiers:
+            try:
+                value = await tier.get(key)
+            except Exception as e:
+                log.error(
+                    f"Error while reading {tier.name} tier of {self._name} cache: {e}"
+                )
+                value = None
+            if value is not None:
+                metrics.increment("cache_hits", cache=self._name, tier=tier.name)
+                break
+            metrics.increment("cache_misses", cache=self._name, tier=tier.name)
+            missed_tiers.append(tier)
+
+        self._lookups += 1
+        if value is not None:
+            self._hits += 1
+            for tier in missed_tiers:
+                await self._set_tier(tier=tier, key=key, value=value)
+        metrics.set_gauge(
+            "cache_hit_ratio", self._hits / self._lookups, cache=self._name
+        )
+        return value
+
+    async def set(self, key: str, value: bytes):
+        """Stores the value in every tier."""
+        key = f"{self._name}:{key}"
+        for tier in self._tiers:
+            await self._set_tier(tier=tier, key=key, value=value)
+
+    async def _set_tier(self, tier: CacheBackend, key: str, value: bytes):
+        try:
+            await tier.set(key, value, ttl_seconds=self._ttl_seconds)
+        except Exception as e:
+            log.error(
+                f"Error while writing {tier.name} tier of {self._name} cache: {e}"
+            )
+            return
+        if tier.bytes_stored is not None:
+            metrics.set_gauge(
+                "cache_bytes_stored",
+                tier.bytes_stored,
+                cache=self._name,
+                tier=tier.name,
+            )
+
+    async def close(self):
+        for tier in self._tiers:
+            await tier.close()
@@ -1,9 +1,64 @@
-from pydantic import BaseModel
+from typing import Optional
 
+from pydantic import BaseModel, field_validator
+
+from app.control.pre.partition import CHUNKING_MODE, ChunkingMode
+from app.llm.circuit_breaker import LLM_FALLBACK_CHAIN
+from app.llm.deadline import INFERENCE_DEADLINE_SECONDS
+from app.llm.hedging import HEDGE_LLM_TYPE, HEDGE_PERCENTILE
 from app.llm.model import LLMType
+from app.llm.router import (
+    LLM_ROUTING_CANDIDATES,
+    LLM_ROUTING_POLICY,
+    ROUTING_LATENCY_SLO_SECONDS,
+    RoutingPolicy,
+)
+from app.llm.token_count import TOKEN_COUNT_MODE, TokenCountMode
 
 
 class InferenceConfig(BaseModel):
     """The main class describing the inference configuration."""
 
-    llm_type: LLMType = LLMType.OPENAI_GPT4
\ No newline at end of file
+    llm_type: LLMType = LLMType.OPENAI_GPT4
+    # Opt-in: only the messages close to a split point or the hard cap are tokenized
+    token_count_mode: TokenCountMode = TOKEN_COUNT_MODE
+    # Optional upper bound on the conversation tokens per chunk, on top of the budget derived from the context window
+    max_chunk_tokens: Optional[int] = None
+    # Opt-in: content-defined boundaries keep the earlier chunks, and their cached notes, when messages are appended to a conversation, at the cost of chunks half as large
+    chunking_mode: ChunkingMode = CHUNKING_MODE
+    # Opt-in: a chunk still running after this percentile (e.g. 95) of the recent latencies of its model gets a second attempt
+    hedge_percentile: Optional[float] = HEDGE_PERCENTILE
+    # The model of the second attempt, which should fit the chunks of `llm_type`. Defaults to `llm_type`.
+    hedge_llm_type: Optional[LLMType] = HEDGE_LLM_TYPE
+    # Models that a chunk moves on to, in order, when the previous one fails or its circuit breaker is open. They should fit the chunks of `llm_type`.
+    fallback_llm_types: list[LLMType] = LLM_FALLBACK_CHAIN
+    # Opt-in: picks the model of every chunk among `llm_type` and `routing_llm_types` that fit it
+    routing_policy: Optional[RoutingPolicy] = LLM_ROUTING_POLICY
+    routing_llm_types: list[LLMType] = LLM_ROUTING_CANDIDATES
+    # The expected latency that the `cost_under_slo` policy has to meet
+    routing_latency_slo_seconds: float = ROUTING_LATENCY_SLO_SECONDS
+    # The time a request has to generate its notes, unless it sends a Request-Timeout header. None means no deadline.
+    deadline_seconds: Optional[float] = INFERENCE_DEADLINE_SECONDS
+
+    @field_validator("fallback_llm_types", "routing_llm_types")
+    @classmethod
+    def validate_notes_support(cls, llm_types: list[LLMType]) -> list[LLMType]:
+        """Rejects at startup the models that a chunk cannot be sent to, instead of failing every chunk sent to them."""
+        for llm_type in llm_types:
+            if not llm_type.supports_notes():
+                raise ValueError(
+                    f"{llm_type} does not answer with the fields of the notes and cannot take over chunks"
+                )
+        return llm_types
+
+    @field_validator("hedge_llm_type")
+    @classmethod
+    def validate_hedge_notes_support(
+        cls, llm_type: Optional[LLMType]
+    ) -> Optional[LLMType]:
+        """Rejects at startup a hedge model that cannot answer with the notes, as every hedge sent to it would fail."""
+        if llm_type is not None and not llm_type.supports_notes():
+            raise ValueError(
+                f"{llm_type} does not answer with the fields of the notes and cannot take over chunks"
+            )
+        return llm_type
@@ -1,22 +1,23 @@
 import logging
 from typing import Any, Optional
 
-from app.exceptions.exception import LogicError
+from app.exceptions.exception import InvalidOutput
 from app.process.types import TODO_MARKER
 from app.prompts.generator.functions import NotesFunctions
 
 log = logging.getLogger(__name__)
 
+
 def post_process(
-    topic: str, 
-    goal: str, 
+    topic: str,
+    goal: str,
     context: str,
-    overview: str, 
+    overview: str,
     key_concepts_lst: list[dict[str, str]],
     tips_lst: Optional[list[dict[str, str]]],
     mcq_practice: Optional[dict[str, Any]],
-    code_practice: Optional[dict[str, str]]
-    ) -> dict[str, Any]:
+    code_practice: Optional[dict[str, str]],
+) -> dict[str, Any]:
     """_summary_
 
     Args:
@@ -33,71 +34,128 @@ def post_process(
         dict[str, Any]: A dictionary containing the parts of the summary
     """
     try:
-        if not isinstance(topic, str):
-            raise TypeError(f"Topic is not a string: {topic}")
-        else:
-            _reject_unlikely_topics(topic=topic)
-
-        if not isinstance(goal, str):
-            raise TypeError(f"Goal is not a string: {goal}")
-        if not isinstance(context, str):
-            raise TypeError(f"Context is not a string: {context}")
-        if not isinstance(overview, str):
-            raise TypeError(f"Overview is not a string: {overview}")
-        if not isinstance(key_concepts_lst, list):
-            raise TypeError(f"Key concepts list is not a list: {key_concepts_lst}")
-        if tips_lst:
-            if not isinstance(tips_lst, list):
-                raise TypeError(f"Tips list is not a list: {tips_lst}")
-        if mcq_practice:
-            if not isinstance(mcq_practice, dict):
-                raise TypeError(f"MCQ practice is not a dictionary: {mcq_practice}")
-            if not isinstance(mcq_practice[NotesFunctions.MCQ_PRACTICE_WRONG_OPTIONS.value], list):
-                raise TypeError(f"MCQ practice wrong options is not a list: {mcq_practice[NotesFunctions.MCQ_PRACTICE_WRONG_OPTIONS.value]}")
-        if code_practice:
-            if not isinstance(code_practice, dict):
-                raise TypeError(f"Code practice is not a dictionary: {code_practice}")
-            
-            half_completed_code: str = code_practice[NotesFunctions.CODE_PRACTICE_HALF_COMPLETED_CODE.value]
-            fully_completed_code: str = code_practice[NotesFunctions.CODE_PRACTICE_FULLY_COMPLETED_CODE.value]
-            _verify_todo_marker_presence(
-                half_completed_code=half_completed_code
-            )
-            _verify_expected_similarity_and_difference(
-                half_completed_code=half_completed_code, 
-                fully_completed_code=fully_completed_code
-            )
-        
+        for field, value in (
+            (NotesFunctions.TOPIC, topic),
+            (NotesFunctions.GOAL, goal),
+            (NotesFunctions.CONTEXT, context),
+            (NotesFunctions.OVERVIEW, overview),
+            (NotesFunctions.KEY_CONCEPTS, key_concepts_lst),
+            (NotesFunctions.TIPS, tips_lst),
+            (NotesFunctions.MCQ_PRACTICE, mcq_practice),
+            (NotesFunctions.CODE_PRACTICE, code_practice),
+        ):
+            _check_field(field=field, value=value)
+
         return {
-            NotesFunctions.TOPIC.value: topic, 
-            NotesFunctions.GOAL.value: goal, 
+            NotesFunctions.TOPIC.value: topic,
+            NotesFunctions.GOAL.value: goal,
             NotesFunctions.CONTEXT.value: context,
-            NotesFunctions.OVERVIEW.value: overview, 
+            NotesFunctions.OVERVIEW.value: overview,
             NotesFunctions.KEY_CONCEPTS.value: key_concepts_lst,
             NotesFunctions.TIPS.value: tips_lst,
             NotesFunctions.MCQ_PRACTICE.value: mcq_practice,
-            NotesFunctions.CODE_PRACTICE.value: code_practice   
+            NotesFunctions.CODE_PRACTICE.value: code_practice,
         }
     except (TypeError, ValueError) as e:
         log.error(f"Logic error while post-processing summary: {e}")
-        raise LogicError(message=str(e))
+        raise InvalidOutput(message=str(e))
     except Exception as e:
         log.error(f"Unexpected error while post-processing summary: {e}")
         raise e
 
 
+def validate_field(field: str, value: Any):
+    """Checks a single field of the notes with the rules of `post_process`, as soon as the model has generated it.
+
+    Every rule of `post_process` only depends on one field, so a streamed generation that is bound to be rejected can be aborted at its first invalid field instead of being paid for in full.
+
+    Args:
+        field (str): The name of the field, e.g. `topic`.
+        value (Any): The value of the field, as generated by the model.
+
+    Raises:
+        InvalidOutput: If `post_process` would reject the field.
+    """
+    try:
+        _check_field(field=field, value=value)
+    except (TypeError, ValueError) as e:
+        log.error(f"Logic error while validating field {field}: {e}")
+        raise InvalidOutput(message=str(e))
+
+
+def _check_field(field: str, value: Any):
+    """Raises a TypeError or ValueError if the field of the notes is invalid. Fields without rules are accepted."""
+    match field:
+        case NotesFunctions.TOPIC:
+            if not isinstance(value, str):
+                raise TypeError(f"Topic is not a string: {value}")
+            _reject_unlikely_topics(topic=value)
+        case NotesFunctions.GOAL:
+            if not isinstance(value, str):
+                raise TypeError(f"Goal is not a string: {value}")
+        case NotesFunctions.CONTEXT:
+            if not isinstance(value, str):
+                raise TypeError(f"Context is not a string: {value}")
+        case NotesFunctions.OVERVIEW:
+            if not isinstance(value, str):
+                raise TypeError(f"Overview is not a string: {value}")
+        case NotesFunctions.KEY_CONCEPTS:
+            if not isinstance(value, list):
+                raise TypeError(f"Key concepts list is not a list: {value}")
+        case NotesFunctions.TIPS:
+            if value and not isinstance(value, list):
+                raise TypeError(f"Tips list is not a list: {value}")
+        case NotesFunctions.MCQ_PRACTICE:
+            if not value:
+                return
+            if not isinstance(value, dict):
+                raise TypeError(f"MCQ practice is not a dictionary: {value}")
+            wrong_options: Any = value.get(
+                NotesFunctions.MCQ_PRACTICE_WRONG_OPTIONS.value
+            )
+            if not isinstance(wrong_options, list):
+                raise TypeError(
+                    f"MCQ practice wrong options is not a list: {wrong_options}"
+                )
+        case NotesFunctions.CODE_PRACTICE:
+            if not value:
+                return
+            if not isinstance(value, dict):
+                raise TypeError(f"Code practice is not a dictionary: {value}")
+            half_completed_code: Any = value.get(
+                NotesFunctions.CODE_PRACTICE_HALF_COMPLETED_CODE.value
+            )
+            fully_completed_code: Any = value.get(
+                NotesFunctions.CODE_PRACTICE_FULLY_COMPLETED_CODE.value
+            )
+            if not isinstance(half_completed_code, str):
+                raise TypeError(
+                    f"Code practice half completed code is not a string: {half_completed_code}"
+                )
+            if not isinstance(fully_completed_code, str):
+                raise TypeError(
+                    f"Code practice fully completed code is not a string: {fully_completed_code}"
+                )
+            _verify_todo_marker_presence(half_completed_code=half_completed_code)
+            _verify_expected_similarity_and_difference(
+                half_completed_code=half_completed_code,
+                fully_completed_code=fully_completed_code,
+            )
+
+
 def _reject_unlikely_topics(topic: str):
     """Throws an error if the topic is unlikely to be valid/of good quality.
 
     The observation is that most valid topics have more than one word. One-word topics generated by LLM tend to be things like "Issue", "Problem", "Solution", etc. that are not what we want.
-    
+
     Args:
         topic (str): the topic-content dictionary to be checked.
     """
-    
+
     if len(topic.split(" ")) <= 1:
         raise ValueError(f"Topic '{topic}' is unlikely to be a valid topic.")
-    
+
+
 def _enforce_code_language_presence(key_concepts_lst: list[dict[str, str]]):
     """Enforces that the code language is present if the code example is present.
 
@@ -105,21 +163,31 @@ def _enforce_code_language_presence(key_concepts_lst: list[dict[str, str]]):
         key_concepts_lst (list[dict[str, str]]): the list of key concepts to be checked.
     """
     for key_concept in key_concepts_lst:
-        code_example: Optional[dict[str, str]] = key_concept.get(NotesFunctions.KEY_CONCEPT_CODE_EXAMPLE.value)
+        code_example: Optional[dict[str, str]] = key_concept.get(
+            NotesFunctions.KEY_CONCEPT_CODE_EXAMPLE.value
+        )
         if not code_example:
             continue
-        if code_example.get(NotesFunctions.KEY_CONCEPT_CODE.value) and not code_example.get(NotesFunctions.KEY_CONCEPT_LANGUAGE.value):
-            raise ValueError(f"Code example present but code language not specified for key concept: {key_concept}")
-        
-def _verify_expected_similarity_and_difference(half_completed_code: str, fully_completed_code: str):
+        if code_example.get(
+            NotesFunctions.KEY_CONCEPT_CODE.value
+        ) and not code_example.get(NotesFunctions.KEY_CONCEPT_LANGUAGE.value):
+            raise ValueError(
+                f"Code example present but code language not specified for key concept: {key_concept}"
+            )
+
+
+def _verify_expected_similarity_and_difference(
+    half_completed_code: str, fully_completed_code: str
+):
     """Verifies that the question and answer blocks are similar before the {TODO_MARKER} and different after the {TODO_MARKER}.
-    
+
     This ensures that our output is streamlined for easy verification by the user.
 
     Args:
         question (str): The question block generated by the LLM.
         answer (str): The answer block generated by the LLM.
     """
+
     def strip_comments_and_whitespace(code: str):
         lines = code.strip().split("\n")
         stripped_lines = []
@@ -130,14 +198,15 @@ def _verify_expected_similarity_and_difference(half_completed_code: str, fully_c
             if not stripped_line.startswith("#") and stripped_line != "":
                 stripped_lines.append(stripped_line)
         return stripped_lines
-    
+
     stripped_question = strip_comments_and_whitespace(half_completed_code)
     stripped_answer = strip_comments_and_whitespace(fully_completed_code)
 
     if stripped_question == stripped_answer:
-        raise ValueError("The question and answer of code practice differ only by comments and white spaces.")
+        raise ValueError(
+            "The question and answer of code practice differ only by comments and white spaces."
+        )
 
-    
     # question_lines = half_completed_code.strip().split("\n")
     # answer_lines = fully_completed_code.strip().split("\n")
     # todo_marker_found = False
@@ -181,7 +250,8 @@ def _verify_expected_similarity_and_difference(half_completed_code: str, fully_c
     #         q_index += 1
     #         a_index += 1
 
+
 def _verify_todo_marker_presence(half_completed_code: str):
     """Verifies that the text contains the {TODO_MARKER}."""
     if TODO_MARKER not in half_completed_code:
-        raise ValueError(f"The text does not contain the placeholder {TODO_MARKER}.")
\ No newline at end of file
+        raise ValueError(f"The text does not contain the placeholder {TODO_MARKER}.")
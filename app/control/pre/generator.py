@@ -1,68 +1,403 @@
 import json
 import logging
-from typing import Any
-
-from transformers import AutoTokenizer
+import math
+import time
+from typing import Any, AsyncIterator, Iterator, NamedTuple
 
+from app.control.pre.partition import (
+    ChunkingMode,
+    group_turns,
+    is_content_boundary,
+    partition_balanced,
+    split_by_characters,
+    split_text,
+)
 from app.exceptions.exception import LogicError
+from app.llm.token_count import (
+    TokenCount,
+    TokenCountMode,
+    TokenEstimator,
+    get_token_estimator,
+)
+from app.llm.tokenizer import BatchTokenizer, TokenizerType, get_batch_tokenizer
+from app.metrics import metrics
 from app.models.conversation import Conversation
 
 log = logging.getLogger(__name__)
 
 MAX_CONVERSATION_TOKENS = 10000
 
-def pre_process(
-    conversation: dict[str, Any], max_input_tokens: int
-) -> tuple[list[Conversation], int]:
+
+class ConversationChunk(NamedTuple):
+    """A conversation chunk yielded by `stream_pre_process`."""
+
+    conversation: Conversation
+    # Upper bound on the token length of the messages in the chunk
+    tokens: int
+    # Token sum of the messages of the conversation counted so far
+    token_sum: TokenCount
+
+
+async def pre_process(
+    conversation: dict[str, Any],
+    max_input_tokens: int,
+    token_count_mode: TokenCountMode = TokenCountMode.EXACT,
+    tokenizer_type: TokenizerType = TokenizerType.CODELLAMA,
+) -> tuple[list[Conversation], TokenCount]:
     """Pre-processes the conversation in preparation for summarisation.
 
     Args:
         conversation_dict (dict[str, Any]): The conversation dictionary to be transformed into a list of Conversation object(s).
         max_input_tokens (int): The maximum input token length allowed per conversation. If the conversation dict exceeds this limit, it will be split into multiple conversations.
+        token_count_mode (TokenCountMode, optional): Whether every message is tokenized, or only the messages close to a split point or the hard cap. Defaults to TokenCountMode.EXACT.
+        tokenizer_type (TokenizerType, optional): The tokenizer of the model that the conversation will be sent to. Defaults to TokenizerType.CODELLAMA.
 
     Returns:
-        tuple[list[Conversation], int]: Returns the list of splitted conversations and the total token sum of the conversation for usage tracking in stomach.
+        tuple[list[Conversation], TokenCount]: Returns the list of splitted conversations and the total token sum of the conversation for usage tracking in stomach. The token sum carries an error bound if some messages were only estimated.
     """
     try:
-        conversation_lst, token_sum = _split_by_token_length(
-            conversation_dict=conversation, max_input_tokens=max_input_tokens
+        token_dict: dict[str, TokenCount] = await _count_tokens(
+            conversation_dict=conversation,
+            max_input_tokens=max_input_tokens,
+            token_count_mode=token_count_mode,
+            tokenizer_type=tokenizer_type,
+        )
+        token_dict, token_sum = _truncate_to_token_cap(token_dict=token_dict)
+        message_dict, message_token_dict = await _split_oversized_messages(
+            conversation_dict=conversation,
+            token_dict=token_dict,
+            max_input_tokens=max_input_tokens,
+            tokenizer_type=tokenizer_type,
+        )
+        conversation_lst: list[Conversation] = _split_by_token_length(
+            conversation_dict=message_dict,
+            token_dict=message_token_dict,
+            max_input_tokens=max_input_tokens,
         )
         return conversation_lst, token_sum
     except LogicError as e:
-        log.error(
-            f"Logic error while pre-processing user chatlog input: {e}"
+        log.error(f"Logic error while pre-processing user chatlog input: {e}")
+        raise e
+    except Exception as e:
+        log.error(f"Unexpected error while pre-processing user chatlog input: {e}")
+        raise e
+
+
+async def stream_pre_process(
+    conversation: dict[str, Any],
+    max_input_tokens: int,
+    token_count_mode: TokenCountMode = TokenCountMode.EXACT,
+    tokenizer_type: TokenizerType = TokenizerType.CODELLAMA,
+    chunking_mode: ChunkingMode = ChunkingMode.BALANCED,
+) -> AsyncIterator[ConversationChunk]:
+    """Pre-processes the conversation like `pre_process`, but yields every chunk as soon as it is full, so that the first chunks can be summarised while the rest of the conversation is still being tokenized.
+
+    The messages are tokenized in batches of about one chunk, and tokenization stops as soon as MAX_CONVERSATION_TOKENS is reached. Since the chunks are emitted before the whole conversation is counted, their target size is planned from the estimated token counts, and a chunk is emitted once it reaches the target or the next turn does not fit into it.
+
+    Args:
+        conversation (dict[str, Any]): The conversation dictionary to be transformed into Conversation chunks.
+        max_input_tokens (int): The maximum input token length allowed per conversation.
+        token_count_mode (TokenCountMode, optional): Whether every message is tokenized, or only the messages close to a split point or the hard cap. Defaults to TokenCountMode.EXACT.
+        tokenizer_type (TokenizerType, optional): The tokenizer of the model that the conversation will be sent to. Defaults to TokenizerType.CODELLAMA.
+        chunking_mode (ChunkingMode, optional): Whether the chunks are balanced over the conversation, or end at content-defined boundaries that stay in place when messages are appended. Defaults to ChunkingMode.BALANCED.
+
+    Yields:
+        ConversationChunk: The next conversation chunk, its token length and the token sum of the messages counted so far. The token sum yielded with the last chunk is the total token sum of the conversation.
+    """
+    try:
+        start: float = time.perf_counter()
+        estimate_dict: dict[str, TokenCount] = _estimate_tokens(
+            conversation_dict=conversation, tokenizer_type=tokenizer_type
+        )
+        if chunking_mode == ChunkingMode.CONTENT_DEFINED:
+            # A target planned from the whole conversation would move every boundary when a message is appended
+            target_tokens: int = max(1, max_input_tokens // 2)
+        else:
+            target_tokens = _plan_target_tokens(
+                estimate_dict=estimate_dict, max_input_tokens=max_input_tokens
+            )
+        builder = _ChunkBuilder(
+            title=str(conversation.get("title", "")),
+            max_input_tokens=max_input_tokens,
+            target_tokens=target_tokens,
+            chunking_mode=chunking_mode,
         )
+        token_sum: TokenCount = TokenCount(tokens=0)
+        turn: dict[str, TokenCount] = {}
+        number_of_chunks: int = 0
+
+        for batch_keys in _batch_by_estimate(
+            estimate_dict=estimate_dict, max_input_tokens=max_input_tokens
+        ):
+            token_dict: dict[str, TokenCount] = await _count_tokens(
+                conversation_dict={key: conversation[key] for key in batch_keys},
+                max_input_tokens=max_input_tokens,
+                token_count_mode=token_count_mode,
+                tokenizer_type=tokenizer_type,
+            )
+            kept_token_dict: dict[str, TokenCount] = {}
+            for key, token_count in token_dict.items():
+                kept_token_dict[key] = token_count
+                token_sum += token_count
+                if token_sum.tokens > MAX_CONVERSATION_TOKENS:
+                    break
+
+            message_dict, message_token_dict = await _split_oversized_messages(
+                conversation_dict=conversation,
+                token_dict=kept_token_dict,
+                max_input_tokens=max_input_tokens,
+                tokenizer_type=tokenizer_type,
+            )
+            for key, token_count in message_token_dict.items():
+                if key.startswith("UserMessage") and turn:
+                    for chunk, chunk_tokens in builder.add_turn(turn=turn):
+                        number_of_chunks += 1
+                        if number_of_chunks == 1:
+                            metrics.observe(
+                                "pre_process_first_chunk_seconds",
+                                time.perf_counter() - start,
+                            )
+                        yield ConversationChunk(chunk, chunk_tokens, token_sum)
+                    turn = {}
+                turn[key] = token_count
+                # The parts of a split message are not estimated, so their exact count stands in
+                builder.remember(
+                    key=key,
+                    value=message_dict[key],
+                    estimated_tokens=estimate_dict.get(key, token_count).tokens,
+                )
+
+            if token_sum.tokens > MAX_CONVERSATION_TOKENS:
+                log.info(
+                    f"Token sum of {token_sum.tokens} exceeds the hard limit of {MAX_CONVERSATION_TOKENS}. Dropping the remaining messages..."
+                )
+                break
+
+        chunks: list[tuple[Conversation, int]] = builder.add_turn(turn=turn)
+        chunks.extend(builder.flush())
+        if not number_of_chunks and not chunks:
+            chunks = [(Conversation(title=builder.title), 0)]
+        if not number_of_chunks:
+            metrics.observe(
+                "pre_process_first_chunk_seconds", time.perf_counter() - start
+            )
+        for chunk, chunk_tokens in chunks:
+            yield ConversationChunk(chunk, chunk_tokens, token_sum)
+    except LogicError as e:
+        log.error(f"Logic error while pre-processing user chatlog input: {e}")
         raise e
     except Exception as e:
         log.error(f"Unexpected error while pre-processing user chatlog input: {e}")
         raise e
 
 
-def _split_by_token_length(
-    conversation_dict: dict[str, Any], max_input_tokens: int
-) -> tuple[list[Conversation], int]:
-    """Returns the splitted conversation in the form of a list (if the original conversation is too long) and the total token sum of the conversation for usage tracking in stomach. If the conversation doesn't require splitting, the list will contain only one conversation (the original conversation
-    
+def _estimate_tokens(
+    conversation_dict: dict[str, Any], tokenizer_type: TokenizerType
+) -> dict[str, TokenCount]:
+    """Returns the estimated token length of every message in the conversation, which only takes a pass over the bytes.
+
     Args:
-        conversation_dict (dict[str, Any]): The conversation dictionary to be transformed into a list of Conversation object(s).
-        max_input_tokens (int): The maximum input token length allowed per conversation. If the conversation dict exceeds this limit, it will be split into multiple conversations.
+        conversation_dict (dict[str, Any]): The conversation dictionary whose messages are to be estimated.
+        tokenizer_type (TokenizerType): The tokenizer of the model that the conversation will be sent to.
+
+    Returns:
+        dict[str, TokenCount]: The estimated token length of each message, keyed by the message key and in the order of the conversation.
     """
+    estimator: TokenEstimator = get_token_estimator(
+        tokenizer=get_batch_tokenizer(tokenizer_type=tokenizer_type).tokenizer
+    )
+    estimate_dict: dict[str, TokenCount] = {}
+    for key, value in conversation_dict.items():
+        if not isinstance(value, str):
+            log.error(
+                f"Type of conversation_dict is wrong when estimating token length: Value for key {key} is not a string."
+            )
+            raise LogicError(
+                f"Type of conversation_dict is wrong: Value for key {key} is not a string."
+            )
+        if key != "title":
+            estimate_dict[key] = estimator.estimate(json.dumps(value))
+    return estimate_dict
+
+
+def _plan_target_tokens(
+    estimate_dict: dict[str, TokenCount], max_input_tokens: int
+) -> int:
+    """Returns the size at which a streamed chunk is emitted, so that the estimated conversation is spread evenly over the minimum number of chunks."""
+    estimated_tokens: list[int] = []
+    total_token_sum: int = 0
+    for token_count in estimate_dict.values():
+        estimated_tokens.append(min(token_count.tokens, max_input_tokens))
+        total_token_sum += token_count.tokens
+        if total_token_sum > MAX_CONVERSATION_TOKENS:
+            break
+    number_of_chunks: int = len(
+        partition_balanced(weights=estimated_tokens, max_weight=max_input_tokens)
+    )
+    if number_of_chunks <= 1:
+        return max_input_tokens
+    return math.ceil(sum(estimated_tokens) / number_of_chunks)
+
+
+def _batch_by_estimate(
+    estimate_dict: dict[str, TokenCount], max_input_tokens: int
+) -> Iterator[list[str]]:
+    """Yields the message keys in batches of about one chunk, going by the upper bound of their estimated token lengths."""
+    batch_keys: list[str] = []
+    batch_token_sum: int = 0
+    for key, token_count in estimate_dict.items():
+        batch_keys.append(key)
+        batch_token_sum += token_count.high
+        if batch_token_sum >= max_input_tokens:
+            yield batch_keys
+            batch_keys = []
+            batch_token_sum = 0
+    if batch_keys:
+        yield batch_keys
+
+
+class _ChunkBuilder:
+    """Fills conversation chunks turn by turn for `stream_pre_process`."""
+
+    title: str
+    _max_input_tokens: int
+    _target_tokens: int
+    _chunking_mode: ChunkingMode
+    _message_dict: dict[str, Any]
+    _estimated_tokens: dict[str, int]
+    _chunk_keys: list[str]
+    _chunk_tokens: int
+    _chunk_estimated_tokens: int
+
+    def __init__(
+        self,
+        title: str,
+        max_input_tokens: int,
+        target_tokens: int,
+        chunking_mode: ChunkingMode = ChunkingMode.BALANCED,
+    ):
+        self.title = title
+        self._max_input_tokens = max_input_tokens
+        self._target_tokens = target_tokens
+        self._chunking_mode = chunking_mode
+        self._message_dict = {}
+        self._estimated_tokens = {}
+        self._chunk_keys = []
+        self._chunk_tokens = 0
+        self._chunk_estimated_tokens = 0
 
-    tokenizer = AutoTokenizer.from_pretrained("codellama/CodeLlama-7b-Instruct-hf")
-    title: str = ""
-    token_dict: dict[dict[str, Any], int] = {}
+    def remember(self, key: str, value: Any, estimated_tokens: int):
+        """Stores the content and the estimated token length of a message that will be added to a chunk with its turn."""
+        self._message_dict[key] = value
+        self._estimated_tokens[key] = estimated_tokens
+
+    def add_turn(self, turn: dict[str, TokenCount]) -> list[tuple[Conversation, int]]:
+        """Adds a completed turn to the current chunk and returns the chunks that are full as a result, along with their token lengths. A turn that does not fit into one chunk is added message by message."""
+        units: list[dict[str, TokenCount]] = [turn]
+        if (
+            sum(token_count.high for token_count in turn.values())
+            > self._max_input_tokens
+        ):
+            units = [{key: token_count} for key, token_count in turn.items()]
+
+        chunks: list[tuple[Conversation, int]] = []
+        for unit in units:
+            if not unit:
+                continue
+            unit_tokens: int = sum(token_count.high for token_count in unit.values())
+            if self._chunk_keys and (
+                self._chunk_tokens + unit_tokens > self._max_input_tokens
+            ):
+                chunks.extend(self.flush())
+            self._chunk_keys.extend(unit)
+            self._chunk_tokens += unit_tokens
+            # The target is planned from the estimates, so it is compared against the estimates too
+            unit_estimated_tokens: int = sum(
+                self._estimated_tokens.pop(key) for key in unit
+            )
+            self._chunk_estimated_tokens += unit_estimated_tokens
+            if self._is_full(unit=unit, unit_estimated_tokens=unit_estimated_tokens):
+                chunks.extend(self.flush())
+        return chunks
+
+    def _is_full(self, unit: dict[str, TokenCount], unit_estimated_tokens: int) -> bool:
+        """Returns whether the current chunk ends after the unit that was just added to it."""
+        if self._chunking_mode == ChunkingMode.BALANCED:
+            return self._chunk_estimated_tokens >= self._target_tokens
+        # Very small chunks are not worth a request of their own
+        if self._chunk_estimated_tokens < self._target_tokens // 4:
+            return False
+        return is_content_boundary(
+            texts=[f"{key}: {self._message_dict[key]}" for key in unit],
+            weight=unit_estimated_tokens,
+            target_weight=self._target_tokens,
+        )
+
+    def flush(self) -> list[tuple[Conversation, int]]:
+        """Returns the current chunk and its token length, if it has any messages, and starts a new one."""
+        if not self._chunk_keys:
+            return []
+        chunk = Conversation(
+            title=self.title,
+            **{key: self._message_dict.pop(key) for key in self._chunk_keys},
+        )
+        chunk_tokens: int = self._chunk_tokens
+        self._chunk_keys = []
+        self._chunk_tokens = 0
+        self._chunk_estimated_tokens = 0
+        return [(chunk, chunk_tokens)]
+
+
+async def _count_tokens(
+    conversation_dict: dict[str, Any],
+    max_input_tokens: int,
+    token_count_mode: TokenCountMode,
+    tokenizer_type: TokenizerType,
+) -> dict[str, TokenCount]:
+    """Returns the token length of every message in the conversation. The messages that need an exact count are tokenized in one batch on the tokenizer worker pool, so the event loop is never blocked.
+
+    Args:
+        conversation_dict (dict[str, Any]): The conversation dictionary whose messages are to be tokenized.
+        max_input_tokens (int): The maximum input token length allowed per conversation.
+        token_count_mode (TokenCountMode): Whether every message is tokenized, or only the messages close to a split point or the hard cap.
+        tokenizer_type (TokenizerType): The tokenizer of the model that the conversation will be sent to.
+
+    Returns:
+        dict[str, TokenCount]: The token length of each message, keyed by the message key and in the order of the conversation.
+    """
+    tokenizer: BatchTokenizer = get_batch_tokenizer(tokenizer_type=tokenizer_type)
+    estimator: TokenEstimator = get_token_estimator(tokenizer=tokenizer.tokenizer)
+    message_keys: list[str] = []
+    message_texts: list[str] = []
 
     try:
         for key, value in conversation_dict.items():
             if not isinstance(value, str):
                 raise TypeError(f"Value for key {key} is not a string.")
             if key == "title":
-                title = value
                 continue
-            token_length: int = len(
-                tokenizer(json.dumps(value), add_special_tokens=False)["input_ids"]
+            message_keys.append(key)
+            message_texts.append(json.dumps(value))
+
+        token_counts: list[TokenCount]
+        if token_count_mode == TokenCountMode.APPROXIMATE:
+            token_counts = [estimator.estimate(text) for text in message_texts]
+            exact_indices: list[int] = _find_ambiguous_indices(
+                token_counts=token_counts, max_input_tokens=max_input_tokens
             )
-            token_dict[key] = token_length
+        else:
+            token_counts = [TokenCount(tokens=0)] * len(message_texts)
+            exact_indices = list(range(len(message_texts)))
+
+        token_lengths: list[int] = await tokenizer.count_tokens(
+            [message_texts[index] for index in exact_indices]
+        )
+        for index, token_length in zip(exact_indices, token_lengths):
+            token_counts[index] = TokenCount(tokens=token_length)
+        metrics.increment(
+            "pre_process_messages_estimated", len(message_texts) - len(exact_indices)
+        )
+        metrics.increment("pre_process_messages_tokenized", len(exact_indices))
     except TypeError as e:
         log.error(
             f"Type of conversation_dict is wrong when calculating token length: {e}"
@@ -74,27 +409,229 @@ def _split_by_token_length(
         )
         raise e
 
-    total_token_sum: int = 0
-    curr_token_sum: int = 0
-    conversation_lst: list[Conversation] = []
-    splitted_conversation_dict: dict[str, Any] = {"title": title}
-    for conversation_dict_key, token_length in token_dict.items():
-        total_token_sum += token_length
-        curr_token_sum += token_length
-        if curr_token_sum > max_input_tokens:
+    return dict(zip(message_keys, token_counts))
+
+
+def _find_ambiguous_indices(
+    token_counts: list[TokenCount], max_input_tokens: int
+) -> list[int]:
+    """Returns the indices of the estimated messages whose real token count could change where the conversation is split or where the hard cap is hit.
+
+    The split points are found with `partition_balanced`, like the split itself, once on the lower and once on the upper bounds of the estimates. The real split points lie between the two, so the messages around and between them are ambiguous. If the two partitions do not even have the same number of chunks, every message is. A message is also ambiguous if the running total may or may not exceed MAX_CONVERSATION_TOKENS after it. Every other message is far enough from a split point for its estimate to be used.
+
+    Args:
+        token_counts (list[TokenCount]): The estimated token count of each message, in the order of the conversation.
+        max_input_tokens (int): The maximum input token length allowed per conversation.
+
+    Returns:
+        list[int]: The indices of the messages that need to be tokenized.
+    """
+    ambiguous_indices: set[int] = set()
+    number_of_messages: int = 0
+    total_token_sum: TokenCount = TokenCount(tokens=0)
+    for index, token_count in enumerate(token_counts):
+        number_of_messages += 1
+        total_token_sum += token_count
+        if total_token_sum.low <= MAX_CONVERSATION_TOKENS < total_token_sum.high:
+            ambiguous_indices.add(index)
+        # The messages after this one are dropped whatever their real count
+        if total_token_sum.low > MAX_CONVERSATION_TOKENS:
+            break
+
+    kept_token_counts: list[TokenCount] = token_counts[:number_of_messages]
+    low_boundaries: list[int] = partition_balanced(
+        weights=[token_count.low for token_count in kept_token_counts],
+        max_weight=max_input_tokens,
+    )
+    high_boundaries: list[int] = partition_balanced(
+        weights=[token_count.high for token_count in kept_token_counts],
+        max_weight=max_input_tokens,
+    )
+    if len(low_boundaries) != len(high_boundaries):
+        return list(range(number_of_messages))
+    # The last boundary is the end of the conversation, which does not move
+    for low_end, high_end in zip(low_boundaries[:-1], high_boundaries[:-1]):
+        ambiguous_indices.update(
+            range(min(low_end, high_end) - 1, max(low_end, high_end) + 1)
+        )
+    return sorted(ambiguous_indices)
+
+
+def _truncate_to_token_cap(
+    token_dict: dict[str, TokenCount],
+) -> tuple[dict[str, TokenCount], TokenCount]:
+    """Drops the messages after the one that takes the conversation over MAX_CONVERSATION_TOKENS. We set this hard limit on the total token sum of the conversation to prevent abuse.
+
+    Args:
+        token_dict (dict[str, TokenCount]): The token length of each message in the conversation.
+
+    Returns:
+        tuple[dict[str, TokenCount], TokenCount]: The token length of the messages that are kept and their total token sum.
+    """
+    truncated_token_dict: dict[str, TokenCount] = {}
+    total_token_sum: TokenCount = TokenCount(tokens=0)
+    for key, token_count in token_dict.items():
+        truncated_token_dict[key] = token_count
+        total_token_sum += token_count
+        if total_token_sum.tokens > MAX_CONVERSATION_TOKENS:
             log.info(
-                f"Token length of {curr_token_sum} exceeds the maximum input token length of {max_input_tokens}. Splitting conversation..."
+                f"Token sum of {total_token_sum.tokens} exceeds the hard limit of {MAX_CONVERSATION_TOKENS}. Dropping the remaining messages..."
             )
-            conversation_lst.append(Conversation(**splitted_conversation_dict))
-            curr_token_sum = 0
-            splitted_conversation_dict: dict[str, Any] = {"title": title}            
-        splitted_conversation_dict[conversation_dict_key] = conversation_dict[
-            conversation_dict_key
-        ]
-        
-        # We will set a hard limit on the total token sum of the conversation to prevent abuse
-        if total_token_sum > MAX_CONVERSATION_TOKENS:
             break
-        
-    conversation_lst.append(Conversation(**splitted_conversation_dict))
-    return (conversation_lst, total_token_sum)
+    return truncated_token_dict, total_token_sum
+
+
+async def _split_oversized_messages(
+    conversation_dict: dict[str, Any],
+    token_dict: dict[str, TokenCount],
+    max_input_tokens: int,
+    tokenizer_type: TokenizerType,
+) -> tuple[dict[str, Any], dict[str, TokenCount]]:
+    """Splits every message that does not fit into a single chunk into parts at sentence or code-block boundaries. The parts of a message are keyed as `<key>_part<n>`.
+
+    Args:
+        conversation_dict (dict[str, Any]): The conversation dictionary whose messages are to be split.
+        token_dict (dict[str, TokenCount]): The token length of the messages to be kept.
+        max_input_tokens (int): The maximum input token length allowed per conversation.
+        tokenizer_type (TokenizerType): The tokenizer of the model that the conversation will be sent to.
+
+    Returns:
+        tuple[dict[str, Any], dict[str, TokenCount]]: The conversation dictionary with the oversized messages replaced by their parts, and the token length of each message and part.
+    """
+    tokenizer: BatchTokenizer = get_batch_tokenizer(tokenizer_type=tokenizer_type)
+    message_dict: dict[str, Any] = {"title": conversation_dict.get("title", "")}
+    message_token_dict: dict[str, TokenCount] = {}
+    for key, token_count in token_dict.items():
+        if token_count.high <= max_input_tokens:
+            message_dict[key] = conversation_dict[key]
+            message_token_dict[key] = token_count
+            continue
+
+        log.info(
+            f"Message {key} of up to {token_count.high} tokens exceeds the maximum input token length of {max_input_tokens}. Splitting message..."
+        )
+        segments: list[tuple[str, int]] = await _segment_text(
+            text=conversation_dict[key],
+            token_length=token_count.high,
+            max_input_tokens=max_input_tokens,
+            tokenizer=tokenizer,
+        )
+        boundaries: list[int] = partition_balanced(
+            weights=[token_length for _, token_length in segments],
+            max_weight=max_input_tokens,
+        )
+        start: int = 0
+        for part_number, end in enumerate(boundaries, start=1):
+            part_key: str = f"{key}_part{part_number}"
+            message_dict[part_key] = "".join(text for text, _ in segments[start:end])
+            message_token_dict[part_key] = TokenCount(
+                tokens=sum(token_length for _, token_length in segments[start:end])
+            )
+            start = end
+    return message_dict, message_token_dict
+
+
+async def _segment_text(
+    text: str,
+    token_length: int,
+    max_input_tokens: int,
+    tokenizer: BatchTokenizer,
+    depth: int = 0,
+) -> list[tuple[str, int]]:
+    """Recursively splits the text into segments that fit into a single chunk. Sentences and code blocks are tried first, then lines, then fixed windows of characters.
+
+    Args:
+        text (str): The text to be split.
+        token_length (int): The token length of the text.
+        max_input_tokens (int): The maximum input token length allowed per conversation.
+        tokenizer (BatchTokenizer): The tokenizer used to count the tokens of the segments.
+        depth (int, optional): The current level of splitting. Defaults to 0.
+
+    Returns:
+        list[tuple[str, int]]: The segments of the text along with their token lengths, in order.
+    """
+    if token_length <= max_input_tokens:
+        return [(text, token_length)]
+
+    segments: list[str]
+    if depth == 0:
+        segments = split_text(text)
+    elif depth == 1:
+        segments = split_text(text, by_lines=True)
+    else:
+        # Windows of half the budget leave room for text whose tokens are not spread evenly over its characters
+        segments = split_by_characters(
+            text, max_characters=len(text) * max_input_tokens // (2 * token_length)
+        )
+    if len(segments) <= 1 and depth < 2:
+        return await _segment_text(
+            text=text,
+            token_length=token_length,
+            max_input_tokens=max_input_tokens,
+            tokenizer=tokenizer,
+            depth=depth + 1,
+        )
+
+    token_lengths: list[int] = await tokenizer.count_tokens(
+        [json.dumps(segment) for segment in segments]
+    )
+    if depth == 2:
+        return list(zip(segments, token_lengths))
+    result: list[tuple[str, int]] = []
+    for segment, segment_token_length in zip(segments, token_lengths):
+        result.extend(
+            await _segment_text(
+                text=segment,
+                token_length=segment_token_length,
+                max_input_tokens=max_input_tokens,
+                tokenizer=tokenizer,
+                depth=depth + 1,
+            )
+        )
+    return result
+
+
+def _split_by_token_length(
+    conversation_dict: dict[str, Any],
+    token_dict: dict[str, TokenCount],
+    max_input_tokens: int,
+) -> list[Conversation]:
+    """Returns the splitted conversation in the form of a list (if the original conversation is too long). If the conversation doesn't require splitting, the list will contain only one conversation (the original conversation).
+
+    The conversation is split into the minimum number of chunks, and the chunks are then made as equal as possible, because the slowest chunk sets the latency of the whole request. A UserMessage and the AssistantMessage(s) answering it are kept in the same chunk unless they do not fit into one chunk together. Estimated messages are counted with the upper bound of their estimate, so that no chunk exceeds the limit.
+
+    Args:
+        conversation_dict (dict[str, Any]): The conversation dictionary to be transformed into a list of Conversation object(s).
+        token_dict (dict[str, TokenCount]): The token length of each message to be kept, none of which exceeds the limit on its own.
+        max_input_tokens (int): The maximum input token length allowed per conversation. If the conversation dict exceeds this limit, it will be split into multiple conversations.
+
+    Returns:
+        list[Conversation]: The conversation chunks, in the order of the conversation.
+    """
+    title: str = conversation_dict.get("title", "")
+    units: list[list[str]] = []
+    for turn in group_turns(keys=list(token_dict)):
+        if sum(token_dict[key].high for key in turn) > max_input_tokens:
+            units.extend([key] for key in turn)
+        else:
+            units.append(turn)
+
+    boundaries: list[int] = partition_balanced(
+        weights=[sum(token_dict[key].high for key in unit) for unit in units],
+        max_weight=max_input_tokens,
+    )
+    if len(boundaries) > 1:
+        log.info(
+            f"Conversation exceeds the maximum input token length of {max_input_tokens}. Splitting conversation into {len(boundaries)} chunks..."
+        )
+
+    conversation_lst: list[Conversation] = []
+    start: int = 0
+    for end in boundaries:
+        splitted_conversation_dict: dict[str, Any] = {"title": title}
+        for unit in units[start:end]:
+            for key in unit:
+                splitted_conversation_dict[key] = conversation_dict[key]
+        conversation_lst.append(Conversation(**splitted_conversation_dict))
+        start = end
+    return conversation_lst or [Conversation(title=title)]
@@ -0,0 +1,135 @@
+import hashlib
+import math
+import os
+import re
+from bisect import bisect_right
+from enum import StrEnum
+from itertools import accumulate
+
+# Fenced code blocks are kept intact when a message is split, unless a single block is itself too large.
+CODE_BLOCK_PATTERN = re.compile(r"(```.*?```)", re.DOTALL)
+# Sentence ends and line breaks. The whitespace that follows is kept at the start of the next segment.
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"(?<=[.!?\n])(?=\s)")
+
+
+class ChunkingMode(StrEnum):
+    # The chunks are balanced over the whole conversation, so appending a message can move every boundary
+    BALANCED = "balanced"
+    # The boundaries are anchored on the content of the messages, so they stay in place when messages are appended
+    CONTENT_DEFINED = "content_defined"
+
+
+# Content-defined chunks aim at half of the chunk budget, so a conversation takes about twice as many calls. Opt in where conversations are often regenerated after new messages.
+CHUNKING_MODE = ChunkingMode(os.environ.get("CHUNKING_MODE", ChunkingMode.BALANCED))
+
+
+def group_turns(keys: list[str]) -> list[list[str]]:
+    """Groups the message keys into turns, where each turn is a UserMessage followed by the AssistantMessage(s) answering it.
+
+    Args:
+        keys (list[str]): The message keys in the order of the conversation.
+
+    Returns:
+        list[list[str]]: The message keys of each turn, in the order of the conversation.
+    """
+    turns: list[list[str]] = []
+    for key in keys:
+        if not turns or key.startswith("UserMessage"):
+            turns.append([key])
+        else:
+            turns[-1].append(key)
+    return turns
+
+
+def _greedy_boundaries(prefix_sums: list[int], max_weight: int) -> list[int]:
+    """Returns the end index (exclusive) of each chunk when chunks are filled greedily up to `max_weight`.
+
+    Every chunk contains at least one item, so an item heavier than `max_weight` ends up in a chunk of its own.
+    """
+    boundaries: list[int] = []
+    start: int = 0
+    number_of_items: int = len(prefix_sums) - 1
+    while start < number_of_items:
+        end: int = (
+            bisect_right(prefix_sums, prefix_sums[start] + max_weight, lo=start + 1) - 1
+        )
+        end = max(end, start + 1)
+        boundaries.append(end)
+        start = end
+    return boundaries
+
+
+def partition_balanced(weights: list[int], max_weight: int) -> list[int]:
+    """Partitions the weights into the minimum number of contiguous chunks of at most `max_weight`, and among those partitions picks one whose heaviest chunk is as light as possible.
+
+    The heaviest chunk is found with a binary search over the greedy partition, which runs in O(k log n) on the prefix sums, so the whole partition takes O(k log n log max_weight) for n items and k chunks.
+
+    Args:
+        weights (list[int]): The weight of each item, in order.
+        max_weight (int): The maximum weight of a chunk.
+
+    Returns:
+        list[int]: The end index (exclusive) of each chunk.
+    """
+    if not weights:
+        return []
+    prefix_sums: list[int] = list(accumulate(weights, initial=0))
+    number_of_chunks: int = len(_greedy_boundaries(prefix_sums, max_weight))
+
+    low: int = min(max_weight, math.ceil(prefix_sums[-1] / number_of_chunks))
+    high: int = max_weight
+    while low < high:
+        mid: int = (low + high) // 2
+        if len(_greedy_boundaries(prefix_sums, mid)) <= number_of_chunks:
+            high = mid
+        else:
+            low = mid + 1
+    return _greedy_boundaries(prefix_sums, low)
+
+
+def split_text(text: str, by_lines: bool = False) -> list[str]:
+    """Splits the text into segments at sentence boundaries, keeping fenced code blocks intact. Joining the segments gives back the text.
+
+    Args:
+        text (str): The text to be split.
+        by_lines (bool, optional): Split at every line break instead, including inside code blocks. Defaults to False.
+
+    Returns:
+        list[str]: The non-empty segments of the text, in order.
+    """
+    if by_lines:
+        return text.splitlines(keepends=True)
+
+    segments: list[str] = []
+    for block in CODE_BLOCK_PATTERN.split(text):
+        if CODE_BLOCK_PATTERN.fullmatch(block):
+            segments.append(block)
+        else:
+            segments.extend(SENTENCE_BOUNDARY_PATTERN.split(block))
+    return [segment for segment in segments if segment]
+
+
+def split_by_characters(text: str, max_characters: int) -> list[str]:
+    """Splits the text into windows of at most `max_characters`, as a last resort for text without any usable boundary."""
+    max_characters = max(1, max_characters)
+    return [
+        text[start : start + max_characters]
+        for start in range(0, len(text), max_characters)
+    ]
+
+
+def is_content_boundary(texts: list[str], weight: int, target_weight: int) -> bool:
+    """Returns whether a chunk ends after the unit made of the texts, like the rolling hash of content-defined chunking.
+
+    The choice only depends on the unit itself, so the boundaries before an appended message never move. A unit ends a chunk with a probability of `weight / target_weight`, which makes the chunks hold about `target_weight` on average.
+
+    Args:
+        texts (list[str]): The content of the unit.
+        weight (int): The weight of the unit.
+        target_weight (int): The average weight of a chunk.
+
+    Returns:
+        bool: Whether the unit is the last one of its chunk.
+    """
+    digest: bytes = hashlib.sha256("\0".join(texts).encode()).digest()
+    return int.from_bytes(digest[:8], "big") < min(1, weight / target_weight) * 2**64
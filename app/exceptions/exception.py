@@ -8,6 +8,10 @@ class LogicError(HTTPException):
         )
 
 
+class InvalidOutput(LogicError):
+    """Raised when the notes generated by the model are rejected by post-processing, which another sample may well pass."""
+
+
 class InferenceFailure(HTTPException):
     def __init__(self, message: str):
         super().__init__(
@@ -15,4 +19,39 @@ class InferenceFailure(HTTPException):
         )
 
 
+class GenerationAborted(HTTPException):
+    """Raised while a response is streamed, as soon as it is bound to be rejected, so that the rest of it is not generated."""
+
+    field: str
+
+    def __init__(self, message: str, field: str):
+        super().__init__(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=message
+        )
+        self.field = field
+
+
+class CircuitOpen(HTTPException):
+    """Raised instead of calling a model whose circuit breaker is open."""
+
+    def __init__(self, message: str):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=message
+        )
+
+
+class DeadlineExceeded(HTTPException):
+    """Raised when a request runs out of the time it was given, so that no more calls are made for it."""
+
+    def __init__(self, message: str):
+        super().__init__(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=message)
+
+
+class IdempotencyConflict(HTTPException):
+    def __init__(self, message: str):
+        super().__init__(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=message
+        )
+
+
 # You can define more custom exceptions as needed.
@@ -0,0 +1,133 @@
+import logging
+import os
+import time
+from typing import Any, Optional
+
+log = logging.getLogger(__name__)
+
+# Opt-in, as the controller can only lower the configured limits of the models
+LLM_ADAPTIVE_CONCURRENCY = os.environ.get(
+    "LLM_ADAPTIVE_CONCURRENCY", "false"
+).lower() in ("1", "true", "yes")
+# Concurrency a model starts at before any feedback from the provider. Unset means the configured limit of the model.
+LLM_ADAPTIVE_INITIAL_LIMIT: Optional[int] = (
+    int(os.environ["LLM_ADAPTIVE_INITIAL_LIMIT"])
+    if os.environ.get("LLM_ADAPTIVE_INITIAL_LIMIT")
+    else None
+)
+# Calls slower than this, for every LLM_LATENCY_TARGET_TOKENS prompt tokens, are treated as a sign that the provider is congested
+LLM_LATENCY_TARGET_SECONDS = float(os.environ.get("LLM_LATENCY_TARGET_SECONDS", 60))
+# Prompt size the latency target is set for. Larger calls are allowed proportionally longer, so that a large chunk is not mistaken for congestion.
+LLM_LATENCY_TARGET_TOKENS = int(os.environ.get("LLM_LATENCY_TARGET_TOKENS", 16000))
+LLM_ADAPTIVE_DECREASE_FACTOR = float(
+    os.environ.get("LLM_ADAPTIVE_DECREASE_FACTOR", 0.5)
+)
+# Weight of the latest call in the moving average of the latency
+LATENCY_SMOOTHING = 0.2
+
+
+class AIMDController:
+    """Adapts the concurrency allowed for a model with additive increase and multiplicative decrease.
+
+    Every call that succeeds within the latency target adds 1 / limit to the limit, so the limit grows by about one per round of calls. A rate limit, a timeout or a call slower than the target cuts the limit by the decrease factor. The target grows with the prompt of the call beyond `latency_target_tokens`. Congestion signals from calls that were dispatched before the last cut are ignored, so that a single burst of 429s only cuts the limit once.
+    """
+
+    _limit: float
+    _min_limit: int
+    _max_limit: int
+    _decrease_factor: float
+    _latency_target_seconds: float
+    _latency_target_tokens: int
+    _latency_ewma_seconds: Optional[float]
+    _last_decrease: float
+    _successes: int
+    _congestion_signals: dict[str, int]
+    _decreases: int
+
+    def __init__(
+        self,
+        max_limit: int,
+        initial_limit: Optional[int] = LLM_ADAPTIVE_INITIAL_LIMIT,
+        min_limit: int = 1,
+        decrease_factor: float = LLM_ADAPTIVE_DECREASE_FACTOR,
+        latency_target_seconds: float = LLM_LATENCY_TARGET_SECONDS,
+        latency_target_tokens: int = LLM_LATENCY_TARGET_TOKENS,
+    ):
+        self._max_limit = max_limit
+        self._min_limit = min(min_limit, max_limit)
+        initial_limit = max_limit if initial_limit is None else initial_limit
+        self._limit = float(max(self._min_limit, min(initial_limit, max_limit)))
+        self._decrease_factor = decrease_factor
+        self._latency_target_seconds = latency_target_seconds
+        self._latency_target_tokens = latency_target_tokens
+        self._latency_ewma_seconds = None
+        self._last_decrease = float("-inf")
+        self._successes = 0
+        self._congestion_signals = {}
+        self._decreases = 0
+
+    @property
+    def limit(self) -> int:
+        """The number of calls currently allowed in flight."""
+        return int(self._limit)
+
+    def latency_target_seconds(self, prompt_tokens: Optional[int] = None) -> float:
+        """Returns the latency a call with the given prompt is allowed before it counts as a sign of congestion."""
+        if not prompt_tokens or prompt_tokens <= self._latency_target_tokens:
+            return self._latency_target_seconds
+        return (
+            self._latency_target_seconds * prompt_tokens / self._latency_target_tokens
+        )
+
+    def on_success(
+        self,
+        latency_seconds: float,
+        started_at: float,
+        prompt_tokens: Optional[int] = None,
+    ):
+        """Records a successful call and raises the limit if the call was fast enough.
+
+        Args:
+            latency_seconds (float): The duration of the call.
+            started_at (float): The time.monotonic() at which the call was dispatched.
+            prompt_tokens (Optional[int], optional): The size of the prompt of the call, which the latency target is scaled by. Defaults to None, which means the unscaled target.
+        """
+        self._successes += 1
+        self._latency_ewma_seconds = (
+            latency_seconds
+            if self._latency_ewma_seconds is None
+            else LATENCY_SMOOTHING * latency_seconds
+            + (1 - LATENCY_SMOOTHING) * self._latency_ewma_seconds
+        )
+        if latency_seconds > self.latency_target_seconds(prompt_tokens=prompt_tokens):
+            self.on_congestion(reason="latency", started_at=started_at)
+            return
+        self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+
+    def on_congestion(self, reason: str, started_at: float):
+        """Records a sign of congestion and cuts the limit, unless the call was dispatched before the last cut.
+
+        Args:
+            reason (str): The kind of congestion, e.g. `rate_limit`, `timeout` or `latency`.
+            started_at (float): The time.monotonic() at which the call was dispatched.
+        """
+        self._congestion_signals[reason] = self._congestion_signals.get(reason, 0) + 1
+        if started_at <= self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self._decreases += 1
+        self._limit = max(self._min_limit, self._limit * self._decrease_factor)
+        log.info(f"Cut concurrency to {self.limit} after {reason}")
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns the state of the controller for introspection."""
+        return {
+            "limit": self.limit,
+            "max_limit": self._max_limit,
+            "latency_ewma_seconds": self._latency_ewma_seconds,
+            "latency_target_seconds": self._latency_target_seconds,
+            "latency_target_tokens": self._latency_target_tokens,
+            "successes": self._successes,
+            "congestion_signals": dict(self._congestion_signals),
+            "decreases": self._decreases,
+        }
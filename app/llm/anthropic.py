@@ -1,39 +1,94 @@
+import json
 import logging
 import os
+from typing import Any, Callable, Optional
 
 import anthropic
+import httpx
 
+from app.exceptions.exception import DeadlineExceeded, InferenceFailure
 from app.llm.base import LLMBaseModel, LLMConfig
+from app.llm.deadline import Deadline
+from app.llm.usage import record_usage
+from app.models.content import Content
+from app.prompts.generator.functions import get_notes_functions, notes_from_arguments
 
 log = logging.getLogger(__name__)
 
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 
+# The response is prefilled with the opening brace, so that the model answers with the JSON object straight away
+NOTES_PREFILL = "{"
+
 
 class Anthropic(LLMBaseModel):
     """This class handles the interaction with Anthropic API."""
 
-    def __init__(self, model_name: str, model_config: LLMConfig):
+    def __init__(
+        self,
+        model_name: str,
+        model_config: LLMConfig,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
         super().__init__(model_name=model_name, model_config=model_config)
-        self._client = anthropic.Anthropic(
+        self._client = anthropic.AsyncAnthropic(
             api_key=ANTHROPIC_API_KEY,
+            http_client=http_client,
+            # Retries are scheduled by app.llm.retry
+            max_retries=0,
         )
 
-    async def send_message(self, system_message: str, user_message: str) -> str:
-        """Sends a message to Anthropic and returns the response."""
+    async def send_message(
+        self,
+        system_message: str,
+        user_message: str,
+        content_lst: list[Content],
+        on_field: Optional[Callable[[str, Any], None]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> Any:
+        """Sends a message to Anthropic and returns the notes.
+
+        The notes are asked for as a JSON object following the schema of the `get_notes` function, like the function call of OpenAI. The response is not streamed, so every field is passed to `on_field` once the response is complete. The call gives up at the `deadline` with DeadlineExceeded.
+        """
+        parameters: dict[str, Any] = get_notes_functions(
+            contains_mcq_practice=bool(Content.MCQ in content_lst),
+            contains_code_practice=bool(Content.CODE in content_lst),
+        )[0]["parameters"]
+        system: str = (
+            f"{system_message}\n"
+            f"Answer with a single JSON object that follows this JSON schema, without any text around it:\n"
+            f"<schema>\n{json.dumps(parameters)}\n</schema>"
+        )
         messages = [
             {"role": "user", "content": user_message},
-            {"role": "assistant", "content": "<output>"},
+            {"role": "assistant", "content": NOTES_PREFILL},
         ]
 
-        log.info(f"Sending messages to Anthropic with messages: {messages}")
-        response = self._client.messages.create(
-            model=self._model_name,
-            max_tokens=self._model_config.max_tokens,
-            temperature=self._model_config.temperature,
-            system=system_message,
-            messages=messages,
-        )
+        log.info(f"Sending messages to Anthropic")
+        try:
+            response = await self._client.messages.create(
+                model=self._model_name,
+                max_tokens=self._model_config.max_tokens,
+                temperature=self._model_config.temperature,
+                system=system,
+                messages=messages,
+                timeout=(
+                    self._model_config.timeout_seconds
+                    if deadline is None
+                    else deadline.bound(self._model_config.timeout_seconds)
+                ),
+            )
+        except Exception as e:
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded(
+                    "Request deadline exceeded while waiting for Anthropic"
+                ) from e
+            raise e
+        if response.usage:
+            record_usage(
+                prompt_tokens=response.usage.input_tokens,
+                completion_tokens=response.usage.output_tokens,
+            )
 
         if len(response.content) > 1:
             log.error(
@@ -41,4 +96,14 @@ class Anthropic(LLMBaseModel):
             )
             log.error(response.content)
             raise TypeError("Received more than one response from Anthropic.")
-        return response.content[0].text
+        try:
+            arguments: dict[str, Any] = json.loads(
+                NOTES_PREFILL + response.content[0].text
+            )
+            if on_field is not None:
+                for field, value in arguments.items():
+                    on_field(field, value)
+            return notes_from_arguments(arguments)
+        except Exception as e:
+            log.error(f"Error processing Anthropic response: {str(e)}")
+            raise InferenceFailure("Error processing Anthropic response") from e
@@ -1,15 +1,22 @@
+import os
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from typing import Any, Callable, Optional
 
 from pydantic import BaseModel
 
+from app.llm.deadline import Deadline
 from app.models.content import Content
 from app.prompts.config import PromptMessageConfig
 
+# Upper bound on a single request to a provider, including the time to generate the output.
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", 120))
+
 
 class LLMConfig(BaseModel):
     temperature: float
     max_tokens: int
+    timeout_seconds: float = LLM_TIMEOUT_SECONDS
 
 
 @dataclass
@@ -33,9 +40,11 @@ class LLMBaseModel(ABC):
         self,
         system_message: str,
         user_message: str,
-        content_lst: list[Content]
-    ) -> str:
-        """Sends a message to the AI and returns the response."""
+        content_lst: list[Content],
+        on_field: Optional[Callable[[str, Any], None]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> Any:
+        """Sends a message to the AI and returns the response. Models that can take chunks, see `LLMType.supports_notes`, return the fields of the notes in the order of `notes_from_arguments`. Models that stream their output pass every field of the notes to `on_field` as soon as it is complete. The call gives up when the `deadline` of the request passes, with DeadlineExceeded."""
         pass
 
     @property
@@ -0,0 +1,222 @@
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from enum import StrEnum
+from typing import Any, Iterator, Optional
+
+from app.exceptions.exception import CircuitOpen, DeadlineExceeded
+from app.llm.model import LLMType
+from app.llm.retry import retry_reason
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Models tried in order after the configured model, when it fails or its breaker is open, e.g. "gpt-3.5-turbo-0125,claude-3-sonnet-20240229"
+LLM_FALLBACK_CHAIN: list[LLMType] = [
+    LLMType(name.strip())
+    for name in os.environ.get("LLM_FALLBACK_CHAIN", "").split(",")
+    if name.strip()
+]
+# The breaker of a model opens after this many provider failures in a row
+CIRCUIT_BREAKER_CONSECUTIVE_FAILURES = int(
+    os.environ.get("CIRCUIT_BREAKER_CONSECUTIVE_FAILURES", 5)
+)
+# ... or when this fraction of its recent calls failed
+CIRCUIT_BREAKER_ERROR_RATE = float(os.environ.get("CIRCUIT_BREAKER_ERROR_RATE", 0.5))
+# Number of most recent calls the error rate is taken over, and the fewest calls it is taken over
+CIRCUIT_BREAKER_WINDOW = int(os.environ.get("CIRCUIT_BREAKER_WINDOW", 20))
+CIRCUIT_BREAKER_MIN_CALLS = int(os.environ.get("CIRCUIT_BREAKER_MIN_CALLS", 10))
+# How long an open breaker fails fast before it lets a probe through
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_OPEN_SECONDS", 30))
+
+# Failures that say the provider is unhealthy. Rejected output and invalid requests do not count against it.
+PROVIDER_FAILURE_REASONS = {"rate_limit", "server_error", "timeout", "connection"}
+
+
+class BreakerState(StrEnum):
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    def level(self) -> int:
+        """Returns the state as a number for the state gauge, from healthy to failing fast."""
+        match self:
+            case BreakerState.CLOSED:
+                return 0
+            case BreakerState.HALF_OPEN:
+                return 1
+            case BreakerState.OPEN:
+                return 2
+
+
+class CircuitBreaker:
+    """Stops calling a model that keeps failing, and probes it again after a while.
+
+    The breaker opens after a number of provider failures in a row, or when the error rate of the recent calls is too high. While it is open, every call fails fast with CircuitOpen. Once the open period is over, the breaker is half-open and lets a single probe through: the breaker closes if the probe succeeds and opens again if it fails.
+    """
+
+    _llm_type: LLMType
+    _consecutive_failures_threshold: int
+    _error_rate_threshold: float
+    _min_calls: int
+    _open_seconds: float
+    _state: BreakerState
+    _outcomes: deque[bool]
+    _consecutive_failures: int
+    _opened_at: float
+    _probe_in_flight: bool
+
+    def __init__(
+        self,
+        llm_type: LLMType,
+        consecutive_failures: int = CIRCUIT_BREAKER_CONSECUTIVE_FAILURES,
+        error_rate: float = CIRCUIT_BREAKER_ERROR_RATE,
+        window: int = CIRCUIT_BREAKER_WINDOW,
+        min_calls: int = CIRCUIT_BREAKER_MIN_CALLS,
+        open_seconds: float = CIRCUIT_BREAKER_OPEN_SECONDS,
+    ):
+        self._llm_type = llm_type
+        self._consecutive_failures_threshold = consecutive_failures
+        self._error_rate_threshold = error_rate
+        self._min_calls = min_calls
+        self._open_seconds = open_seconds
+        self._state = BreakerState.CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._consecutive_failures = 0
+        self._opened_at = float("-inf")
+        self._probe_in_flight = False
+        metrics.set_gauge(
+            "llm_circuit_breaker_state", self._state.level(), model=llm_type.value
+        )
+
+    @property
+    def state(self) -> BreakerState:
+        if (
+            self._state == BreakerState.OPEN
+            and time.monotonic() - self._opened_at >= self._open_seconds
+        ):
+            self._transition(BreakerState.HALF_OPEN)
+        return self._state
+
+    @property
+    def is_available(self) -> bool:
+        """Whether a call would be let through right now."""
+        state: BreakerState = self.state
+        return state == BreakerState.CLOSED or (
+            state == BreakerState.HALF_OPEN and not self._probe_in_flight
+        )
+
+    def _transition(self, state: BreakerState):
+        log.warning(
+            f"Circuit breaker of {self._llm_type} is now {state} (was {self._state})"
+        )
+        metrics.increment(
+            "llm_circuit_breaker_transitions",
+            model=self._llm_type.value,
+            from_state=self._state.value,
+            to_state=state.value,
+        )
+        metrics.set_gauge(
+            "llm_circuit_breaker_state", state.level(), model=self._llm_type.value
+        )
+        self._state = state
+        if state == BreakerState.OPEN:
+            self._opened_at = time.monotonic()
+        elif state == BreakerState.CLOSED:
+            self._outcomes.clear()
+            self._consecutive_failures = 0
+
+    def _on_success(self):
+        self._outcomes.append(True)
+        self._consecutive_failures = 0
+        if self._state == BreakerState.HALF_OPEN:
+            self._transition(BreakerState.CLOSED)
+
+    def _on_failure(self):
+        self._outcomes.append(False)
+        self._consecutive_failures += 1
+        if self._state == BreakerState.HALF_OPEN:
+            self._transition(BreakerState.OPEN)
+            return
+        error_rate: float = self._outcomes.count(False) / len(self._outcomes)
+        if self._state == BreakerState.CLOSED and (
+            self._consecutive_failures >= self._consecutive_failures_threshold
+            or (
+                len(self._outcomes) >= self._min_calls
+                and error_rate >= self._error_rate_threshold
+            )
+        ):
+            self._transition(BreakerState.OPEN)
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        """Lets a call to the model through, or fails fast, and records its outcome.
+
+        Only provider failures count against the model. A call that is cancelled, e.g. because a hedge won, or cut short by the deadline of its request is not recorded.
+
+        Raises:
+            CircuitOpen: If the breaker is open, or half-open with its probe already in flight.
+        """
+        if not self.is_available:
+            metrics.increment(
+                "llm_circuit_breaker_rejected", model=self._llm_type.value
+            )
+            raise CircuitOpen(f"Circuit breaker of {self._llm_type} is {self._state}")
+        is_probe: bool = self._state == BreakerState.HALF_OPEN
+        if is_probe:
+            self._probe_in_flight = True
+        try:
+            yield
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if retry_reason(e) in PROVIDER_FAILURE_REASONS:
+                self._on_failure()
+            else:
+                # The provider answered, the request or its output was the problem
+                self._on_success()
+            raise
+        else:
+            self._on_success()
+        finally:
+            if is_probe:
+                self._probe_in_flight = False
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns the state of the breaker for introspection."""
+        return {
+            "state": self.state.value,
+            "consecutive_failures": self._consecutive_failures,
+            "error_rate": (
+                self._outcomes.count(False) / len(self._outcomes)
+                if self._outcomes
+                else 0.0
+            ),
+        }
+
+
+class CircuitBreakers:
+    """The circuit breakers of every model, created on first use."""
+
+    _breakers: dict[LLMType, CircuitBreaker]
+
+    def __init__(self):
+        self._breakers = {}
+
+    def get(self, llm_type: LLMType) -> CircuitBreaker:
+        breaker: Optional[CircuitBreaker] = self._breakers.get(llm_type)
+        if breaker is None:
+            breaker = CircuitBreaker(llm_type=llm_type)
+            self._breakers[llm_type] = breaker
+        return breaker
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            llm_type.value: breaker.snapshot()
+            for llm_type, breaker in self._breakers.items()
+        }
+
+
+llm_circuit_breakers = CircuitBreakers()
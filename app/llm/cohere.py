@@ -1,10 +1,16 @@
 import logging
 import os
+from typing import Any, Callable, Optional
 
 import cohere
+import httpx
 from dotenv import load_dotenv
 
+from app.exceptions.exception import DeadlineExceeded
 from app.llm.base import LLMBaseModel, LLMConfig
+from app.llm.deadline import Deadline
+from app.llm.usage import record_usage
+from app.models.content import Content
 
 load_dotenv()
 
@@ -16,21 +22,52 @@ COHERE_API_KEY = os.environ.get("COHERE_API_KEY")
 class Cohere(LLMBaseModel):
     """This class handles the interaction with Cohere API."""
 
-    def __init__(self, model_name: str, model_config: LLMConfig):
+    def __init__(
+        self,
+        model_name: str,
+        model_config: LLMConfig,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
         super().__init__(model_name=model_name, model_config=model_config)
-        self._co = cohere.Client(COHERE_API_KEY)
+        self._co = cohere.AsyncClient(COHERE_API_KEY, httpx_client=http_client)
 
-    async def send_message(self, system_message: str, user_message: str) -> str:
-        """Sends a message to Cohere and returns the response."""
+    async def send_message(
+        self,
+        system_message: str,
+        user_message: str,
+        content_lst: Optional[list[Content]] = None,
+        on_field: Optional[Callable[[str, Any], None]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> str:
+        """Sends a message to Cohere and returns the response. The call gives up at the `deadline` with DeadlineExceeded."""
         messages = [
             {"role": "SYSTEM", "message": system_message},
         ]
 
         log.info(f"Sending messages to Cohere")
-        response = self._co.chat(
-            chat_history=messages,
-            message=user_message,
-            max_tokens=self._model_config.max_tokens,
-            temperature=self._model_config.temperature,
+        timeout_seconds: float = (
+            self._model_config.timeout_seconds
+            if deadline is None
+            else deadline.bound(self._model_config.timeout_seconds)
         )
+        try:
+            response = await self._co.chat(
+                chat_history=messages,
+                message=user_message,
+                max_tokens=self._model_config.max_tokens,
+                temperature=self._model_config.temperature,
+                request_options={"timeout_in_seconds": timeout_seconds},
+            )
+        except Exception as e:
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded(
+                    "Request deadline exceeded while waiting for Cohere"
+                ) from e
+            raise e
+        billed_units = response.meta.billed_units if response.meta else None
+        if billed_units:
+            record_usage(
+                prompt_tokens=billed_units.input_tokens,
+                completion_tokens=billed_units.output_tokens,
+            )
         return response.text
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from app.exceptions.exception import DeadlineExceeded
+from app.metrics import metrics
+
+# Time a request has to generate its notes, unless the client sends a shorter or longer one in the Request-Timeout header. Unset means no deadline.
+INFERENCE_DEADLINE_SECONDS: Optional[float] = (
+    float(os.environ["INFERENCE_DEADLINE_SECONDS"])
+    if os.environ.get("INFERENCE_DEADLINE_SECONDS")
+    else None
+)
+# A chunk is only retried if at least this much of the deadline is left once the backoff is over
+DEADLINE_MIN_ATTEMPT_SECONDS = float(os.environ.get("DEADLINE_MIN_ATTEMPT_SECONDS", 10))
+
+
+class Deadline:
+    """The time by which a request has to be answered, shared by every call made for it."""
+
+    _expires_at: Optional[float]
+
+    def __init__(self, timeout_seconds: Optional[float] = None):
+        """
+        Args:
+            timeout_seconds (Optional[float], optional): The time the request has from now. Defaults to None, which means no deadline.
+        """
+        self._expires_at = (
+            None if timeout_seconds is None else time.monotonic() + timeout_seconds
+        )
+
+    @property
+    def remaining_seconds(self) -> Optional[float]:
+        """The time left before the deadline, or None if there is no deadline."""
+        if self._expires_at is None:
+            return None
+        return max(0.0, self._expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self._expires_at is not None and time.monotonic() >= self._expires_at
+
+    def bound(self, timeout_seconds: float) -> float:
+        """Returns the timeout of a call, shortened to the time left before the deadline."""
+        remaining_seconds: Optional[float] = self.remaining_seconds
+        if remaining_seconds is None:
+            return timeout_seconds
+        return min(timeout_seconds, remaining_seconds)
+
+    def check(self):
+        """Raises DeadlineExceeded if the deadline has passed, so that no new call is started."""
+        if self.expired:
+            raise DeadlineExceeded("Request deadline exceeded")
+
+    @asynccontextmanager
+    async def enforce(self) -> AsyncIterator[None]:
+        """Cancels the block once the deadline has passed, with every task it is waiting for, and raises DeadlineExceeded instead.
+
+        Raises:
+            DeadlineExceeded: If the block was still running at the deadline.
+        """
+        timeout = asyncio.timeout(self.remaining_seconds)
+        try:
+            async with timeout:
+                yield
+        except TimeoutError as e:
+            if not timeout.expired():
+                raise e
+            metrics.increment("inference_deadline_exceeded")
+            raise DeadlineExceeded("Request deadline exceeded") from e
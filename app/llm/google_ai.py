@@ -1,10 +1,13 @@
 import logging
+from typing import Any, Callable, Optional
 
 from dotenv import load_dotenv
 from langchain_core.messages import AIMessage, HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 
 from app.llm.base import LLMBaseModel, LLMConfig
+from app.llm.deadline import Deadline
+from app.models.content import Content
 
 load_dotenv()
 
@@ -20,14 +23,23 @@ class GoogleAI(LLMBaseModel):
         super().__init__(model_name=model_name, model_config=model_config)
         try:
             self.model = ChatGoogleGenerativeAI(
-                model=model_name, temperature=model_config.temperature
+                model=model_name,
+                temperature=model_config.temperature,
+                timeout=model_config.timeout_seconds,
             )
         except Exception as e:
             log.error(f"Error initializing Google AI: {e}")
             raise e
 
-    async def send_message(self, system_message: str, user_message: str) -> str:
-        """Sends a message to Google AI and returns the response."""
+    async def send_message(
+        self,
+        system_message: str,
+        user_message: str,
+        content_lst: Optional[list[Content]] = None,
+        on_field: Optional[Callable[[str, Any], None]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> str:
+        """Sends a message to Google AI and returns the response. The call is cancelled at the `deadline` with DeadlineExceeded, as its timeout is fixed when the client is created."""
         # As of now, gemini pro doesn't support system message, and the messages must follow Human/AI/Human/AI pattern. We will be using Human/AI conversation to mimic system message.
         messages = []
         if system_message:
@@ -38,5 +50,8 @@ class GoogleAI(LLMBaseModel):
         messages.append(HumanMessage(content=user_message))
 
         log.info(f"Sending messages to Google AI")
-        response = (await self.model.ainvoke(messages)).content
+        if deadline is None:
+            return (await self.model.ainvoke(messages)).content
+        async with deadline.enforce():
+            response = (await self.model.ainvoke(messages)).content
         return response
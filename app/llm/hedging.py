@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict, deque
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from app.llm.model import LLMType
+from app.metrics import metrics
+from app.metrics import percentile as nearest_rank_percentile
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Hedging is opt-in: a call is hedged once it has run longer than this percentile (e.g. 95) of the recent latencies of its model
+HEDGE_PERCENTILE: Optional[float] = (
+    float(os.environ["HEDGE_PERCENTILE"])
+    if os.environ.get("HEDGE_PERCENTILE")
+    else None
+)
+# The model of the second attempt. Defaults to the model of the first attempt.
+HEDGE_LLM_TYPE: Optional[LLMType] = (
+    LLMType(os.environ["HEDGE_LLM_TYPE"]) if os.environ.get("HEDGE_LLM_TYPE") else None
+)
+# Cap on the hedged calls, as a fraction of all the calls of a model
+HEDGE_MAX_EXTRA_FRACTION = float(os.environ.get("HEDGE_MAX_EXTRA_FRACTION", 0.1))
+# Calls are not hedged until the model has this many latencies to take the percentile of
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+# Number of most recent latencies kept per model
+HEDGE_LATENCY_WINDOW = 256
+
+
+class Hedger:
+    """Fires a second attempt at the calls that run longer than usual for their model, and returns whichever attempt succeeds first.
+
+    The hedged calls are capped to a fraction of all the calls of a model, so that a slow provider cannot double its own load.
+    """
+
+    _max_extra_fraction: float
+    _min_samples: int
+    _latencies: dict[LLMType, deque[float]]
+    _calls: dict[LLMType, int]
+    _hedges: dict[LLMType, int]
+
+    def __init__(
+        self,
+        max_extra_fraction: float = HEDGE_MAX_EXTRA_FRACTION,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+        window: int = HEDGE_LATENCY_WINDOW,
+    ):
+        self._max_extra_fraction = max_extra_fraction
+        self._min_samples = min_samples
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._calls = defaultdict(int)
+        self._hedges = defaultdict(int)
+
+    def record_latency(self, llm_type: LLMType, seconds: float):
+        """Adds the latency of a call to the recent latencies of its model."""
+        self._latencies[llm_type].append(seconds)
+
+    def hedge_delay(self, llm_type: LLMType, percentile: float) -> Optional[float]:
+        """Returns how long a call of the model runs before it is hedged, or None if too few latencies have been recorded yet."""
+        latencies: deque[float] = self._latencies[llm_type]
+        if len(latencies) < self._min_samples:
+            return None
+        # Imported under another name, as `percentile` is the argument here
+        return nearest_rank_percentile(
+            sorted_values=sorted(latencies), percentile=percentile
+        )
+
+    def _try_acquire_hedge(self, llm_type: LLMType) -> bool:
+        if (
+            self._hedges[llm_type] + 1
+            > self._max_extra_fraction * self._calls[llm_type]
+        ):
+            metrics.increment("llm_hedges_capped", model=llm_type.value)
+            return False
+        self._hedges[llm_type] += 1
+        return True
+
+    def _export(self, llm_type: LLMType):
+        metrics.set_gauge(
+            "llm_hedge_extra_fraction",
+            self._hedges[llm_type] / self._calls[llm_type],
+            model=llm_type.value,
+        )
+
+    async def call(
+        self,
+        llm_type: LLMType,
+        percentile: float,
+        primary: Callable[[], Awaitable[T]],
+        hedge: Callable[[], Awaitable[T]],
+        hedge_llm_type: Optional[LLMType] = None,
+    ) -> T:
+        """Calls `primary`, and also calls `hedge` if `primary` has not completed after the percentile of the recent latencies of the model.
+
+        The first attempt to succeed wins and the other one is cancelled. If both attempts fail, the failure of `primary` is raised.
+
+        Args:
+            llm_type (LLMType): The model called by `primary`.
+            percentile (float): The percentile of the recent latencies after which the call is hedged, e.g. 95.
+            primary (Callable[[], Awaitable[T]]): The first attempt.
+            hedge (Callable[[], Awaitable[T]]): The second attempt.
+            hedge_llm_type (Optional[LLMType], optional): The model called by `hedge`. Defaults to `llm_type`.
+
+        Returns:
+            T: The result of the first attempt to succeed.
+        """
+        hedge_llm_type = hedge_llm_type or llm_type
+        self._calls[llm_type] += 1
+        delay: Optional[float] = self.hedge_delay(
+            llm_type=llm_type, percentile=percentile
+        )
+        start: float = time.monotonic()
+        primary_task: asyncio.Task = asyncio.create_task(primary())
+        hedge_task: Optional[asyncio.Task] = None
+        tasks: set[asyncio.Task] = {primary_task}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self._try_acquire_hedge(llm_type=llm_type):
+                    log.info(
+                        f"Hedging call to {llm_type} on {hedge_llm_type} after {delay:.2f}s"
+                    )
+                    hedge_started_at: float = time.monotonic()
+                    hedge_task = asyncio.create_task(hedge())
+                    tasks.add(hedge_task)
+            self._export(llm_type=llm_type)
+
+            errors: dict[asyncio.Task, BaseException] = {}
+            pending: set[asyncio.Task] = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # The primary attempt wins a tie
+                for task in sorted(done, key=lambda task: task is not primary_task):
+                    if task.exception() is not None:
+                        errors[task] = task.exception()
+                        continue
+                    # When the hedge wins, the primary attempt took at least this long, which keeps the slow calls in the percentile
+                    self.record_latency(llm_type, time.monotonic() - start)
+                    if task is hedge_task:
+                        self.record_latency(
+                            hedge_llm_type, time.monotonic() - hedge_started_at
+                        )
+                    if hedge_task is not None:
+                        metrics.increment(
+                            "llm_hedges",
+                            model=llm_type.value,
+                            outcome="won" if task is hedge_task else "lost",
+                        )
+                    return task.result()
+            if hedge_task is not None:
+                metrics.increment("llm_hedges", model=llm_type.value, outcome="failed")
+            raise errors.get(primary_task) or errors[hedge_task]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns the calls, the hedged calls and the current hedge delay at the 95th percentile of every model that has been called."""
+        return {
+            llm_type.value: {
+                "calls": calls,
+                "hedges": self._hedges[llm_type],
+                "p95_seconds": self.hedge_delay(llm_type=llm_type, percentile=95),
+            }
+            for llm_type, calls in self._calls.items()
+        }
+
+
+llm_hedger = Hedger()
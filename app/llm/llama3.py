@@ -1,32 +1,73 @@
-import logging 
-import requests
-import os 
+import logging
+import os
+from typing import Any, Callable, Optional
 
+import httpx
+
+from app.exceptions.exception import DeadlineExceeded
 from app.llm.base import LLMBaseModel, LLMConfig
+from app.llm.deadline import Deadline
+from app.models.content import Content
 
 log = logging.getLogger(__name__)
 
 HUGGINGFACE_TOKEN = os.environ.get("HUGGINGFACE_TOKEN")
 
-API_URL = "https://api-inference.huggingface.co/models/meta-llama/Meta-Llama-3-8B-Instruct"
+API_URL = (
+    "https://api-inference.huggingface.co/models/meta-llama/Meta-Llama-3-8B-Instruct"
+)
 headers = {"Authorization": f"Bearer {HUGGINGFACE_TOKEN}"}
 
+
 class Llama3(LLMBaseModel):
     """This class handles the interaction with Llama3 API."""
-    
-    def query(self, payload):
-        response = requests.post(API_URL, headers=headers, json=payload)
+
+    _client: httpx.AsyncClient
+
+    async def query(self, payload, timeout_seconds: Optional[float] = None):
+        response = await self._client.post(
+            API_URL,
+            headers=headers,
+            json=payload,
+            timeout=timeout_seconds or self._model_config.timeout_seconds,
+        )
+        response.raise_for_status()
         return response.json()
 
-    def __init__(self, model_name: str, model_config: LLMConfig):
+    def __init__(
+        self,
+        model_name: str,
+        model_config: LLMConfig,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
         super().__init__(model_name=model_name, model_config=model_config)
         self._model = None
-    
-    async def send_message(self, system_message: str, user_message: str) -> str:
-        """Sends a message to Llama3 and returns the response."""
+        self._client = http_client or httpx.AsyncClient()
+
+    async def send_message(
+        self,
+        system_message: str,
+        user_message: str,
+        content_lst: Optional[list[Content]] = None,
+        on_field: Optional[Callable[[str, Any], None]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> str:
+        """Sends a message to Llama3 and returns the response. The call gives up at the `deadline` with DeadlineExceeded."""
         log.info(f"Sending messages to Llama3")
-        response = self.query({
-            "inputs": system_message + "\n\n" + user_message,
-        })
+        try:
+            response = await self.query(
+                {"inputs": system_message + "\n\n" + user_message},
+                timeout_seconds=(
+                    None
+                    if deadline is None
+                    else deadline.bound(self._model_config.timeout_seconds)
+                ),
+            )
+        except Exception as e:
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded(
+                    "Request deadline exceeded while waiting for Llama3"
+                ) from e
+            raise e
         print(response[0].get("generated_text"))
-        return response[0].get("generated_text")
\ No newline at end of file
+        return response[0].get("generated_text")
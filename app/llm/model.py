@@ -2,12 +2,23 @@ from dataclasses import dataclass
 from enum import StrEnum
 from typing import Optional
 
+import httpx
+
 from app.llm.anthropic import Anthropic
 from app.llm.base import LLMBaseModel, LLMConfig
 from app.llm.cohere import Cohere
 from app.llm.google_ai import GoogleAI
 from app.llm.llama3 import Llama3
 from app.llm.open_ai import OpenAi
+from app.llm.tokenizer import TokenizerType
+
+
+class LLMProvider(StrEnum):
+    OPENAI = "openai"
+    GOOGLE = "google"
+    ANTHROPIC = "anthropic"
+    COHERE = "cohere"
+    HUGGINGFACE = "huggingface"
 
 
 class LLMType(StrEnum):
@@ -64,6 +75,83 @@ class LLMType(StrEnum):
             )
         raise ValueError(f"Unsupported LLM type: {self}")
 
+    def context_window(self) -> int:
+        """Returns the total number of tokens (input and output) that the model accepts in one request."""
+        match self:
+            case LLMType.OPENAI_GPT4:
+                return 128000
+            case LLMType.OPENAI_GPT3_5:
+                return 16385
+            case LLMType.GEMINI_PRO:
+                return 32760
+            case LLMType.CLAUDE_3_SONNET:
+                return 200000
+            case LLMType.CLAUDE_INSTANT_1:
+                return 100000
+            case LLMType.COHERE_COMMAND_R:
+                return 128000
+            case LLMType.COHERE_COMMAND_R_PLUS:
+                return 128000
+            case LLMType.LLAMA3:
+                return 8192
+        raise ValueError(f"Unsupported LLM type: {self}")
+
+    def provider(self) -> LLMProvider:
+        """Returns the provider serving the model, whose rate limits are shared by all its models."""
+        match self:
+            case LLMType.OPENAI_GPT4 | LLMType.OPENAI_GPT3_5:
+                return LLMProvider.OPENAI
+            case LLMType.GEMINI_PRO:
+                return LLMProvider.GOOGLE
+            case LLMType.CLAUDE_3_SONNET | LLMType.CLAUDE_INSTANT_1:
+                return LLMProvider.ANTHROPIC
+            case LLMType.COHERE_COMMAND_R | LLMType.COHERE_COMMAND_R_PLUS:
+                return LLMProvider.COHERE
+            case LLMType.LLAMA3:
+                return LLMProvider.HUGGINGFACE
+        raise ValueError(f"Unsupported LLM type: {self}")
+
+    def price_per_million_tokens(self) -> tuple[float, float]:
+        """Returns the list price in USD of a million input tokens and of a million output tokens."""
+        match self:
+            case LLMType.OPENAI_GPT4:
+                return 0.15, 0.6
+            case LLMType.OPENAI_GPT3_5:
+                return 0.5, 1.5
+            case LLMType.GEMINI_PRO:
+                return 0.5, 1.5
+            case LLMType.CLAUDE_3_SONNET:
+                return 3.0, 15.0
+            case LLMType.CLAUDE_INSTANT_1:
+                return 0.8, 2.4
+            case LLMType.COHERE_COMMAND_R:
+                return 0.5, 1.5
+            case LLMType.COHERE_COMMAND_R_PLUS:
+                return 3.0, 15.0
+            case LLMType.LLAMA3:
+                # Served by the free Hugging Face inference API
+                return 0.0, 0.0
+        raise ValueError(f"Unsupported LLM type: {self}")
+
+    def supports_notes(self) -> bool:
+        """Returns whether the client of the model answers with the fields of the notes, which every model that a chunk can be sent to has to do."""
+        match self.provider():
+            case LLMProvider.OPENAI | LLMProvider.ANTHROPIC:
+                return True
+        return False
+
+    def tokenizer_type(self) -> TokenizerType:
+        """Returns the tokenizer used to count tokens for the model.
+
+        Models whose tokenizer is not available locally are counted with the CodeLlama tokenizer. Its vocabulary is smaller than theirs, so it tends to over-count and keeps the budgets on the safe side.
+        """
+        match self:
+            case LLMType.OPENAI_GPT4:
+                return TokenizerType.O200K_BASE
+            case LLMType.OPENAI_GPT3_5:
+                return TokenizerType.CL100K_BASE
+        return TokenizerType.CODELLAMA
+
 
 @dataclass
 class LLM:
@@ -75,40 +163,56 @@ class LLM:
         self,
         model_type: LLMType,
         model_config: Optional[LLMConfig] = None,
+        http_client: Optional[httpx.AsyncClient] = None,
     ):
         model_config: LLMConfig = model_config or model_type.default_config()
         match model_type:
             case LLMType.OPENAI_GPT4:
                 self._model = OpenAi(
-                    model_name=model_type.value, model_config=model_config
+                    model_name=model_type.value,
+                    model_config=model_config,
+                    http_client=http_client,
                 )
             case LLMType.OPENAI_GPT3_5:
                 self._model = OpenAi(
-                    model_name=model_type.value, model_config=model_config
+                    model_name=model_type.value,
+                    model_config=model_config,
+                    http_client=http_client,
                 )
             case LLMType.GEMINI_PRO:
+                # ChatGoogleGenerativeAI calls Gemini over the gRPC client of google-generativeai, which cannot be given an httpx client. The registry still shares one instance, and so one gRPC channel, across requests.
                 self._model = GoogleAI(
                     model_name=model_type.value, model_config=model_config
                 )
             case LLMType.CLAUDE_3_SONNET:
                 self._model = Anthropic(
-                    model_name=model_type.value, model_config=model_config
+                    model_name=model_type.value,
+                    model_config=model_config,
+                    http_client=http_client,
                 )
             case LLMType.CLAUDE_INSTANT_1:
                 self._model = Anthropic(
-                    model_name=model_type.value, model_config=model_config
+                    model_name=model_type.value,
+                    model_config=model_config,
+                    http_client=http_client,
                 )
             case LLMType.COHERE_COMMAND_R:
                 self._model = Cohere(
-                    model_name=model_type.value, model_config=model_config
+                    model_name=model_type.value,
+                    model_config=model_config,
+                    http_client=http_client,
                 )
             case LLMType.COHERE_COMMAND_R_PLUS:
                 self._model = Cohere(
-                    model_name=model_type.value, model_config=model_config
+                    model_name=model_type.value,
+                    model_config=model_config,
+                    http_client=http_client,
                 )
             case LLMType.LLAMA3:
                 self._model = Llama3(
-                    model_name=model_type.value, model_config=model_config
+                    model_name=model_type.value,
+                    model_config=model_config,
+                    http_client=http_client,
                 )
 
     @property
@@ -1,108 +1,210 @@
-import json
+import asyncio
 import logging
-from typing import Any, Optional
-from openai import OpenAI
 import os
+import time
+from typing import Any, Callable, Optional
 
-from app.exceptions.exception import InferenceFailure
+import httpx
+from openai import AsyncOpenAI
+
+from app.exceptions.exception import (
+    DeadlineExceeded,
+    GenerationAborted,
+    InferenceFailure,
+)
 from app.llm.base import LLMBaseModel, LLMConfig
+from app.llm.deadline import Deadline
+from app.llm.streaming_json import IncrementalJSONParser
+from app.llm.usage import record_usage
+from app.metrics import metrics
 from app.models.content import Content
 from app.prompts.config import PromptMessageConfig
-from app.prompts.generator.functions import get_notes_functions, NotesFunctions
+from app.prompts.generator.functions import (
+    NotesFunctions,
+    get_notes_functions,
+    notes_from_arguments,
+)
 
 log = logging.getLogger(__name__)
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+# Overrides the API endpoint, e.g. to go through a proxy. Defaults to the official endpoint.
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL")
+# Weight of the latest complete generation in the average output length, which estimates what an aborted generation would have cost
+OUTPUT_TOKENS_SMOOTHING = 0.2
+
 
 class OpenAi(LLMBaseModel):
     """This class handles the interaction with OpenAI API."""
 
-
-    def __init__(self, model_name: str, model_config: LLMConfig):
+    def __init__(
+        self,
+        model_name: str,
+        model_config: LLMConfig,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
         super().__init__(model_name=model_name, model_config=model_config)
-        self._client = OpenAI(
+        self._client = AsyncOpenAI(
             api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL,
+            http_client=http_client,
+            # Retries are scheduled by app.llm.retry
+            max_retries=0,
         )
+        self._average_output_tokens: Optional[float] = None
+
+    async def send_message(
+        self,
+        system_message: str,
+        user_message: str,
+        content_lst: list[Content],
+        on_field: Optional[Callable[[str, Any], None]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> Any:
+        """Sends a message to OpenAI and returns the response.
+
+        The response is streamed, and every field of the notes is passed to `on_field` as soon as it is complete, before the rest of the notes are generated. If `on_field` raises GenerationAborted, the stream is closed at once, so the provider stops generating the rest of the notes.
+
+        The call is bounded by the timeout of the model, shortened to the time left before `deadline`. If the deadline is what cut the call short, DeadlineExceeded is raised instead of InferenceFailure, so that the call is not retried.
+        """
 
-    async def send_message(self, system_message: str, user_message: str, content_lst: list[Content]) -> Any:
-        """Sends a message to OpenAI and returns the response."""
-        
         log.info(f"Sending messages to OpenAI")
+        timeout_seconds: float = (
+            self._model_config.timeout_seconds
+            if deadline is None
+            else deadline.bound(self._model_config.timeout_seconds)
+        )
         try:
-            response = self._client.chat.completions.create(
-                model = self._model_name,
-                messages = [
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_message}
-                ],
-                functions=get_notes_functions(
-                    contains_mcq_practice=bool(Content.MCQ in content_lst),
-                    contains_code_practice=bool(Content.CODE in content_lst)
-                ),
-                function_call = {"name": NotesFunctions.GET_NOTES}
-            )
+            parser = IncrementalJSONParser(on_field=on_field)
+            start: float = time.perf_counter()
+            first_token_at: Optional[float] = None
+            output_tokens: int = 0
+            completion_tokens: Optional[int] = None
+            # The timeout bounds the whole generation, not only the wait between two streamed chunks
+            async with asyncio.timeout(timeout_seconds):
+                stream = await self._client.chat.completions.create(
+                    model=self._model_name,
+                    messages=[
+                        {"role": "system", "content": system_message},
+                        {"role": "user", "content": user_message},
+                    ],
+                    functions=get_notes_functions(
+                        contains_mcq_practice=bool(Content.MCQ in content_lst),
+                        contains_code_practice=bool(Content.CODE in content_lst),
+                    ),
+                    function_call={"name": NotesFunctions.GET_NOTES},
+                    stream=True,
+                    # Sent as a raw body parameter, since older clients do not know stream_options
+                    extra_body={"stream_options": {"include_usage": True}},
+                    timeout=timeout_seconds,
+                )
+                try:
+                    async for chunk in stream:
+                        if chunk.usage:
+                            completion_tokens = chunk.usage.completion_tokens
+                            record_usage(
+                                prompt_tokens=chunk.usage.prompt_tokens,
+                                completion_tokens=chunk.usage.completion_tokens,
+                            )
+                        if not chunk.choices:
+                            continue
+                        function_call = chunk.choices[0].delta.function_call
+                        if function_call and function_call.arguments:
+                            # Every streamed delta carries about one token
+                            output_tokens += 1
+                            if first_token_at is None:
+                                first_token_at = time.perf_counter()
+                            parser.feed(function_call.arguments)
+                except GenerationAborted as e:
+                    self._report_abort(
+                        field=e.field,
+                        output_tokens=output_tokens,
+                        streaming_seconds=time.perf_counter()
+                        - (first_token_at or start),
+                    )
+                    raise e
+                finally:
+                    # Dropping the connection is what stops the provider from generating the rest of an aborted response
+                    await stream.close()
+            self._record_output_tokens(output_tokens=completion_tokens or output_tokens)
             try:
-                json_response: dict[str, str] = json.loads(response.choices[0].message.function_call.arguments)
+                json_response: dict[str, str] = parser.result()
                 print("~~~LLM RESPONSE~~~")
                 print(json_response)
-                topic: str = json_response[NotesFunctions.TOPIC]
-                goal: str = json_response[NotesFunctions.GOAL]
-                context: str = json_response[NotesFunctions.CONTEXT]
-                overview: str = json_response[NotesFunctions.OVERVIEW]
-                
-                key_concepts_lst: list = []
-                for key_concept in json_response[NotesFunctions.KEY_CONCEPTS]:
-                    code_example: Optional[dict[str, str]] = key_concept.get(NotesFunctions.KEY_CONCEPT_CODE_EXAMPLE)
-                    if code_example:
-                        key_concepts_lst.append({
-                            NotesFunctions.KEY_CONCEPT_TITLE.value: key_concept[NotesFunctions.KEY_CONCEPT_TITLE],
-                            NotesFunctions.KEY_CONCEPT_EXPLANATION.value: key_concept[NotesFunctions.KEY_CONCEPT_EXPLANATION],
-                            NotesFunctions.KEY_CONCEPT_CODE_EXAMPLE.value: {
-                                NotesFunctions.KEY_CONCEPT_CODE.value: code_example[NotesFunctions.KEY_CONCEPT_CODE],
-                                NotesFunctions.KEY_CONCEPT_LANGUAGE.value: code_example[NotesFunctions.KEY_CONCEPT_LANGUAGE]
-                            }
-                        })
-                    else:
-                        key_concepts_lst.append({
-                            NotesFunctions.KEY_CONCEPT_TITLE.value: key_concept[NotesFunctions.KEY_CONCEPT_TITLE],
-                            NotesFunctions.KEY_CONCEPT_EXPLANATION.value: key_concept[NotesFunctions.KEY_CONCEPT_EXPLANATION],
-                        })
-                        
-                tips_lst: list = []
-                tips: Optional[list[dict[str, str]]] = json_response.get(NotesFunctions.TIPS)
-                if tips:
-                    for tip in tips:
-                        tips_lst.append({
-                            NotesFunctions.TIP_TITLE.value: tip[NotesFunctions.TIP_TITLE],
-                            NotesFunctions.TIP_EXPLANATION.value: tip[NotesFunctions.TIP_EXPLANATION]
-                        })     
-                        
-                mcq_practice: Optional[dict[str, str]] = json_response.get(NotesFunctions.MCQ_PRACTICE)
-                if mcq_practice:
-                    mcq_practice = {
-                        NotesFunctions.MCQ_PRACTICE_TITLE.value: mcq_practice[NotesFunctions.MCQ_PRACTICE_TITLE],
-                        NotesFunctions.MCQ_PRACTICE_QUESTION.value: mcq_practice[NotesFunctions.MCQ_PRACTICE_QUESTION],
-                        NotesFunctions.MCQ_PRACTICE_WRONG_OPTIONS.value: mcq_practice[NotesFunctions.MCQ_PRACTICE_WRONG_OPTIONS],
-                        NotesFunctions.MCQ_PRACTICE_CORRECT_OPTION.value: mcq_practice[NotesFunctions.MCQ_PRACTICE_CORRECT_OPTION]
-                    }     
-                
-                code_practice: Optional[dict[str, str]] = json_response.get(NotesFunctions.CODE_PRACTICE)
-                if code_practice:
-                    code_practice = {
-                        NotesFunctions.CODE_PRACTICE_TITLE.value: code_practice[NotesFunctions.CODE_PRACTICE_TITLE],
-                        NotesFunctions.CODE_PRACTICE_QUESTION.value: code_practice[NotesFunctions.CODE_PRACTICE_QUESTION],
-                        NotesFunctions.CODE_PRACTICE_HALF_COMPLETED_CODE.value: code_practice[NotesFunctions.CODE_PRACTICE_HALF_COMPLETED_CODE],
-                        NotesFunctions.CODE_PRACTICE_FULLY_COMPLETED_CODE.value: code_practice[NotesFunctions.CODE_PRACTICE_FULLY_COMPLETED_CODE],
-                        NotesFunctions.CODE_PRACTICE_LANGUAGE.value: code_practice[NotesFunctions.CODE_PRACTICE_LANGUAGE]
-                    }
-                
-                log.info(f"Topic: {topic}, Goal: {goal}, Context: {context}, Overview: {overview}, Key concepts: {key_concepts_lst}, Tips: {tips_lst}, MCQ Practice: {mcq_practice}, Code Practice: {code_practice}")
-                return (topic, goal, context, overview, key_concepts_lst, tips_lst, mcq_practice, code_practice)
+                (
+                    topic,
+                    goal,
+                    context,
+                    overview,
+                    key_concepts_lst,
+                    tips_lst,
+                    mcq_practice,
+                    code_practice,
+                ) = notes_from_arguments(json_response)
+                log.info(
+                    f"Topic: {topic}, Goal: {goal}, Context: {context}, Overview: {overview}, Key concepts: {key_concepts_lst}, Tips: {tips_lst}, MCQ Practice: {mcq_practice}, Code Practice: {code_practice}"
+                )
+                return (
+                    topic,
+                    goal,
+                    context,
+                    overview,
+                    key_concepts_lst,
+                    tips_lst,
+                    mcq_practice,
+                    code_practice,
+                )
             except Exception as e:
                 log.error(f"Error processing or receiving OpenAI response: {str(e)}")
-                raise InferenceFailure("Error processing OpenAI response")
+                raise InferenceFailure("Error processing OpenAI response") from e
         except Exception as e:
+            if deadline is not None and deadline.expired:
+                log.error(
+                    f"Request deadline exceeded while waiting for OpenAI: {str(e)}"
+                )
+                raise DeadlineExceeded(
+                    "Request deadline exceeded while waiting for OpenAI"
+                ) from e
             log.error(f"Error sending message to OpenAI: {str(e)}")
-            raise InferenceFailure("Error sending message to OpenAI")
-            
-        
+            raise InferenceFailure("Error sending message to OpenAI") from e
+
+    def _record_output_tokens(self, output_tokens: int):
+        """Adds a complete generation to the average output length of the model."""
+        if self._average_output_tokens is None:
+            self._average_output_tokens = float(output_tokens)
+        else:
+            self._average_output_tokens += OUTPUT_TOKENS_SMOOTHING * (
+                output_tokens - self._average_output_tokens
+            )
+
+    def _report_abort(self, field: str, output_tokens: int, streaming_seconds: float):
+        """Reports the output tokens and the seconds saved by aborting a generation.
+
+        The aborted generation is assumed to have been as long as the average complete generation of the model, or as long as the maximum output tokens before any has completed, and to have kept streaming at the same rate.
+
+        Args:
+            field (str): The field that was rejected.
+            output_tokens (int): The output tokens generated before the abort.
+            streaming_seconds (float): The time spent streaming them.
+        """
+        expected_output_tokens: float = (
+            self._average_output_tokens
+            if self._average_output_tokens is not None
+            else self._model_config.max_tokens
+        )
+        saved_output_tokens: float = max(0.0, expected_output_tokens - output_tokens)
+        saved_seconds: float = (
+            saved_output_tokens * streaming_seconds / max(1, output_tokens)
+        )
+        metrics.increment("llm_early_aborts", model=self._model_name, field=field)
+        metrics.observe(
+            "llm_early_abort_saved_output_tokens",
+            saved_output_tokens,
+            model=self._model_name,
+        )
+        metrics.observe(
+            "llm_early_abort_saved_seconds", saved_seconds, model=self._model_name
+        )
+        log.warning(
+            f"Aborted OpenAI generation at field {field} after {output_tokens} output tokens, saving about {saved_output_tokens:.0f} tokens and {saved_seconds:.2f}s"
+        )
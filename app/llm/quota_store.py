@@ -0,0 +1,135 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# Path of the SQLite file shared by the workers on a host. Each worker keeps its own buckets if it is not set.
+LLM_QUOTA_STORE_PATH = os.environ.get("LLM_QUOTA_STORE_PATH")
+
+
+class SQLiteQuotaStore:
+    """Token buckets stored in a SQLite file, so that every worker process on the host draws from the same provider quota.
+
+    Each acquire is a single short write transaction. The file is opened in WAL mode without fsync, since the buckets only need to outlive the transaction, not a crash. The calls block while another worker holds the write lock, so async callers run them in a thread.
+    """
+
+    _path: str
+    _local: threading.local
+
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the connection of the current thread, opening it on first use."""
+        connection: Optional[sqlite3.Connection] = getattr(
+            self._local, "connection", None
+        )
+        if connection is None:
+            connection = sqlite3.connect(
+                self._path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+        return connection
+
+    def _update(
+        self,
+        key: str,
+        amount: float,
+        capacity: float,
+        refill_per_second: float,
+        force: bool,
+    ) -> float:
+        connection: sqlite3.Connection = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front, so that two workers cannot both read the same balance
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now: float = time.time()
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens: float = (
+                capacity
+                if row is None
+                else min(capacity, row[0] + max(0.0, now - row[1]) * refill_per_second)
+            )
+            wait_seconds: float = 0.0
+            if force or tokens >= amount:
+                tokens = min(capacity, tokens - amount)
+            else:
+                wait_seconds = (amount - tokens) / refill_per_second
+            connection.execute(
+                "INSERT INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (key, tokens, now),
+            )
+            connection.execute("COMMIT")
+            return wait_seconds
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def try_acquire(
+        self, key: str, amount: float, capacity: float, refill_per_second: float
+    ) -> float:
+        """Takes `amount` from the bucket if it holds enough.
+
+        Args:
+            key (str): The bucket, e.g. the requests of a model under an API key.
+            amount (float): The amount to be taken.
+            capacity (float): The maximum amount the bucket holds. A new bucket starts full.
+            refill_per_second (float): The rate at which the bucket refills.
+
+        Returns:
+            float: 0 if the amount was taken, otherwise the number of seconds until the bucket could hold it.
+        """
+        return self._update(
+            key=key,
+            amount=amount,
+            capacity=capacity,
+            refill_per_second=refill_per_second,
+            force=False,
+        )
+
+    def adjust(
+        self, key: str, amount: float, capacity: float, refill_per_second: float
+    ):
+        """Gives back (positive) or takes (negative) `amount` unconditionally. The bucket may go into debt."""
+        self._update(
+            key=key,
+            amount=-amount,
+            capacity=capacity,
+            refill_per_second=refill_per_second,
+            force=True,
+        )
+
+    def tokens(self, key: str, capacity: float, refill_per_second: float) -> float:
+        """Returns the amount currently held by the bucket."""
+        row = (
+            self._connection()
+            .execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return capacity
+        return min(
+            capacity, row[0] + max(0.0, time.time() - row[1]) * refill_per_second
+        )
+
+    def close(self):
+        """Closes the connection of the current thread."""
+        connection: Optional[sqlite3.Connection] = getattr(
+            self._local, "connection", None
+        )
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
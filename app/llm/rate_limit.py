@@ -0,0 +1,277 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Optional
+
+from app.llm.model import LLMProvider, LLMType
+from app.llm.quota_store import LLM_QUOTA_STORE_PATH, SQLiteQuotaStore
+from app.llm.usage import Usage, track_usage
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Limits of the account, e.g. "gpt-4o-mini-2024-07-18=2000000:5000,claude-3-sonnet-20240229=80000:1000" (tokens per minute:requests per minute).
+# Only the models listed are paced, as the limits depend on the tier of the account.
+LLM_RATE_LIMITS = os.environ.get("LLM_RATE_LIMITS", "")
+
+
+# Environment variables holding the API key of each provider. The quota is shared by everything that uses the same key.
+API_KEY_ENV_VARS: dict[LLMProvider, str] = {
+    LLMProvider.OPENAI: "OPENAI_API_KEY",
+    LLMProvider.GOOGLE: "GOOGLE_API_KEY",
+    LLMProvider.ANTHROPIC: "ANTHROPIC_API_KEY",
+    LLMProvider.COHERE: "COHERE_API_KEY",
+    LLMProvider.HUGGINGFACE: "HUGGINGFACE_TOKEN",
+}
+
+
+def _quota_key(llm_type: LLMType) -> str:
+    """Returns the name under which the quota of the model is shared, made of the model and a fingerprint of the API key."""
+    api_key: str = os.environ.get(API_KEY_ENV_VARS[llm_type.provider()], "")
+    fingerprint: str = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    return f"{llm_type.provider().value}:{fingerprint}:{llm_type.value}"
+
+
+@dataclass(frozen=True)
+class RateLimits:
+    tokens_per_minute: int
+    requests_per_minute: int
+
+
+def parse_rate_limits(rate_limits: str) -> dict[LLMType, RateLimits]:
+    """Parses rate limits written as comma-separated `model=tokens_per_minute:requests_per_minute` pairs."""
+    parsed: dict[LLMType, RateLimits] = {}
+    for pair in rate_limits.split(","):
+        if not pair.strip():
+            continue
+        name, _, limits = pair.partition("=")
+        tokens_per_minute, _, requests_per_minute = limits.partition(":")
+        try:
+            parsed[LLMType(name.strip())] = RateLimits(
+                tokens_per_minute=int(tokens_per_minute),
+                requests_per_minute=int(requests_per_minute),
+            )
+        except ValueError:
+            log.error(f"Ignoring invalid rate limit {pair!r}")
+    return parsed
+
+
+class TokenBucket:
+    """Bucket that refills continuously up to its capacity. Callers wait for their turn in arrival order."""
+
+    _capacity: float
+    _refill_per_second: float
+    _tokens: float
+    _updated_at: float
+    _lock: asyncio.Lock
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self._capacity = capacity
+        self._refill_per_second = refill_per_second
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now: float = time.monotonic()
+        self._tokens = min(
+            self._capacity,
+            self._tokens + (now - self._updated_at) * self._refill_per_second,
+        )
+        self._updated_at = now
+
+    async def acquire(self, amount: float) -> float:
+        """Waits until the bucket holds `amount` and takes it. Amounts larger than the capacity only wait for a full bucket.
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        amount = min(amount, self._capacity)
+        start: float = time.monotonic()
+        async with self._lock:
+            self._refill()
+            while self._tokens < amount:
+                await asyncio.sleep((amount - self._tokens) / self._refill_per_second)
+                self._refill()
+            self._tokens -= amount
+        return time.monotonic() - start
+
+    async def adjust(self, amount: float):
+        """Gives back (positive) or takes (negative) tokens once the real cost of a call is known. The bucket may go into debt."""
+        self._refill()
+        self._tokens = min(self._capacity, self._tokens + amount)
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+
+class SharedTokenBucket:
+    """Token bucket kept in a quota store, so that it is shared by every worker on the host. Callers within a worker wait for their turn in arrival order."""
+
+    _store: SQLiteQuotaStore
+    _key: str
+    _capacity: float
+    _refill_per_second: float
+    _lock: asyncio.Lock
+
+    def __init__(
+        self,
+        store: SQLiteQuotaStore,
+        key: str,
+        capacity: float,
+        refill_per_second: float,
+    ):
+        self._store = store
+        self._key = key
+        self._capacity = capacity
+        self._refill_per_second = refill_per_second
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float) -> float:
+        """Waits until the bucket holds `amount` and takes it. Amounts larger than the capacity only wait for a full bucket.
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        amount = min(amount, self._capacity)
+        start: float = time.monotonic()
+        async with self._lock:
+            while True:
+                # The transaction may wait for the write lock of another worker, which must not block the event loop
+                wait_seconds: float = await asyncio.to_thread(
+                    self._store.try_acquire,
+                    key=self._key,
+                    amount=amount,
+                    capacity=self._capacity,
+                    refill_per_second=self._refill_per_second,
+                )
+                if not wait_seconds:
+                    break
+                await asyncio.sleep(wait_seconds)
+        return time.monotonic() - start
+
+    async def adjust(self, amount: float):
+        """Gives back (positive) or takes (negative) tokens once the real cost of a call is known. The bucket may go into debt."""
+        await asyncio.to_thread(
+            self._store.adjust,
+            key=self._key,
+            amount=amount,
+            capacity=self._capacity,
+            refill_per_second=self._refill_per_second,
+        )
+
+    @property
+    def tokens(self) -> float:
+        return self._store.tokens(
+            key=self._key,
+            capacity=self._capacity,
+            refill_per_second=self._refill_per_second,
+        )
+
+
+class RateLimiter:
+    """Paces the calls to each model under its tokens-per-minute and requests-per-minute limits, so that calls wait for capacity instead of being rejected with 429. Models without limits are not paced.
+
+    With a quota store, the buckets are shared by every worker on the host that uses the same API key. Otherwise each worker keeps its own buckets.
+    """
+
+    _rate_limits: dict[LLMType, RateLimits]
+    _store: Optional[SQLiteQuotaStore]
+    _token_buckets: dict[LLMType, TokenBucket | SharedTokenBucket]
+    _request_buckets: dict[LLMType, TokenBucket | SharedTokenBucket]
+
+    def __init__(
+        self,
+        rate_limits: Optional[dict[LLMType, RateLimits]] = None,
+        store: Optional[SQLiteQuotaStore] = None,
+    ):
+        self._store = store
+        self._rate_limits = (
+            rate_limits
+            if rate_limits is not None
+            else parse_rate_limits(LLM_RATE_LIMITS)
+        )
+        self._token_buckets = {}
+        self._request_buckets = {}
+
+    def _bucket(self, key: str, per_minute: int) -> TokenBucket | SharedTokenBucket:
+        if self._store is None:
+            return TokenBucket(capacity=per_minute, refill_per_second=per_minute / 60)
+        return SharedTokenBucket(
+            store=self._store,
+            key=key,
+            capacity=per_minute,
+            refill_per_second=per_minute / 60,
+        )
+
+    def _buckets(
+        self, llm_type: LLMType
+    ) -> tuple[TokenBucket | SharedTokenBucket, TokenBucket | SharedTokenBucket]:
+        if llm_type not in self._token_buckets:
+            rate_limits: RateLimits = self._rate_limits[llm_type]
+            quota_key: str = _quota_key(llm_type)
+            self._token_buckets[llm_type] = self._bucket(
+                key=f"{quota_key}:tokens", per_minute=rate_limits.tokens_per_minute
+            )
+            self._request_buckets[llm_type] = self._bucket(
+                key=f"{quota_key}:requests",
+                per_minute=rate_limits.requests_per_minute,
+            )
+        return self._token_buckets[llm_type], self._request_buckets[llm_type]
+
+    @asynccontextmanager
+    async def reserve(self, llm_type: LLMType, tokens: int) -> AsyncIterator[Usage]:
+        """Reserves one request and `tokens` tokens of the model's limits for a call, then corrects the token charge with the usage reported by the provider.
+
+        Args:
+            llm_type (LLMType): The model to be called.
+            tokens (int): The estimated prompt tokens plus the tokens reserved for the output.
+
+        Yields:
+            Usage: The usage reported by the provider during the call.
+        """
+        if llm_type not in self._rate_limits:
+            with track_usage() as usage:
+                yield usage
+            return
+        token_bucket, request_bucket = self._buckets(llm_type)
+        waited_seconds: float = await request_bucket.acquire(1)
+        waited_seconds += await token_bucket.acquire(tokens)
+        metrics.observe(
+            "llm_rate_limit_wait_seconds", waited_seconds, model=llm_type.value
+        )
+        metrics.increment(
+            "llm_rate_limit_tokens_reserved", tokens, model=llm_type.value
+        )
+        with track_usage() as usage:
+            try:
+                yield usage
+            finally:
+                if usage.reported:
+                    await token_bucket.adjust(tokens - usage.total_tokens)
+                    metrics.increment(
+                        "llm_rate_limit_tokens_used",
+                        usage.total_tokens,
+                        model=llm_type.value,
+                    )
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns the capacity left in the buckets of every model that has been called."""
+        return {
+            llm_type.value: {
+                "tokens": self._token_buckets[llm_type].tokens,
+                "requests": self._request_buckets[llm_type].tokens,
+            }
+            for llm_type in self._token_buckets
+        }
+
+
+llm_rate_limiter = RateLimiter(
+    store=SQLiteQuotaStore(path=LLM_QUOTA_STORE_PATH) if LLM_QUOTA_STORE_PATH else None
+)
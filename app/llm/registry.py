@@ -0,0 +1,101 @@
+import logging
+import os
+from typing import Optional
+
+import httpx
+
+from app.llm.base import LLMBaseModel, LLMConfig
+from app.llm.model import LLM, LLMType
+
+log = logging.getLogger(__name__)
+
+# Limits of the connection pool shared by every provider client in the process
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 100))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 20))
+LLM_KEEPALIVE_EXPIRY_SECONDS = float(os.environ.get("LLM_KEEPALIVE_EXPIRY_SECONDS", 30))
+# HTTP/2 multiplexes the concurrent requests to a provider over one connection
+LLM_HTTP2 = os.environ.get("LLM_HTTP2", "true").lower() == "true"
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """Returns the keep-alive connection pool shared by the provider clients."""
+    return httpx.AsyncClient(
+        http2=LLM_HTTP2,
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+    )
+
+
+class ClientRegistry:
+    """Process-lifetime registry of provider clients, keyed by the model type and its config.
+
+    Every client is built on the same HTTP connection pool, so connections and TLS sessions are reused across requests instead of being set up on every call.
+    """
+
+    _http_client: httpx.AsyncClient
+    _models: dict[tuple[LLMType, str], LLMBaseModel]
+
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
+        self._http_client = http_client or create_http_client()
+        self._models = {}
+
+    def get_model(
+        self, llm_type: LLMType, model_config: Optional[LLMConfig] = None
+    ) -> LLMBaseModel:
+        """Returns the client for the model, creating it on first use.
+
+        Args:
+            llm_type (LLMType): The model to be called.
+            model_config (Optional[LLMConfig], optional): The config of the model. Defaults to the default config of the model type.
+
+        Returns:
+            LLMBaseModel: The shared client of the model.
+        """
+        model_config = model_config or llm_type.default_config()
+        key: tuple[LLMType, str] = (llm_type, model_config.model_dump_json())
+        model: Optional[LLMBaseModel] = self._models.get(key)
+        if model is None:
+            model = LLM(
+                model_type=llm_type,
+                model_config=model_config,
+                http_client=self._http_client,
+            ).model
+            self._models[key] = model
+            log.info(f"Created {llm_type} client")
+        return model
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        return self._http_client
+
+    async def aclose(self):
+        """Closes the shared connection pool and forgets every client."""
+        self._models.clear()
+        await self._http_client.aclose()
+
+
+_registry: Optional[ClientRegistry] = None
+
+
+def open_client_registry() -> ClientRegistry:
+    """Creates the process-wide registry. Called once in the application lifespan."""
+    global _registry
+    if _registry is None:
+        _registry = ClientRegistry()
+    return _registry
+
+
+async def close_client_registry():
+    """Closes the process-wide registry on shutdown."""
+    global _registry
+    if _registry is not None:
+        await _registry.aclose()
+        _registry = None
+
+
+def get_client_registry() -> ClientRegistry:
+    """Returns the process-wide registry, creating it if the application lifespan has not run (e.g. in scripts)."""
+    return open_client_registry()
@@ -0,0 +1,342 @@
+import email.utils
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Iterator, NamedTuple, Optional, TypeVar
+
+import anthropic
+import httpx
+import openai
+from fastapi import HTTPException
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from tenacity.stop import stop_base
+from tenacity.wait import wait_base
+
+from app.exceptions.exception import (
+    CircuitOpen,
+    DeadlineExceeded,
+    GenerationAborted,
+    InvalidOutput,
+    LogicError,
+)
+from app.llm.deadline import DEADLINE_MIN_ATTEMPT_SECONDS, Deadline
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Attempts per chunk, including the first one
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", 5))
+# Extra attempts shared by all the chunks of a request, so that a failing provider cannot multiply the load
+RETRY_BUDGET_PER_REQUEST = int(os.environ.get("RETRY_BUDGET_PER_REQUEST", 8))
+RETRY_INITIAL_BACKOFF_SECONDS = float(
+    os.environ.get("RETRY_INITIAL_BACKOFF_SECONDS", 1)
+)
+RETRY_MAX_BACKOFF_SECONDS = float(os.environ.get("RETRY_MAX_BACKOFF_SECONDS", 30))
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+RETRYABLE_EXCEPTIONS = (
+    TimeoutError,
+    ConnectionError,
+    json.JSONDecodeError,
+    httpx.TransportError,
+    openai.APIConnectionError,
+    anthropic.APIConnectionError,
+)
+
+
+def _exception_chain(exception: BaseException) -> Iterator[BaseException]:
+    """Yields the exception followed by the exceptions it was raised from or while handling."""
+    seen: set[int] = set()
+    current: Optional[BaseException] = exception
+    while current is not None and id(current) not in seen:
+        seen.add(id(current))
+        yield current
+        current = current.__cause__ or current.__context__
+
+
+def _status_code(exception: BaseException) -> Optional[int]:
+    """Returns the HTTP status code carried by a provider exception, if any. Our own HTTPExceptions describe the response to the client, not the provider's response, so they are skipped."""
+    if isinstance(exception, HTTPException):
+        return None
+    status_code: Any = getattr(exception, "status_code", None)
+    if status_code is None:
+        response: Any = getattr(exception, "response", None)
+        status_code = getattr(response, "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def retry_reason(exception: BaseException) -> Optional[str]:
+    """Classifies a failed LLM call, looking through the chain of exceptions it was raised from.
+
+    Args:
+        exception (BaseException): The exception raised by the call.
+
+    Returns:
+        Optional[str]: Why the call is worth retrying (e.g. `rate_limit`, `timeout`, `server_error`, `invalid_json`, `invalid_output`, `early_abort`, `circuit_open`), or None if the failure is fatal and retrying would fail the same way.
+    """
+    for cause in _exception_chain(exception):
+        # The request has no time left for another attempt, whatever made this one time out
+        if isinstance(cause, DeadlineExceeded):
+            return None
+        # The output was rejected while it was generated, and the next sample may well pass
+        if isinstance(cause, GenerationAborted):
+            return "early_abort"
+        # Every model of the fallback chain is failing fast, until one of them is probed again
+        if isinstance(cause, CircuitOpen):
+            return "circuit_open"
+        # The model left out a field of the notes, or filled one in wrongly, so its output is resampled like invalid JSON
+        if isinstance(cause, (InvalidOutput, KeyError)):
+            return "invalid_output"
+        if isinstance(cause, LogicError):
+            return None
+        status_code: Optional[int] = _status_code(cause)
+        if status_code == 429:
+            return "rate_limit"
+        if status_code is not None and (
+            status_code >= 500 or status_code in RETRYABLE_STATUS_CODES
+        ):
+            return "server_error"
+        if isinstance(
+            cause,
+            (
+                TimeoutError,
+                httpx.TimeoutException,
+                openai.APITimeoutError,
+                anthropic.APITimeoutError,
+            ),
+        ):
+            return "timeout"
+        if isinstance(cause, json.JSONDecodeError):
+            return "invalid_json"
+        if isinstance(cause, RETRYABLE_EXCEPTIONS):
+            return "connection"
+    return None
+
+
+def failure_reason(exception: BaseException) -> str:
+    """Classifies a call that failed for good, e.g. for a client to decide whether to send its chunk again.
+
+    Args:
+        exception (BaseException): The exception raised by the call, after its retries.
+
+    Returns:
+        str: `deadline_exceeded`, `rejected_output`, the reason of `retry_reason` if the failure was retryable, or `error`.
+    """
+    for cause in _exception_chain(exception):
+        if isinstance(cause, DeadlineExceeded):
+            return "deadline_exceeded"
+        if isinstance(cause, LogicError):
+            return "rejected_output"
+    return retry_reason(exception) or "error"
+
+
+def retry_after_seconds(exception: BaseException) -> Optional[float]:
+    """Returns the delay requested by the provider through the `Retry-After` (or `retry-after-ms`) header, if any."""
+    for cause in _exception_chain(exception):
+        headers: Any = getattr(getattr(cause, "response", None), "headers", None)
+        if headers is None:
+            headers = getattr(cause, "headers", None)
+        if not headers:
+            continue
+        retry_after_ms: Optional[str] = headers.get("retry-after-ms")
+        if retry_after_ms:
+            try:
+                return float(retry_after_ms) / 1000
+            except ValueError:
+                pass
+        retry_after: Optional[str] = headers.get("retry-after")
+        if not retry_after:
+            continue
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+            if retry_at is not None:
+                return max(0.0, retry_at.timestamp() - time.time())
+    return None
+
+
+class RetryBudget:
+    """Caps the extra attempts of all the chunks of a request."""
+
+    _remaining: int
+
+    def __init__(self, max_retries: int = RETRY_BUDGET_PER_REQUEST):
+        self._remaining = max_retries
+
+    def try_acquire(self) -> bool:
+        """Takes one retry from the budget. Returns False if the budget is exhausted."""
+        if self._remaining <= 0:
+            return False
+        self._remaining -= 1
+        return True
+
+    @property
+    def remaining(self) -> int:
+        return self._remaining
+
+
+class _stop_when_budget_exhausted(stop_base):
+    """Stops retrying once the request has used up its retry budget."""
+
+    def __init__(self, budget: RetryBudget):
+        self._budget = budget
+
+    def __call__(self, retry_state: RetryCallState) -> bool:
+        if self._budget.try_acquire():
+            return False
+        metrics.increment("llm_retry_budget_exhausted")
+        return True
+
+
+class _stop_at_deadline(stop_base):
+    """Stops retrying once an attempt could not finish before the deadline of the request, see `_wait_within_deadline`."""
+
+    def __init__(self, deadline: Deadline, min_attempt_seconds: float):
+        self._deadline = deadline
+        self._min_attempt_seconds = min_attempt_seconds
+
+    def __call__(self, retry_state: RetryCallState) -> bool:
+        remaining_seconds: Optional[float] = self._deadline.remaining_seconds
+        if remaining_seconds is None or remaining_seconds >= self._min_attempt_seconds:
+            return False
+        metrics.increment("llm_retry_deadline_exceeded")
+        return True
+
+
+class _wait_within_deadline(wait_base):
+    """Shortens the backoff so that the next attempt still has `min_attempt_seconds` before the deadline of the request.
+
+    The stop conditions do not see the backoff, since tenacity only computes it after them in the pinned version.
+    """
+
+    def __init__(self, wait: wait_base, deadline: Deadline, min_attempt_seconds: float):
+        self._wait = wait
+        self._deadline = deadline
+        self._min_attempt_seconds = min_attempt_seconds
+
+    def __call__(self, retry_state: RetryCallState) -> float:
+        sleep_seconds: float = self._wait(retry_state)
+        remaining_seconds: Optional[float] = self._deadline.remaining_seconds
+        if remaining_seconds is None:
+            return sleep_seconds
+        return max(
+            0.0, min(sleep_seconds, remaining_seconds - self._min_attempt_seconds)
+        )
+
+
+class _wait_retry_after(wait_base):
+    """Waits as long as the provider asked for, or falls back to exponential backoff with jitter."""
+
+    def __init__(self, fallback: wait_base, max_seconds: float):
+        self._fallback = fallback
+        self._max_seconds = max_seconds
+
+    def __call__(self, retry_state: RetryCallState) -> float:
+        exception: Optional[BaseException] = retry_state.outcome.exception()
+        # The provider is healthy, only its output was rejected, so there is nothing to back off from
+        if exception is not None and retry_reason(exception) in (
+            "early_abort",
+            "invalid_output",
+        ):
+            return 0.0
+        retry_after: Optional[float] = (
+            retry_after_seconds(exception) if exception else None
+        )
+        if retry_after is not None:
+            return min(retry_after, self._max_seconds)
+        return self._fallback(retry_state)
+
+
+class RetryEvent(NamedTuple):
+    """A failed attempt that is about to be retried."""
+
+    attempt: int
+    reason: Optional[str]
+    sleep_seconds: float
+    error: str
+
+
+def _log_retry(retry_state: RetryCallState) -> RetryEvent:
+    exception: Optional[BaseException] = retry_state.outcome.exception()
+    reason: Optional[str] = retry_reason(exception) if exception else None
+    metrics.increment("llm_retries", reason=reason)
+    log.warning(
+        f"Retrying LLM call after attempt {retry_state.attempt_number} failed ({reason}), sleeping {retry_state.next_action.sleep:.2f}s: {exception}"
+    )
+    return RetryEvent(
+        attempt=retry_state.attempt_number,
+        reason=reason,
+        sleep_seconds=retry_state.next_action.sleep,
+        error=str(exception),
+    )
+
+
+async def call_with_retry(
+    fn: Callable[[], Awaitable[T]],
+    budget: RetryBudget,
+    max_attempts: int = RETRY_MAX_ATTEMPTS,
+    initial_backoff_seconds: float = RETRY_INITIAL_BACKOFF_SECONDS,
+    max_backoff_seconds: float = RETRY_MAX_BACKOFF_SECONDS,
+    on_retry: Optional[Callable[[RetryEvent], None]] = None,
+    deadline: Optional[Deadline] = None,
+    min_attempt_seconds: float = DEADLINE_MIN_ATTEMPT_SECONDS,
+) -> T:
+    """Calls `fn` and retries it on retryable failures with exponential backoff and jitter, honouring `Retry-After`.
+
+    Fatal failures are raised immediately. Retryable failures are raised once the chunk has used up its attempts, the request has used up its retry budget, or an attempt could not finish before the deadline of the request. A backoff, even one asked for with `Retry-After`, is shortened so that the next attempt can still finish before the deadline.
+
+    Args:
+        fn (Callable[[], Awaitable[T]]): The call to be made, e.g. the generation of one chunk.
+        budget (RetryBudget): The retry budget of the request that the call belongs to.
+        max_attempts (int, optional): The maximum number of attempts, including the first one. Defaults to RETRY_MAX_ATTEMPTS.
+        initial_backoff_seconds (float, optional): The scale of the backoff. Defaults to RETRY_INITIAL_BACKOFF_SECONDS.
+        max_backoff_seconds (float, optional): The longest wait between attempts. Defaults to RETRY_MAX_BACKOFF_SECONDS.
+        on_retry (Optional[Callable[[RetryEvent], None]], optional): Called before sleeping for every retry, e.g. to report it to a streaming client. Defaults to None.
+        deadline (Optional[Deadline], optional): The deadline of the request that the call belongs to. Defaults to None.
+        min_attempt_seconds (float, optional): The time an attempt needs at least, which has to be left before the deadline once the backoff is over. Defaults to DEADLINE_MIN_ATTEMPT_SECONDS.
+
+    Returns:
+        T: The result of the first successful attempt.
+    """
+
+    def _before_sleep(retry_state: RetryCallState):
+        retry_event: RetryEvent = _log_retry(retry_state)
+        if on_retry is not None:
+            on_retry(retry_event)
+
+    deadline = deadline or Deadline()
+    retrying = AsyncRetrying(
+        retry=retry_if_exception(lambda e: retry_reason(e) is not None),
+        # The deadline is checked before the budget, so that a retry that is not made does not use up the budget
+        stop=stop_after_attempt(max_attempts)
+        | _stop_at_deadline(deadline=deadline, min_attempt_seconds=min_attempt_seconds)
+        | _stop_when_budget_exhausted(budget),
+        wait=_wait_within_deadline(
+            wait=_wait_retry_after(
+                fallback=wait_random_exponential(
+                    multiplier=initial_backoff_seconds, max=max_backoff_seconds
+                ),
+                max_seconds=max_backoff_seconds,
+            ),
+            deadline=deadline,
+            min_attempt_seconds=min_attempt_seconds,
+        ),
+        before_sleep=_before_sleep,
+        reraise=True,
+    )
+
+    async def _attempt() -> T:
+        # AsyncRetrying only awaits the result of coroutine functions, not of plain callables such as a lambda returning a coroutine
+        return await fn()
+
+    return await retrying(_attempt)
@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass
+from enum import StrEnum
+from typing import Any, NamedTuple, Optional
+
+from app.llm.model import LLMType
+from app.metrics import metrics, percentile
+from app.models.content import Content
+
+log = logging.getLogger(__name__)
+# One JSON object per routing decision, so that the policy can be audited offline
+routing_decision_log = logging.getLogger(f"{__name__}.decisions")
+
+
+class RoutingPolicy(StrEnum):
+    MIN_LATENCY = "min_latency"
+    MIN_COST = "min_cost"
+    # The cheapest model whose expected latency meets the SLO, or the fastest one if none does
+    COST_UNDER_SLO = "cost_under_slo"
+
+
+# Routing is opt-in: every chunk goes to the configured model unless a policy is set
+LLM_ROUTING_POLICY: Optional[RoutingPolicy] = (
+    RoutingPolicy(os.environ["LLM_ROUTING_POLICY"])
+    if os.environ.get("LLM_ROUTING_POLICY")
+    else None
+)
+# The models a chunk can be routed to besides the configured model, e.g. "gpt-3.5-turbo-0125,claude-3-sonnet-20240229"
+LLM_ROUTING_CANDIDATES: list[LLMType] = [
+    LLMType(name.strip())
+    for name in os.environ.get("LLM_ROUTING_CANDIDATES", "").split(",")
+    if name.strip()
+]
+ROUTING_LATENCY_SLO_SECONDS = float(os.environ.get("ROUTING_LATENCY_SLO_SECONDS", 60))
+# Appends the routing decisions to this file as JSON lines, on top of the application log
+ROUTING_DECISION_LOG_PATH = os.environ.get("ROUTING_DECISION_LOG_PATH")
+# The latency assumed for a model until it has enough recorded calls
+ROUTING_PRIOR_LATENCY_SECONDS = float(
+    os.environ.get("ROUTING_PRIOR_LATENCY_SECONDS", 30)
+)
+ROUTING_MIN_SAMPLES = int(os.environ.get("ROUTING_MIN_SAMPLES", 5))
+# Number of most recent calls kept per model
+ROUTING_WINDOW = 200
+# The latency of a model is taken at this percentile of its recent successful calls
+ROUTING_LATENCY_PERCENTILE = 90
+# Floor of the success rate, so that a model that keeps failing still gets a finite estimate
+MIN_SUCCESS_RATE = 0.05
+
+if ROUTING_DECISION_LOG_PATH:
+    _decision_handler = logging.FileHandler(ROUTING_DECISION_LOG_PATH)
+    _decision_handler.setFormatter(logging.Formatter("%(message)s"))
+    routing_decision_log.addHandler(_decision_handler)
+
+
+def sections_key(content_lst: list[Content]) -> str:
+    """Returns the requested sections as a key, e.g. `code+mcq`, since they drive the length of the output."""
+    return "+".join(sorted(content.value for content in content_lst)) or "none"
+
+
+class _Outcome(NamedTuple):
+    seconds: float
+    succeeded: bool
+    output_tokens: Optional[int]
+    sections: str
+
+
+@dataclass
+class ModelEstimate:
+    """What a chunk is expected to cost on a model, including the retries of the attempts that fail."""
+
+    llm_type: LLMType
+    latency_seconds: float
+    cost_usd: float
+    success_rate: float
+    output_tokens: float
+    samples: int
+
+
+@dataclass
+class RoutingDecision:
+    llm_type: LLMType
+    policy: RoutingPolicy
+    reason: str
+    prompt_tokens: int
+    sections: str
+    estimates: list[ModelEstimate]
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+class Router:
+    """Picks the model of every chunk from a rolling record of the latency, the success rate after post-processing and the output length of every model, and its price per token."""
+
+    _min_samples: int
+    _prior_latency_seconds: float
+    _outcomes: dict[LLMType, deque[_Outcome]]
+
+    def __init__(
+        self,
+        window: int = ROUTING_WINDOW,
+        min_samples: int = ROUTING_MIN_SAMPLES,
+        prior_latency_seconds: float = ROUTING_PRIOR_LATENCY_SECONDS,
+    ):
+        self._min_samples = min_samples
+        self._prior_latency_seconds = prior_latency_seconds
+        self._outcomes = defaultdict(lambda: deque(maxlen=window))
+
+    def record(
+        self,
+        llm_type: LLMType,
+        seconds: float,
+        succeeded: bool,
+        content_lst: list[Content],
+        output_tokens: Optional[int] = None,
+    ):
+        """Records a call to the model.
+
+        Args:
+            llm_type (LLMType): The model that was called.
+            seconds (float): The duration of the call.
+            succeeded (bool): Whether the notes passed post-processing.
+            content_lst (list[Content]): The sections that were requested.
+            output_tokens (Optional[int], optional): The output tokens reported by the provider, if any. Defaults to None.
+        """
+        self._outcomes[llm_type].append(
+            _Outcome(
+                seconds=seconds,
+                succeeded=succeeded,
+                output_tokens=output_tokens,
+                sections=sections_key(content_lst),
+            )
+        )
+
+    def estimate(
+        self, llm_type: LLMType, prompt_tokens: int, content_lst: list[Content]
+    ) -> ModelEstimate:
+        """Returns the expected latency and cost of a chunk on the model.
+
+        Until the model has enough recorded calls, it is assumed to always succeed within the prior latency, so that new models get tried. The output length is the average of the successful calls for the same sections, or for any sections, or the maximum output tokens of the model.
+
+        Only the cost depends on `prompt_tokens`. The latency is taken from the recent calls of the model whatever the size of their chunks, since the time of a call is driven by its output rather than its prompt. A chunk much larger than the usual ones may take longer than estimated.
+
+        Args:
+            llm_type (LLMType): The model.
+            prompt_tokens (int): The tokens of the request.
+            content_lst (list[Content]): The sections requested.
+
+        Returns:
+            ModelEstimate: The expected latency and cost, divided by the success rate to account for the retries.
+        """
+        outcomes: deque[_Outcome] = self._outcomes[llm_type]
+        successes: list[_Outcome] = [
+            outcome for outcome in outcomes if outcome.succeeded
+        ]
+        if len(outcomes) < self._min_samples:
+            success_rate: float = 1.0
+        else:
+            success_rate = max(MIN_SUCCESS_RATE, len(successes) / len(outcomes))
+        latency_seconds: float = (
+            percentile(
+                sorted_values=sorted(outcome.seconds for outcome in successes),
+                percentile=ROUTING_LATENCY_PERCENTILE,
+            )
+            if len(successes) >= self._min_samples
+            else self._prior_latency_seconds
+        )
+
+        sections: str = sections_key(content_lst)
+        output_tokens_lst: list[int] = [
+            outcome.output_tokens
+            for outcome in successes
+            if outcome.output_tokens is not None and outcome.sections == sections
+        ] or [
+            outcome.output_tokens
+            for outcome in successes
+            if outcome.output_tokens is not None
+        ]
+        output_tokens: float = (
+            sum(output_tokens_lst) / len(output_tokens_lst)
+            if output_tokens_lst
+            else llm_type.default_config().max_tokens
+        )
+        input_price, output_price = llm_type.price_per_million_tokens()
+        cost_usd: float = (
+            prompt_tokens * input_price + output_tokens * output_price
+        ) / 1_000_000
+        return ModelEstimate(
+            llm_type=llm_type,
+            latency_seconds=latency_seconds / success_rate,
+            cost_usd=cost_usd / success_rate,
+            success_rate=success_rate,
+            output_tokens=output_tokens,
+            samples=len(outcomes),
+        )
+
+    def route(
+        self,
+        policy: RoutingPolicy,
+        candidates: list[LLMType],
+        prompt_tokens: int,
+        content_lst: list[Content],
+        latency_slo_seconds: float = ROUTING_LATENCY_SLO_SECONDS,
+    ) -> RoutingDecision:
+        """Picks the model of a chunk among the candidates, and logs the decision with the estimates of every candidate.
+
+        Args:
+            policy (RoutingPolicy): What the choice minimises.
+            candidates (list[LLMType]): The models that fit the chunk, in order of preference among equal estimates.
+            prompt_tokens (int): The tokens of the request.
+            content_lst (list[Content]): The sections requested.
+            latency_slo_seconds (float, optional): The latency that `COST_UNDER_SLO` has to meet. Defaults to ROUTING_LATENCY_SLO_SECONDS.
+
+        Returns:
+            RoutingDecision: The chosen model and why.
+        """
+        estimates: list[ModelEstimate] = [
+            self.estimate(
+                llm_type=llm_type, prompt_tokens=prompt_tokens, content_lst=content_lst
+            )
+            for llm_type in candidates
+        ]
+        fastest: ModelEstimate = min(
+            estimates,
+            key=lambda estimate: (estimate.latency_seconds, estimate.cost_usd),
+        )
+        cheapest: ModelEstimate = min(
+            estimates,
+            key=lambda estimate: (estimate.cost_usd, estimate.latency_seconds),
+        )
+        match policy:
+            case RoutingPolicy.MIN_LATENCY:
+                chosen, reason = fastest, "lowest expected latency"
+            case RoutingPolicy.MIN_COST:
+                chosen, reason = cheapest, "lowest expected cost"
+            case RoutingPolicy.COST_UNDER_SLO:
+                within_slo: list[ModelEstimate] = [
+                    estimate
+                    for estimate in estimates
+                    if estimate.latency_seconds <= latency_slo_seconds
+                ]
+                if within_slo:
+                    chosen = min(
+                        within_slo,
+                        key=lambda estimate: (
+                            estimate.cost_usd,
+                            estimate.latency_seconds,
+                        ),
+                    )
+                    reason = f"lowest expected cost within {latency_slo_seconds:g}s"
+                else:
+                    chosen = fastest
+                    reason = f"no model expected within {latency_slo_seconds:g}s, lowest expected latency"
+
+        decision = RoutingDecision(
+            llm_type=chosen.llm_type,
+            policy=policy,
+            reason=reason,
+            prompt_tokens=prompt_tokens,
+            sections=sections_key(content_lst),
+            estimates=estimates,
+        )
+        metrics.increment(
+            "llm_routing_decisions", policy=policy.value, model=chosen.llm_type.value
+        )
+        routing_decision_log.info(
+            json.dumps({"timestamp": time.time(), **decision.to_dict()})
+        )
+        return decision
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns the recorded calls, success rate and latency of every model that has been called."""
+        snapshot: dict[str, Any] = {}
+        for llm_type, outcomes in self._outcomes.items():
+            estimate: ModelEstimate = self.estimate(
+                llm_type=llm_type, prompt_tokens=0, content_lst=[]
+            )
+            snapshot[llm_type.value] = {
+                "calls": len(outcomes),
+                "success_rate": estimate.success_rate,
+                "latency_seconds": estimate.latency_seconds,
+            }
+        return snapshot
+
+
+llm_router = Router()
@@ -0,0 +1,249 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Optional
+
+from app.llm.adaptive import LLM_ADAPTIVE_CONCURRENCY, AIMDController
+from app.llm.model import LLMType
+from app.llm.retry import retry_reason
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Default number of calls in flight at once per provider and per model
+LLM_MAX_IN_FLIGHT_PER_PROVIDER = int(
+    os.environ.get("LLM_MAX_IN_FLIGHT_PER_PROVIDER", 32)
+)
+LLM_MAX_IN_FLIGHT_PER_MODEL = int(os.environ.get("LLM_MAX_IN_FLIGHT_PER_MODEL", 16))
+# Overrides of the defaults, e.g. "openai=64,anthropic=8" and "gpt-4o-mini-2024-07-18=32"
+LLM_PROVIDER_LIMITS = os.environ.get("LLM_PROVIDER_LIMITS", "")
+LLM_MODEL_LIMITS = os.environ.get("LLM_MODEL_LIMITS", "")
+
+
+def parse_limits(limits: str) -> dict[str, int]:
+    """Parses limits written as comma-separated `name=limit` pairs."""
+    parsed: dict[str, int] = {}
+    for pair in limits.split(","):
+        if not pair.strip():
+            continue
+        name, _, limit = pair.partition("=")
+        try:
+            parsed[name.strip()] = int(limit)
+        except ValueError:
+            log.error(f"Ignoring invalid limit {pair!r}")
+    return parsed
+
+
+class PriorityLimiter:
+    """Limits the number of callers holding a slot at once. Waiting callers are served highest priority first, and in arrival order among equal priorities."""
+
+    _limit: int
+    _labels: dict[str, Any]
+    _in_flight: int
+    _waiters: list[tuple[float, int, asyncio.Future]]
+    _counter: itertools.count
+
+    def __init__(self, limit: int, **labels: Any):
+        self._limit = limit
+        self._labels = labels
+        self._in_flight = 0
+        self._waiters = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: float = 0):
+        """Waits until a slot is free and takes it."""
+        if self._in_flight < self._limit and not self.queue_depth:
+            self._in_flight += 1
+            self._export()
+            return
+
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, next(self._counter), future))
+        self._export()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            self._export()
+            raise
+
+    def release(self):
+        """Hands the slot over to the next waiter, or frees it."""
+        if self._in_flight > self._limit:
+            # The limit was lowered while the slot was held
+            self._in_flight -= 1
+            self._export()
+            return
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                self._export()
+                return
+        self._in_flight -= 1
+        self._export()
+
+    def set_limit(self, limit: int):
+        """Changes the limit. Raising it dispatches waiters right away, lowering it takes effect as the slots are released."""
+        self._limit = limit
+        while self._in_flight < self._limit and self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._in_flight += 1
+                future.set_result(None)
+        self._export()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _export(self):
+        metrics.set_gauge("llm_queue_depth", self.queue_depth, **self._labels)
+        metrics.set_gauge("llm_in_flight", self._in_flight, **self._labels)
+        metrics.set_gauge("llm_concurrency_limit", self._limit, **self._labels)
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns the state of the limiter for introspection."""
+        return {
+            "limit": self._limit,
+            "in_flight": self._in_flight,
+            "queue_depth": self.queue_depth,
+        }
+
+
+class LLMScheduler:
+    """Schedules the calls to the LLM providers under a limit per provider and a limit per model.
+
+    When a limit is reached, the waiting calls are dispatched largest first, so that the slowest chunk of a request starts as early as possible. If adaptive concurrency is turned on, the limit of each model moves between 1 and its configured limit under an AIMD controller, driven by the rate limits, timeouts and latency of its calls.
+    """
+
+    _provider_limits: dict[str, int]
+    _model_limits: dict[str, int]
+    _default_provider_limit: int
+    _default_model_limit: int
+    _adaptive: bool
+    _limiters: dict[str, PriorityLimiter]
+    _controllers: dict[LLMType, AIMDController]
+
+    def __init__(
+        self,
+        provider_limits: Optional[dict[str, int]] = None,
+        model_limits: Optional[dict[str, int]] = None,
+        default_provider_limit: int = LLM_MAX_IN_FLIGHT_PER_PROVIDER,
+        default_model_limit: int = LLM_MAX_IN_FLIGHT_PER_MODEL,
+        adaptive: bool = LLM_ADAPTIVE_CONCURRENCY,
+    ):
+        self._provider_limits = (
+            provider_limits
+            if provider_limits is not None
+            else parse_limits(LLM_PROVIDER_LIMITS)
+        )
+        self._model_limits = (
+            model_limits if model_limits is not None else parse_limits(LLM_MODEL_LIMITS)
+        )
+        self._default_provider_limit = default_provider_limit
+        self._default_model_limit = default_model_limit
+        self._adaptive = adaptive
+        self._limiters = {}
+        self._controllers = {}
+
+    def _limiter(self, kind: str, name: str) -> PriorityLimiter:
+        key: str = f"{kind}:{name}"
+        limiter: Optional[PriorityLimiter] = self._limiters.get(key)
+        if limiter is None:
+            if kind == "provider":
+                limit = self._provider_limits.get(name, self._default_provider_limit)
+            else:
+                limit = self._model_limits.get(name, self._default_model_limit)
+            limiter = PriorityLimiter(limit=limit, **{kind: name})
+            self._limiters[key] = limiter
+        return limiter
+
+    def _controller(self, llm_type: LLMType) -> Optional[AIMDController]:
+        if not self._adaptive:
+            return None
+        controller: Optional[AIMDController] = self._controllers.get(llm_type)
+        if controller is None:
+            model_limiter: PriorityLimiter = self._limiter("model", llm_type.value)
+            controller = AIMDController(max_limit=model_limiter.limit)
+            model_limiter.set_limit(controller.limit)
+            self._controllers[llm_type] = controller
+        return controller
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        llm_type: LLMType,
+        priority: float = 0,
+        prompt_tokens: Optional[int] = None,
+    ) -> AsyncIterator[None]:
+        """Holds a slot of the model and of its provider for the duration of a call.
+
+        Args:
+            llm_type (LLMType): The model to be called.
+            priority (float, optional): The size of the call. Larger calls are dispatched first. Defaults to 0.
+            prompt_tokens (Optional[int], optional): The prompt tokens of the call, which its latency is judged against. Defaults to None.
+        """
+        controller: Optional[AIMDController] = self._controller(llm_type)
+        model_limiter: PriorityLimiter = self._limiter("model", llm_type.value)
+        provider_limiter: PriorityLimiter = self._limiter(
+            "provider", llm_type.provider().value
+        )
+        start: float = time.perf_counter()
+        # The model slot is always taken before the provider slot, so that the two limits cannot deadlock
+        await model_limiter.acquire(priority=priority)
+        try:
+            await provider_limiter.acquire(priority=priority)
+        except BaseException:
+            model_limiter.release()
+            raise
+        metrics.observe(
+            "llm_queue_wait_seconds", time.perf_counter() - start, model=llm_type.value
+        )
+        started_at: float = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            reason: Optional[str] = retry_reason(e)
+            if controller and reason in ("rate_limit", "timeout"):
+                controller.on_congestion(reason=reason, started_at=started_at)
+                model_limiter.set_limit(controller.limit)
+            raise
+        else:
+            if controller:
+                controller.on_success(
+                    latency_seconds=time.monotonic() - started_at,
+                    started_at=started_at,
+                    prompt_tokens=prompt_tokens,
+                )
+                model_limiter.set_limit(controller.limit)
+        finally:
+            provider_limiter.release()
+            model_limiter.release()
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns the limits, load and adaptive state of every provider and model that has been called."""
+        snapshot: dict[str, Any] = {"providers": {}, "models": {}}
+        for key, limiter in self._limiters.items():
+            kind, _, name = key.partition(":")
+            snapshot[f"{kind}s"][name] = limiter.snapshot()
+        for llm_type, controller in self._controllers.items():
+            snapshot["models"][llm_type.value]["adaptive"] = controller.snapshot()
+        return snapshot
+
+
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,137 @@
+import json
+from enum import StrEnum
+from typing import Any, Callable, Optional
+
+
+class _State(StrEnum):
+    START = "start"
+    KEY = "key"
+    COLON = "colon"
+    VALUE = "value"
+    NEXT = "next"
+    DONE = "done"
+
+
+class IncrementalJSONParser:
+    """Parses a JSON object that arrives in pieces, e.g. the arguments of a streamed function call, and reports every top-level field as soon as its value is complete.
+
+    Every character is scanned once, and every field value is decoded once when it completes, so parsing the whole object stays linear in its length however it is split.
+    """
+
+    _on_field: Optional[Callable[[str, Any], None]]
+    _text: str
+    _position: int
+    _state: _State
+    _depth: int
+    _in_string: bool
+    _escape: bool
+    _start: Optional[int]
+    _key: Optional[str]
+    fields: dict[str, Any]
+
+    def __init__(self, on_field: Optional[Callable[[str, Any], None]] = None):
+        self._on_field = on_field
+        self._text = ""
+        self._position = 0
+        self._state = _State.START
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._start = None
+        self._key = None
+        self.fields = {}
+
+    def feed(self, text: str):
+        """Parses the next piece of the object, and reports the fields completed by it.
+
+        Raises:
+            json.JSONDecodeError: If the object is not valid JSON.
+        """
+        self._text += text
+        while self._position < len(self._text):
+            self._scan(self._text[self._position])
+            self._position += 1
+
+    def result(self) -> dict[str, Any]:
+        """Returns the whole object.
+
+        Raises:
+            json.JSONDecodeError: If the object is incomplete or not valid JSON.
+        """
+        return json.loads(self._text)
+
+    def _scan(self, char: str):
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                if self._depth == 1 and self._state == _State.KEY:
+                    self._key = json.loads(self._text[self._start : self._position + 1])
+                    self._state = _State.COLON
+                elif self._depth == 1 and self._state == _State.VALUE:
+                    self._complete(end=self._position + 1, state=_State.NEXT)
+            return
+        if char.isspace():
+            return
+
+        match self._state:
+            case _State.START:
+                self._expect(char, "{")
+                self._depth = 1
+                self._state = _State.KEY
+            case _State.KEY:
+                if char == "}":
+                    self._depth = 0
+                    self._state = _State.DONE
+                else:
+                    self._expect(char, '"')
+                    self._in_string = True
+                    self._start = self._position
+            case _State.COLON:
+                self._expect(char, ":")
+                self._state = _State.VALUE
+                self._start = None
+            case _State.VALUE:
+                if self._start is None:
+                    self._start = self._position
+                if char == '"':
+                    self._in_string = True
+                elif char in "{[":
+                    self._depth += 1
+                elif char in "}]" and self._depth == 1:
+                    # The end of the object also ends a number, boolean or null
+                    self._complete(end=self._position, state=_State.DONE)
+                    self._depth = 0
+                elif char in "}]":
+                    self._depth -= 1
+                    if self._depth == 1:
+                        self._complete(end=self._position + 1, state=_State.NEXT)
+                elif char == "," and self._depth == 1:
+                    self._complete(end=self._position, state=_State.KEY)
+            case _State.NEXT:
+                if char == ",":
+                    self._state = _State.KEY
+                else:
+                    self._expect(char, "}")
+                    self._depth = 0
+                    self._state = _State.DONE
+            case _State.DONE:
+                self._expect(char, "")
+
+    def _complete(self, end: int, state: _State):
+        value: Any = json.loads(self._text[self._start : end])
+        self.fields[self._key] = value
+        self._state = state
+        if self._on_field is not None:
+            self._on_field(self._key, value)
+
+    def _expect(self, char: str, expected: str):
+        if char != expected:
+            raise json.JSONDecodeError(
+                f"Expecting {expected!r}" if expected else "Extra data",
+                self._text,
+                self._position,
+            )
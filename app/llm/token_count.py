@@ -0,0 +1,158 @@
+import json
+import logging
+import math
+import os
+from dataclasses import dataclass
+from enum import StrEnum
+
+from app.llm.tokenizer import Tokenizer, TokenizerType, get_tokenizer
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Conservative defaults used until the estimator is calibrated against a loaded tokenizer.
+DEFAULT_BYTES_PER_TOKEN = 3.0
+DEFAULT_RELATIVE_ERROR = 0.5
+# Slack added to every estimate, which dominates the error of very short messages (e.g. "Hi").
+ABSOLUTE_ERROR_TOKENS = 4
+# The relative error measured during calibration is widened by this factor before it is used as a bound.
+CALIBRATION_SAFETY_MARGIN = 1.5
+
+# Representative message bodies used to calibrate the estimator: prose, code, markdown, stack traces and non-ASCII text.
+CALIBRATION_SAMPLES: list[str] = [
+    "Can you explain why my FastAPI endpoint returns a 422 error when I send a JSON body? I have defined a pydantic model for the request and I am sending all the fields as far as I can tell.",
+    "The 422 status code means that the request body failed validation. FastAPI validates the body against your pydantic model before calling the endpoint, so a missing field, a wrong type or an extra nesting level will all be rejected. Check the `detail` field of the response, which lists every field that failed along with the reason.",
+    "def split(conversation: dict[str, str], limit: int) -> list[dict[str, str]]:\n    chunks = [{}]\n    size = 0\n    for key, value in conversation.items():\n        if size + len(value) > limit:\n            chunks.append({})\n            size = 0\n        chunks[-1][key] = value\n        size += len(value)\n    return chunks\n",
+    "```typescript\nexport async function fetchNotes(id: string): Promise<Note[]> {\n  const response = await fetch(`/api/notes/${id}`, { headers: { 'Content-Type': 'application/json' } });\n  if (!response.ok) {\n    throw new Error(`Request failed with status ${response.status}`);\n  }\n  return (await response.json()) as Note[];\n}\n```",
+    'Traceback (most recent call last):\n  File "/app/main.py", line 42, in generate_notes\n    result, token_sum = await generate(conversation=input.conversation)\n  File "/app/scripts/generate.py", line 87, in generate\n    raise InferenceFailure("Failed to post-process remaining 2 conversations after 5 attempts.")\napp.exceptions.exception.InferenceFailure: 500: Failed to post-process remaining 2 conversations',
+    "## Summary\n\n1. **Indexes** speed up reads at the cost of slower writes.\n2. A *composite index* on `(user_id, created_at)` serves queries filtering on `user_id` and sorting by `created_at`.\n3. Use `EXPLAIN ANALYZE` to confirm that the planner actually uses the index.\n\n| Query | Before | After |\n|-------|--------|-------|\n| list notes | 1.2s | 8ms |",
+    "SELECT n.id, n.topic, COUNT(c.id) AS concept_count FROM notes n LEFT JOIN key_concepts c ON c.note_id = n.id WHERE n.user_id = $1 AND n.created_at > NOW() - INTERVAL '7 days' GROUP BY n.id, n.topic ORDER BY concept_count DESC LIMIT 20;",
+    "Das Ergebnis ist korrekt, aber die Komplexität beträgt O(n²). Mit einem Wörterbuch lässt sich die Suche auf O(n) reduzieren. 使用字典可以把查找降到线性时间。",
+]
+
+
+class TokenCountMode(StrEnum):
+    # Every message is tokenized
+    EXACT = "exact"
+    # Messages are estimated and only those close to a split point or the hard cap are tokenized
+    APPROXIMATE = "approximate"
+
+
+# The estimators are calibrated on the few CALIBRATION_SAMPLES only, so approximate counting is opt-in until they are checked against real traffic
+TOKEN_COUNT_MODE = TokenCountMode(
+    os.environ.get("TOKEN_COUNT_MODE", TokenCountMode.EXACT)
+)
+
+
+@dataclass(frozen=True)
+class TokenCount:
+    """A token count which is either exact (error of 0) or an estimate within +/- `error` tokens of the real count."""
+
+    tokens: int
+    error: int = 0
+
+    @property
+    def is_exact(self) -> bool:
+        return self.error == 0
+
+    @property
+    def low(self) -> int:
+        return max(0, self.tokens - self.error)
+
+    @property
+    def high(self) -> int:
+        return self.tokens + self.error
+
+    def __add__(self, other: "TokenCount") -> "TokenCount":
+        return TokenCount(
+            tokens=self.tokens + other.tokens, error=self.error + other.error
+        )
+
+
+class TokenEstimator:
+    """Estimates token counts from the UTF-8 byte length of a text.
+
+    The estimate of a text is within `relative_error * estimate + ABSOLUTE_ERROR_TOKENS` of the real count for text that
+    resembles the calibration samples.
+    """
+
+    _bytes_per_token: float
+    _relative_error: float
+
+    def __init__(
+        self,
+        bytes_per_token: float = DEFAULT_BYTES_PER_TOKEN,
+        relative_error: float = DEFAULT_RELATIVE_ERROR,
+    ):
+        if bytes_per_token <= 0:
+            raise ValueError("Bytes per token must be positive.")
+        self._bytes_per_token = bytes_per_token
+        self._relative_error = relative_error
+
+    @property
+    def bytes_per_token(self) -> float:
+        return self._bytes_per_token
+
+    @property
+    def relative_error(self) -> float:
+        return self._relative_error
+
+    def estimate(self, text: str) -> TokenCount:
+        """Returns the estimated token count of the text along with its error bound."""
+        tokens: int = round(len(text.encode("utf-8")) / self._bytes_per_token)
+        error: int = math.ceil(tokens * self._relative_error) + ABSOLUTE_ERROR_TOKENS
+        return TokenCount(tokens=tokens, error=error)
+
+    @classmethod
+    def calibrate(
+        cls, tokenizer: Tokenizer, samples: list[str] = CALIBRATION_SAMPLES
+    ) -> "TokenEstimator":
+        """Fits the bytes-per-token ratio against the tokenizer and measures the worst relative error over the samples.
+
+        Args:
+            tokenizer (Tokenizer): The tokenizer whose counts are being estimated.
+            samples (list[str], optional): The texts to calibrate on. Defaults to CALIBRATION_SAMPLES.
+
+        Returns:
+            TokenEstimator: The calibrated estimator.
+        """
+        token_counts: list[int] = tokenizer.count_tokens_batch(samples)
+        byte_counts: list[int] = [len(sample.encode("utf-8")) for sample in samples]
+        bytes_per_token: float = sum(byte_counts) / max(1, sum(token_counts))
+        worst_relative_error: float = max(
+            abs(byte_count / bytes_per_token - token_count) / max(1, token_count)
+            for byte_count, token_count in zip(byte_counts, token_counts)
+        )
+        relative_error: float = worst_relative_error * CALIBRATION_SAFETY_MARGIN
+
+        metrics.set_gauge(
+            "token_estimator_bytes_per_token", bytes_per_token, tokenizer=tokenizer.name
+        )
+        metrics.set_gauge(
+            "token_estimator_relative_error", relative_error, tokenizer=tokenizer.name
+        )
+        log.info(
+            f"Calibrated token estimator for {tokenizer.name}: {bytes_per_token:.2f} bytes per token, error bound of {relative_error:.0%} + {ABSOLUTE_ERROR_TOKENS} tokens"
+        )
+        return cls(bytes_per_token=bytes_per_token, relative_error=relative_error)
+
+
+_token_estimators: dict[str, TokenEstimator] = {}
+
+
+def get_token_estimator(tokenizer: Tokenizer) -> TokenEstimator:
+    """Returns the estimator calibrated against the tokenizer, or a conservative default one if it is not calibrated yet."""
+    return _token_estimators.get(tokenizer.name) or TokenEstimator()
+
+
+def calibrate_token_estimators(tokenizer_types: list[TokenizerType]):
+    """Calibrates the process-wide estimators against the tokenizers of the given types. Called once at application startup.
+
+    Messages are tokenized in their JSON-encoded form, so the estimators are calibrated on the same representation.
+    """
+    for tokenizer_type in tokenizer_types:
+        tokenizer: Tokenizer = get_tokenizer(tokenizer_type=tokenizer_type)
+        _token_estimators[tokenizer.name] = TokenEstimator.calibrate(
+            tokenizer=tokenizer,
+            samples=[json.dumps(sample) for sample in CALIBRATION_SAMPLES],
+        )
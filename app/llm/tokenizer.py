@@ -0,0 +1,368 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import StrEnum
+from typing import Optional
+
+import tiktoken
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
+
+from app.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Hugging Face hub repository the CodeLlama tokenizer files are downloaded from
+CODELLAMA_TOKENIZER_REPO = "codellama/CodeLlama-7b-Instruct-hf"
+# Local directory containing the CodeLlama tokenizer files (tokenizer.json, tokenizer_config.json, special_tokens_map.json).
+# If left unset, the tokenizer is resolved from the local Hugging Face cache. The hub is never contacted in either case.
+CODELLAMA_TOKENIZER_PATH = (
+    os.environ.get("CODELLAMA_TOKENIZER_PATH") or CODELLAMA_TOKENIZER_REPO
+)
+# Number of dedicated threads running tokenizer batches. The fast tokenizer releases the GIL while encoding.
+TOKENIZER_WORKERS = int(os.environ.get("TOKENIZER_WORKERS", 2))
+# Upper bound on the characters sent to the tokenizer in one call, so that one large conversation cannot hold a worker for long.
+TOKENIZER_MAX_BATCH_CHARS = int(os.environ.get("TOKENIZER_MAX_BATCH_CHARS", 200_000))
+
+
+def _rss_bytes() -> int:
+    """Returns the resident set size of the current process in bytes, or 0 if it cannot be determined."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class TokenizerType(StrEnum):
+    CODELLAMA = "codellama"
+    O200K_BASE = "o200k_base"
+    CL100K_BASE = "cl100k_base"
+
+
+class Tokenizer(ABC):
+    """Process-wide tokenizer service that loads the tokenizer once and reuses it for every token count."""
+
+    _name: str
+    _lock: threading.Lock
+    _is_loaded: bool
+
+    def __init__(self, name: str):
+        self._name = name
+        self._lock = threading.Lock()
+        self._is_loaded = False
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._is_loaded
+
+    def load(self):
+        """Loads the tokenizer from local files only. Subsequent calls are no-ops.
+
+        The load time and the growth of the process memory caused by the load are exported as metrics.
+        """
+        if self._is_loaded:
+            return
+        with self._lock:
+            if self._is_loaded:
+                return
+            rss_before: int = _rss_bytes()
+            start: float = time.perf_counter()
+            try:
+                self._load()
+            except Exception as e:
+                log.error(
+                    f"Error loading tokenizer {self._name}. Make sure the tokenizer files are available locally: {e}"
+                )
+                raise e
+            load_seconds: float = time.perf_counter() - start
+            memory_bytes: int = max(0, _rss_bytes() - rss_before)
+            self._is_loaded = True
+
+        metrics.set_gauge("tokenizer_load_seconds", load_seconds, tokenizer=self._name)
+        metrics.set_gauge("tokenizer_memory_bytes", memory_bytes, tokenizer=self._name)
+        log.info(
+            f"Loaded tokenizer {self._name} in {load_seconds:.3f}s using {memory_bytes / 1e6:.1f}MB"
+        )
+
+    def count_tokens(self, text: str) -> int:
+        """Returns the number of tokens in the text, excluding special tokens."""
+        return self.count_tokens_batch([text])[0]
+
+    def count_tokens_batch(self, texts: list[str]) -> list[int]:
+        """Returns the number of tokens in each text, excluding special tokens, using a single batched tokenizer call."""
+        self.load()
+        if not texts:
+            return []
+        return self._count_tokens_batch(texts)
+
+    @abstractmethod
+    def _load(self):
+        """Loads the underlying tokenizer. Only called once."""
+        pass
+
+    @abstractmethod
+    def _count_tokens_batch(self, texts: list[str]) -> list[int]:
+        """Tokenizes a non-empty batch of texts with the loaded tokenizer."""
+        pass
+
+
+class HuggingFaceTokenizer(Tokenizer):
+    """Tokenizer loaded with `transformers` from a local directory or the local Hugging Face cache."""
+
+    _path: str
+    _download_hint: Optional[str]
+    _tokenizer: Optional[PreTrainedTokenizerBase]
+
+    def __init__(self, name: str, path: str, download_hint: Optional[str] = None):
+        """
+        Args:
+            name (str): The name of the tokenizer, used in logs and metrics.
+            path (str): The local directory of the tokenizer files, or a hub repository id resolved from the local Hugging Face cache.
+            download_hint (Optional[str], optional): How to make the tokenizer files available locally, added to the error raised when they are missing. Defaults to None.
+        """
+        super().__init__(name=name)
+        self._path = path
+        self._download_hint = download_hint
+        self._tokenizer = None
+
+    def _load(self):
+        try:
+            self._tokenizer = AutoTokenizer.from_pretrained(
+                self._path, local_files_only=True
+            )
+        except OSError as e:
+            # transformers reports missing files as a failed connection to the hub, which is never contacted here
+            message: str = (
+                f"Tokenizer files of {self._name} were not found in {self._path} or in the local Hugging Face cache."
+            )
+            if self._download_hint:
+                message = f"{message} {self._download_hint}"
+            raise OSError(message) from e
+
+    def _count_tokens_batch(self, texts: list[str]) -> list[int]:
+        return [
+            len(input_ids)
+            for input_ids in self._tokenizer(texts, add_special_tokens=False)[
+                "input_ids"
+            ]
+        ]
+
+
+class TiktokenTokenizer(Tokenizer):
+    """Tokenizer backed by a tiktoken encoding, as used by the OpenAI models.
+
+    The encoding files are read from TIKTOKEN_CACHE_DIR when it is set, which keeps the service offline.
+    """
+
+    _encoding_name: str
+    _fallback_encoding_name: Optional[str]
+    _encoding: Optional[tiktoken.Encoding]
+
+    def __init__(
+        self,
+        name: str,
+        encoding_name: str,
+        fallback_encoding_name: Optional[str] = None,
+    ):
+        super().__init__(name=name)
+        self._encoding_name = encoding_name
+        self._fallback_encoding_name = fallback_encoding_name
+        self._encoding = None
+
+    def _load(self):
+        try:
+            self._encoding = tiktoken.get_encoding(self._encoding_name)
+        except ValueError as e:
+            if not self._fallback_encoding_name:
+                raise e
+            # Older versions of tiktoken do not ship every encoding. The fallback encoding produces more tokens for the
+            # same text, so the budgets computed with it stay on the safe side.
+            log.warning(
+                f"Encoding {self._encoding_name} is not available, falling back to {self._fallback_encoding_name}: {e}"
+            )
+            self._encoding = tiktoken.get_encoding(self._fallback_encoding_name)
+
+    def _count_tokens_batch(self, texts: list[str]) -> list[int]:
+        return [len(tokens) for tokens in self._encoding.encode_ordinary_batch(texts)]
+
+
+@dataclass
+class _CountJob:
+    """The texts of one `count_tokens` call and the future that resolves to their token counts."""
+
+    texts: list[str]
+    future: asyncio.Future
+    counts: list[Optional[int]] = field(default_factory=list)
+    next_index: int = 0
+    remaining: int = 0
+
+
+class BatchTokenizer:
+    """Counts tokens on a dedicated worker pool, coalescing the texts of concurrent callers into batched tokenizer calls.
+
+    Texts are taken from the pending jobs in a round-robin fashion, so that the messages of a small request are tokenized
+    in the next batch even while a large conversation is still being processed.
+    """
+
+    _tokenizer: Tokenizer
+    _workers: int
+    _max_batch_chars: int
+    _executor: Optional[ThreadPoolExecutor]
+    _pending: deque[_CountJob]
+    _in_flight: int
+
+    def __init__(self, tokenizer: Tokenizer, workers: int, max_batch_chars: int):
+        self._tokenizer = tokenizer
+        self._workers = workers
+        self._max_batch_chars = max_batch_chars
+        self._executor = None
+        self._pending = deque()
+        self._in_flight = 0
+
+    @property
+    def tokenizer(self) -> Tokenizer:
+        return self._tokenizer
+
+    async def count_tokens(self, texts: list[str]) -> list[int]:
+        """Returns the number of tokens in each text without blocking the event loop.
+
+        Args:
+            texts (list[str]): The texts to be tokenized.
+
+        Returns:
+            list[int]: The token count of each text, in the same order as the texts.
+        """
+        if not texts:
+            return []
+        job = _CountJob(
+            texts=texts,
+            future=asyncio.get_running_loop().create_future(),
+            counts=[None] * len(texts),
+            remaining=len(texts),
+        )
+        self._pending.append(job)
+        metrics.set_gauge("tokenizer_pending_jobs", len(self._pending))
+        self._dispatch()
+        return await job.future
+
+    def _dispatch(self):
+        """Submits batches of pending texts to the worker pool until every worker is busy."""
+        loop = asyncio.get_running_loop()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._workers, thread_name_prefix="tokenizer"
+            )
+        while self._pending and self._in_flight < self._workers:
+            batch: list[tuple[_CountJob, int]] = self._take_batch()
+            self._in_flight += 1
+            future = loop.run_in_executor(
+                self._executor,
+                self._tokenizer.count_tokens_batch,
+                [job.texts[index] for job, index in batch],
+            )
+            future.add_done_callback(
+                lambda future, batch=batch: self._complete(batch=batch, future=future)
+            )
+        metrics.set_gauge("tokenizer_pending_jobs", len(self._pending))
+
+    def _take_batch(self) -> list[tuple[_CountJob, int]]:
+        """Takes texts from the pending jobs in a round-robin fashion until the batch reaches the character limit."""
+        batch: list[tuple[_CountJob, int]] = []
+        batch_chars: int = 0
+        while self._pending:
+            job: _CountJob = self._pending.popleft()
+            if job.future.done():
+                # The caller was cancelled or the job already failed, so its remaining texts are dropped.
+                continue
+            text_chars: int = len(job.texts[job.next_index])
+            if batch and batch_chars + text_chars > self._max_batch_chars:
+                self._pending.appendleft(job)
+                break
+            batch.append((job, job.next_index))
+            batch_chars += text_chars
+            job.next_index += 1
+            if job.next_index < len(job.texts):
+                self._pending.append(job)
+        return batch
+
+    def _complete(self, batch: list[tuple[_CountJob, int]], future: asyncio.Future):
+        """Distributes the token counts of a finished batch to the jobs they belong to."""
+        self._in_flight -= 1
+        exception: Optional[BaseException] = (
+            future.exception() if not future.cancelled() else asyncio.CancelledError()
+        )
+        if exception is not None:
+            log.error(f"Error tokenizing batch of {len(batch)} texts: {exception}")
+        counts: list[int] = future.result() if exception is None else []
+        for position, (job, index) in enumerate(batch):
+            if job.future.done():
+                continue
+            if exception is not None:
+                job.future.set_exception(exception)
+                continue
+            job.counts[index] = counts[position]
+            job.remaining -= 1
+            if job.remaining == 0:
+                job.future.set_result(job.counts)
+        if exception is not None:
+            self._pending = deque(job for job in self._pending if not job.future.done())
+        metrics.increment("tokenizer_batches")
+        metrics.observe("tokenizer_batch_size", len(batch))
+        self._dispatch()
+
+
+_tokenizers: dict[TokenizerType, Tokenizer] = {
+    TokenizerType.CODELLAMA: HuggingFaceTokenizer(
+        name=TokenizerType.CODELLAMA.value,
+        path=CODELLAMA_TOKENIZER_PATH,
+        download_hint=(
+            f"Download them with `huggingface-cli download {CODELLAMA_TOKENIZER_REPO} tokenizer.json tokenizer_config.json "
+            f"special_tokens_map.json --local-dir <directory>` and set CODELLAMA_TOKENIZER_PATH to the directory."
+        ),
+    ),
+    TokenizerType.O200K_BASE: TiktokenTokenizer(
+        name=TokenizerType.O200K_BASE.value,
+        encoding_name=TokenizerType.O200K_BASE.value,
+        fallback_encoding_name=TokenizerType.CL100K_BASE.value,
+    ),
+    TokenizerType.CL100K_BASE: TiktokenTokenizer(
+        name=TokenizerType.CL100K_BASE.value,
+        encoding_name=TokenizerType.CL100K_BASE.value,
+    ),
+}
+_batch_tokenizers: dict[TokenizerType, BatchTokenizer] = {
+    tokenizer_type: BatchTokenizer(
+        tokenizer=tokenizer,
+        workers=TOKENIZER_WORKERS,
+        max_batch_chars=TOKENIZER_MAX_BATCH_CHARS,
+    )
+    for tokenizer_type, tokenizer in _tokenizers.items()
+}
+
+
+def get_tokenizer(tokenizer_type: TokenizerType = TokenizerType.CODELLAMA) -> Tokenizer:
+    """Returns the process-wide tokenizer of the given type."""
+    return _tokenizers[tokenizer_type]
+
+
+def get_batch_tokenizer(
+    tokenizer_type: TokenizerType = TokenizerType.CODELLAMA,
+) -> BatchTokenizer:
+    """Returns the process-wide batched tokenizer of the given type, used to count tokens from async code."""
+    return _batch_tokenizers[tokenizer_type]
+
+
+def load_tokenizers(tokenizer_types: list[TokenizerType]):
+    """Eagerly loads the process-wide tokenizers of the given types. Called once at application startup."""
+    for tokenizer_type in tokenizer_types:
+        _tokenizers[tokenizer_type].load()
@@ -0,0 +1,42 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+
+@dataclass
+class Usage:
+    """The tokens reported by the provider for the calls made within a `track_usage` block."""
+
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Whether any call in the block reported its usage
+    reported: bool = False
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+_current_usage: ContextVar[Optional[Usage]] = ContextVar("llm_usage", default=None)
+
+
+@contextmanager
+def track_usage() -> Iterator[Usage]:
+    """Collects the usage reported by the provider clients called within the block, in the current task."""
+    usage = Usage()
+    token = _current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _current_usage.reset(token)
+
+
+def record_usage(prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    """Reports the usage of a provider call to the enclosing `track_usage` block, if any."""
+    usage: Optional[Usage] = _current_usage.get()
+    if usage is None:
+        return
+    usage.prompt_tokens += prompt_tokens or 0
+    usage.completion_tokens += completion_tokens or 0
+    usage.reported = True
@@ -1,46 +1,290 @@
+import asyncio
+import hashlib
+import json
 import logging
+import os
+from contextlib import asynccontextmanager, suppress
+from typing import Any, AsyncIterator, Coroutine, Optional, TypeVar
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
-from app.exceptions.exception import InferenceFailure, LogicError
-from app.models.inference import InferenceInput
+from app.cache.idempotency import (
+    IdempotentExecutor,
+    IdempotentResponse,
+    close_idempotent_executor,
+    get_idempotent_executor,
+    open_idempotent_executor,
+)
+from app.cache.notes import close_notes_caches, open_notes_caches
+from app.config import InferenceConfig
+from app.exceptions.exception import DeadlineExceeded, InferenceFailure, LogicError
+from app.llm.circuit_breaker import llm_circuit_breakers
+from app.llm.deadline import Deadline
+from app.llm.hedging import llm_hedger
+from app.llm.rate_limit import llm_rate_limiter
+from app.llm.registry import close_client_registry, open_client_registry
+from app.llm.router import llm_router
+from app.llm.scheduler import llm_scheduler
+from app.llm.token_count import TokenCount, calibrate_token_estimators
+from app.llm.tokenizer import load_tokenizers
+from app.metrics import metrics
 from app.models.content import Content
-from app.scripts.generate import generate
+from app.models.inference import InferenceInput
+from app.scripts.generate import (
+    ChunkResult,
+    generate,
+    generate_partial,
+    stream_generate,
+)
 
 log = logging.getLogger(__name__)
 
-app = FastAPI()
+T = TypeVar("T")
+
+# How often a request checks whether its client is still connected
+CLIENT_DISCONNECT_POLL_SECONDS = float(
+    os.environ.get("CLIENT_DISCONNECT_POLL_SECONDS", 1)
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Loads the process-wide resources once before the first request is served, and releases them on shutdown."""
+    config = InferenceConfig()
+    tokenizer_types = [
+        llm_type.tokenizer_type()
+        for llm_type in (
+            config.llm_type,
+            config.hedge_llm_type,
+            *config.fallback_llm_types,
+            *config.routing_llm_types,
+        )
+        if llm_type is not None
+    ]
+    load_tokenizers(tokenizer_types=tokenizer_types)
+    calibrate_token_estimators(tokenizer_types=tokenizer_types)
+    open_client_registry()
+    open_notes_caches()
+    idempotent_executor: IdempotentExecutor = open_idempotent_executor()
+    compaction = asyncio.create_task(idempotent_executor.compact_periodically())
+    yield
+    compaction.cancel()
+    with suppress(asyncio.CancelledError):
+        await compaction
+    close_idempotent_executor()
+    await close_notes_caches()
+    await close_client_registry()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/api/metrics")
+async def get_metrics() -> JSONResponse:
+    """Returns a snapshot of the in-process metrics."""
+    return JSONResponse(status_code=200, content=metrics.snapshot())
+
+
+@app.get("/api/llm/concurrency")
+async def get_llm_concurrency() -> JSONResponse:
+    """Returns the concurrency limit, load and adaptive controller state of every provider and model, the capacity left under their rate limits, their hedged calls, their circuit breakers and the record their routing is based on."""
+    return JSONResponse(
+        status_code=200,
+        content={
+            **llm_scheduler.snapshot(),
+            "rate_limits": llm_rate_limiter.snapshot(),
+            "hedging": llm_hedger.snapshot(),
+            "circuit_breakers": llm_circuit_breakers.snapshot(),
+            "routing": llm_router.snapshot(),
+        },
+    )
+
+
+def _deadline(request_timeout: Optional[float]) -> Deadline:
+    """Returns the deadline of a request, from its Request-Timeout header or the configured default."""
+    return Deadline(
+        timeout_seconds=(
+            request_timeout
+            if request_timeout is not None
+            else InferenceConfig().deadline_seconds
+        )
+    )
+
+
+async def _cancel_on_disconnect(request: Request, coro: Coroutine[Any, Any, T]) -> T:
+    """Runs the coroutine, and cancels it, with every call to the LLM it is waiting for, if the client disconnects before it completes.
+
+    Raises:
+        HTTPException: With status 499 if the client disconnected. Nobody reads the response, the status is only logged.
+    """
+    task: asyncio.Task[T] = asyncio.create_task(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=CLIENT_DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                log.warning(
+                    "Client disconnected. Cancelling the generation of its notes..."
+                )
+                metrics.increment("inference_client_disconnected")
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        task.cancel()
 
 
 @app.post("/api/inference")
-async def generate_notes(input: InferenceInput) -> JSONResponse:
+async def generate_notes(
+    input: InferenceInput,
+    request: Request,
+    idempotency_key: Optional[str] = Header(default=None),
+    request_timeout: Optional[float] = Header(default=None),
+) -> Response:
     """Entrance of the inference pipeline, which generates notes based on the input conversation.
 
     Args:
         input (InferenceInput): The input conversation and tasks to be performed.
+        request (Request): The HTTP request, which is watched for the client disconnecting.
+        idempotency_key (Optional[str], optional): The Idempotency-Key header. A retry with the same key waits for the first request, or gets its stored response, instead of running the inference again. Defaults to None.
+        request_timeout (Optional[float], optional): The Request-Timeout header, in seconds. The calls to the LLM that are still running at the deadline are cancelled and the request fails with status 504. Defaults to None, which falls back to the configured deadline.
 
     Returns:
-       JSONResponse: The generated notes that will be propagated back to Stomach upon successful inference.
+       Response: The generated notes that will be propagated back to Stomach upon successful inference. The Idempotent-Replayed header tells whether they come from an earlier request with the same key. With `partial_results` in the input, the notes of the chunks that succeeded are returned even if others failed or were still running at the deadline, with the status, failure reason and message range of every chunk. Such a response is not replayed to a retry with the same key, which generates the failed chunks again.
     """
+    deadline: Deadline = _deadline(request_timeout=request_timeout)
+    if idempotency_key is None:
+        return await _cancel_on_disconnect(
+            request=request, coro=_generate_notes(input=input, deadline=deadline)
+        )
+
+    # The request keeps running if its client disconnects, so that a retry with the same key gets its response, but not past its deadline
+    async def _run() -> IdempotentResponse:
+        response: JSONResponse = await _generate_notes(input=input, deadline=deadline)
+        return IdempotentResponse(
+            status_code=response.status_code,
+            body=response.body,
+            complete=not json.loads(response.body).get("failed_chunks"),
+        )
+
+    response, replayed = await get_idempotent_executor().run(
+        key=idempotency_key,
+        fingerprint=hashlib.sha256(
+            json.dumps(input.model_dump(), sort_keys=True).encode()
+        ).hexdigest(),
+        fn=_run,
+    )
+    return Response(
+        content=response.body,
+        status_code=response.status_code,
+        media_type="application/json",
+        headers={"Idempotent-Replayed": str(replayed).lower()},
+    )
+
+
+async def _generate_notes(input: InferenceInput, deadline: Deadline) -> JSONResponse:
+    """Runs the inference pipeline on the input and returns the generated notes."""
     try:
         content: list[str] = input.content
         validated_content_lst: list[Content] = Content.validate(content_str_lst=content)
-        result, token_sum = await generate(
+        if input.partial_results:
+            chunk_results, token_sum = await generate_partial(
+                conversation=input.conversation,
+                content_lst=validated_content_lst,
+                deadline=deadline,
+            )
+            return _partial_notes_response(
+                chunk_results=chunk_results, token_sum=token_sum
+            )
+        result, token_sum, cached_chunks = await generate(
             conversation=input.conversation,
-            content_lst=validated_content_lst
+            content_lst=validated_content_lst,
+            deadline=deadline,
         )
         return JSONResponse(
             status_code=200,
-            content={"result": result, "token_sum": token_sum},
+            content={
+                "result": result,
+                "token_sum": token_sum.tokens,
+                "token_sum_error": token_sum.error,
+                "cached_chunks": cached_chunks,
+            },
         )
     except LogicError as e:
         log.error(f"Logic error while trying to generate notes: {str(e)}")
     except InferenceFailure as e:
         log.error(f"Inference failure while trying to generate notes: {str(e)}")
+    except DeadlineExceeded as e:
+        log.error(f"Deadline exceeded while trying to generate notes: {str(e)}")
+        raise e
     except Exception as e:
         log.error(f"Error in generating notes: {str(e)}")
         # Raise exception only when an unexpected error occurs. If not, try to return good results as much as possible.
         raise HTTPException(status_code=500, detail=str(e))
 
     raise HTTPException(status_code=400, detail="Failed to generate notes completely.")
+
+
+def _partial_notes_response(
+    chunk_results: list[ChunkResult], token_sum: TokenCount
+) -> JSONResponse:
+    """Returns the notes of the chunks that succeeded, in order, with the status of every chunk and the failed chunks, whose messages can be sent again on their own."""
+    return JSONResponse(
+        status_code=200,
+        content={
+            "result": [
+                chunk_result.notes
+                for chunk_result in chunk_results
+                if chunk_result.succeeded
+            ],
+            "token_sum": token_sum.tokens,
+            "token_sum_error": token_sum.error,
+            "cached_chunks": [
+                chunk_result.chunk
+                for chunk_result in chunk_results
+                if chunk_result.cached
+            ],
+            "failed_chunks": [
+                chunk_result.chunk
+                for chunk_result in chunk_results
+                if not chunk_result.succeeded
+            ],
+            "chunks": [chunk_result.to_dict() for chunk_result in chunk_results],
+        },
+    )
+
+
+@app.post("/api/inference/stream")
+async def stream_notes(
+    input: InferenceInput, request_timeout: Optional[float] = Header(default=None)
+) -> StreamingResponse:
+    """Streaming variant of the inference pipeline, which sends the notes of every chunk as soon as they are ready instead of waiting for the slowest chunk.
+
+    The chunks are cancelled when the client disconnects, and the ones still running at the deadline are reported as failed.
+
+    Args:
+        input (InferenceInput): The input conversation and tasks to be performed.
+        request_timeout (Optional[float], optional): The Request-Timeout header, in seconds. Defaults to None, which falls back to the configured deadline.
+
+    Returns:
+        StreamingResponse: Newline-delimited JSON events: the progress, retries and notes of the chunks in the order in which they complete, followed by a summary with the token sum of the conversation.
+    """
+    try:
+        validated_content_lst: list[Content] = Content.validate(
+            content_str_lst=input.content
+        )
+    except LogicError as e:
+        log.error(f"Logic error while trying to stream notes: {str(e)}")
+        raise HTTPException(status_code=400, detail=e.detail)
+
+    deadline: Deadline = _deadline(request_timeout=request_timeout)
+
+    async def _events() -> AsyncIterator[str]:
+        async for event in stream_generate(
+            conversation=input.conversation,
+            content_lst=validated_content_lst,
+            deadline=deadline,
+        ):
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(_events(), media_type="application/x-ndjson")
@@ -0,0 +1,90 @@
+import threading
+from collections import defaultdict, deque
+from typing import Any
+
+# Number of most recent observations kept per histogram to compute percentiles.
+HISTOGRAM_WINDOW = 1024
+
+
+def _metric_key(name: str, labels: dict[str, Any]) -> str:
+    """Returns the flat key under which a metric is stored, e.g. `tokenizer_load_seconds{tokenizer=codellama}`."""
+    if not labels:
+        return name
+    label_str: str = ",".join(f"{key}={value}" for key, value in sorted(labels.items()))
+    return f"{name}{{{label_str}}}"
+
+
+def percentile(sorted_values: list[float], percentile: float) -> float:
+    """Returns the nearest-rank percentile of an already sorted list of values."""
+    if not sorted_values:
+        return 0.0
+    index: int = min(
+        len(sorted_values) - 1, max(0, round(percentile / 100 * len(sorted_values)) - 1)
+    )
+    return sorted_values[index]
+
+
+class Metrics:
+    """In-process registry of counters, gauges and histograms exposed through the metrics endpoint."""
+
+    _lock: threading.Lock
+    _counters: dict[str, float]
+    _gauges: dict[str, float]
+    _histograms: dict[str, deque[float]]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._histograms = defaultdict(lambda: deque(maxlen=HISTOGRAM_WINDOW))
+
+    def increment(self, name: str, value: float = 1, **labels: Any):
+        """Increments the counter `name` by `value`."""
+        with self._lock:
+            self._counters[_metric_key(name=name, labels=labels)] += value
+
+    def set_gauge(self, name: str, value: float, **labels: Any):
+        """Sets the gauge `name` to `value`."""
+        with self._lock:
+            self._gauges[_metric_key(name=name, labels=labels)] = value
+
+    def observe(self, name: str, value: float, **labels: Any):
+        """Records a single observation (e.g. a latency) for the histogram `name`."""
+        with self._lock:
+            self._histograms[_metric_key(name=name, labels=labels)].append(value)
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns a JSON-serialisable view of every metric currently recorded.
+
+        Returns:
+            dict[str, Any]: The counters and gauges as-is, and a count/mean/p50/p99 summary of every histogram.
+        """
+        with self._lock:
+            histograms: dict[str, dict[str, float]] = {}
+            for key, values in self._histograms.items():
+                sorted_values: list[float] = sorted(values)
+                histograms[key] = {
+                    "count": len(sorted_values),
+                    "mean": (
+                        sum(sorted_values) / len(sorted_values)
+                        if sorted_values
+                        else 0.0
+                    ),
+                    "p50": percentile(sorted_values=sorted_values, percentile=50),
+                    "p99": percentile(sorted_values=sorted_values, percentile=99),
+                }
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "histograms": histograms,
+            }
+
+    def reset(self):
+        """Clears every metric. Only meant to be used in tests."""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+metrics = Metrics()
@@ -6,3 +6,5 @@ from pydantic import BaseModel
 class InferenceInput(BaseModel):
     conversation: dict[str, Any]
     content: list[str]
+    # Opt-in: returns the notes of the chunks that succeeded, with the status of every chunk, instead of failing when any chunk fails
+    partial_results: bool = False
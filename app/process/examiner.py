@@ -4,34 +4,47 @@ from app.config import InferenceConfig
 from app.control.post.examiner import post_process
 from app.exceptions.exception import InferenceFailure, LogicError
 from app.llm.base import LLMBaseModel
-from app.llm.model import LLM, LLMType
+from app.llm.model import LLMType
+from app.llm.rate_limit import llm_rate_limiter
+from app.llm.registry import get_client_registry
+from app.llm.scheduler import llm_scheduler
+from app.llm.token_count import get_token_estimator
+from app.llm.tokenizer import get_tokenizer
 from app.models.content import Task
 from app.prompts.config import PromptMessageConfig
 from app.prompts.examiner.anthropic import (
     generate_anthropic_examiner_system_message,
-    generate_anthropic_examiner_user_message)
+    generate_anthropic_examiner_user_message,
+)
 from app.prompts.examiner.cohere import (
     generate_cohere_examiner_system_message,
-    generate_cohere_examiner_user_message)
+    generate_cohere_examiner_user_message,
+)
 from app.prompts.examiner.google_ai import (
     generate_google_ai_examiner_system_message,
-    generate_google_ai_examiner_user_message)
-from app.prompts.examiner.llama3 import generate_llama3_examiner_system_message, generate_llama3_examiner_user_message
+    generate_google_ai_examiner_user_message,
+)
+from app.prompts.examiner.llama3 import (
+    generate_llama3_examiner_system_message,
+    generate_llama3_examiner_user_message,
+)
 from app.prompts.examiner.open_ai import (
     generate_open_ai_examiner_system_message,
-    generate_open_ai_examiner_user_message)
+    generate_open_ai_examiner_user_message,
+)
 
 log = logging.getLogger(__name__)
 
+
 class Examiner:
     TASK = Task.PRACTICE
-    
+
     _llm_type: LLMType
     _model: LLMBaseModel
 
     def __init__(self, config: InferenceConfig):
         self._llm_type = config.llm_type.get(self.TASK)
-        self._model = LLM(model_type=self._llm_type).model
+        self._model = get_client_registry().get_model(llm_type=self._llm_type)
 
     def generate_system_message(self) -> str:
         match self._llm_type:
@@ -85,7 +98,9 @@ class Examiner:
             case LLMType.LLAMA3:
                 return generate_llama3_examiner_user_message()
 
-    async def examine(self, topic: str, summary_chunk: str) -> tuple[str, str, str, str]:
+    async def examine(
+        self, topic: str, summary_chunk: str
+    ) -> tuple[str, str, str, str]:
         """This method generates a practice question and answer for a given topic and summary chunk.
 
         Args:
@@ -100,20 +115,54 @@ class Examiner:
             topic=topic, summary_chunk=summary_chunk
         )
 
-        try:
-            language, question, half_completed_code, fully_completed_code = await self._model.send_message(
-                system_message=system_message, user_message=user_message, config=PromptMessageConfig.PRACTICE
+        prompt_tokens: int = (
+            get_token_estimator(
+                tokenizer=get_tokenizer(tokenizer_type=self._llm_type.tokenizer_type())
             )
-            language, question, half_completed_code, fully_completed_code = post_process(
-                language=language, question=question, half_completed_code=half_completed_code, fully_completed_code=fully_completed_code
+            .estimate(system_message + user_message)
+            .high
+        )
+
+        try:
+            async with (
+                llm_scheduler.slot(
+                    llm_type=self._llm_type,
+                    priority=len(user_message),
+                    prompt_tokens=prompt_tokens,
+                ),
+                llm_rate_limiter.reserve(
+                    llm_type=self._llm_type,
+                    tokens=prompt_tokens + self._model.model_config.max_tokens,
+                ),
+            ):
+                language, question, half_completed_code, fully_completed_code = (
+                    await self._model.send_message(
+                        system_message=system_message,
+                        user_message=user_message,
+                        config=PromptMessageConfig.PRACTICE,
+                    )
+                )
+            language, question, half_completed_code, fully_completed_code = (
+                post_process(
+                    language=language,
+                    question=question,
+                    half_completed_code=half_completed_code,
+                    fully_completed_code=fully_completed_code,
+                )
             )
             return language, question, half_completed_code, fully_completed_code
         except LogicError as e:
-            log.error(f"Logic error occurred while generating practices off the summary: {e}")
+            log.error(
+                f"Logic error occurred while generating practices off the summary: {e}"
+            )
             raise e
         except InferenceFailure as e:
-            log.error(f"Inference failure occurred while generating practices off the summary: {e}")
+            log.error(
+                f"Inference failure occurred while generating practices off the summary: {e}"
+            )
             raise e
         except Exception as e:
-            log.error(f"Unexpected error occurred while generating practices off the summary: {e}")
+            log.error(
+                f"Unexpected error occurred while generating practices off the summary: {e}"
+            )
             raise e
@@ -1,41 +1,160 @@
+import hashlib
+import json
 import logging
-from typing import Any
+import time
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, NamedTuple, Optional
 
 from app.config import InferenceConfig
-from app.control.post.generator import post_process
-from app.control.pre.generator import pre_process
-from app.exceptions.exception import InferenceFailure, LogicError
-from app.llm.base import LLMBaseModel
-from app.llm.model import LLM, LLMType
-from app.models.conversation import Conversation
+from app.control.post.generator import post_process, validate_field
+from app.control.pre.generator import ConversationChunk, pre_process, stream_pre_process
+from app.control.pre.partition import ChunkingMode
+from app.exceptions.exception import (
+    DeadlineExceeded,
+    GenerationAborted,
+    InferenceFailure,
+    LogicError,
+)
+from app.llm.base import LLMBaseModel, LLMConfig
+from app.llm.circuit_breaker import PROVIDER_FAILURE_REASONS, llm_circuit_breakers
+from app.llm.deadline import Deadline
+from app.llm.hedging import llm_hedger
+from app.llm.model import LLMType
+from app.llm.rate_limit import llm_rate_limiter
+from app.llm.registry import get_client_registry
+from app.llm.retry import retry_reason
+from app.llm.router import RoutingDecision, RoutingPolicy, llm_router
+from app.llm.scheduler import llm_scheduler
+from app.llm.token_count import TokenCount, TokenCountMode, get_token_estimator
+from app.llm.tokenizer import TokenizerType, get_tokenizer
+from app.metrics import metrics
 from app.models.content import Content
+from app.models.conversation import Conversation
 from app.prompts.generator.anthropic import (
     generate_anthropic_summariser_system_message,
-    generate_anthropic_summariser_user_message)
+    generate_anthropic_summariser_user_message,
+)
 from app.prompts.generator.cohere import (
     generate_cohere_summariser_system_message,
-    generate_cohere_summariser_user_message)
+    generate_cohere_summariser_user_message,
+)
+from app.prompts.generator.functions import get_notes_functions
 from app.prompts.generator.google_ai import (
     generate_google_ai_summariser_system_message,
-    generate_google_ai_summariser_user_message)
-from app.prompts.generator.llama3 import generate_llama3_summariser_system_message, generate_llama3_summariser_user_message
+    generate_google_ai_summariser_user_message,
+)
+from app.prompts.generator.llama3 import (
+    generate_llama3_summariser_system_message,
+    generate_llama3_summariser_user_message,
+)
 from app.prompts.generator.open_ai import (
     generate_open_ai_summariser_system_message,
-    generate_open_ai_summariser_user_message)
+    generate_open_ai_summariser_user_message,
+)
 
 log = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=64)
+def _count_prompt_tokens(tokenizer_type: TokenizerType, text: str) -> int:
+    """Returns the token count of a prompt component. The prompts rarely change, so their counts are cached."""
+    return get_tokenizer(tokenizer_type=tokenizer_type).count_tokens(text)
+
+
+class GeneratedNotes(NamedTuple):
+    """The notes of a chunk, with the model that generated them, which may not be the model of the generator when the chunk was routed, hedged or fell back."""
+
+    notes: dict[str, Any]
+    llm_type: LLMType
+
+
 class Generator:
-    
+
     _llm_type: LLMType
     _model: LLMBaseModel
-    _max_tokens: int
+    _max_chunk_tokens: Optional[int]
+    _token_count_mode: TokenCountMode
+    _chunking_mode: ChunkingMode
+    _hedge_percentile: Optional[float]
+    _hedge_generator: Optional["Generator"]
+    _fallback_generators: list["Generator"]
+    _routing_policy: Optional[RoutingPolicy]
+    _routing_latency_slo_seconds: float
+    _routing_generators: list["Generator"]
 
     def __init__(self, config: InferenceConfig):
         self._llm_type = config.llm_type
-        self._model = LLM(model_type=self._llm_type).model
-        self._max_tokens = self._model.model_config.max_tokens
+        self._model = get_client_registry().get_model(llm_type=self._llm_type)
+        self._max_chunk_tokens = config.max_chunk_tokens
+        self._token_count_mode = config.token_count_mode
+        self._chunking_mode = config.chunking_mode
+        self._hedge_percentile = config.hedge_percentile
+        # The attempts on other models build the prompts of those models
+        self._hedge_generator = None
+        if (
+            config.hedge_llm_type is not None
+            and config.hedge_llm_type != self._llm_type
+        ):
+            self._hedge_generator = Generator(
+                config=config.model_copy(
+                    update={
+                        "llm_type": config.hedge_llm_type,
+                        "hedge_percentile": None,
+                        "fallback_llm_types": [],
+                        "routing_policy": None,
+                    }
+                )
+            )
+        self._fallback_generators = [
+            Generator(
+                config=config.model_copy(
+                    update={
+                        "llm_type": llm_type,
+                        "hedge_percentile": None,
+                        "fallback_llm_types": [],
+                        "routing_policy": None,
+                    }
+                )
+            )
+            for llm_type in config.fallback_llm_types
+            if llm_type != self._llm_type
+        ]
+        self._routing_policy = config.routing_policy
+        self._routing_latency_slo_seconds = config.routing_latency_slo_seconds
+        self._routing_generators = [
+            Generator(
+                config=config.model_copy(
+                    update={
+                        "llm_type": llm_type,
+                        "hedge_percentile": None,
+                        "fallback_llm_types": [],
+                        "routing_policy": None,
+                    }
+                )
+            )
+            for llm_type in config.routing_llm_types
+            if llm_type != self._llm_type
+        ]
+
+    @property
+    def llm_type(self) -> LLMType:
+        return self._llm_type
+
+    @property
+    def model_config(self) -> LLMConfig:
+        return self._model.model_config
+
+    def candidate_generators(self) -> list["Generator"]:
+        """Returns the generators of every model that may generate the notes of a chunk: this one, then the routing candidates, the fallback chain and the hedge model."""
+        candidates: dict[LLMType, Generator] = {}
+        for generator in (
+            self,
+            *self._routing_generators,
+            *self._fallback_generators,
+            *([self._hedge_generator] if self._hedge_generator is not None else []),
+        ):
+            candidates.setdefault(generator.llm_type, generator)
+        return list(candidates.values())
 
     def generate_system_message(self) -> str:
         match self._llm_type:
@@ -91,56 +210,445 @@ class Generator:
                     conversation=conversation
                 )
 
-    def pre_process(
-        self, conversation: dict[str, Any]
-    ) -> tuple[list[Conversation], int]:
-        """Pre-processes the conversation given the summarisation model's max tokens limit. 
-        
-        The conversation will be split up into multiple conversation chunks if it exceeds the max tokens limit.
+    def prompt_tokens(self, title: str, content_lst: list[Content]) -> int:
+        """Returns the number of tokens that every request spends on the system message, the function schema, the user message template and the title, counted with the model's own tokenizer.
+
+        Args:
+            title (str): The title of the conversation, which is repeated in every chunk.
+            content_lst (list[Content]): The content types that the user wants to generate notes for, which determine the function schema.
+
+        Returns:
+            int: The number of prompt tokens spent outside of the conversation.
+        """
+        tokenizer_type: TokenizerType = self._llm_type.tokenizer_type()
+        notes_functions: list[dict[str, Any]] = get_notes_functions(
+            contains_mcq_practice=bool(Content.MCQ in content_lst),
+            contains_code_practice=bool(Content.CODE in content_lst),
+        )
+        prompt_tokens: list[int] = [
+            _count_prompt_tokens(tokenizer_type=tokenizer_type, text=text)
+            for text in (
+                self.generate_system_message(),
+                json.dumps(notes_functions),
+                self.generate_user_message(conversation=Conversation(title="")),
+            )
+        ]
+        prompt_tokens.append(
+            get_tokenizer(tokenizer_type=tokenizer_type).count_tokens(title)
+        )
+        return sum(prompt_tokens)
+
+    def prompt_version(self, content_lst: list[Content]) -> str:
+        """Returns a fingerprint of the prompts sent along with the conversation, so that cached notes are invalidated when the prompts change.
+
+        Args:
+            content_lst (list[Content]): The content types that the user wants to generate notes for, which determine the function schema.
+
+        Returns:
+            str: The hash of the system message, the function schema and the user message template.
+        """
+        notes_functions: list[dict[str, Any]] = get_notes_functions(
+            contains_mcq_practice=bool(Content.MCQ in content_lst),
+            contains_code_practice=bool(Content.CODE in content_lst),
+        )
+        prompt: str = "\n".join(
+            (
+                self.generate_system_message(),
+                json.dumps(notes_functions, sort_keys=True),
+                self.generate_user_message(conversation=Conversation(title="")),
+            )
+        )
+        return hashlib.sha256(prompt.encode()).hexdigest()
+
+    def request_tokens(
+        self,
+        conversation: Conversation,
+        content_lst: list[Content],
+        conversation_tokens: Optional[int] = None,
+    ) -> int:
+        """Returns the number of prompt tokens of a request to the summarisation model for the conversation.
+
+        Args:
+            conversation (Conversation): The conversation to generate revision notes of.
+            content_lst (list[Content]): The content types that the user wants to generate notes for.
+            conversation_tokens (Optional[int], optional): The token length of the conversation counted during pre-processing. Estimated from the prompt if not given. Defaults to None.
+
+        Returns:
+            int: The prompt tokens, including the system message, the function schema and the user message.
+        """
+        if conversation_tokens is None:
+            return (
+                get_token_estimator(
+                    tokenizer=get_tokenizer(
+                        tokenizer_type=self._llm_type.tokenizer_type()
+                    )
+                )
+                .estimate(
+                    self.generate_system_message()
+                    + self.generate_user_message(conversation=conversation)
+                )
+                .high
+            )
+        return conversation_tokens + self.prompt_tokens(
+            title=conversation.title, content_lst=content_lst
+        )
+
+    def chunk_budget(self, title: str, content_lst: list[Content]) -> int:
+        """Returns the number of conversation tokens that fit into a single request to the summarisation model.
+
+        The budget is the model's context window minus the prompt tokens spent outside of the conversation and the tokens reserved for the output, all counted with the model's own tokenizer.
+
+        Args:
+            title (str): The title of the conversation, which is repeated in every chunk.
+            content_lst (list[Content]): The content types that the user wants to generate notes for, which determine the function schema.
+
+        Returns:
+            int: The maximum number of conversation tokens per chunk.
+        """
+        budget: int = (
+            self._llm_type.context_window()
+            - self.prompt_tokens(title=title, content_lst=content_lst)
+            - self._model.model_config.max_tokens
+        )
+        if self._max_chunk_tokens:
+            budget = min(budget, self._max_chunk_tokens)
+        if budget <= 0:
+            raise LogicError(
+                f"The context window of {self._llm_type} cannot fit any conversation tokens."
+            )
+        return budget
+
+    async def pre_process(
+        self, conversation: dict[str, Any], content_lst: list[Content]
+    ) -> tuple[list[Conversation], TokenCount]:
+        """Pre-processes the conversation given the summarisation model's context window.
+
+        The conversation will be split up into multiple conversation chunks if it exceeds the chunk budget. Tokenization runs on the tokenizer worker pool, so the event loop is not blocked.
 
         Args:
             conversation (dict[str, Any]): The user's conversation chatlog.
+            content_lst (list[Content]): The content types that the user wants to generate notes for.
 
         Returns:
-            tuple[list[Conversation], int]: The list of conversation chunks and the total token sum of the conversation.
+            tuple[list[Conversation], TokenCount]: The list of conversation chunks and the total token sum of the conversation.
         """
-        conversation_lst, token_sum = pre_process(
-            conversation=conversation, max_input_tokens=self._max_tokens
+        max_input_tokens: int = self.chunk_budget(
+            title=str(conversation.get("title", "")), content_lst=content_lst
+        )
+        conversation_lst, token_sum = await pre_process(
+            conversation=conversation,
+            max_input_tokens=max_input_tokens,
+            token_count_mode=self._token_count_mode,
+            tokenizer_type=self._llm_type.tokenizer_type(),
         )
         log.info(f"Length of conversation list: {len(conversation_lst)} post split")
         log.info(f"Token sum of conversation: {token_sum}")
         return conversation_lst, token_sum
 
-    async def generate(self, conversation: Conversation, content_lst: list[Content]) -> dict[str, Any]:
+    async def stream_pre_process(
+        self, conversation: dict[str, Any], content_lst: list[Content]
+    ) -> AsyncIterator[ConversationChunk]:
+        """Pre-processes the conversation like `pre_process`, but yields every conversation chunk as soon as it is full, so that it can be summarised while the rest of the conversation is still being tokenized.
+
+        Args:
+            conversation (dict[str, Any]): The user's conversation chatlog.
+            content_lst (list[Content]): The content types that the user wants to generate notes for.
+
+        Yields:
+            ConversationChunk: The next conversation chunk, its token length and the token sum of the conversation counted so far.
+        """
+        max_input_tokens: int = self.chunk_budget(
+            title=str(conversation.get("title", "")), content_lst=content_lst
+        )
+        async for conversation_chunk in stream_pre_process(
+            conversation=conversation,
+            max_input_tokens=max_input_tokens,
+            token_count_mode=self._token_count_mode,
+            tokenizer_type=self._llm_type.tokenizer_type(),
+            chunking_mode=self._chunking_mode,
+        ):
+            yield conversation_chunk
+
+    async def generate(
+        self,
+        conversation: Conversation,
+        content_lst: list[Content],
+        conversation_tokens: Optional[int] = None,
+        on_field: Optional[Callable[[str, Any], None]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> GeneratedNotes:
         """Invokes the LLM to generate revision notes from the conversation.
 
+        The call waits for room under the model's rate limits, reserving the prompt tokens and the maximum output tokens up front.
+
+        Every field is checked with the rules of post-processing as soon as the model has generated it. A streamed generation is aborted at its first invalid field, and is retried without a backoff like any other retryable failure.
+
+        If routing is enabled, the chunk goes to the model that the routing policy picks among the models that fit it, and the fallback chain follows that model.
+
+        Every model is guarded by a circuit breaker. If the model fails with a provider failure, or its breaker is open, the call moves on to the next model of the fallback chain right away.
+
+        If hedging is enabled, a call that is still running after the configured percentile of the recent latencies of the model gets a second attempt, on the hedge model if one is configured. Whichever attempt passes post-processing first is returned and the other one is cancelled. Only the fields of the first attempt are passed to `on_field`.
+
+        No call is started once the deadline of the request has passed, and every call gives up at the deadline, with DeadlineExceeded, which does not move on to the fallback chain.
+
         Args:
             conversation (Conversation): The conversation to generate revision notes of.
             content_lst (list[Content]): The content types that the user wants to generate notes for.
-            
+            conversation_tokens (Optional[int], optional): The token length of the conversation counted during pre-processing. Estimated from the prompt if not given. Defaults to None.
+            on_field (Optional[Callable[[str, Any], None]], optional): Called with every valid field of the notes as soon as the model has generated it, before post-processing. Defaults to None.
+            deadline (Optional[Deadline], optional): The deadline of the request that the chunk belongs to. Defaults to None.
+
         Returns:
-            dict[str, str]: A dictionary containing the content of the revision notes
+            GeneratedNotes: A dictionary containing the content of the revision notes, and the model that generated them
         """
+        generator: Generator = self._route(
+            conversation=conversation,
+            content_lst=content_lst,
+            conversation_tokens=conversation_tokens,
+        )
+        start: float = time.perf_counter()
+        if self._hedge_percentile is None:
+            generated_notes: GeneratedNotes = await self._generate_with_fallback(
+                conversation=conversation,
+                content_lst=content_lst,
+                conversation_tokens=conversation_tokens,
+                on_field=on_field,
+                first=generator,
+                deadline=deadline,
+            )
+        else:
+            hedge_generator: Generator = self._hedge_generator or generator
+            generated_notes = await llm_hedger.call(
+                llm_type=generator.llm_type,
+                percentile=self._hedge_percentile,
+                primary=lambda: self._generate_with_fallback(
+                    conversation=conversation,
+                    content_lst=content_lst,
+                    conversation_tokens=conversation_tokens,
+                    on_field=on_field,
+                    first=generator,
+                    deadline=deadline,
+                ),
+                hedge=lambda: hedge_generator._generate_with_fallback(
+                    conversation=conversation,
+                    content_lst=content_lst,
+                    conversation_tokens=conversation_tokens,
+                    deadline=deadline,
+                ),
+                hedge_llm_type=hedge_generator.llm_type,
+            )
+        # Compared across deployments with and without hedging
+        metrics.observe(
+            "inference_chunk_seconds",
+            time.perf_counter() - start,
+            model=generator.llm_type.value,
+            hedging="off" if self._hedge_percentile is None else "on",
+        )
+        return generated_notes
+
+    def _route(
+        self,
+        conversation: Conversation,
+        content_lst: list[Content],
+        conversation_tokens: Optional[int] = None,
+    ) -> "Generator":
+        """Returns the generator of the model that the routing policy picks for the chunk, among the models whose chunk budget fits it, or this generator if routing is disabled."""
+        if self._routing_policy is None or not self._routing_generators:
+            return self
+        candidates: list[Generator] = []
+        for generator in (self, *self._routing_generators):
+            if conversation_tokens is None:
+                candidates.append(generator)
+                continue
+            try:
+                chunk_budget: int = generator.chunk_budget(
+                    title=conversation.title, content_lst=content_lst
+                )
+            except LogicError:
+                continue
+            if conversation_tokens <= chunk_budget:
+                candidates.append(generator)
+        if not candidates:
+            return self
+        decision: RoutingDecision = llm_router.route(
+            policy=self._routing_policy,
+            candidates=[generator.llm_type for generator in candidates],
+            prompt_tokens=self.request_tokens(
+                conversation=conversation,
+                content_lst=content_lst,
+                conversation_tokens=conversation_tokens,
+            ),
+            content_lst=content_lst,
+            latency_slo_seconds=self._routing_latency_slo_seconds,
+        )
+        log.info(f"Routed chunk to {decision.llm_type}: {decision.reason}")
+        return next(
+            generator
+            for generator in candidates
+            if generator.llm_type == decision.llm_type
+        )
+
+    async def _generate_with_fallback(
+        self,
+        conversation: Conversation,
+        content_lst: list[Content],
+        conversation_tokens: Optional[int] = None,
+        on_field: Optional[Callable[[str, Any], None]] = None,
+        first: Optional["Generator"] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> GeneratedNotes:
+        """Makes an attempt with the first model of the fallback chain whose circuit breaker lets it through and that does not fail with a provider failure, see `generate`.
+
+        The chain starts with `first`, e.g. the model picked by the router, and goes on with the model of this generator and its fallback models.
+
+        Raises:
+            Exception: The first provider failure if every model failed, or CircuitOpen if every breaker is open. Any other failure is raised at once.
+        """
+        first = first or self
+        chain: list[Generator] = [
+            first,
+            *(
+                generator
+                for generator in (self, *self._fallback_generators)
+                if generator.llm_type != first.llm_type
+            ),
+        ]
+        errors: list[Exception] = []
+        for generator in chain:
+            try:
+                with llm_circuit_breakers.get(llm_type=generator.llm_type).guard():
+                    processed_summary: dict[str, Any] = await generator._generate(
+                        conversation=conversation,
+                        content_lst=content_lst,
+                        conversation_tokens=conversation_tokens,
+                        on_field=on_field,
+                        deadline=deadline,
+                    )
+                return GeneratedNotes(
+                    notes=processed_summary, llm_type=generator.llm_type
+                )
+            except Exception as e:
+                reason: Optional[str] = retry_reason(e)
+                if reason != "circuit_open" and reason not in PROVIDER_FAILURE_REASONS:
+                    raise e
+                log.warning(f"Falling back from {generator.llm_type} ({reason}): {e}")
+                metrics.increment(
+                    "llm_fallbacks", model=generator.llm_type.value, reason=reason
+                )
+                errors.append(e)
+        raise next(
+            (error for error in errors if retry_reason(error) != "circuit_open"),
+            errors[-1],
+        )
+
+    async def _generate(
+        self,
+        conversation: Conversation,
+        content_lst: list[Content],
+        conversation_tokens: Optional[int] = None,
+        on_field: Optional[Callable[[str, Any], None]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> dict[str, Any]:
+        """Makes a single attempt at generating the revision notes with the model of the generator, see `generate`."""
         system_message: str = self.generate_system_message()
         user_message: str = self.generate_user_message(conversation=conversation)
+        prompt_tokens: int = self.request_tokens(
+            conversation=conversation,
+            content_lst=content_lst,
+            conversation_tokens=conversation_tokens,
+        )
+
+        def _on_field(field: str, value: Any):
+            try:
+                validate_field(field=field, value=value)
+            except LogicError as e:
+                raise GenerationAborted(
+                    f"Generation aborted at field {field}: {e.detail}", field=field
+                ) from e
+            if on_field is not None:
+                on_field(field, value)
 
+        start: float = time.perf_counter()
         try:
-            topic, goal, context, overview, key_concepts_lst, tips_lst, mcq_practice, code_practice = await self._model.send_message(
-                system_message=system_message, 
-                user_message=user_message, 
-                content_lst=content_lst
-            )
+            # Larger chunks take longer, so they are dispatched first when the provider is saturated. Their tokens are only
+            # reserved once they hold a slot, so that the calls waiting for a slot do not take the rate limit of the calls in flight.
+            async with (
+                llm_scheduler.slot(
+                    llm_type=self._llm_type,
+                    priority=len(user_message),
+                    prompt_tokens=prompt_tokens,
+                ),
+                llm_rate_limiter.reserve(
+                    llm_type=self._llm_type,
+                    tokens=prompt_tokens + self._model.model_config.max_tokens,
+                ) as usage,
+            ):
+                # The wait for capacity may have used up the time of the request
+                if deadline is not None:
+                    deadline.check()
+                (
+                    topic,
+                    goal,
+                    context,
+                    overview,
+                    key_concepts_lst,
+                    tips_lst,
+                    mcq_practice,
+                    code_practice,
+                ) = await self._model.send_message(
+                    system_message=system_message,
+                    user_message=user_message,
+                    content_lst=content_lst,
+                    on_field=_on_field,
+                    deadline=deadline,
+                )
             processed_summary: dict[str, Any] = post_process(
-                topic=topic, goal=goal, context=context, overview=overview, key_concepts_lst=key_concepts_lst, tips_lst=tips_lst, mcq_practice=mcq_practice, code_practice=code_practice
+                topic=topic,
+                goal=goal,
+                context=context,
+                overview=overview,
+                key_concepts_lst=key_concepts_lst,
+                tips_lst=tips_lst,
+                mcq_practice=mcq_practice,
+                code_practice=code_practice,
             )
             log.info(f"Processed Summary: {processed_summary}")
+            self._record_outcome(
+                start=start,
+                succeeded=True,
+                content_lst=content_lst,
+                output_tokens=usage.completion_tokens if usage.reported else None,
+            )
             return processed_summary
+        except DeadlineExceeded as e:
+            # The call was cut short by the request, which says nothing about the model
+            log.error(f"Deadline exceeded while summarizing conversation: {e}")
+            raise e
         except LogicError as e:
             log.error(f"Logic error occurred while summarizing conversation: {e}")
+            self._record_outcome(start=start, succeeded=False, content_lst=content_lst)
             raise e
         except InferenceFailure as e:
             log.error(f"Inference failure occurred while summarizing conversation: {e}")
+            self._record_outcome(start=start, succeeded=False, content_lst=content_lst)
             raise e
         except Exception as e:
             log.error(f"Error occurred while summarizing conversation: {e}")
+            self._record_outcome(start=start, succeeded=False, content_lst=content_lst)
             raise e
+
+    def _record_outcome(
+        self,
+        start: float,
+        succeeded: bool,
+        content_lst: list[Content],
+        output_tokens: Optional[int] = None,
+    ):
+        """Records an attempt with the model of the generator, which the routing of the next chunks is based on."""
+        llm_router.record(
+            llm_type=self._llm_type,
+            seconds=time.perf_counter() - start,
+            succeeded=succeeded,
+            content_lst=content_lst,
+            output_tokens=output_tokens,
+        )
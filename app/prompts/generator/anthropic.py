@@ -1,34 +1,28 @@
 from app.models.conversation import Conversation
+from app.process.types import TODO_MARKER
 
 
 def generate_anthropic_summariser_system_message():
-    system_message: str = """
-You are good at summarizing technical conversations and can explain complex software engineering concepts in a way that is easy to understand. You will be given a conversation between a user and a large language model in <conversation></conversation> tags. The user has asked the model to help him with certain problems he faced while programming. 
+    system_message: str = f"""
+You are good at generating revision notes from technical conversations and can transform highly specific conversations into transferable software engineering principles. You will be given a conversation between a user and a large language model in <conversation></conversation> tags. The user has asked the model to help him with certain problems he faced while programming. 
 
 Follow these instructions in <instruction></instruction> tags:
 <instruction>
-1. Summarise the key ideas present in the model's response without referencing specific function or variable names.
-2. Avoid narrating the conversation history without adding value to the summary.
-3. Try to generalise and avoid being too specific to the examples present in the conversation, so that the summary can be applied to a wide range of similar scenarios.
-4. The summary should be in a declarative tone and avoid referencing the model explicitly.
+1. State the topic which the revision notes cover
+2. Summarise the questions which the user asked the model. These questions should serve as context to aid in the user's understanding of the subsequent content of the revision notes.
+3. State the goal of the revision notes and what users should learn after reading through the notes.
+4. Provide an overview of the key ideas present in the revision notes.
+5. List 2-4 key concepts present in the conversation. Each key concept should have a title, an explanation in one or two sentences. If useful, provide a short code example with appropriate inline comments that illustrate the corresponding key concept and state the programming language of the code. Do not repeat the same code example in multiple key concepts.
+6. If useful, provide 1-2 tips that will help students to apply the key concepts better in the future.
+7. If useful, provide a multiple-choice (MCQ) practice question with 3-4 options that tests the student's understanding of the key concepts. The MCQ should test conceptual understanding, and not be overly specific to any example in the conversation. 
+8. If useful, provide an original code practice question that tests the student's understanding of the key concepts. The code practice question should be a half-completed block of code of your own creation with 1-3 lines of logic intentionally left blank for the student to fill up. Indicate with a comment '{TODO_MARKER}' in place of the lines of code that are intentionally left blank. Make sure that the missing code is IMPORTANT to the concept being taught, so that the practice is meaningful for the student. You should also provide a fully completed version of the code, which is an exact replica of the half-completed block of code, except that the '{TODO_MARKER}' is now replaced with the actual 1-3 lines of expected code. Give enough hints and context within the question such that the student can complete the code without any ambiguity. Your code practice question should not be too similar to code present in other parts of your revision notes.
 </instruction>
-
-An example of the expected output format is as follows:
-
-<output>
-**Key Ideas:**
-1. **Topic**: This is the summary of the first topic.
-2. **Topic**: This is the summary of the second topic.
-3. **Topic**: This is the summary of the third topic.
-</output>
 """
     return system_message
 
 
 def generate_anthropic_summariser_user_message(conversation: Conversation):
     user_message: str = f"<conversation>\n{conversation.stringify()}\n</conversation>\n"
-    user_message += (
-        "Summarise the key ideas of the model's response in the conversation:"
-    )
+    user_message += "Generate revision notes from the model's response. Avoid referencing the model or the user in your notes aside outside of the context portion. Describe the content as if it is from a textbook:"
 
     return user_message
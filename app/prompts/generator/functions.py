@@ -1,51 +1,56 @@
 from enum import StrEnum
-from typing import Any
+from typing import Any, Optional
+
 
 class NotesFunctions(StrEnum):
     GET_NOTES = "get_notes"
-    
-    # Unique element to output 
-    TOPIC = "topic" # Compulsory
-    GOAL = "goal" # Compulsory
-    CONTEXT = "context" # Compulsory
-    OVERVIEW = "overview" # Compulsory
+
+    # Unique element to output
+    TOPIC = "topic"  # Compulsory
+    GOAL = "goal"  # Compulsory
+    CONTEXT = "context"  # Compulsory
+    OVERVIEW = "overview"  # Compulsory
 
     # List element to output
-    KEY_CONCEPTS = "key_concepts" # Compulsory
+    KEY_CONCEPTS = "key_concepts"  # Compulsory
     # List of tuples containing these 3 elements
-    KEY_CONCEPT_TITLE = "key_concept_title" # Compulsory
-    KEY_CONCEPT_EXPLANATION = "key_concept_explanation" # Compulsory
-    KEY_CONCEPT_CODE_EXAMPLE = "key_concept_code_example" # Optional
+    KEY_CONCEPT_TITLE = "key_concept_title"  # Compulsory
+    KEY_CONCEPT_EXPLANATION = "key_concept_explanation"  # Compulsory
+    KEY_CONCEPT_CODE_EXAMPLE = "key_concept_code_example"  # Optional
     # KEY_CONCEPT_CODE_EXAMPLE contains these 2 elements
-    KEY_CONCEPT_CODE = "key_concept_code" # Compulsory
-    KEY_CONCEPT_LANGUAGE = "key_concept_language" # Compulsory
-    
+    KEY_CONCEPT_CODE = "key_concept_code"  # Compulsory
+    KEY_CONCEPT_LANGUAGE = "key_concept_language"  # Compulsory
+
     # List element to output
-    TIPS = "tips" # Optional
+    TIPS = "tips"  # Optional
     # List of tuples containing these 2 elements
-    TIP_TITLE = "tip_title" # Compulsory
-    TIP_EXPLANATION = "tip_explanation" # Compulsory
-    
+    TIP_TITLE = "tip_title"  # Compulsory
+    TIP_EXPLANATION = "tip_explanation"  # Compulsory
+
     # Unique element to output
-    MCQ_PRACTICE = "mcq_practice" # Optional
+    MCQ_PRACTICE = "mcq_practice"  # Optional
     # MCQ_PRACTICE contains these 4 elements
-    MCQ_PRACTICE_TITLE = "mcq_practice_title" # Compulsory
-    MCQ_PRACTICE_QUESTION = "mcq_practice_question" # Compulsory
-    MCQ_PRACTICE_WRONG_OPTIONS = "mcq_practice_wrong_options" # Compulsory
-    MCQ_PRACTICE_CORRECT_OPTION = "mcq_practice_correct_option" # Compulsory
-    
+    MCQ_PRACTICE_TITLE = "mcq_practice_title"  # Compulsory
+    MCQ_PRACTICE_QUESTION = "mcq_practice_question"  # Compulsory
+    MCQ_PRACTICE_WRONG_OPTIONS = "mcq_practice_wrong_options"  # Compulsory
+    MCQ_PRACTICE_CORRECT_OPTION = "mcq_practice_correct_option"  # Compulsory
+
     # Unique element to output
-    CODE_PRACTICE = "code_practice" # Optional
+    CODE_PRACTICE = "code_practice"  # Optional
     # CODE_PRACTICE contains these 3 elements
-    CODE_PRACTICE_TITLE = "code_practice_title" # Compulsory
-    CODE_PRACTICE_QUESTION = "code_practice_question" # Compulsory
-    CODE_PRACTICE_HALF_COMPLETED_CODE = "code_practice_half_completed_code" # Compulsory
-    CODE_PRACTICE_FULLY_COMPLETED_CODE = "code_practice_fully_completed_code" # Compulsory
-    CODE_PRACTICE_LANGUAGE = "code_practice_language" # Compulsory
+    CODE_PRACTICE_TITLE = "code_practice_title"  # Compulsory
+    CODE_PRACTICE_QUESTION = "code_practice_question"  # Compulsory
+    CODE_PRACTICE_HALF_COMPLETED_CODE = (
+        "code_practice_half_completed_code"  # Compulsory
+    )
+    CODE_PRACTICE_FULLY_COMPLETED_CODE = (
+        "code_practice_fully_completed_code"  # Compulsory
+    )
+    CODE_PRACTICE_LANGUAGE = "code_practice_language"  # Compulsory
+
 
 def get_notes_functions(
-    contains_mcq_practice: bool, 
-    contains_code_practice: bool
+    contains_mcq_practice: bool, contains_code_practice: bool
 ) -> list[dict[str, Any]]:
     """Returns the function-calling function that will be passed into the LLM
 
@@ -59,19 +64,19 @@ def get_notes_functions(
     properties = {
         NotesFunctions.TOPIC: {
             "type": "string",
-            "description": "The topic which the revision notes cover in fewer than 7 words."
+            "description": "The topic which the revision notes cover in fewer than 7 words.",
         },
         NotesFunctions.GOAL: {
             "type": "string",
-            "description": "The goal of the revision notes in one sentence. Students should achieve this goal after reading the notes."
+            "description": "The goal of the revision notes in one sentence. Students should achieve this goal after reading the notes.",
         },
         NotesFunctions.CONTEXT: {
             "type": "string",
-            "description": "A summary of the questions which the user asked in fewer than 2 sentences. These questions serve as the context behind the revision notes."
+            "description": "A summary of the questions which the user asked in fewer than 2 sentences. These questions serve as the context behind the revision notes.",
         },
         NotesFunctions.OVERVIEW: {
             "type": "string",
-            "description": "A high-level summary of the key ideas present in the revision notes in one sentence."
+            "description": "A high-level summary of the key ideas present in the revision notes in one sentence.",
         },
         NotesFunctions.KEY_CONCEPTS: {
             "type": "array",
@@ -81,29 +86,35 @@ def get_notes_functions(
                 "properties": {
                     NotesFunctions.KEY_CONCEPT_TITLE: {
                         "type": "string",
-                        "description": "The title of the key concept."
+                        "description": "The title of the key concept.",
                     },
                     NotesFunctions.KEY_CONCEPT_EXPLANATION: {
                         "type": "string",
-                        "description": "State the key concept in one or two sentences. Bold important terms."
+                        "description": "State the key concept in one or two sentences. Bold important terms.",
                     },
                     NotesFunctions.KEY_CONCEPT_CODE_EXAMPLE: {
                         "type": "object",
                         "properties": {
                             NotesFunctions.KEY_CONCEPT_CODE: {
                                 "type": "string",
-                                "description": "The code example illustrating the key concept."
+                                "description": "The code example illustrating the key concept.",
                             },
                             NotesFunctions.KEY_CONCEPT_LANGUAGE: {
                                 "type": "string",
-                                "description": "The programming language of the code example."
-                            }
+                                "description": "The programming language of the code example.",
+                            },
                         },
-                        "required": [NotesFunctions.KEY_CONCEPT_CODE, NotesFunctions.KEY_CONCEPT_LANGUAGE],
-                    }
+                        "required": [
+                            NotesFunctions.KEY_CONCEPT_CODE,
+                            NotesFunctions.KEY_CONCEPT_LANGUAGE,
+                        ],
+                    },
                 },
-                "required": [NotesFunctions.KEY_CONCEPT_TITLE, NotesFunctions.KEY_CONCEPT_EXPLANATION]
-            }
+                "required": [
+                    NotesFunctions.KEY_CONCEPT_TITLE,
+                    NotesFunctions.KEY_CONCEPT_EXPLANATION,
+                ],
+            },
         },
         NotesFunctions.TIPS: {
             "type": "array",
@@ -113,16 +124,16 @@ def get_notes_functions(
                 "properties": {
                     NotesFunctions.TIP_TITLE: {
                         "type": "string",
-                        "description": "The title of the tip."
+                        "description": "The title of the tip.",
                     },
                     NotesFunctions.TIP_EXPLANATION: {
                         "type": "string",
-                        "description": "State the tip in one or two sentences."
-                    }
+                        "description": "State the tip in one or two sentences.",
+                    },
                 },
-                "required": [NotesFunctions.TIP_TITLE, NotesFunctions.TIP_EXPLANATION]
-            }
-        }
+                "required": [NotesFunctions.TIP_TITLE, NotesFunctions.TIP_EXPLANATION],
+            },
+        },
     }
 
     if contains_mcq_practice:
@@ -132,25 +143,28 @@ def get_notes_functions(
             "properties": {
                 NotesFunctions.MCQ_PRACTICE_TITLE: {
                     "type": "string",
-                    "description": "A short descriptive title for the multiple-choice question."
+                    "description": "A short descriptive title for the multiple-choice question.",
                 },
                 NotesFunctions.MCQ_PRACTICE_QUESTION: {
                     "type": "string",
-                    "description": "The multiple-choice question that students have to answer."
+                    "description": "The multiple-choice question that students have to answer.",
                 },
                 NotesFunctions.MCQ_PRACTICE_WRONG_OPTIONS: {
                     "type": "array",
                     "description": "A list of wrong options for the multiple-choice question.",
-                    "items": {
-                        "type": "string"
-                    }
+                    "items": {"type": "string"},
                 },
                 NotesFunctions.MCQ_PRACTICE_CORRECT_OPTION: {
                     "type": "string",
                     "description": "The correct option for the multiple-choice question.",
                 },
             },
-            "required": [NotesFunctions.MCQ_PRACTICE_TITLE, NotesFunctions.MCQ_PRACTICE_QUESTION, NotesFunctions.MCQ_PRACTICE_WRONG_OPTIONS, NotesFunctions.MCQ_PRACTICE_CORRECT_OPTION]
+            "required": [
+                NotesFunctions.MCQ_PRACTICE_TITLE,
+                NotesFunctions.MCQ_PRACTICE_QUESTION,
+                NotesFunctions.MCQ_PRACTICE_WRONG_OPTIONS,
+                NotesFunctions.MCQ_PRACTICE_CORRECT_OPTION,
+            ],
         }
 
     if contains_code_practice:
@@ -160,26 +174,32 @@ def get_notes_functions(
             "properties": {
                 NotesFunctions.CODE_PRACTICE_TITLE: {
                     "type": "string",
-                    "description": "A short descriptive title for the coding question."
+                    "description": "A short descriptive title for the coding question.",
                 },
                 NotesFunctions.CODE_PRACTICE_QUESTION: {
                     "type": "string",
-                    "description": "The coding question that is formulated based on the key concepts, with enough context and hints for the student to complete the code without ambiguity."
+                    "description": "The coding question that is formulated based on the key concepts, with enough context and hints for the student to complete the code without ambiguity.",
                 },
                 NotesFunctions.CODE_PRACTICE_HALF_COMPLETED_CODE: {
                     "type": "string",
-                    "description": "The half-completed code with the TODO marker in place of the missing code."
+                    "description": "The half-completed code with the TODO marker in place of the missing code.",
                 },
                 NotesFunctions.CODE_PRACTICE_FULLY_COMPLETED_CODE: {
                     "type": "string",
-                    "description": "The fully-completed code, with the missing parts annotated by the TODO marker filled."
+                    "description": "The fully-completed code, with the missing parts annotated by the TODO marker filled.",
                 },
                 NotesFunctions.CODE_PRACTICE_LANGUAGE: {
                     "type": "string",
-                    "description": "The programming language used in the practice question."
-                }
+                    "description": "The programming language used in the practice question.",
+                },
             },
-            "required": [NotesFunctions.CODE_PRACTICE_TITLE, NotesFunctions.CODE_PRACTICE_QUESTION, NotesFunctions.CODE_PRACTICE_HALF_COMPLETED_CODE, NotesFunctions.CODE_PRACTICE_FULLY_COMPLETED_CODE, NotesFunctions.CODE_PRACTICE_LANGUAGE]
+            "required": [
+                NotesFunctions.CODE_PRACTICE_TITLE,
+                NotesFunctions.CODE_PRACTICE_QUESTION,
+                NotesFunctions.CODE_PRACTICE_HALF_COMPLETED_CODE,
+                NotesFunctions.CODE_PRACTICE_FULLY_COMPLETED_CODE,
+                NotesFunctions.CODE_PRACTICE_LANGUAGE,
+            ],
         }
 
     notes_functions: list[dict[str, Any]] = [
@@ -190,17 +210,131 @@ def get_notes_functions(
                 "type": "object",
                 "properties": properties,
                 "required": [
-                    NotesFunctions.TOPIC, 
-                    NotesFunctions.GOAL, 
+                    NotesFunctions.TOPIC,
+                    NotesFunctions.GOAL,
                     NotesFunctions.CONTEXT,
-                    NotesFunctions.OVERVIEW, 
+                    NotesFunctions.OVERVIEW,
                     NotesFunctions.KEY_CONCEPTS,
                     NotesFunctions.TIPS,
                     NotesFunctions.MCQ_PRACTICE,
-                    NotesFunctions.CODE_PRACTICE
-                ]
-            }
+                    NotesFunctions.CODE_PRACTICE,
+                ],
+            },
         }
     ]
 
-    return notes_functions
\ No newline at end of file
+    return notes_functions
+
+
+def notes_from_arguments(arguments: dict[str, Any]) -> tuple:
+    """Returns the fields of the notes from the arguments of a `get_notes` call, in the order that post-processing takes them.
+
+    Args:
+        arguments (dict[str, Any]): The arguments generated by the LLM.
+
+    Returns:
+        tuple: The topic, goal, context, overview, key concepts, tips, MCQ practice and code practice of the notes.
+    """
+    topic: str = arguments[NotesFunctions.TOPIC]
+    goal: str = arguments[NotesFunctions.GOAL]
+    context: str = arguments[NotesFunctions.CONTEXT]
+    overview: str = arguments[NotesFunctions.OVERVIEW]
+
+    key_concepts_lst: list = []
+    for key_concept in arguments[NotesFunctions.KEY_CONCEPTS]:
+        code_example: Optional[dict[str, str]] = key_concept.get(
+            NotesFunctions.KEY_CONCEPT_CODE_EXAMPLE
+        )
+        if code_example:
+            key_concepts_lst.append(
+                {
+                    NotesFunctions.KEY_CONCEPT_TITLE.value: key_concept[
+                        NotesFunctions.KEY_CONCEPT_TITLE
+                    ],
+                    NotesFunctions.KEY_CONCEPT_EXPLANATION.value: key_concept[
+                        NotesFunctions.KEY_CONCEPT_EXPLANATION
+                    ],
+                    NotesFunctions.KEY_CONCEPT_CODE_EXAMPLE.value: {
+                        NotesFunctions.KEY_CONCEPT_CODE.value: code_example[
+                            NotesFunctions.KEY_CONCEPT_CODE
+                        ],
+                        NotesFunctions.KEY_CONCEPT_LANGUAGE.value: code_example[
+                            NotesFunctions.KEY_CONCEPT_LANGUAGE
+                        ],
+                    },
+                }
+            )
+        else:
+            key_concepts_lst.append(
+                {
+                    NotesFunctions.KEY_CONCEPT_TITLE.value: key_concept[
+                        NotesFunctions.KEY_CONCEPT_TITLE
+                    ],
+                    NotesFunctions.KEY_CONCEPT_EXPLANATION.value: key_concept[
+                        NotesFunctions.KEY_CONCEPT_EXPLANATION
+                    ],
+                }
+            )
+
+    tips_lst: list = []
+    tips: Optional[list[dict[str, str]]] = arguments.get(NotesFunctions.TIPS)
+    if tips:
+        for tip in tips:
+            tips_lst.append(
+                {
+                    NotesFunctions.TIP_TITLE.value: tip[NotesFunctions.TIP_TITLE],
+                    NotesFunctions.TIP_EXPLANATION.value: tip[
+                        NotesFunctions.TIP_EXPLANATION
+                    ],
+                }
+            )
+
+    mcq_practice: Optional[dict[str, str]] = arguments.get(NotesFunctions.MCQ_PRACTICE)
+    if mcq_practice:
+        mcq_practice = {
+            NotesFunctions.MCQ_PRACTICE_TITLE.value: mcq_practice[
+                NotesFunctions.MCQ_PRACTICE_TITLE
+            ],
+            NotesFunctions.MCQ_PRACTICE_QUESTION.value: mcq_practice[
+                NotesFunctions.MCQ_PRACTICE_QUESTION
+            ],
+            NotesFunctions.MCQ_PRACTICE_WRONG_OPTIONS.value: mcq_practice[
+                NotesFunctions.MCQ_PRACTICE_WRONG_OPTIONS
+            ],
+            NotesFunctions.MCQ_PRACTICE_CORRECT_OPTION.value: mcq_practice[
+                NotesFunctions.MCQ_PRACTICE_CORRECT_OPTION
+            ],
+        }
+
+    code_practice: Optional[dict[str, str]] = arguments.get(
+        NotesFunctions.CODE_PRACTICE
+    )
+    if code_practice:
+        code_practice = {
+            NotesFunctions.CODE_PRACTICE_TITLE.value: code_practice[
+                NotesFunctions.CODE_PRACTICE_TITLE
+            ],
+            NotesFunctions.CODE_PRACTICE_QUESTION.value: code_practice[
+                NotesFunctions.CODE_PRACTICE_QUESTION
+            ],
+            NotesFunctions.CODE_PRACTICE_HALF_COMPLETED_CODE.value: code_practice[
+                NotesFunctions.CODE_PRACTICE_HALF_COMPLETED_CODE
+            ],
+            NotesFunctions.CODE_PRACTICE_FULLY_COMPLETED_CODE.value: code_practice[
+                NotesFunctions.CODE_PRACTICE_FULLY_COMPLETED_CODE
+            ],
+            NotesFunctions.CODE_PRACTICE_LANGUAGE.value: code_practice[
+                NotesFunctions.CODE_PRACTICE_LANGUAGE
+            ],
+        }
+
+    return (
+        topic,
+        goal,
+        context,
+        overview,
+        key_concepts_lst,
+        tips_lst,
+        mcq_practice,
+        code_practice,
+    )
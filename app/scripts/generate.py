@@ -1,83 +1,576 @@
+import asyncio
+import json
 import logging
-from typing import Any, Union
-import asyncio 
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Optional
 
+from app.cache.keys import combined_cache_key, notes_cache_key
+from app.cache.notes import (
+    CHUNK_NOTES_CACHE,
+    NOTES_CACHE,
+    decode_notes,
+    encode_notes,
+    get_notes_cache,
+)
+from app.cache.single_flight import SingleFlight
+from app.cache.tiered import TieredCache
 from app.config import InferenceConfig
-from app.exceptions.exception import InferenceFailure, LogicError
-from app.models.conversation import Conversation
+from app.control.pre.generator import ConversationChunk
+from app.exceptions.exception import DeadlineExceeded, InferenceFailure, LogicError
+from app.llm.deadline import Deadline
+from app.llm.model import LLMType
+from app.llm.retry import RetryBudget, RetryEvent, call_with_retry, failure_reason
+from app.llm.token_count import TokenCount
+from app.metrics import metrics
 from app.models.content import Content
-from app.process.generator import Generator
+from app.models.conversation import Conversation
+from app.process.generator import GeneratedNotes, Generator
 
 logging.basicConfig(level=logging.INFO)
 
 log = logging.getLogger(__name__)
 
+# Coalesces the identical requests in flight, keyed like the notes cache
+notes_flight: SingleFlight[tuple[list["ChunkResult"], TokenCount]] = SingleFlight(
+    name="notes"
+)
+
+# A message that was too long for a chunk is split into parts named after it, e.g. `UserMessage3_part2`
+MESSAGE_PART_PATTERN = re.compile(r"_part\d+$")
+
+
+@dataclass
+class ChunkResult:
+    """The outcome of one chunk of a conversation."""
+
+    chunk: int
+    notes: Optional[dict[str, Any]] = None
+    cached: bool = False
+    # The first and last message keys of the chunk, so that the messages of a failed chunk can be sent again on their own. Unknown if the notes of the whole conversation were cached.
+    messages: Optional[dict[str, str]] = None
+    # Why the chunk failed, e.g. `deadline_exceeded`, `rejected_output` or the reason of its last retry such as `rate_limit`
+    reason: Optional[str] = None
+    detail: Optional[str] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.notes is not None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "chunk": self.chunk,
+            "status": "succeeded" if self.succeeded else "failed",
+            "cached": self.cached,
+            "messages": self.messages,
+            "reason": self.reason,
+            "detail": self.detail,
+        }
+
+
+def _message_range(conversation: Conversation) -> Optional[dict[str, str]]:
+    """Returns the first and last message keys of a conversation chunk, with the part of a split message reported as the message itself."""
+    keys: list[str] = [
+        MESSAGE_PART_PATTERN.sub("", key)
+        for key in conversation.model_dump()
+        if key != "title"
+    ]
+    if not keys:
+        return None
+    return {"first": keys[0], "last": keys[-1]}
+
+
 async def generate(
-    conversation: Union[dict[str, Any] | list[Conversation]],
+    conversation: dict[str, Any],
     content_lst: list[Content],
-    attempt: int = 1,
-    max_attempts: int = 5,
-    token_sum: int = 0,
-) -> tuple[list[dict[str, Any]], int]:
+    deadline: Optional[Deadline] = None,
+) -> tuple[list[dict[str, Any]], TokenCount, list[int]]:
     """Returns the gemerated notes and the total token sum of the conversation for usage tracking in stomach.
 
+    Every chunk is retried on its own, with backoff, until it succeeds, fails fatally or runs out of attempts. The retries of all the chunks are capped by one retry budget per request.
+
+    The notes are cached by the content of the request, the model and the prompts, so a conversation that is sent again is answered without calling the LLM, and a conversation that is sent again while its notes are being generated waits for them. The notes of every chunk are cached too, so after messages are appended to a conversation only the chunks that changed are summarised again.
+
+    Once the deadline has passed, the request stops waiting and every chunk that is still running is cancelled, unless an identical request is still waiting for it. Before that, every call to the LLM is bounded by the time left, and a chunk is not retried if the retry could not finish in time. Requests coalesced with one in flight share its deadline for the calls and retries, but each one stops waiting at its own deadline.
+
     Args:
-        conversations (Union[dict[str, Any]  |  list[Conversation]]): The conversation to be summarised. There are two possible types depending on whether it is the first attempt or not.
+        conversation (dict[str, Any]): The conversation to be summarised.
         content_lst (list[Content]): The content types that the user wants to generate notes for.
-        attempt (int, optional): The current attempt number which will be incremented with every retry. Defaults to 1.
-        max_attempts (int, optional): The attempt number which will cause the inference pipeline to stop when reached. Defaults to 9.
-        token_sum (int, optional): The total token sum that is used by the user to generate the notes. Defaults to 0.
+        deadline (Optional[Deadline], optional): The time by which the notes have to be returned. Defaults to None, which means no deadline.
+
+    Raises:
+        DeadlineExceeded: If the notes were not generated before the deadline.
+        InferenceFailure: If any chunk failed. See `generate_partial` to get the notes of the other chunks.
 
     Returns:
-        tuple[dict[str, str], int]: The summary in topic-content key-value pairs and the total token sum of the conversation
+        tuple[dict[str, str], TokenCount, list[int]]: The summary in topic-content key-value pairs, the total token sum of the conversation, which carries an error bound if it was partly estimated, and the indices of the chunks whose notes were served from the cache
     """
+    deadline = deadline or Deadline()
+    async with deadline.enforce():
+        chunk_results, token_sum = await _generate_chunk_results(
+            conversation=conversation, content_lst=content_lst, deadline=deadline
+        )
 
-    config = InferenceConfig()
-    generator = Generator(config=config)
+    failed_chunks: list[ChunkResult] = [
+        chunk_result for chunk_result in chunk_results if not chunk_result.succeeded
+    ]
+    if any(
+        chunk_result.reason == "deadline_exceeded" for chunk_result in failed_chunks
+    ):
+        raise DeadlineExceeded("Request deadline exceeded")
+    if failed_chunks:
+        raise InferenceFailure(
+            f"Failed to generate notes for {len(failed_chunks)} of {len(chunk_results)} conversations."
+        )
+    return (
+        [chunk_result.notes for chunk_result in chunk_results],
+        token_sum,
+        [chunk_result.chunk for chunk_result in chunk_results if chunk_result.cached],
+    )
 
-    conversation_lst: list[Conversation] = None
-    if attempt == 1:
-        try:
-            conversation_lst, token_sum = generator.pre_process(
-                conversation=conversation
+
+async def generate_partial(
+    conversation: dict[str, Any],
+    content_lst: list[Content],
+    deadline: Optional[Deadline] = None,
+) -> tuple[list[ChunkResult], TokenCount]:
+    """Generates the notes like `generate`, but returns the notes of the chunks that succeeded instead of failing the whole conversation when a chunk fails.
+
+    At the deadline, the chunks that are still running are cancelled and reported as failed with `deadline_exceeded`, instead of being waited for. A request coalesced with one in flight gets its results at the deadline of the request in flight.
+
+    The notes of the chunks that succeeded are cached, so sending the conversation again, or only the messages of the failed chunks, does not summarise them again.
+
+    Args:
+        conversation (dict[str, Any]): The conversation to be summarised.
+        content_lst (list[Content]): The content types that the user wants to generate notes for.
+        deadline (Optional[Deadline], optional): The time by which the notes have to be returned. Defaults to None, which means no deadline.
+
+    Returns:
+        tuple[list[ChunkResult], TokenCount]: The outcome of every chunk in order, with the message range and failure reason of the chunks that failed, and the total token sum of the conversation.
+    """
+    return await _generate_chunk_results(
+        conversation=conversation,
+        content_lst=content_lst,
+        deadline=deadline or Deadline(),
+    )
+
+
+async def _generate_chunk_results(
+    conversation: dict[str, Any],
+    content_lst: list[Content],
+    deadline: Deadline,
+) -> tuple[list[ChunkResult], TokenCount]:
+    """Returns the outcome of every chunk of the conversation from the notes cache, or from the generation of the identical request in flight, or generates them."""
+    generator = Generator(config=InferenceConfig())
+    notes_cache: TieredCache = get_notes_cache(name=NOTES_CACHE)
+    _cache_key: Callable[[dict[str, Any], Optional[LLMType]], str] = _notes_cache_key(
+        generator=generator, content_lst=content_lst
+    )
+    cache_key: str = _cache_key(conversation)
+    cached_notes: Optional[bytes] = await notes_cache.get(cache_key)
+    if cached_notes is not None:
+        log.info("Notes of conversation found in cache")
+        notes, token_sum = decode_notes(cached_notes)
+        return [
+            ChunkResult(chunk=chunk, notes=chunk_notes, cached=True)
+            for chunk, chunk_notes in enumerate(notes)
+        ], token_sum
+
+    # Identical requests that arrive while the notes are being generated wait for the same result
+    return await notes_flight.do(
+        cache_key,
+        lambda: _generate_notes(
+            generator=generator,
+            conversation=conversation,
+            content_lst=content_lst,
+            cache_key=cache_key,
+            chunk_cache_key=_cache_key,
+            deadline=deadline,
+        ),
+    )
+
+
+async def _generate_notes(
+    generator: Generator,
+    conversation: dict[str, Any],
+    content_lst: list[Content],
+    cache_key: str,
+    chunk_cache_key: Callable[[dict[str, Any], Optional[LLMType]], str],
+    deadline: Deadline,
+) -> tuple[list[ChunkResult], TokenCount]:
+    """Generates the notes of a conversation that is not in the notes cache, chunk by chunk, and caches them if every chunk succeeded. The chunks still running at the deadline are cancelled and reported as failed."""
+    notes_cache: TieredCache = get_notes_cache(name=NOTES_CACHE)
+    budget = RetryBudget()
+
+    conversation_lst: list[Conversation] = []
+    generate_tasks: list[asyncio.Task] = []
+    token_sum: TokenCount = TokenCount(tokens=0)
+    # Every chunk is sent to the LLM as soon as it is full, while the rest of the conversation is still being pre-processed
+    try:
+        async for conversation_chunk in generator.stream_pre_process(
+            conversation=conversation, content_lst=content_lst
+        ):
+            conversation_lst.append(conversation_chunk.conversation)
+            token_sum = conversation_chunk.token_sum
+            generate_tasks.append(
+                asyncio.create_task(
+                    _generate_chunk(
+                        generator=generator,
+                        conversation_chunk=conversation_chunk,
+                        content_lst=content_lst,
+                        chunk_cache_key=chunk_cache_key,
+                        budget=budget,
+                        deadline=deadline,
+                    )
+                )
             )
-        except LogicError as e:
-            log.error(f"Logic error while trying to pre-process conversation: {str(e)}")
-            raise e
-    else:
-        conversation_lst = conversation 
-
-    notes: list[dict[str, Any]] = []
-    remaining_conversations: list[Conversation] = []
-    generate_tasks = [
-        generator.generate(conversation=conversation, content_lst=content_lst) for conversation in conversation_lst
-    ]
-    results = await asyncio.gather(*generate_tasks, return_exceptions=True)
-    
-    for i, result in enumerate(results):
-        if isinstance(result, Exception):
-            # TODO: Handle exceptions individually
-            log.error(
-                f"Error processing conversation {i+1} (attempt {attempt}/{max_attempts}): {result}"
+    except LogicError as e:
+        log.error(f"Logic error while trying to pre-process conversation: {str(e)}")
+        for task in generate_tasks:
+            task.cancel()
+        raise e
+    except Exception as e:
+        log.error(f"Error while trying to pre-process conversation: {str(e)}")
+        for task in generate_tasks:
+            task.cancel()
+        raise e
+    except asyncio.CancelledError:
+        for task in generate_tasks:
+            task.cancel()
+        raise
+    log.info(f"Length of conversation list: {len(conversation_lst)} post split")
+    log.info(f"Token sum of conversation: {token_sum}")
+
+    pending: set[asyncio.Task] = set()
+    try:
+        if generate_tasks:
+            _, pending = await asyncio.wait(
+                generate_tasks, timeout=deadline.remaining_seconds
             )
-            remaining_conversations.append(conversation_lst[i])
+    finally:
+        # Cancelled with the request, or still running at the deadline
+        for task in generate_tasks:
+            if not task.done():
+                task.cancel()
+    if pending:
+        metrics.increment("inference_deadline_exceeded")
+        log.error(
+            f"Deadline exceeded before {len(pending)} of {len(generate_tasks)} conversations were processed"
+        )
+
+    chunk_results: list[ChunkResult] = []
+    for i, task in enumerate(generate_tasks):
+        chunk_result = ChunkResult(
+            chunk=i, messages=_message_range(conversation_lst[i])
+        )
+        if task in pending:
+            chunk_result.reason = "deadline_exceeded"
+            chunk_result.detail = "Request deadline exceeded"
+        elif task.exception() is not None:
+            log.error(f"Error processing conversation {i+1}: {task.exception()}")
+            chunk_result.reason = failure_reason(task.exception())
+            chunk_result.detail = str(task.exception())
         else:
-            notes.append(result)
+            chunk_result.notes, chunk_result.cached = task.result()
+        chunk_results.append(chunk_result)
+    log.info(
+        f"Notes of {sum(chunk_result.cached for chunk_result in chunk_results)} of {len(chunk_results)} conversations found in cache"
+    )
 
-    if remaining_conversations and attempt < max_attempts:
-        log.info(
-            f"Retrying summary generation for remaining {len(remaining_conversations)} conversations..."
+    if all(chunk_result.succeeded for chunk_result in chunk_results):
+        await notes_cache.set(
+            cache_key,
+            encode_notes(
+                notes=[chunk_result.notes for chunk_result in chunk_results],
+                token_sum=token_sum,
+            ),
+        )
+    return chunk_results, token_sum
+
+
+def _notes_cache_key(
+    generator: Generator, content_lst: list[Content]
+) -> Callable[[dict[str, Any], Optional[LLMType]], str]:
+    """Returns the function that computes the notes cache key of a conversation, or of a conversation chunk, for the generator and content types.
+
+    The key of a chunk is computed for the model that generated its notes, as every candidate model of the generator has its own prompts and config. Without a model, the key covers every candidate model, as the notes of a whole conversation may come from any of them.
+    """
+    candidates: dict[LLMType, tuple[Generator, str]] = {
+        candidate.llm_type: (
+            candidate,
+            candidate.prompt_version(content_lst=content_lst),
         )
-        return await generate(
-            conversation=remaining_conversations,
+        for candidate in generator.candidate_generators()
+    }
+
+    def _cache_key(
+        conversation: dict[str, Any], llm_type: Optional[LLMType] = None
+    ) -> str:
+        if llm_type is None:
+            return combined_cache_key(
+                [_cache_key(conversation, llm_type) for llm_type in candidates]
+            )
+        candidate, prompt_version = candidates[llm_type]
+        return notes_cache_key(
+            conversation=conversation,
             content_lst=content_lst,
-            attempt=attempt + 1,
-            max_attempts=max_attempts,
-            token_sum=token_sum,
+            llm_type=llm_type,
+            model_config=candidate.model_config,
+            prompt_version=prompt_version,
         )
-    elif remaining_conversations:
-        raise InferenceFailure(
-            f"Failed to post-process remaining {len(remaining_conversations)} conversations after {max_attempts} attempts."
+
+    return _cache_key
+
+
+async def _generate_chunk(
+    generator: Generator,
+    conversation_chunk: ConversationChunk,
+    content_lst: list[Content],
+    chunk_cache_key: Callable[[dict[str, Any], Optional[LLMType]], str],
+    budget: RetryBudget,
+    on_retry: Optional[Callable[[RetryEvent], None]] = None,
+    on_field: Optional[Callable[[str, Any], None]] = None,
+    deadline: Optional[Deadline] = None,
+) -> tuple[dict[str, Any], bool]:
+    """Returns the notes of a conversation chunk from the chunk notes cache, or generates them with retries and caches them under the model that generated them.
+
+    `on_retry` is called for every retry, and `on_field` with every field of the notes as soon as the model has generated it. The calls and the retries are bounded by the `deadline` of the request.
+
+    Returns:
+        tuple[dict[str, Any], bool]: The notes of the chunk, and whether they were served from the cache.
+    """
+    chunk_notes_cache: TieredCache = get_notes_cache(name=CHUNK_NOTES_CACHE)
+    chunk: dict[str, Any] = conversation_chunk.conversation.model_dump()
+    # The notes may have been generated by any candidate model, the model of the generator being preferred
+    cached_chunk_notes_lst: list[Optional[bytes]] = await asyncio.gather(
+        *(
+            chunk_notes_cache.get(chunk_cache_key(chunk, candidate.llm_type))
+            for candidate in generator.candidate_generators()
         )
+    )
+    cached_chunk_notes: Optional[bytes] = next(
+        (notes for notes in cached_chunk_notes_lst if notes is not None), None
+    )
+    if cached_chunk_notes is not None:
+        return json.loads(cached_chunk_notes), True
+    generated_notes: GeneratedNotes = await call_with_retry(
+        lambda: generator.generate(
+            conversation=conversation_chunk.conversation,
+            content_lst=content_lst,
+            conversation_tokens=conversation_chunk.tokens,
+            on_field=on_field,
+            deadline=deadline,
+        ),
+        budget=budget,
+        on_retry=on_retry,
+        deadline=deadline,
+    )
+    await chunk_notes_cache.set(
+        chunk_cache_key(chunk, generated_notes.llm_type),
+        json.dumps(generated_notes.notes).encode(),
+    )
+    return generated_notes.notes, False
+
+
+async def stream_generate(
+    conversation: dict[str, Any],
+    content_lst: list[Content],
+    deadline: Optional[Deadline] = None,
+) -> AsyncIterator[dict[str, Any]]:
+    """Generates the notes like `generate`, but yields the notes of every chunk as soon as they are ready, in the order in which the chunks complete.
+
+    The events are:
+    - `progress`: a chunk was sent to the LLM (`stage` is `pre_process`) or completed (`stage` is `generate`), with the number of chunks so far and the number completed and failed.
+    - `retry`: an attempt at a chunk failed and will be retried after `sleep_seconds`.
+    - `field`: a field of the notes of a chunk, as soon as the model has generated it. The fields of an attempt that is retried are sent again by the next attempt.
+    - `note`: the post-processed notes of a chunk, and whether they were served from the cache.
+    - `chunk_failed`: a chunk failed for good, or was still running at the deadline and was cancelled, with the reason and the range of its messages (see `ChunkResult`).
+    - `error`: the conversation could not be pre-processed. No other event follows.
+    - `summary`: the last event, with the token sum of the conversation, the failed and cached chunks and the time to the first note.
+
+    Args:
+        conversation (dict[str, Any]): The conversation to be summarised.
+        content_lst (list[Content]): The content types that the user wants to generate notes for.
+        deadline (Optional[Deadline], optional): The time by which the stream has to end. The notes that are ready by then are sent, and the summary follows right away. Defaults to None, which means no deadline.
+
+    Yields:
+        dict[str, Any]: The next event, with its type under `event`.
+    """
+    start: float = time.perf_counter()
+    time_to_first_note: Optional[float] = None
+    deadline = deadline or Deadline()
+
+    def _note_event(
+        chunk: int, chunk_notes: dict[str, Any], cached: bool
+    ) -> dict[str, Any]:
+        nonlocal time_to_first_note
+        if time_to_first_note is None:
+            time_to_first_note = time.perf_counter() - start
+            metrics.observe("inference_time_to_first_note_seconds", time_to_first_note)
+        return {"event": "note", "chunk": chunk, "notes": chunk_notes, "cached": cached}
+
+    generator = Generator(config=InferenceConfig())
+    notes_cache: TieredCache = get_notes_cache(name=NOTES_CACHE)
+    _cache_key: Callable[[dict[str, Any], Optional[LLMType]], str] = _notes_cache_key(
+        generator=generator, content_lst=content_lst
+    )
+    cache_key: str = _cache_key(conversation)
+    cached_notes: Optional[bytes] = await notes_cache.get(cache_key)
+    if cached_notes is not None:
+        log.info("Notes of conversation found in cache")
+        notes, token_sum = decode_notes(cached_notes)
+        for chunk, chunk_notes in enumerate(notes):
+            yield _note_event(chunk=chunk, chunk_notes=chunk_notes, cached=True)
+        yield {
+            "event": "summary",
+            "token_sum": token_sum.tokens,
+            "token_sum_error": token_sum.error,
+            "chunks": len(notes),
+            "failed_chunks": [],
+            "cached_chunks": list(range(len(notes))),
+            "time_to_first_note_seconds": time_to_first_note,
+        }
+        return
+
+    budget = RetryBudget()
+    # Retries and fields happen inside the chunk tasks, so they are handed over to the stream in order
+    chunk_events: list[dict[str, Any]] = []
+    chunk_events_ready = asyncio.Event()
+
+    def _push_chunk_event(chunk_event: dict[str, Any]):
+        chunk_events.append(chunk_event)
+        chunk_events_ready.set()
 
-    return notes, token_sum
+    chunk_tasks: dict[asyncio.Task, int] = {}
+    chunk_messages: list[Optional[dict[str, str]]] = []
+    next_chunk_event: Optional[asyncio.Task] = None
+    token_sum: TokenCount = TokenCount(tokens=0)
+    try:
+        try:
+            async for conversation_chunk in generator.stream_pre_process(
+                conversation=conversation, content_lst=content_lst
+            ):
+                chunk: int = len(chunk_tasks)
+                token_sum = conversation_chunk.token_sum
+                task: asyncio.Task = asyncio.create_task(
+                    _generate_chunk(
+                        generator=generator,
+                        conversation_chunk=conversation_chunk,
+                        content_lst=content_lst,
+                        chunk_cache_key=_cache_key,
+                        budget=budget,
+                        on_retry=lambda retry_event, chunk=chunk: _push_chunk_event(
+                            {"event": "retry", "chunk": chunk, **retry_event._asdict()}
+                        ),
+                        on_field=lambda field, value, chunk=chunk: _push_chunk_event(
+                            {
+                                "event": "field",
+                                "chunk": chunk,
+                                "field": field,
+                                "value": value,
+                            }
+                        ),
+                        deadline=deadline,
+                    )
+                )
+                chunk_tasks[task] = chunk
+                chunk_messages.append(_message_range(conversation_chunk.conversation))
+                yield {
+                    "event": "progress",
+                    "stage": "pre_process",
+                    "chunks": len(chunk_tasks),
+                    "completed": 0,
+                    "failed": 0,
+                }
+        except Exception as e:
+            log.error(f"Error while trying to pre-process conversation: {str(e)}")
+            yield {"event": "error", "detail": str(e)}
+            return
+
+        notes: list[Optional[dict[str, Any]]] = [None] * len(chunk_tasks)
+        cached_chunks: list[int] = []
+        failed_chunks: list[int] = []
+        pending: set[asyncio.Task] = set(chunk_tasks)
+        # The chunks and their events are awaited together, so that retries and fields are reported while their chunk is still running
+        while pending:
+            if next_chunk_event is None or next_chunk_event.done():
+                next_chunk_event = asyncio.create_task(chunk_events_ready.wait())
+            done, _ = await asyncio.wait(
+                pending | {next_chunk_event},
+                timeout=deadline.remaining_seconds,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            # A chunk pushes its events before it completes, so they are all sent before its notes
+            chunk_events_ready.clear()
+            while chunk_events:
+                yield chunk_events.pop(0)
+            for task in done & pending:
+                pending.remove(task)
+                chunk = chunk_tasks[task]
+                if task.exception() is not None:
+                    log.error(
+                        f"Error processing conversation {chunk + 1}: {task.exception()}"
+                    )
+                    failed_chunks.append(chunk)
+                    yield {
+                        "event": "chunk_failed",
+                        "chunk": chunk,
+                        "reason": failure_reason(task.exception()),
+                        "messages": chunk_messages[chunk],
+                        "detail": str(task.exception()),
+                    }
+                else:
+                    chunk_notes, cached = task.result()
+                    notes[chunk] = chunk_notes
+                    if cached:
+                        cached_chunks.append(chunk)
+                    yield _note_event(
+                        chunk=chunk, chunk_notes=chunk_notes, cached=cached
+                    )
+                yield {
+                    "event": "progress",
+                    "stage": "generate",
+                    "chunks": len(chunk_tasks),
+                    "completed": len(chunk_tasks) - len(pending) - len(failed_chunks),
+                    "failed": len(failed_chunks),
+                }
+            if pending and deadline.expired:
+                metrics.increment("inference_deadline_exceeded")
+                for task in pending:
+                    task.cancel()
+                    chunk = chunk_tasks[task]
+                    log.error(
+                        f"Deadline exceeded before conversation {chunk + 1} was processed"
+                    )
+                    failed_chunks.append(chunk)
+                    yield {
+                        "event": "chunk_failed",
+                        "chunk": chunk,
+                        "reason": "deadline_exceeded",
+                        "messages": chunk_messages[chunk],
+                        "detail": "Request deadline exceeded",
+                    }
+                pending.clear()
+        while chunk_events:
+            yield chunk_events.pop(0)
+
+        if not failed_chunks:
+            await notes_cache.set(
+                cache_key, encode_notes(notes=notes, token_sum=token_sum)
+            )
+        yield {
+            "event": "summary",
+            "token_sum": token_sum.tokens,
+            "token_sum_error": token_sum.error,
+            "chunks": len(chunk_tasks),
+            "failed_chunks": sorted(failed_chunks),
+            "cached_chunks": sorted(cached_chunks),
+            "time_to_first_note_seconds": time_to_first_note,
+        }
+    finally:
+        # The client may disconnect before the stream is exhausted
+        for task in chunk_tasks:
+            task.cancel()
+        if next_chunk_event is not None:
+            next_chunk_event.cancel()
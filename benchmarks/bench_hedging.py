@@ -0,0 +1,128 @@
+"""Compares the chunk latency and the extra calls with and without hedging, on simulated provider calls with a heavy tail.
+
+Most calls take about `--median-ms`, and `--slow-fraction` of them take `--slow-factor` times longer, like a provider that stalls now and then.
+
+    python -m benchmarks.bench_hedging --chunks 400 --percentile 90 95
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from typing import Any, Optional
+
+from app.llm.hedging import Hedger
+from app.llm.model import LLMType
+from app.metrics import percentile as nearest_rank_percentile
+
+LLM_TYPE = LLMType.OPENAI_GPT4
+
+
+class _SimulatedProvider:
+    """Sleeps like a provider call, and counts the calls that were made."""
+
+    def __init__(
+        self, median_seconds: float, slow_fraction: float, slow_factor: float, seed: int
+    ):
+        self._median_seconds = median_seconds
+        self._slow_fraction = slow_fraction
+        self._slow_factor = slow_factor
+        self._rng = random.Random(seed)
+        self.calls = 0
+
+    async def __call__(self) -> str:
+        self.calls += 1
+        seconds: float = self._median_seconds * self._rng.lognormvariate(0, 0.25)
+        if self._rng.random() < self._slow_fraction:
+            seconds *= self._slow_factor
+        await asyncio.sleep(seconds)
+        return "notes"
+
+
+async def _run(
+    percentile: Optional[float],
+    chunks: int,
+    concurrency: int,
+    max_extra_fraction: float,
+    provider: _SimulatedProvider,
+) -> dict[str, Any]:
+    """Runs `chunks` calls, `concurrency` at a time, and returns the p50 and p99 latency and the extra calls."""
+    hedger = Hedger(max_extra_fraction=max_extra_fraction)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def _chunk():
+        async with semaphore:
+            start: float = time.perf_counter()
+            if percentile is None:
+                await provider()
+            else:
+                await hedger.call(
+                    llm_type=LLM_TYPE,
+                    percentile=percentile,
+                    primary=provider,
+                    hedge=provider,
+                )
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[_chunk() for _ in range(chunks)])
+    sorted_latencies: list[float] = sorted(latencies)
+    # Imported under another name, as `percentile` is the argument here
+    return {
+        "p50": nearest_rank_percentile(sorted_values=sorted_latencies, percentile=50),
+        "p99": nearest_rank_percentile(sorted_values=sorted_latencies, percentile=99),
+        "extra_calls": provider.calls / chunks - 1,
+    }
+
+
+async def main(
+    chunks: int,
+    concurrency: int,
+    percentiles: list[float],
+    max_extra_fraction: float,
+    median_seconds: float,
+    slow_fraction: float,
+    slow_factor: float,
+):
+    print(f"{'hedging':>10} {'p50 ms':>9} {'p99 ms':>9} {'extra calls':>11}")
+    for percentile in [None, *percentiles]:
+        provider = _SimulatedProvider(
+            median_seconds=median_seconds,
+            slow_fraction=slow_fraction,
+            slow_factor=slow_factor,
+            seed=0,
+        )
+        result: dict[str, Any] = await _run(
+            percentile=percentile,
+            chunks=chunks,
+            concurrency=concurrency,
+            max_extra_fraction=max_extra_fraction,
+            provider=provider,
+        )
+        label: str = "off" if percentile is None else f"p{percentile:g}"
+        print(
+            f"{label:>10} {result['p50'] * 1000:>9.1f} {result['p99'] * 1000:>9.1f} {result['extra_calls']:>10.1%}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--percentile", type=float, nargs="+", default=[90, 95])
+    parser.add_argument("--max-extra-fraction", type=float, default=0.1)
+    parser.add_argument("--median-ms", type=float, default=50)
+    parser.add_argument("--slow-fraction", type=float, default=0.05)
+    parser.add_argument("--slow-factor", type=float, default=10)
+    args = parser.parse_args()
+    asyncio.run(
+        main(
+            chunks=args.chunks,
+            concurrency=args.concurrency,
+            percentiles=args.percentile,
+            max_extra_fraction=args.max_extra_fraction,
+            median_seconds=args.median_ms / 1000,
+            slow_fraction=args.slow_fraction,
+            slow_factor=args.slow_factor,
+        )
+    )
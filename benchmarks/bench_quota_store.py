@@ -0,0 +1,70 @@
+"""Measures the acquire throughput of the SQLite quota store with several worker processes competing for the same bucket.
+
+python -m benchmarks.bench_quota_store --processes 8 --acquires 5000
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from app.llm.quota_store import SQLiteQuotaStore
+
+
+def _worker(path: str, acquires: int, start_event, results):
+    store = SQLiteQuotaStore(path=path)
+    latencies: list[float] = []
+    start_event.wait()
+    for _ in range(acquires):
+        start: float = time.perf_counter()
+        store.try_acquire(
+            key="openai:benchmark:gpt-4o-mini-2024-07-18:requests",
+            amount=1,
+            capacity=1e12,
+            refill_per_second=1e9,
+        )
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+
+def main(processes: int, acquires: int):
+    with tempfile.TemporaryDirectory() as directory:
+        path: str = os.path.join(directory, "quota.sqlite")
+        SQLiteQuotaStore(path=path)
+        context = multiprocessing.get_context("spawn")
+        start_event = context.Event()
+        results = context.Queue()
+        workers = [
+            context.Process(target=_worker, args=(path, acquires, start_event, results))
+            for _ in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        # Give every process time to import and open its connection
+        time.sleep(1)
+        start: float = time.perf_counter()
+        start_event.set()
+        latencies: list[float] = sorted(
+            latency for _ in workers for latency in results.get()
+        )
+        elapsed: float = time.perf_counter() - start
+        for worker in workers:
+            worker.join()
+
+    total: int = processes * acquires
+    print(
+        f"{'processes':>9} {'acquires':>9} {'acquires/s':>11} {'p50 us':>8} {'p99 us':>8}"
+    )
+    print(
+        f"{processes:>9} {total:>9} {total / elapsed:>11.0f} "
+        f"{latencies[len(latencies) // 2] * 1e6:>8.0f} {latencies[int(len(latencies) * 0.99)] * 1e6:>8.0f}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--acquires", type=int, default=5000)
+    args = parser.parse_args()
+    main(processes=args.processes, acquires=args.acquires)
@@ -0,0 +1,119 @@
+"""Compares exact and approximate token counting in pre_process on large conversations.
+
+Requires the tokenizer files to be available locally (see CODELLAMA_TOKENIZER_PATH and TIKTOKEN_CACHE_DIR in the README).
+
+    python -m benchmarks.bench_token_counting --messages 200 1000 5000 --tokenizer codellama
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from typing import Any
+
+from app.control.pre.generator import pre_process
+from app.llm.token_count import (
+    CALIBRATION_SAMPLES,
+    TokenCountMode,
+    calibrate_token_estimators,
+)
+from app.llm.tokenizer import TokenizerType, load_tokenizers
+from app.metrics import metrics
+
+
+def _make_conversation(number_of_messages: int, seed: int) -> dict[str, Any]:
+    """Builds a synthetic conversation by stitching together fragments of the calibration samples."""
+    rng = random.Random(seed)
+    conversation: dict[str, Any] = {"title": "Benchmark conversation"}
+    for index in range(number_of_messages):
+        role: str = "UserMessage" if index % 2 == 0 else "AssistantMessage"
+        fragments: list[str] = rng.choices(CALIBRATION_SAMPLES, k=rng.randint(1, 6))
+        conversation[f"{role}{index // 2 + 1}"] = "\n\n".join(fragments)
+    return conversation
+
+
+async def _run(
+    conversation: dict[str, Any],
+    max_input_tokens: int,
+    token_count_mode: TokenCountMode,
+    tokenizer_type: TokenizerType,
+    repeats: int,
+) -> dict[str, Any]:
+    """Runs pre_process `repeats` times and returns the best wall time along with the result of the last run."""
+    best_seconds: float = float("inf")
+    for _ in range(repeats):
+        metrics.reset()
+        start: float = time.perf_counter()
+        conversation_lst, token_sum = await pre_process(
+            conversation=conversation,
+            max_input_tokens=max_input_tokens,
+            token_count_mode=token_count_mode,
+            tokenizer_type=tokenizer_type,
+        )
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+    counters: dict[str, float] = metrics.snapshot()["counters"]
+    return {
+        "seconds": best_seconds,
+        "chunks": len(conversation_lst),
+        "token_sum": token_sum,
+        "tokenized": int(counters.get("pre_process_messages_tokenized", 0)),
+    }
+
+
+async def main(
+    message_counts: list[int],
+    max_input_tokens: int,
+    tokenizer_type: TokenizerType,
+    repeats: int,
+):
+    load_tokenizers(tokenizer_types=[tokenizer_type])
+    calibrate_token_estimators(tokenizer_types=[tokenizer_type])
+    print(
+        f"{'messages':>8} {'mode':>12} {'ms':>9} {'tokenized':>9} {'chunks':>6} {'token_sum':>16} {'real error':>10}"
+    )
+    for number_of_messages in message_counts:
+        conversation: dict[str, Any] = _make_conversation(
+            number_of_messages=number_of_messages, seed=number_of_messages
+        )
+        exact: dict[str, Any] = await _run(
+            conversation,
+            max_input_tokens,
+            TokenCountMode.EXACT,
+            tokenizer_type,
+            repeats,
+        )
+        approximate: dict[str, Any] = await _run(
+            conversation,
+            max_input_tokens,
+            TokenCountMode.APPROXIMATE,
+            tokenizer_type,
+            repeats,
+        )
+        for mode, result in (("exact", exact), ("approximate", approximate)):
+            real_error: int = result["token_sum"].tokens - exact["token_sum"].tokens
+            print(
+                f"{number_of_messages:>8} {mode:>12} {result['seconds'] * 1000:>9.1f} {result['tokenized']:>9} "
+                f"{result['chunks']:>6} {result['token_sum'].tokens:>8} +/-{result['token_sum'].error:<5} {real_error:>10}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, nargs="+", default=[200, 1000, 5000])
+    parser.add_argument("--max-input-tokens", type=int, default=3000)
+    parser.add_argument(
+        "--tokenizer",
+        type=TokenizerType,
+        choices=list(TokenizerType),
+        default=TokenizerType.CODELLAMA,
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(
+        main(
+            message_counts=args.messages,
+            max_input_tokens=args.max_input_tokens,
+            tokenizer_type=args.tokenizer,
+            repeats=args.repeats,
+        )
+    )
@@ -0,0 +1,145 @@
+import asyncio
+from contextlib import nullcontext
+from unittest.mock import patch
+
+import pytest
+
+from app.cache.idempotency import (
+    IdempotencyStore,
+    IdempotentExecutor,
+    IdempotentResponse,
+)
+from app.exceptions.exception import IdempotencyConflict
+
+RESPONSE = IdempotentResponse(status_code=200, body=b'{"result": []}')
+
+
+class Job:
+    def __init__(self, response=RESPONSE, error=None):
+        self.response = response
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        if self.error:
+            raise self.error
+        return self.response
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = IdempotencyStore(
+        path=str(tmp_path / "idempotency.sqlite"),
+        retention_seconds=100,
+        lock_timeout_seconds=10,
+    )
+    yield store
+    store.close()
+
+
+def test_executor_replays_completed_response(store):
+    job = Job()
+
+    async def _run():
+        executor = IdempotentExecutor(store=store)
+        first = await executor.run(key="key", fingerprint="a", fn=job)
+        second = await executor.run(key="key", fingerprint="a", fn=job)
+        return first, second
+
+    assert asyncio.run(_run()) == ((RESPONSE, False), (RESPONSE, True))
+    assert job.calls == 1
+
+
+def test_executor_retry_waits_for_running_request(store):
+    job = Job()
+
+    async def _run():
+        executor = IdempotentExecutor(store=store)
+        return await asyncio.gather(
+            executor.run(key="key", fingerprint="a", fn=job),
+            executor.run(key="key", fingerprint="a", fn=job),
+        )
+
+    assert asyncio.run(_run()) == [(RESPONSE, False), (RESPONSE, True)]
+    assert job.calls == 1
+
+
+def test_executor_completes_request_after_client_disconnects(store):
+    job = Job()
+
+    async def _run():
+        executor = IdempotentExecutor(store=store)
+        first = asyncio.create_task(executor.run(key="key", fingerprint="a", fn=job))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0.1)
+        return await executor.run(key="key", fingerprint="a", fn=job)
+
+    assert asyncio.run(_run()) == (RESPONSE, True)
+    assert job.calls == 1
+
+
+def test_executor_waits_for_request_in_other_worker(tmp_path):
+    path = str(tmp_path / "idempotency.sqlite")
+    job = Job()
+
+    async def _run():
+        workers = [
+            IdempotentExecutor(store=IdempotencyStore(path=path)) for _ in range(2)
+        ]
+        with patch("app.cache.idempotency.IDEMPOTENCY_POLL_SECONDS", 0.01):
+            return await asyncio.gather(
+                *(worker.run(key="key", fingerprint="a", fn=job) for worker in workers)
+            )
+
+    # Either worker may claim the key first, as the store is called from a thread
+    results = asyncio.run(_run())
+    assert sorted(results, key=lambda result: result[1]) == [
+        (RESPONSE, False),
+        (RESPONSE, True),
+    ]
+    assert job.calls == 1
+
+
+def test_executor_rejects_key_reused_with_different_request(store):
+    async def _run():
+        executor = IdempotentExecutor(store=store)
+        await executor.run(key="key", fingerprint="a", fn=Job())
+        await executor.run(key="key", fingerprint="b", fn=Job())
+
+    with pytest.raises(IdempotencyConflict):
+        asyncio.run(_run())
+
+
+FAILURE_DATA = [
+    {"error": ValueError("failed")},
+    {"response": IdempotentResponse(status_code=400, body=b"{}")},
+    {"response": IdempotentResponse(status_code=200, body=b"{}", complete=False)},
+]
+
+
+@pytest.mark.parametrize("kwargs", FAILURE_DATA)
+def test_executor_reruns_failed_request(store, kwargs):
+    async def _run():
+        executor = IdempotentExecutor(store=store)
+        with pytest.raises(ValueError) if "error" in kwargs else nullcontext():
+            await executor.run(key="key", fingerprint="a", fn=Job(**kwargs))
+        return await executor.run(key="key", fingerprint="a", fn=Job())
+
+    assert asyncio.run(_run()) == (RESPONSE, False)
+
+
+def test_store_expires_and_compacts_requests(store):
+    with patch("app.cache.idempotency.time.time", return_value=1000):
+        assert store.claim(key="completed", fingerprint="a") is None
+        store.complete(key="completed", response=RESPONSE)
+        assert store.claim(key="running", fingerprint="a") is None
+    with patch("app.cache.idempotency.time.time", return_value=1050):
+        assert store.claim(key="completed", fingerprint="a").response == RESPONSE
+        # The worker running the request is assumed to have died
+        assert store.claim(key="running", fingerprint="a") is None
+    with patch("app.cache.idempotency.time.time", return_value=1101):
+        assert store.compact() == 2
+        assert store.claim(key="completed", fingerprint="a") is None
@@ -0,0 +1,56 @@
+import pytest
+
+from app.cache.keys import notes_cache_key
+from app.llm.model import LLMType
+from app.models.content import Content
+
+CONVERSATION = {
+    "title": "Sorting",
+    "UserMessage1": "How does quicksort work?",
+    "AssistantMessage1": "It partitions the array around a pivot.",
+}
+
+
+def _key(
+    conversation=CONVERSATION,
+    content_lst=[Content.MCQ, Content.CODE],
+    llm_type=LLMType.OPENAI_GPT4,
+    prompt_version="v1",
+):
+    return notes_cache_key(
+        conversation=conversation,
+        content_lst=content_lst,
+        llm_type=llm_type,
+        model_config=llm_type.default_config(),
+        prompt_version=prompt_version,
+    )
+
+
+SAME_KEY_DATA = [
+    {"conversation": dict(reversed(list(CONVERSATION.items())))},
+    {
+        "conversation": {
+            **CONVERSATION,
+            "UserMessage1": "  How does quicksort work?\r\n",
+        }
+    },
+    {"content_lst": [Content.CODE, Content.MCQ]},
+]
+
+
+@pytest.mark.parametrize("kwargs", SAME_KEY_DATA)
+def test_notes_cache_key_ignores_insignificant_changes(kwargs):
+    assert _key(**kwargs) == _key()
+
+
+DIFFERENT_KEY_DATA = [
+    {"conversation": {**CONVERSATION, "UserMessage1": "How does mergesort work?"}},
+    {"content_lst": [Content.MCQ]},
+    {"llm_type": LLMType.OPENAI_GPT3_5},
+    {"prompt_version": "v2"},
+]
+
+
+@pytest.mark.parametrize("kwargs", DIFFERENT_KEY_DATA)
+def test_notes_cache_key_covers_request(kwargs):
+    assert _key(**kwargs) != _key()
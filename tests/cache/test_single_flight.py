@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from app.cache.single_flight import SingleFlight
+from app.metrics import metrics
+
+
+class SlowCall:
+    def __init__(self, result="notes", error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.cancelled = False
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise self.error
+        return self.result
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    metrics.reset()
+    flight = SingleFlight(name="test")
+    fn = SlowCall()
+
+    async def _run():
+        return await asyncio.gather(*(flight.do("key", fn) for _ in range(5)))
+
+    assert asyncio.run(_run()) == ["notes"] * 5
+    assert fn.calls == 1
+    assert flight.in_flight() == 0
+    assert metrics.snapshot()["counters"]["single_flight_coalesced{flight=test}"] == 4
+
+
+def test_single_flight_raises_error_to_every_caller():
+    flight = SingleFlight(name="test")
+    fn = SlowCall(error=ValueError("invalid"))
+
+    async def _run():
+        return await asyncio.gather(
+            *(flight.do("key", fn) for _ in range(2)), return_exceptions=True
+        )
+
+    results = asyncio.run(_run())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert fn.calls == 1
+
+
+def test_single_flight_keeps_call_while_callers_remain():
+    flight = SingleFlight(name="test")
+    fn = SlowCall()
+
+    async def _run():
+        leaving = asyncio.create_task(flight.do("key", fn))
+        staying = asyncio.create_task(flight.do("key", fn))
+        await asyncio.sleep(0.01)
+        leaving.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leaving
+        return await staying
+
+    assert asyncio.run(_run()) == "notes"
+    assert not fn.cancelled
+
+
+def test_single_flight_cancels_call_when_every_caller_left():
+    flight = SingleFlight(name="test")
+    fn = SlowCall()
+
+    async def _run():
+        callers = [asyncio.create_task(flight.do("key", fn)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        # A new caller starts a new call
+        return await flight.do("key", fn)
+
+    assert asyncio.run(_run()) == "notes"
+    assert fn.cancelled
+    assert fn.calls == 2
@@ -0,0 +1,161 @@
+import asyncio
+import sqlite3
+import threading
+from unittest.mock import patch
+
+from app.cache.memory import MemoryCache
+from app.cache.redis import RedisCache
+from app.cache.sqlite import SQLiteCache
+from app.cache.tiered import TieredCache
+from app.metrics import metrics
+
+
+def test_memory_cache_evicts_least_recently_used():
+    async def _run():
+        cache = MemoryCache(max_bytes=10)
+        await cache.set("a", b"aaaa")
+        await cache.set("b", b"bbbb")
+        assert await cache.get("a") == b"aaaa"
+        await cache.set("c", b"cccc")
+        assert await cache.get("b") is None
+        assert await cache.get("a") == b"aaaa"
+        assert cache.bytes_stored == 8
+
+    asyncio.run(_run())
+
+
+def test_memory_cache_expires_entries():
+    async def _run():
+        cache = MemoryCache(max_bytes=100)
+        with patch("app.cache.memory.time.time", return_value=1000):
+            await cache.set("a", b"value", ttl_seconds=10)
+        with patch("app.cache.memory.time.time", return_value=1005):
+            assert await cache.get("a") == b"value"
+        with patch("app.cache.memory.time.time", return_value=1011):
+            assert await cache.get("a") is None
+        assert cache.bytes_stored == 0
+
+    asyncio.run(_run())
+
+
+def test_sqlite_cache_persists_and_evicts(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+
+    async def _run():
+        cache = SQLiteCache(path=path, max_bytes=10)
+        with patch("app.cache.sqlite.time.time", return_value=1000):
+            await cache.set("a", b"aaaa")
+        with patch("app.cache.sqlite.time.time", return_value=1001):
+            await cache.set("b", b"bbbb")
+        with patch("app.cache.sqlite.time.time", return_value=1002):
+            assert await cache.get("a") == b"aaaa"
+        with patch("app.cache.sqlite.time.time", return_value=1003):
+            await cache.set("c", b"cccc", ttl_seconds=10)
+        await cache.close()
+
+        reopened = SQLiteCache(path=path, max_bytes=10)
+        assert reopened.bytes_stored == 8
+        with patch("app.cache.sqlite.time.time", return_value=1004):
+            assert await reopened.get("b") is None
+            assert await reopened.get("a") == b"aaaa"
+            assert await reopened.get("c") == b"cccc"
+        with patch("app.cache.sqlite.time.time", return_value=1020):
+            assert await reopened.get("c") is None
+        assert reopened.bytes_stored == 4
+        await reopened.close()
+
+    asyncio.run(_run())
+
+
+def test_sqlite_cache_waits_for_write_lock_off_event_loop(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+
+    async def _run():
+        cache = SQLiteCache(path=path, max_bytes=100)
+        # Another worker holds the write lock for a while
+        other_worker = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        other_worker.execute("BEGIN IMMEDIATE")
+        threading.Timer(0.3, other_worker.execute, args=("COMMIT",)).start()
+        ticks = 0
+
+        async def _tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(_tick())
+        await asyncio.gather(*(cache.set(key, b"value") for key in "abc"))
+        ticker.cancel()
+        assert [await cache.get(key) for key in "abc"] == [b"value"] * 3
+        await cache.close()
+        return ticks
+
+    # The event loop kept running while the writes waited for the lock
+    assert asyncio.run(_run()) > 5
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+        self.expiries = {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.expiries[key] = ex
+
+    async def delete(self, key):
+        self.values.pop(key, None)
+
+    async def aclose(self):
+        pass
+
+
+def test_tiered_cache_promotes_hits_and_exports_metrics():
+    metrics.reset()
+    redis = FakeRedis()
+
+    async def _run():
+        memory = MemoryCache(max_bytes=100)
+        cache = TieredCache(
+            name="notes",
+            tiers=[memory, RedisCache(client=redis)],
+            ttl_seconds=60,
+        )
+        assert await cache.get("key") is None
+        await RedisCache(client=redis).set("notes:key", b"notes")
+        assert await cache.get("key") == b"notes"
+        assert await memory.get("notes:key") == b"notes"
+        assert await cache.get("key") == b"notes"
+
+    asyncio.run(_run())
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"]["cache_hits{cache=notes,tier=memory}"] == 1
+    assert snapshot["counters"]["cache_hits{cache=notes,tier=redis}"] == 1
+    assert snapshot["counters"]["cache_misses{cache=notes,tier=memory}"] == 2
+    assert snapshot["gauges"]["cache_hit_ratio{cache=notes}"] == 2 / 3
+    assert snapshot["gauges"]["cache_bytes_stored{cache=notes,tier=memory}"] == 5
+    assert redis.expiries["brain:notes:key"] is None
+
+
+def test_tiered_cache_treats_failing_tier_as_miss():
+    class BrokenTier(MemoryCache):
+        name = "broken"
+
+        async def get(self, key):
+            raise ConnectionError("unavailable")
+
+        async def set(self, key, value, ttl_seconds=None):
+            raise ConnectionError("unavailable")
+
+    async def _run():
+        cache = TieredCache(name="notes", tiers=[BrokenTier(max_bytes=100)])
+        await cache.set("key", b"notes")
+        assert await cache.get("key") is None
+
+    asyncio.run(_run())
@@ -5,6 +5,7 @@ from app.control.post.generator import (
     post_process,
     _verify_expected_similarity_and_difference, 
     _verify_todo_marker_presence, 
+    validate_field,
 )
 from app.exceptions.exception import LogicError
 
@@ -13,6 +14,7 @@ POST_PROCESS_VALID_DATA = [
     (
         "Good topic",
         "A good goal",
+        "A good context",
         "A good overview",
         [
            {
@@ -46,6 +48,7 @@ POST_PROCESS_VALID_DATA = [
         {
             "topic": "Good topic",
             "goal": "A good goal",
+            "context": "A good context",
             "overview": "A good overview",
             "key_concepts": [
                 {
@@ -81,14 +84,15 @@ POST_PROCESS_VALID_DATA = [
 ]
 
 
-@pytest.mark.parametrize("topic, goal, overview, key_concepts_lst, tips_lst, mcq_practice, code_practice, expected", POST_PROCESS_VALID_DATA)
-def test_post_process_valid(topic, goal, overview, key_concepts_lst, tips_lst, mcq_practice, code_practice, expected):
-    assert post_process(topic=topic, goal=goal, overview=overview, key_concepts_lst=key_concepts_lst, tips_lst=tips_lst,  mcq_practice=mcq_practice, code_practice=code_practice) == expected
+@pytest.mark.parametrize("topic, goal, context, overview, key_concepts_lst, tips_lst, mcq_practice, code_practice, expected", POST_PROCESS_VALID_DATA)
+def test_post_process_valid(topic, goal, context, overview, key_concepts_lst, tips_lst, mcq_practice, code_practice, expected):
+    assert post_process(topic=topic, goal=goal, context=context, overview=overview, key_concepts_lst=key_concepts_lst, tips_lst=tips_lst,  mcq_practice=mcq_practice, code_practice=code_practice) == expected
 
 POST_PROCESS_INVALID_DATA = [
     (
         "Good topic",
         "A good goal",
+        "A good context",
         "A good overview",
         [
            {
@@ -123,6 +127,7 @@ POST_PROCESS_INVALID_DATA = [
     (
         "Good topic",
         "A good goal",
+        "A good context",
         123,
         [
            {
@@ -157,10 +162,10 @@ POST_PROCESS_INVALID_DATA = [
 ]
 
 
-@pytest.mark.parametrize("topic, goal, overview, key_concepts_lst, tips_lst, mcq_practice, code_practice", POST_PROCESS_INVALID_DATA)
-def test_post_process_invalid(topic, goal, overview, key_concepts_lst, tips_lst, mcq_practice, code_practice):
+@pytest.mark.parametrize("topic, goal, context, overview, key_concepts_lst, tips_lst, mcq_practice, code_practice", POST_PROCESS_INVALID_DATA)
+def test_post_process_invalid(topic, goal, context, overview, key_concepts_lst, tips_lst, mcq_practice, code_practice):
     with pytest.raises(LogicError):
-        post_process(topic=topic, goal=goal, overview=overview, key_concepts_lst=key_concepts_lst, tips_lst=tips_lst, mcq_practice=mcq_practice, code_practice=code_practice)
+        post_process(topic=topic, goal=goal, context=context, overview=overview, key_concepts_lst=key_concepts_lst, tips_lst=tips_lst, mcq_practice=mcq_practice, code_practice=code_practice)
 
 
 REJECT_UNLIKELY_TOPICS_ACCEPTED_DATA = [
@@ -423,4 +428,43 @@ def test():
 @pytest.mark.parametrize("half_completed_code", VERIFY_TODO_MARKER_PRESENCE_INVALID_DATA)
 def test_invalid_verify_todo_marker_presence(half_completed_code):
     with pytest.raises(ValueError):
-        _verify_todo_marker_presence(half_completed_code=half_completed_code)
\ No newline at end of file
+        _verify_todo_marker_presence(half_completed_code=half_completed_code)
+
+
+VALIDATE_FIELD_VALID_DATA = [
+    ("topic", "Good topic"),
+    ("goal", "A good goal"),
+    ("tips", None),
+    ("mcq_practice", None),
+    ("unknown_field", 42),
+]
+
+
+@pytest.mark.parametrize("field, value", VALIDATE_FIELD_VALID_DATA)
+def test_validate_field_valid(field, value):
+    assert validate_field(field=field, value=value) == None
+
+
+VALIDATE_FIELD_INVALID_DATA = [
+    ("topic", "Topic"),
+    ("overview", ["Not", "a", "string"]),
+    ("key_concepts", "Not a list"),
+    (
+        "code_practice",
+        {
+            "code_practice_half_completed_code": "print(1)",
+            "code_practice_fully_completed_code": "print(1)",
+        },
+    ),
+    ("mcq_practice", {"mcq_practice_title": "A title"}),
+    (
+        "code_practice",
+        {"code_practice_half_completed_code": "# TODO: Add the missing line(s) below."},
+    ),
+]
+
+
+@pytest.mark.parametrize("field, value", VALIDATE_FIELD_INVALID_DATA)
+def test_validate_field_invalid(field, value):
+    with pytest.raises(LogicError):
+        validate_field(field=field, value=value)
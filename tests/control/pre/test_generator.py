@@ -1,9 +1,21 @@
+import asyncio
+import json
 from unittest.mock import MagicMock, patch
 
 import pytest
 
-from app.control.pre.generator import _split_by_token_length, pre_process
+from app.control.pre.generator import (
+    MAX_CONVERSATION_TOKENS,
+    _find_ambiguous_indices,
+    _split_by_token_length,
+    _truncate_to_token_cap,
+    pre_process,
+    stream_pre_process,
+)
+from app.control.pre.partition import ChunkingMode
 from app.exceptions.exception import LogicError
+from app.llm.token_count import TokenCount, TokenCountMode
+from app.llm.tokenizer import BatchTokenizer, HuggingFaceTokenizer
 from app.models.conversation import Conversation
 
 
@@ -11,16 +23,34 @@ from app.models.conversation import Conversation
 def mock_tokenizer():
     mock = MagicMock()
     # Set a higher token count for each element
-    mock.return_value.__getitem__.return_value = {"input_ids": [0] * 60}
+    mock.side_effect = lambda texts, **kwargs: {"input_ids": [[0] * 60 for _ in texts]}
     return mock
 
 
-# This must match the number of XMessage in the fixture below
-MOCK_TOKENIZER_CALL_COUNT = 3
+@pytest.fixture
+def tokenizer(mock_tokenizer):
+    with patch(
+        "app.llm.tokenizer.AutoTokenizer.from_pretrained",
+        return_value=mock_tokenizer,
+    ):
+        service = BatchTokenizer(
+            tokenizer=HuggingFaceTokenizer(name="codellama", path="codellama"),
+            workers=2,
+            max_batch_chars=10_000,
+        )
+        with patch(
+            "app.control.pre.generator.get_batch_tokenizer", return_value=service
+        ):
+            yield service
+
+
+# All messages of the conversation are tokenized in one batched call
+MOCK_TOKENIZER_CALL_COUNT = 1
 # This must match the token length of the content in the fixture below
 TOKEN_SPLIT_VALID_DATA = [
-    (150, 1),
-    (2, 2),
+    (200, 1),
+    (150, 2),
+    (100, 3),
 ]
 
 
@@ -43,40 +73,277 @@ def invalid_conversation_dict():
     "max_input_tokens, expected_number_of_splits", TOKEN_SPLIT_VALID_DATA
 )
 def test_pre_process(
-    max_input_tokens, expected_number_of_splits, mock_tokenizer, valid_conversation_dict
+    max_input_tokens,
+    expected_number_of_splits,
+    mock_tokenizer,
+    tokenizer,
+    valid_conversation_dict,
 ):
-    with patch(
-        "app.control.pre.generator.AutoTokenizer.from_pretrained",
-        return_value=mock_tokenizer,
-    ):
-        result, token_sum = pre_process(
+    result, token_sum = asyncio.run(
+        pre_process(
             conversation=valid_conversation_dict, max_input_tokens=max_input_tokens
         )
-        assert mock_tokenizer.call_count == MOCK_TOKENIZER_CALL_COUNT
-        assert len(result) == expected_number_of_splits
-        for conversation in result:
-            assert isinstance(conversation, Conversation)
+    )
+    assert mock_tokenizer.call_count == MOCK_TOKENIZER_CALL_COUNT
+    assert len(result) == expected_number_of_splits
+    assert token_sum == TokenCount(tokens=180)
+    for conversation in result:
+        assert isinstance(conversation, Conversation)
 
 
 def test_pre_process_with_invalid_input(invalid_conversation_dict):
     with pytest.raises(LogicError):
-        pre_process(conversation=invalid_conversation_dict, max_input_tokens=100)
+        asyncio.run(
+            pre_process(conversation=invalid_conversation_dict, max_input_tokens=100)
+        )
 
 
 @pytest.mark.parametrize(
     "max_input_tokens, expected_number_of_splits", TOKEN_SPLIT_VALID_DATA
 )
 def test_split_by_token_length(
-    max_input_tokens, expected_number_of_splits, mock_tokenizer, valid_conversation_dict
+    max_input_tokens, expected_number_of_splits, valid_conversation_dict
 ):
-    with patch(
-        "app.control.pre.generator.AutoTokenizer.from_pretrained",
-        return_value=mock_tokenizer,
-    ):
-        result, token_sum = _split_by_token_length(
-            valid_conversation_dict, max_input_tokens
+    token_dict = {
+        "UserMessage1": TokenCount(tokens=60),
+        "AssistantMessage1": TokenCount(tokens=60),
+        "UserMessage2": TokenCount(tokens=60),
+    }
+    result = _split_by_token_length(
+        valid_conversation_dict, token_dict, max_input_tokens
+    )
+    assert len(result) == expected_number_of_splits
+    for conversation in result:
+        assert isinstance(conversation, Conversation)
+        assert (
+            sum(token_dict[key].tokens for key in conversation.model_extra)
+            <= max_input_tokens
+        )
+
+
+def test_split_by_token_length_uses_upper_bound_of_estimates(valid_conversation_dict):
+    token_dict = {
+        "UserMessage1": TokenCount(tokens=60, error=10),
+        "AssistantMessage1": TokenCount(tokens=60, error=10),
+        "UserMessage2": TokenCount(tokens=60),
+    }
+    result = _split_by_token_length(valid_conversation_dict, token_dict, 130)
+    assert len(result) == 2
+
+
+def test_split_by_token_length_keeps_turns_together(valid_conversation_dict):
+    token_dict = {
+        "UserMessage1": TokenCount(tokens=40),
+        "AssistantMessage1": TokenCount(tokens=40),
+        "UserMessage2": TokenCount(tokens=40),
+    }
+    result = _split_by_token_length(valid_conversation_dict, token_dict, 100)
+    assert [list(conversation.model_extra) for conversation in result] == [
+        ["UserMessage1", "AssistantMessage1"],
+        ["UserMessage2"],
+    ]
+
+
+def test_truncate_to_token_cap():
+    token_dict = {
+        f"UserMessage{i}": TokenCount(tokens=MAX_CONVERSATION_TOKENS // 3)
+        for i in range(1, 6)
+    }
+    truncated_token_dict, token_sum = _truncate_to_token_cap(token_dict)
+    # The message that crosses the cap is kept, the ones after it are dropped
+    assert list(truncated_token_dict) == [f"UserMessage{i}" for i in range(1, 5)]
+    assert token_sum.tokens > MAX_CONVERSATION_TOKENS
+
+
+def test_pre_process_splits_oversized_message(tokenizer, mock_tokenizer):
+    # One token per four characters
+    mock_tokenizer.side_effect = lambda texts, **kwargs: {
+        "input_ids": [[0] * (len(text) // 4) for text in texts]
+    }
+    sentence = "This sentence is exactly forty chars.. "
+    conversation = {
+        "title": "Test Conversation",
+        "UserMessage1": sentence * 30,
+        "AssistantMessage1": "Short answer.",
+    }
+    result, _ = asyncio.run(
+        pre_process(conversation=conversation, max_input_tokens=100)
+    )
+    keys = [key for conversation in result for key in conversation.model_extra]
+    assert keys[0] == "UserMessage1_part1"
+    assert keys[-1] == "AssistantMessage1"
+    assert (
+        "".join(
+            conversation.model_extra[key]
+            for conversation in result
+            for key in conversation.model_extra
+            if key.startswith("UserMessage1")
+        )
+        == sentence * 30
+    )
+    for conversation in result:
+        assert (
+            sum(
+                len(json.dumps(value)) // 4
+                for value in conversation.model_extra.values()
+            )
+            <= 100
         )
-        assert mock_tokenizer.call_count == MOCK_TOKENIZER_CALL_COUNT
-        assert len(result) == expected_number_of_splits
-        for conversation in result:
-            assert isinstance(conversation, Conversation)
+
+
+FIND_AMBIGUOUS_INDICES_DATA = [
+    # Everything fits comfortably into one chunk
+    ([TokenCount(tokens=10, error=2)] * 5, 100, []),
+    # The boundary between the two chunks may move by one message either way
+    ([TokenCount(tokens=30, error=5)] * 4, 95, [1, 2]),
+    # The chunks are balanced, so the boundary is in the middle and not where a greedy split would put it
+    ([TokenCount(tokens=10, error=1)] * 10, 80, [4, 5]),
+    # The conversation may or may not need a second chunk
+    ([TokenCount(tokens=30, error=5)] * 3, 95, [0, 1, 2]),
+    # The running total may or may not cross the hard cap on the last message
+    (
+        [TokenCount(tokens=MAX_CONVERSATION_TOKENS // 2, error=10)] * 2,
+        2 * MAX_CONVERSATION_TOKENS,
+        [1],
+    ),
+]
+
+
+@pytest.mark.parametrize(
+    "token_counts, max_input_tokens, expected", FIND_AMBIGUOUS_INDICES_DATA
+)
+def test_find_ambiguous_indices(token_counts, max_input_tokens, expected):
+    assert (
+        _find_ambiguous_indices(
+            token_counts=token_counts, max_input_tokens=max_input_tokens
+        )
+        == expected
+    )
+
+
+def test_pre_process_approximate_skips_tokenizer_far_from_split_points(
+    mock_tokenizer, tokenizer, valid_conversation_dict
+):
+    result, token_sum = asyncio.run(
+        pre_process(
+            conversation=valid_conversation_dict,
+            max_input_tokens=1000,
+            token_count_mode=TokenCountMode.APPROXIMATE,
+        )
+    )
+    assert mock_tokenizer.call_count == 0
+    assert len(result) == 1
+    assert not token_sum.is_exact
+
+
+def test_concurrent_requests_share_tokenizer_batches(mock_tokenizer, tokenizer):
+    conversations = [
+        {"title": f"Conversation {i}", "UserMessage1": f"Hello {i}"} for i in range(50)
+    ]
+
+    async def run():
+        return await asyncio.gather(
+            *[
+                pre_process(conversation=conversation, max_input_tokens=100)
+                for conversation in conversations
+            ]
+        )
+
+    results = asyncio.run(run())
+    assert [token_sum.tokens for _, token_sum in results] == [60] * 50
+    # Requests arriving while the workers are busy are coalesced into shared batches
+    assert mock_tokenizer.call_count < len(conversations)
+
+
+async def _collect(conversation, max_input_tokens):
+    return [
+        item
+        async for item in stream_pre_process(
+            conversation=conversation, max_input_tokens=max_input_tokens
+        )
+    ]
+
+
+@pytest.fixture
+def long_conversation_dict():
+    conversation = {"title": "Test Conversation"}
+    for i in range(1, 11):
+        conversation[f"UserMessage{i}"] = "a" * 180
+        conversation[f"AssistantMessage{i}"] = "b" * 180
+    return conversation
+
+
+@pytest.mark.parametrize(
+    "max_input_tokens, expected_number_of_splits", TOKEN_SPLIT_VALID_DATA
+)
+def test_stream_pre_process(
+    max_input_tokens, expected_number_of_splits, tokenizer, valid_conversation_dict
+):
+    result = asyncio.run(_collect(valid_conversation_dict, max_input_tokens))
+    assert len(result) == expected_number_of_splits
+    assert result[-1].token_sum == TokenCount(tokens=180)
+
+
+def test_stream_pre_process_yields_before_tokenizing_everything(
+    mock_tokenizer, tokenizer, long_conversation_dict
+):
+    async def first_chunk():
+        stream = stream_pre_process(
+            conversation=long_conversation_dict, max_input_tokens=150
+        )
+        chunk = (await anext(stream)).conversation
+        call_count = mock_tokenizer.call_count
+        await stream.aclose()
+        return chunk, call_count
+
+    chunk, call_count = asyncio.run(first_chunk())
+    assert list(chunk.model_extra) == ["UserMessage1", "AssistantMessage1"]
+    # Only the batches needed to complete the first turn have been tokenized
+    assert call_count == 2
+
+
+def test_stream_pre_process_stops_tokenizing_at_cap(
+    mock_tokenizer, tokenizer, long_conversation_dict
+):
+    with patch("app.control.pre.generator.MAX_CONVERSATION_TOKENS", 300):
+        result = asyncio.run(_collect(long_conversation_dict, 150))
+    tokenized = sum(len(call.args[0]) for call in mock_tokenizer.call_args_list)
+    assert tokenized < len(long_conversation_dict) - 1
+    assert result[-1].token_sum == TokenCount(tokens=360)
+    assert sum(len(chunk.conversation.model_extra) for chunk in result) == 6
+    assert sum(chunk.tokens for chunk in result) == 360
+
+
+def _growing_conversation(number_of_turns):
+    conversation = {"title": "Test Conversation"}
+    for i in range(1, number_of_turns + 1):
+        conversation[f"UserMessage{i}"] = f"Question {i} " + "a" * (i % 7 * 40)
+        conversation[f"AssistantMessage{i}"] = f"Answer {i} " + "b" * (i % 5 * 60)
+    return conversation
+
+
+def test_stream_pre_process_content_defined_keeps_boundaries_on_append(tokenizer):
+    async def collect(conversation, chunking_mode):
+        return [
+            chunk.conversation
+            async for chunk in stream_pre_process(
+                conversation=conversation,
+                max_input_tokens=1200,
+                chunking_mode=chunking_mode,
+            )
+        ]
+
+    before = asyncio.run(
+        collect(_growing_conversation(30), ChunkingMode.CONTENT_DEFINED)
+    )
+    after = asyncio.run(
+        collect(_growing_conversation(31), ChunkingMode.CONTENT_DEFINED)
+    )
+    assert len(before) > 2
+    assert after[: len(before) - 1] == before[:-1]
+    assert len(after) - len(before) <= 1
+
+    # Balanced chunks are planned over the whole conversation, so the earlier boundaries move
+    before = asyncio.run(collect(_growing_conversation(30), ChunkingMode.BALANCED))
+    after = asyncio.run(collect(_growing_conversation(31), ChunkingMode.BALANCED))
+    assert after[: len(before) - 1] != before[:-1]
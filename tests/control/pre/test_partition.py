@@ -0,0 +1,69 @@
+import pytest
+
+from app.control.pre.partition import (
+    group_turns,
+    is_content_boundary,
+    partition_balanced,
+    split_by_characters,
+    split_text,
+)
+
+PARTITION_BALANCED_DATA = [
+    ([], 10, []),
+    ([5, 5], 10, [2]),
+    # Greedy filling would give chunks of 9 and 1
+    ([1] * 10, 9, [5, 10]),
+    # Greedy filling would give chunks of 12, 13 and 1
+    ([6, 6, 6, 6, 1, 1], 13, [2, 4, 6]),
+    # An item heavier than the limit ends up in a chunk of its own
+    ([3, 20, 3], 10, [1, 2, 3]),
+]
+
+
+@pytest.mark.parametrize("weights, max_weight, expected", PARTITION_BALANCED_DATA)
+def test_partition_balanced(weights, max_weight, expected):
+    assert partition_balanced(weights=weights, max_weight=max_weight) == expected
+
+
+def test_group_turns():
+    keys = [
+        "UserMessage1",
+        "AssistantMessage1",
+        "UserMessage2",
+        "AssistantMessage2",
+        "AssistantMessage3",
+    ]
+    assert group_turns(keys) == [
+        ["UserMessage1", "AssistantMessage1"],
+        ["UserMessage2", "AssistantMessage2", "AssistantMessage3"],
+    ]
+
+
+def test_split_text_keeps_code_blocks_intact():
+    code_block = "```python\nprint('a.')\nprint('b.')\n```"
+    text = f"First sentence. Second one!\n{code_block} Last sentence."
+    segments = split_text(text)
+    assert "".join(segments) == text
+    assert code_block in segments
+    assert segments[0] == "First sentence."
+
+
+def test_split_text_by_lines():
+    text = "line one\nline two\nline three"
+    assert split_text(text, by_lines=True) == ["line one\n", "line two\n", "line three"]
+
+
+def test_split_by_characters():
+    assert split_by_characters("abcdefg", max_characters=3) == ["abc", "def", "g"]
+
+
+def test_is_content_boundary_depends_on_content_only():
+    texts = ["UserMessage1: What is a heap?"]
+    assert is_content_boundary(texts, 10, 100) == is_content_boundary(texts, 10, 100)
+    # A unit at least as heavy as the target always ends its chunk
+    assert is_content_boundary(texts, 100, 100)
+    boundaries = sum(
+        is_content_boundary([f"UserMessage{i}: question {i}"], 10, 100)
+        for i in range(2000)
+    )
+    assert 100 < boundaries < 300
@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+NOTES_ARGUMENTS = {
+    "topic": "Asyncio",
+    "goal": "Learn asyncio",
+    "context": "A conversation about asyncio",
+    "overview": "Overview of asyncio",
+    "key_concepts": [
+        {
+            "key_concept_title": "Event loop",
+            "key_concept_explanation": "Runs the coroutines",
+        }
+    ],
+}
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """Local HTTP server that answers like the OpenAI and Hugging Face inference APIs after a fixed latency.
+
+    Streamed chat completions send the function call arguments in pieces of `stream_piece_characters`, every `stream_piece_seconds`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency_seconds: float):
+        super().__init__(("127.0.0.1", 0), _FakeLLMHandler)
+        self.latency_seconds = latency_seconds
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.request_count = 0
+        self.requests = []
+        self.arguments = json.dumps(NOTES_ARGUMENTS)
+        self.stream_piece_characters = 16
+        self.stream_piece_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Clients that time out close the connection before the response is written
+        pass
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class _FakeLLMHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server: FakeLLMServer = self.server
+        request = json.loads(
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        )
+        with server._lock:
+            server.requests.append(request)
+            server.request_count += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(server.latency_seconds)
+        with server._lock:
+            server.in_flight -= 1
+
+        if self.path.endswith("/chat/completions") and request.get("stream"):
+            self._stream_chat_completion(server)
+            return
+        if self.path.endswith("/chat/completions"):
+            body = {
+                "id": "chatcmpl-test",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-4o-mini-2024-07-18",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "function_call",
+                        "message": {
+                            "role": "assistant",
+                            "content": None,
+                            "function_call": {
+                                "name": "get_notes",
+                                "arguments": server.arguments,
+                            },
+                        },
+                    }
+                ],
+            }
+        else:
+            body = [{"generated_text": "Hello from Llama3"}]
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _stream_chat_completion(self, server: FakeLLMServer):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        arguments = server.arguments
+        for start in range(0, len(arguments), server.stream_piece_characters):
+            piece = arguments[start : start + server.stream_piece_characters]
+            self._send_event(
+                {
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": None,
+                            "delta": {"function_call": {"arguments": piece}},
+                        }
+                    ]
+                }
+            )
+            time.sleep(server.stream_piece_seconds)
+        self._send_event(
+            {
+                "choices": [],
+                "usage": {
+                    "prompt_tokens": 100,
+                    "completion_tokens": 50,
+                    "total_tokens": 150,
+                },
+            }
+        )
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _send_event(self, body: dict):
+        event = {
+            "id": "chatcmpl-test",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-4o-mini-2024-07-18",
+            **body,
+        }
+        self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+        self.wfile.flush()
+
+
+@pytest.fixture
+def fake_llm_server():
+    server = FakeLLMServer(latency_seconds=0.5)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
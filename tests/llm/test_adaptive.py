@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from app.llm.adaptive import AIMDController
+from app.llm.model import LLMType
+from app.llm.scheduler import LLMScheduler
+
+
+def test_controller_increases_additively():
+    controller = AIMDController(max_limit=10, initial_limit=2)
+    for _ in range(4):
+        controller.on_success(latency_seconds=0.1, started_at=time.monotonic())
+    assert controller.limit == 3
+
+
+def test_controller_cuts_once_per_burst():
+    controller = AIMDController(max_limit=32, initial_limit=16)
+    started_at = time.monotonic()
+    for _ in range(5):
+        controller.on_congestion(reason="rate_limit", started_at=started_at)
+    assert controller.limit == 8
+    assert controller.snapshot()["congestion_signals"] == {"rate_limit": 5}
+
+
+def test_controller_treats_slow_calls_as_congestion():
+    controller = AIMDController(
+        max_limit=32, initial_limit=16, latency_target_seconds=1
+    )
+    controller.on_success(latency_seconds=5, started_at=time.monotonic())
+    assert controller.limit == 8
+
+
+def test_controller_allows_large_prompts_proportionally_longer():
+    controller = AIMDController(
+        max_limit=32,
+        initial_limit=16,
+        latency_target_seconds=1,
+        latency_target_tokens=1000,
+    )
+    controller.on_success(
+        latency_seconds=5, started_at=time.monotonic(), prompt_tokens=8000
+    )
+    assert controller.limit == 16
+    controller.on_success(
+        latency_seconds=5, started_at=time.monotonic(), prompt_tokens=2000
+    )
+    assert controller.limit == 8
+
+
+def test_controller_starts_at_configured_limit():
+    assert AIMDController(max_limit=16, initial_limit=None).limit == 16
+
+
+class ThrottlingProvider:
+    """Fake provider that answers 429 whenever more than `capacity` calls are in flight."""
+
+    def __init__(self, capacity: float, latency_seconds: float = 0.005):
+        self.capacity = capacity
+        self.latency_seconds = latency_seconds
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+
+    async def send_message(self):
+        self.calls += 1
+        if self.in_flight >= self.capacity:
+            self.throttled += 1
+            await asyncio.sleep(0)
+            request = httpx.Request("POST", "http://llm.test")
+            raise httpx.HTTPStatusError(
+                "Too Many Requests",
+                request=request,
+                response=httpx.Response(429, request=request),
+            )
+        self.in_flight += 1
+        await asyncio.sleep(self.latency_seconds)
+        self.in_flight -= 1
+
+
+def _simulate(provider, scheduler, clients=40, calls_per_client=10):
+    async def client():
+        completed = 0
+        while completed < calls_per_client:
+            try:
+                async with scheduler.slot(llm_type=LLMType.OPENAI_GPT4):
+                    await provider.send_message()
+                completed += 1
+            except httpx.HTTPStatusError:
+                await asyncio.sleep(0.001)
+
+    async def run():
+        await asyncio.gather(*[client() for _ in range(clients)])
+
+    asyncio.run(run())
+    return scheduler.snapshot()["models"][LLMType.OPENAI_GPT4.value]
+
+
+def test_simulation_converges_below_provider_capacity():
+    provider = ThrottlingProvider(capacity=5)
+    scheduler = LLMScheduler(
+        provider_limits={}, model_limits={}, default_model_limit=64, adaptive=True
+    )
+    state = _simulate(provider, scheduler)
+    assert state["adaptive"]["decreases"] > 0
+    assert 1 <= state["limit"] <= 2 * provider.capacity
+    # Without the controller, 40 clients against a capacity of 5 would be throttled most of the time
+    assert provider.throttled < 0.2 * provider.calls
+
+
+def test_simulation_grows_when_provider_is_idle():
+    provider = ThrottlingProvider(capacity=float("inf"))
+    scheduler = LLMScheduler(
+        provider_limits={}, model_limits={}, default_model_limit=64, adaptive=True
+    )
+    state = _simulate(provider, scheduler)
+    assert provider.throttled == 0
+    assert state["limit"] > 10
@@ -0,0 +1,199 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+from app.exceptions.exception import (
+    DeadlineExceeded,
+    GenerationAborted,
+    InferenceFailure,
+)
+from app.llm.base import LLMConfig
+from app.llm.deadline import Deadline
+from app.llm.llama3 import Llama3
+from app.llm.open_ai import OpenAi
+from app.llm.usage import track_usage
+from app.metrics import metrics
+from app.models.content import Content
+from tests.llm.conftest import NOTES_ARGUMENTS
+
+NUMBER_OF_CALLS = 8
+
+
+async def _send_concurrently(model, number_of_calls, **kwargs):
+    return await asyncio.gather(
+        *[
+            model.send_message(system_message="System", user_message="User", **kwargs)
+            for _ in range(number_of_calls)
+        ]
+    )
+
+
+def test_open_ai_calls_overlap(fake_llm_server):
+    with patch("app.llm.open_ai.OPENAI_API_KEY", "test"), patch(
+        "app.llm.open_ai.OPENAI_BASE_URL", fake_llm_server.url
+    ):
+        model = OpenAi(
+            model_name="gpt-4o-mini-2024-07-18",
+            model_config=LLMConfig(temperature=1, max_tokens=100),
+        )
+        start = time.perf_counter()
+        results = asyncio.run(
+            _send_concurrently(model, NUMBER_OF_CALLS, content_lst=[Content.MCQ])
+        )
+        elapsed = time.perf_counter() - start
+
+    assert [result[0] for result in results] == ["Asyncio"] * NUMBER_OF_CALLS
+    assert fake_llm_server.max_in_flight >= NUMBER_OF_CALLS // 2
+    # Sequential calls would take NUMBER_OF_CALLS times the latency
+    assert elapsed < 3 * fake_llm_server.latency_seconds
+
+
+def test_llama3_calls_overlap(fake_llm_server):
+    with patch("app.llm.llama3.API_URL", f"{fake_llm_server.url}/llama3"):
+        model = Llama3(
+            model_name="llama3", model_config=LLMConfig(temperature=1, max_tokens=100)
+        )
+        start = time.perf_counter()
+        results = asyncio.run(_send_concurrently(model, NUMBER_OF_CALLS))
+        elapsed = time.perf_counter() - start
+
+    assert results == ["Hello from Llama3"] * NUMBER_OF_CALLS
+    assert fake_llm_server.max_in_flight >= NUMBER_OF_CALLS // 2
+    assert elapsed < 3 * fake_llm_server.latency_seconds
+
+
+def test_llama3_call_times_out(fake_llm_server):
+    with patch("app.llm.llama3.API_URL", f"{fake_llm_server.url}/llama3"):
+        model = Llama3(
+            model_name="llama3",
+            model_config=LLMConfig(temperature=1, max_tokens=100, timeout_seconds=0.1),
+        )
+        with pytest.raises(httpx.TimeoutException):
+            asyncio.run(_send_concurrently(model, 1))
+
+
+def test_llama3_call_gives_up_at_deadline(fake_llm_server):
+    with patch("app.llm.llama3.API_URL", f"{fake_llm_server.url}/llama3"):
+        model = Llama3(
+            model_name="llama3", model_config=LLMConfig(temperature=1, max_tokens=100)
+        )
+        start = time.perf_counter()
+        with pytest.raises(DeadlineExceeded):
+            asyncio.run(
+                model.send_message(
+                    system_message="System",
+                    user_message="User",
+                    deadline=Deadline(
+                        timeout_seconds=fake_llm_server.latency_seconds / 4
+                    ),
+                )
+            )
+        assert time.perf_counter() - start < fake_llm_server.latency_seconds
+
+
+def test_open_ai_streams_fields_before_completion(fake_llm_server):
+    fake_llm_server.stream_piece_seconds = 0.02
+    field_times = {}
+    with patch("app.llm.open_ai.OPENAI_API_KEY", "test"), patch(
+        "app.llm.open_ai.OPENAI_BASE_URL", fake_llm_server.url
+    ):
+        model = OpenAi(
+            model_name="gpt-4o-mini-2024-07-18",
+            model_config=LLMConfig(temperature=1, max_tokens=100),
+        )
+
+        async def _send():
+            with track_usage() as usage:
+                result = await model.send_message(
+                    system_message="System",
+                    user_message="User",
+                    content_lst=[],
+                    on_field=lambda field, value: field_times.setdefault(
+                        field, time.perf_counter()
+                    ),
+                )
+            return result, usage
+
+        result, usage = asyncio.run(_send())
+        end = time.perf_counter()
+
+    assert result[0] == NOTES_ARGUMENTS["topic"]
+    assert list(field_times) == list(NOTES_ARGUMENTS)
+    # The topic is the first field, so it arrives long before the last piece
+    assert end - field_times["topic"] > 10 * fake_llm_server.stream_piece_seconds
+    assert fake_llm_server.requests[0]["stream_options"] == {"include_usage": True}
+    assert (usage.prompt_tokens, usage.completion_tokens) == (100, 50)
+
+
+def test_open_ai_aborts_stream_on_rejected_field(fake_llm_server):
+    fake_llm_server.stream_piece_seconds = 0.05
+    metrics.reset()
+
+    def reject_topic(field, value):
+        if field == "topic":
+            raise GenerationAborted("Topic rejected", field=field)
+
+    with patch("app.llm.open_ai.OPENAI_API_KEY", "test"), patch(
+        "app.llm.open_ai.OPENAI_BASE_URL", fake_llm_server.url
+    ):
+        model = OpenAi(
+            model_name="gpt-4o-mini-2024-07-18",
+            model_config=LLMConfig(temperature=1, max_tokens=100),
+        )
+        start = time.perf_counter()
+        with pytest.raises(InferenceFailure) as exc_info:
+            asyncio.run(
+                model.send_message(
+                    system_message="System",
+                    user_message="User",
+                    content_lst=[],
+                    on_field=reject_topic,
+                )
+            )
+        elapsed = time.perf_counter() - start
+
+    assert isinstance(exc_info.value.__cause__, GenerationAborted)
+    pieces = len(fake_llm_server.arguments) / fake_llm_server.stream_piece_characters
+    # The stream is dropped right after the topic instead of being read to the end
+    assert (
+        elapsed
+        < fake_llm_server.latency_seconds
+        + pieces / 2 * fake_llm_server.stream_piece_seconds
+    )
+    snapshot = metrics.snapshot()
+    assert (
+        snapshot["counters"][
+            "llm_early_aborts{field=topic,model=gpt-4o-mini-2024-07-18}"
+        ]
+        == 1
+    )
+    assert (
+        "llm_early_abort_saved_output_tokens{model=gpt-4o-mini-2024-07-18}"
+        in snapshot["histograms"]
+    )
+
+
+def test_open_ai_call_gives_up_at_deadline(fake_llm_server):
+    with patch("app.llm.open_ai.OPENAI_API_KEY", "test"), patch(
+        "app.llm.open_ai.OPENAI_BASE_URL", fake_llm_server.url
+    ):
+        model = OpenAi(
+            model_name="gpt-4o-mini-2024-07-18",
+            model_config=LLMConfig(temperature=1, max_tokens=100),
+        )
+        start = time.perf_counter()
+        with pytest.raises(DeadlineExceeded):
+            asyncio.run(
+                model.send_message(
+                    system_message="System",
+                    user_message="User",
+                    content_lst=[Content.MCQ],
+                    deadline=Deadline(
+                        timeout_seconds=fake_llm_server.latency_seconds / 4
+                    ),
+                )
+            )
+        assert time.perf_counter() - start < fake_llm_server.latency_seconds
@@ -0,0 +1,99 @@
+import time
+
+import httpx
+import pytest
+
+from app.exceptions.exception import CircuitOpen, LogicError
+from app.llm.circuit_breaker import BreakerState, CircuitBreaker
+from app.llm.model import LLMType
+from app.metrics import metrics
+
+
+def _status_error(status_code: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://llm.test")
+    return httpx.HTTPStatusError(
+        "status error",
+        request=request,
+        response=httpx.Response(status_code, request=request),
+    )
+
+
+def _call(breaker: CircuitBreaker, error: Exception = None):
+    with breaker.guard():
+        if error is not None:
+            raise error
+
+
+def _fail(breaker: CircuitBreaker, times: int, error: Exception = None):
+    for _ in range(times):
+        with pytest.raises(type(error or _status_error(503))):
+            _call(breaker, error or _status_error(503))
+
+
+def test_opens_after_consecutive_failures_and_fails_fast():
+    breaker = CircuitBreaker(llm_type=LLMType.OPENAI_GPT4, consecutive_failures=3)
+    _fail(breaker, 2)
+    assert breaker.state == BreakerState.CLOSED
+    _fail(breaker, 1)
+    assert breaker.state == BreakerState.OPEN
+    with pytest.raises(CircuitOpen):
+        _call(breaker)
+
+
+def test_opens_on_error_rate():
+    breaker = CircuitBreaker(
+        llm_type=LLMType.OPENAI_GPT4,
+        consecutive_failures=100,
+        error_rate=0.5,
+        min_calls=4,
+    )
+    for _ in range(2):
+        _call(breaker)
+        _fail(breaker, 1)
+    assert breaker.state == BreakerState.OPEN
+
+
+def test_rejected_output_does_not_count_against_the_provider():
+    breaker = CircuitBreaker(llm_type=LLMType.OPENAI_GPT4, consecutive_failures=2)
+    _fail(breaker, 5, error=LogicError("Topic is unlikely to be valid"))
+    assert breaker.state == BreakerState.CLOSED
+
+
+def _half_open_breaker() -> CircuitBreaker:
+    breaker = CircuitBreaker(
+        llm_type=LLMType.OPENAI_GPT4, consecutive_failures=1, open_seconds=0.05
+    )
+    _fail(breaker, 1)
+    time.sleep(0.06)
+    assert breaker.state == BreakerState.HALF_OPEN
+    return breaker
+
+
+def test_half_open_lets_one_probe_through_and_closes_on_success():
+    metrics.reset()
+    breaker = _half_open_breaker()
+    with breaker.guard():
+        with pytest.raises(CircuitOpen):
+            _call(breaker)
+    assert breaker.state == BreakerState.CLOSED
+
+    counters = metrics.snapshot()["counters"]
+    for from_state, to_state in (
+        ("closed", "open"),
+        ("open", "half_open"),
+        ("half_open", "closed"),
+    ):
+        assert (
+            counters[
+                f"llm_circuit_breaker_transitions{{from_state={from_state},model=gpt-4o-mini-2024-07-18,to_state={to_state}}}"
+            ]
+            == 1
+        )
+
+
+def test_half_open_reopens_when_probe_fails():
+    breaker = _half_open_breaker()
+    _fail(breaker, 1)
+    assert breaker.state == BreakerState.OPEN
+    with pytest.raises(CircuitOpen):
+        _call(breaker)
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from app.exceptions.exception import DeadlineExceeded
+from app.llm.deadline import Deadline
+
+
+def test_no_deadline():
+    deadline = Deadline()
+    assert deadline.remaining_seconds is None
+    assert not deadline.expired
+    assert deadline.bound(120) == 120
+    deadline.check()
+
+
+def test_bound_shortens_timeout_to_time_left():
+    deadline = Deadline(timeout_seconds=5)
+    assert 4 < deadline.bound(120) <= 5
+    assert deadline.bound(1) == 1
+
+
+def test_expired_deadline_refuses_new_calls():
+    deadline = Deadline(timeout_seconds=0)
+    assert deadline.expired
+    assert deadline.remaining_seconds == 0
+    with pytest.raises(DeadlineExceeded):
+        deadline.check()
+
+
+def test_enforce_cancels_the_block_at_deadline():
+    cancelled = []
+
+    async def _call():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def _run():
+        async with Deadline(timeout_seconds=0.05).enforce():
+            await asyncio.gather(_call(), _call())
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(_run())
+    assert cancelled == [True, True]
+
+
+def test_enforce_lets_other_timeouts_through():
+    async def _run():
+        async with Deadline(timeout_seconds=5).enforce():
+            raise TimeoutError("provider timed out")
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(_run())
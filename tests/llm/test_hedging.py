@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from app.llm.hedging import Hedger
+from app.llm.model import LLMType
+from app.metrics import metrics
+
+
+class SlowCall:
+    def __init__(self, seconds: float, result: str, error: BaseException = None):
+        self.seconds = seconds
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.cancelled = 0
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.seconds)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _warm_hedger(latency_seconds: float = 0.05, **kwargs) -> Hedger:
+    hedger = Hedger(min_samples=10, **kwargs)
+    for _ in range(100):
+        hedger.record_latency(LLMType.OPENAI_GPT4, latency_seconds)
+    return hedger
+
+
+def _hedged_call(hedger, primary, hedge):
+    return asyncio.run(
+        hedger.call(
+            llm_type=LLMType.OPENAI_GPT4,
+            percentile=95,
+            primary=primary,
+            hedge=hedge,
+            hedge_llm_type=LLMType.OPENAI_GPT3_5,
+        )
+    )
+
+
+def test_hedge_delay_needs_samples():
+    hedger = Hedger(min_samples=3)
+    for seconds in (0.1, 0.2):
+        hedger.record_latency(LLMType.OPENAI_GPT4, seconds)
+    assert hedger.hedge_delay(LLMType.OPENAI_GPT4, percentile=50) is None
+    hedger.record_latency(LLMType.OPENAI_GPT4, 0.3)
+    assert hedger.hedge_delay(LLMType.OPENAI_GPT4, percentile=50) == 0.2
+
+
+def test_fast_call_is_not_hedged():
+    hedger = _warm_hedger(max_extra_fraction=1)
+    primary, hedge = SlowCall(0.01, "primary"), SlowCall(0.01, "hedge")
+    assert _hedged_call(hedger, primary, hedge) == "primary"
+    assert hedge.calls == 0
+
+
+def test_slow_call_is_hedged_and_loser_cancelled():
+    metrics.reset()
+    hedger = _warm_hedger(max_extra_fraction=1)
+    primary, hedge = SlowCall(1, "primary"), SlowCall(0.01, "hedge")
+    assert _hedged_call(hedger, primary, hedge) == "hedge"
+    assert primary.cancelled == 1
+    assert (
+        metrics.snapshot()["counters"][
+            "llm_hedges{model=gpt-4o-mini-2024-07-18,outcome=won}"
+        ]
+        == 1
+    )
+
+
+def test_hedge_failure_waits_for_primary():
+    hedger = _warm_hedger(max_extra_fraction=1)
+    primary = SlowCall(0.2, "primary")
+    hedge = SlowCall(0.01, "hedge", error=TimeoutError("hedge timed out"))
+    assert _hedged_call(hedger, primary, hedge) == "primary"
+
+
+def test_primary_failure_is_raised_when_both_fail():
+    hedger = _warm_hedger(max_extra_fraction=1)
+    primary = SlowCall(0.2, "primary", error=ValueError("primary failed"))
+    hedge = SlowCall(0.01, "hedge", error=TimeoutError("hedge timed out"))
+    with pytest.raises(ValueError):
+        _hedged_call(hedger, primary, hedge)
+
+
+def test_hedges_are_capped():
+    hedger = _warm_hedger(max_extra_fraction=0.5)
+    hedges = [SlowCall(0.01, "hedge") for _ in range(4)]
+    for hedge in hedges:
+        _hedged_call(hedger, SlowCall(0.2, "primary"), hedge)
+    # A hedge is only fired while the hedged calls stay within half of all the calls
+    assert sum(hedge.calls for hedge in hedges) == 2
@@ -0,0 +1,98 @@
+import asyncio
+import multiprocessing
+import sqlite3
+import threading
+
+from app.llm.model import LLMType
+from app.llm.quota_store import SQLiteQuotaStore
+from app.llm.rate_limit import RateLimiter, RateLimits, SharedTokenBucket
+
+NUMBER_OF_WORKERS = 4
+CAPACITY = 100
+
+
+def _drain(path: str, attempts: int, results):
+    store = SQLiteQuotaStore(path=path)
+    granted = 0
+    for _ in range(attempts):
+        if not store.try_acquire(
+            key="bucket", amount=1, capacity=CAPACITY, refill_per_second=1e-9
+        ):
+            granted += 1
+    results.put(granted)
+
+
+async def _reserve(rate_limiter, tokens):
+    async with rate_limiter.reserve(llm_type=LLMType.LLAMA3, tokens=tokens):
+        pass
+
+
+def test_workers_share_one_budget(tmp_path):
+    path = str(tmp_path / "quota.sqlite")
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    workers = [
+        context.Process(target=_drain, args=(path, CAPACITY, results))
+        for _ in range(NUMBER_OF_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    granted = [results.get() for _ in workers]
+    # Each worker alone would be granted the whole capacity
+    assert sum(granted) == CAPACITY
+
+
+def test_try_acquire_returns_wait_time(tmp_path):
+    store = SQLiteQuotaStore(path=str(tmp_path / "quota.sqlite"))
+    assert store.try_acquire("bucket", 10, capacity=10, refill_per_second=100) == 0
+    assert store.try_acquire("bucket", 5, capacity=10, refill_per_second=100) > 0
+    store.adjust("bucket", 5, capacity=10, refill_per_second=100)
+    assert store.try_acquire("bucket", 5, capacity=10, refill_per_second=100) == 0
+
+
+def test_rate_limiters_share_quota_store(tmp_path):
+    path = str(tmp_path / "quota.sqlite")
+    rate_limits = {
+        LLMType.LLAMA3: RateLimits(tokens_per_minute=1000, requests_per_minute=1000)
+    }
+    workers = [
+        RateLimiter(rate_limits=rate_limits, store=SQLiteQuotaStore(path=path))
+        for _ in range(2)
+    ]
+    asyncio.run(_reserve(workers[0], tokens=600))
+    asyncio.run(_reserve(workers[1], tokens=100))
+    # The second worker sees the tokens taken by the first one
+    assert workers[1].snapshot()[LLMType.LLAMA3.value]["tokens"] < 400
+
+
+def test_shared_bucket_waits_for_write_lock_off_event_loop(tmp_path):
+    path = str(tmp_path / "quota.sqlite")
+    bucket = SharedTokenBucket(
+        store=SQLiteQuotaStore(path=path),
+        key="bucket",
+        capacity=CAPACITY,
+        refill_per_second=1,
+    )
+    # Another worker holds the write lock for a while
+    other_worker = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    other_worker.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.3, other_worker.execute, args=("COMMIT",)).start()
+
+    async def _run():
+        ticks = 0
+
+        async def _tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(_tick())
+        await bucket.acquire(1)
+        ticker.cancel()
+        return ticks
+
+    # The event loop kept running while the acquire waited for the lock
+    assert asyncio.run(_run()) > 5
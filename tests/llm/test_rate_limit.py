@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import pytest
+
+from app.llm.model import LLMType
+from app.llm.rate_limit import RateLimiter, RateLimits, TokenBucket, parse_rate_limits
+from app.llm.usage import record_usage
+
+
+def test_parse_rate_limits():
+    assert parse_rate_limits("llama3=1000:10, unknown=1:1,llama3-bad") == {
+        LLMType.LLAMA3: RateLimits(tokens_per_minute=1000, requests_per_minute=10)
+    }
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(capacity=10, refill_per_second=100)
+
+    async def run():
+        assert await bucket.acquire(10) < 0.01
+        return await bucket.acquire(5)
+
+    waited = asyncio.run(run())
+    assert waited == pytest.approx(0.05, abs=0.03)
+
+
+def test_token_bucket_caps_amount_at_capacity():
+    bucket = TokenBucket(capacity=10, refill_per_second=100)
+    assert asyncio.run(bucket.acquire(1000)) < 0.01
+
+
+def _rate_limiter(tokens_per_minute: int) -> RateLimiter:
+    return RateLimiter(
+        rate_limits={
+            LLMType.LLAMA3: RateLimits(
+                tokens_per_minute=tokens_per_minute, requests_per_minute=6000
+            )
+        }
+    )
+
+
+def test_reserve_corrects_charge_with_reported_usage():
+    rate_limiter = _rate_limiter(tokens_per_minute=600000)
+
+    async def run():
+        async with rate_limiter.reserve(llm_type=LLMType.LLAMA3, tokens=500000):
+            record_usage(prompt_tokens=100000, completion_tokens=50000)
+
+    asyncio.run(run())
+    tokens = rate_limiter.snapshot()[LLMType.LLAMA3.value]["tokens"]
+    assert tokens == pytest.approx(450000, abs=1000)
+
+
+def test_reserve_does_not_pace_models_without_limits():
+    rate_limiter = RateLimiter(rate_limits={})
+
+    async def run():
+        start = time.perf_counter()
+        for _ in range(3):
+            async with rate_limiter.reserve(
+                llm_type=LLMType.CLAUDE_3_SONNET, tokens=200000
+            ) as usage:
+                record_usage(prompt_tokens=190000, completion_tokens=1000)
+        return time.perf_counter() - start, usage
+
+    elapsed, usage = asyncio.run(run())
+    assert elapsed < 0.1
+    assert usage.completion_tokens == 1000
+    assert rate_limiter.snapshot() == {}
+
+
+def test_reserve_waits_for_capacity_instead_of_failing():
+    rate_limiter = _rate_limiter(tokens_per_minute=6000)
+
+    async def run():
+        async with rate_limiter.reserve(llm_type=LLMType.LLAMA3, tokens=6000):
+            pass
+        start = time.perf_counter()
+        async with rate_limiter.reserve(llm_type=LLMType.LLAMA3, tokens=50):
+            pass
+        return time.perf_counter() - start
+
+    # 6000 tokens per minute refill 100 tokens per second
+    assert asyncio.run(run()) == pytest.approx(0.5, abs=0.15)
@@ -0,0 +1,39 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from app.llm.base import LLMConfig
+from app.llm.model import LLMType
+from app.llm.registry import ClientRegistry
+
+
+@pytest.fixture
+def registry():
+    with patch("app.llm.open_ai.OPENAI_API_KEY", "test"):
+        registry = ClientRegistry()
+        yield registry
+        asyncio.run(registry.aclose())
+
+
+def test_registry_reuses_clients(registry):
+    model = registry.get_model(llm_type=LLMType.OPENAI_GPT4)
+    assert registry.get_model(llm_type=LLMType.OPENAI_GPT4) is model
+    other_config = LLMConfig(temperature=0, max_tokens=10)
+    assert (
+        registry.get_model(llm_type=LLMType.OPENAI_GPT4, model_config=other_config)
+        is not model
+    )
+
+
+def test_registry_shares_connection_pool(registry):
+    open_ai = registry.get_model(llm_type=LLMType.OPENAI_GPT4)
+    llama3 = registry.get_model(llm_type=LLMType.LLAMA3)
+    assert open_ai._client._client is registry.http_client
+    assert llama3._client is registry.http_client
+
+
+def test_registry_closes_connection_pool():
+    registry = ClientRegistry()
+    asyncio.run(registry.aclose())
+    assert registry.http_client.is_closed
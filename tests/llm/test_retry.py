@@ -0,0 +1,231 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from app.exceptions.exception import (
+    DeadlineExceeded,
+    GenerationAborted,
+    InferenceFailure,
+    InvalidOutput,
+    LogicError,
+)
+from app.llm.deadline import Deadline
+from app.llm.retry import (
+    RetryBudget,
+    call_with_retry,
+    failure_reason,
+    retry_after_seconds,
+    retry_reason,
+)
+from app.prompts.generator.functions import notes_from_arguments
+
+
+def _status_error(status_code: int, headers: dict = None) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://llm.test")
+    return httpx.HTTPStatusError(
+        "status error",
+        request=request,
+        response=httpx.Response(status_code, headers=headers, request=request),
+    )
+
+
+def _wrapped(cause: BaseException) -> InferenceFailure:
+    try:
+        raise cause
+    except BaseException as e:
+        try:
+            raise InferenceFailure("Error sending message") from e
+        except InferenceFailure as failure:
+            return failure
+
+
+def _missing_field() -> InferenceFailure:
+    """The failure of a call whose response is a JSON object without the required fields of the notes."""
+    try:
+        notes_from_arguments({"topic": "Asyncio"})
+    except KeyError as e:
+        return _wrapped(e)
+
+
+RETRY_REASON_DATA = [
+    (_status_error(429), "rate_limit"),
+    (_status_error(503), "server_error"),
+    (_status_error(401), None),
+    (httpx.ReadTimeout("timed out"), "timeout"),
+    (_wrapped(json.JSONDecodeError("Expecting value", "", 0)), "invalid_json"),
+    (_wrapped(_status_error(502)), "server_error"),
+    (TypeError("cannot unpack non-iterable NoneType object"), None),
+    (InferenceFailure("Error processing response"), None),
+    (LogicError("Wrong input"), None),
+    (_missing_field(), "invalid_output"),
+    (InvalidOutput("Topic rejected"), "invalid_output"),
+    (_wrapped(GenerationAborted("Topic rejected", field="topic")), "early_abort"),
+    (_wrapped(DeadlineExceeded("Request deadline exceeded")), None),
+]
+
+
+@pytest.mark.parametrize("exception, expected", RETRY_REASON_DATA)
+def test_retry_reason(exception, expected):
+    assert retry_reason(exception) == expected
+
+
+FAILURE_REASON_DATA = [
+    (_wrapped(DeadlineExceeded("Request deadline exceeded")), "deadline_exceeded"),
+    (LogicError("Topic rejected"), "rejected_output"),
+    (InvalidOutput("Topic rejected"), "rejected_output"),
+    (_missing_field(), "invalid_output"),
+    (_status_error(429), "rate_limit"),
+    (ValueError("Unexpected"), "error"),
+]
+
+
+@pytest.mark.parametrize("exception, expected", FAILURE_REASON_DATA)
+def test_failure_reason(exception, expected):
+    assert failure_reason(exception) == expected
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds(_status_error(429, {"Retry-After": "2"})) == 2
+    assert retry_after_seconds(_status_error(429, {"retry-after-ms": "500"})) == 0.5
+    assert retry_after_seconds(_status_error(429)) is None
+
+
+class FlakyCall:
+    def __init__(self, failures: list[BaseException]):
+        self.failures = failures
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return "notes"
+
+
+def _call(fn, budget=None, **kwargs):
+    return asyncio.run(
+        call_with_retry(
+            fn,
+            budget=budget or RetryBudget(max_retries=10),
+            initial_backoff_seconds=0.01,
+            **kwargs,
+        )
+    )
+
+
+def test_call_with_retry_recovers_from_retryable_errors():
+    fn = FlakyCall([_status_error(503), httpx.ReadTimeout("timed out")])
+    assert _call(fn) == "notes"
+    assert fn.calls == 3
+
+
+def test_call_with_retry_awaits_lambda():
+    fn = FlakyCall([_status_error(503)])
+    assert _call(lambda: fn()) == "notes"
+    assert fn.calls == 2
+
+
+def test_call_with_retry_does_not_retry_fatal_errors():
+    fn = FlakyCall([TypeError("cannot unpack"), None])
+    with pytest.raises(TypeError):
+        _call(fn)
+    assert fn.calls == 1
+
+
+def test_call_with_retry_stops_after_max_attempts():
+    fn = FlakyCall([_status_error(503)] * 10)
+    with pytest.raises(httpx.HTTPStatusError):
+        _call(fn, max_attempts=3)
+    assert fn.calls == 3
+
+
+def test_call_with_retry_shares_budget_across_calls():
+    budget = RetryBudget(max_retries=3)
+    calls = [FlakyCall([_status_error(503)] * 10) for _ in range(2)]
+
+    async def run():
+        return await asyncio.gather(
+            *[
+                call_with_retry(fn, budget=budget, initial_backoff_seconds=0.01)
+                for fn in calls
+            ],
+            return_exceptions=True,
+        )
+
+    asyncio.run(run())
+    # Two first attempts plus the three retries of the budget
+    assert sum(fn.calls for fn in calls) == 5
+    assert budget.remaining == 0
+
+
+def test_call_with_retry_honours_retry_after():
+    fn = FlakyCall([_status_error(429, {"Retry-After": "0.3"})])
+    start = time.perf_counter()
+    assert _call(fn) == "notes"
+    assert time.perf_counter() - start >= 0.3
+
+
+def test_call_with_retry_retries_early_aborts_without_backoff():
+    fn = FlakyCall([_wrapped(GenerationAborted("Topic rejected", field="topic"))])
+    start = time.perf_counter()
+    result = asyncio.run(
+        call_with_retry(
+            fn, budget=RetryBudget(max_retries=10), initial_backoff_seconds=10
+        )
+    )
+    assert result == "notes"
+    assert fn.calls == 2
+    assert time.perf_counter() - start < 1
+
+
+def test_call_with_retry_resamples_output_with_missing_field():
+    fn = FlakyCall([_missing_field()])
+    budget = RetryBudget(max_retries=10)
+    start = time.perf_counter()
+    result = asyncio.run(call_with_retry(fn, budget=budget, initial_backoff_seconds=10))
+    assert result == "notes"
+    assert fn.calls == 2
+    assert budget.remaining == 9
+    assert time.perf_counter() - start < 1
+
+
+def test_call_with_retry_skips_retries_that_cannot_finish_before_deadline():
+    fn = FlakyCall([_status_error(503)] * 10)
+    budget = RetryBudget(max_retries=10)
+    with pytest.raises(httpx.HTTPStatusError):
+        _call(
+            fn,
+            budget=budget,
+            deadline=Deadline(timeout_seconds=5),
+            min_attempt_seconds=10,
+        )
+    assert fn.calls == 1
+    # The retry that was not made is not taken from the budget
+    assert budget.remaining == 10
+
+
+def test_call_with_retry_retries_while_deadline_allows():
+    fn = FlakyCall([_status_error(503)] * 2)
+    assert (
+        _call(fn, deadline=Deadline(timeout_seconds=5), min_attempt_seconds=1)
+        == "notes"
+    )
+    assert fn.calls == 3
+
+
+def test_call_with_retry_shortens_backoff_to_deadline():
+    fn = FlakyCall([_status_error(429, {"Retry-After": "30"})])
+    retry_events = []
+    assert (
+        _call(
+            fn,
+            deadline=Deadline(timeout_seconds=2),
+            min_attempt_seconds=1.8,
+            on_retry=retry_events.append,
+        )
+        == "notes"
+    )
+    assert retry_events[0].sleep_seconds <= 0.2
@@ -0,0 +1,111 @@
+import json
+import logging
+
+import pytest
+
+from app.llm.model import LLMType
+from app.llm.router import Router, RoutingPolicy
+from app.models.content import Content
+
+# GPT-4o mini is the cheaper model, Claude 3 Sonnet the faster one in these records
+RECORDS = {
+    LLMType.OPENAI_GPT4: 20.0,
+    LLMType.CLAUDE_3_SONNET: 5.0,
+}
+
+
+def _router(records: dict[LLMType, float] = RECORDS, succeeded: bool = True) -> Router:
+    router = Router(min_samples=3)
+    for llm_type, seconds in records.items():
+        for _ in range(10):
+            router.record(
+                llm_type=llm_type,
+                seconds=seconds,
+                succeeded=succeeded,
+                content_lst=[],
+                output_tokens=500,
+            )
+    return router
+
+
+ROUTE_DATA = [
+    (RoutingPolicy.MIN_LATENCY, 60, LLMType.CLAUDE_3_SONNET),
+    (RoutingPolicy.MIN_COST, 60, LLMType.OPENAI_GPT4),
+    (RoutingPolicy.COST_UNDER_SLO, 30, LLMType.OPENAI_GPT4),
+    (RoutingPolicy.COST_UNDER_SLO, 10, LLMType.CLAUDE_3_SONNET),
+    (RoutingPolicy.COST_UNDER_SLO, 1, LLMType.CLAUDE_3_SONNET),
+]
+
+
+@pytest.mark.parametrize("policy, latency_slo_seconds, expected", ROUTE_DATA)
+def test_route(policy, latency_slo_seconds, expected):
+    decision = _router().route(
+        policy=policy,
+        candidates=list(RECORDS),
+        prompt_tokens=2000,
+        content_lst=[],
+        latency_slo_seconds=latency_slo_seconds,
+    )
+    assert decision.llm_type == expected
+
+
+def test_failures_make_a_model_more_expensive():
+    router = _router()
+    for _ in range(40):
+        router.record(
+            llm_type=LLMType.OPENAI_GPT4, seconds=20, succeeded=False, content_lst=[]
+        )
+    estimate = router.estimate(
+        llm_type=LLMType.OPENAI_GPT4, prompt_tokens=2000, content_lst=[]
+    )
+    assert estimate.success_rate == pytest.approx(0.2)
+    assert estimate.latency_seconds == pytest.approx(100)
+
+
+def test_output_length_is_estimated_per_sections():
+    router = _router()
+    for _ in range(5):
+        router.record(
+            llm_type=LLMType.OPENAI_GPT4,
+            seconds=20,
+            succeeded=True,
+            content_lst=[Content.CODE, Content.MCQ],
+            output_tokens=2000,
+        )
+    with_practice = router.estimate(
+        llm_type=LLMType.OPENAI_GPT4,
+        prompt_tokens=2000,
+        content_lst=[Content.MCQ, Content.CODE],
+    )
+    assert with_practice.output_tokens == 2000
+    # Sections without any record of their own fall back to the other sections
+    assert router.estimate(
+        llm_type=LLMType.OPENAI_GPT4, prompt_tokens=2000, content_lst=[Content.MCQ]
+    ).output_tokens == pytest.approx((10 * 500 + 5 * 2000) / 15)
+
+
+def test_unknown_model_uses_prior_latency():
+    router = Router(min_samples=3, prior_latency_seconds=7)
+    estimate = router.estimate(
+        llm_type=LLMType.COHERE_COMMAND_R, prompt_tokens=1000, content_lst=[]
+    )
+    assert (estimate.latency_seconds, estimate.success_rate) == (7, 1.0)
+    assert (
+        estimate.output_tokens == LLMType.COHERE_COMMAND_R.default_config().max_tokens
+    )
+
+
+def test_decisions_are_logged_as_json(caplog):
+    with caplog.at_level(logging.INFO, logger="app.llm.router.decisions"):
+        _router().route(
+            policy=RoutingPolicy.MIN_COST,
+            candidates=list(RECORDS),
+            prompt_tokens=2000,
+            content_lst=[Content.MCQ],
+        )
+    decision = json.loads(caplog.records[-1].getMessage())
+    assert decision["llm_type"] == LLMType.OPENAI_GPT4.value
+    assert decision["sections"] == "mcq"
+    assert [estimate["llm_type"] for estimate in decision["estimates"]] == [
+        llm_type.value for llm_type in RECORDS
+    ]
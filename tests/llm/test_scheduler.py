@@ -0,0 +1,88 @@
+import asyncio
+
+from app.llm.model import LLMType
+from app.llm.scheduler import LLMScheduler, PriorityLimiter, parse_limits
+from app.metrics import metrics
+
+
+def test_parse_limits():
+    assert parse_limits("openai=64, anthropic=8,,bad") == {
+        "openai": 64,
+        "anthropic": 8,
+    }
+
+
+def test_priority_limiter_serves_largest_first():
+    limiter = PriorityLimiter(limit=1)
+    started = []
+
+    async def call(size):
+        await limiter.acquire(priority=size)
+        started.append(size)
+        await asyncio.sleep(0.01)
+        limiter.release()
+
+    async def run():
+        await asyncio.gather(*[call(size) for size in [1, 5, 3, 9, 2]])
+
+    asyncio.run(run())
+    # The first call takes the free slot, the others wait and are served largest first
+    assert started == [1, 9, 5, 3, 2]
+    assert limiter.in_flight == 0
+
+
+def test_priority_limiter_skips_cancelled_waiters():
+    limiter = PriorityLimiter(limit=1)
+
+    async def run():
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire(priority=5))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        limiter.release()
+        assert limiter.in_flight == 0
+        assert limiter.queue_depth == 0
+
+    asyncio.run(run())
+
+
+def test_scheduler_applies_model_and_provider_limits():
+    scheduler = LLMScheduler(
+        provider_limits={"openai": 3},
+        model_limits={},
+        default_model_limit=2,
+        adaptive=False,
+    )
+    in_flight = {"model": 0, "provider": 0}
+    peak = {"model": 0, "provider": 0}
+
+    async def call(llm_type):
+        async with scheduler.slot(llm_type=llm_type):
+            in_flight["provider"] += 1
+            if llm_type == LLMType.OPENAI_GPT4:
+                in_flight["model"] += 1
+            peak["model"] = max(peak["model"], in_flight["model"])
+            peak["provider"] = max(peak["provider"], in_flight["provider"])
+            await asyncio.sleep(0.01)
+            in_flight["provider"] -= 1
+            if llm_type == LLMType.OPENAI_GPT4:
+                in_flight["model"] -= 1
+
+    async def run():
+        await asyncio.gather(
+            *[call(LLMType.OPENAI_GPT4) for _ in range(6)],
+            *[call(LLMType.OPENAI_GPT3_5) for _ in range(6)],
+        )
+
+    metrics.reset()
+    asyncio.run(run())
+    assert peak == {"model": 2, "provider": 3}
+    snapshot = metrics.snapshot()
+    assert (
+        snapshot["histograms"][
+            f"llm_queue_wait_seconds{{model={LLMType.OPENAI_GPT4.value}}}"
+        ]["count"]
+        == 6
+    )
+    assert snapshot["gauges"]["llm_queue_depth{provider=openai}"] == 0
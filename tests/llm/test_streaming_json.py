@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from app.llm.streaming_json import IncrementalJSONParser
+
+ARGUMENTS = {
+    "topic": 'A "quoted" topic, with {braces} and \\\\ backslashes',
+    "goal": "Learn asyncio",
+    "key_concepts": [
+        {"key_concept_title": "Event loop]}", "key_concept_explanation": "Runs"}
+    ],
+    "tips": [],
+    "mcq_practice": {},
+    "score": -1.5e3,
+    "complete": True,
+    "code_practice": None,
+}
+
+
+@pytest.mark.parametrize("piece_characters", [1, 3, 16, 1000])
+def test_parser_reports_fields_in_order(piece_characters):
+    text = json.dumps(ARGUMENTS, indent=2)
+    fields = []
+    parser = IncrementalJSONParser(
+        on_field=lambda key, value: fields.append((key, value))
+    )
+    for start in range(0, len(text), piece_characters):
+        parser.feed(text[start : start + piece_characters])
+    assert fields == list(ARGUMENTS.items())
+    assert parser.result() == ARGUMENTS
+
+
+def test_parser_reports_field_once_complete():
+    fields = []
+    parser = IncrementalJSONParser(on_field=lambda key, value: fields.append(key))
+    parser.feed(
+        '{"topic": "Asyncio basics", "key_concepts": [{"key_concept_title": "Ev'
+    )
+    assert fields == ["topic"]
+    assert parser.fields == {"topic": "Asyncio basics"}
+    parser.feed('ent loop"}]')
+    assert fields == ["topic", "key_concepts"]
+    with pytest.raises(json.JSONDecodeError):
+        parser.result()
+
+
+INVALID_DATA = ['["topic"]', '{"topic" "Asyncio"}', '{"topic": "Asyncio"} {}']
+
+
+@pytest.mark.parametrize("text", INVALID_DATA)
+def test_parser_rejects_invalid_json(text):
+    with pytest.raises(json.JSONDecodeError):
+        IncrementalJSONParser().feed(text)
@@ -0,0 +1,43 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from app.llm.token_count import ABSOLUTE_ERROR_TOKENS, TokenCount, TokenEstimator
+
+
+def test_token_count_bounds():
+    token_count = TokenCount(tokens=100, error=10) + TokenCount(tokens=50)
+    assert token_count == TokenCount(tokens=150, error=10)
+    assert (token_count.low, token_count.high) == (140, 160)
+    assert not token_count.is_exact
+    assert TokenCount(tokens=5).is_exact
+
+
+ESTIMATE_DATA = [
+    ("", 0),
+    ("abcd", 1),
+    ("a" * 400, 100),
+]
+
+
+@pytest.mark.parametrize("text, expected_tokens", ESTIMATE_DATA)
+def test_estimate(text, expected_tokens):
+    estimator = TokenEstimator(bytes_per_token=4, relative_error=0.1)
+    estimate = estimator.estimate(text)
+    assert estimate.tokens == expected_tokens
+    assert estimate.error >= ABSOLUTE_ERROR_TOKENS
+
+
+def test_calibrate_bounds_the_samples():
+    samples = ["a" * 40, "b" * 100, "c" * 300]
+    actual_counts = [10, 30, 60]
+    tokenizer = MagicMock()
+    tokenizer.name = "test"
+    tokenizer.count_tokens_batch.return_value = actual_counts
+
+    estimator = TokenEstimator.calibrate(tokenizer=tokenizer, samples=samples)
+
+    assert estimator.bytes_per_token == pytest.approx(440 / 100)
+    for sample, actual in zip(samples, actual_counts):
+        estimate = estimator.estimate(sample)
+        assert estimate.low <= actual <= estimate.high
@@ -0,0 +1,84 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.llm.tokenizer import HuggingFaceTokenizer, TiktokenTokenizer
+from app.metrics import metrics
+
+
+@pytest.fixture
+def mock_tokenizer():
+    mock = MagicMock()
+    mock.side_effect = lambda texts, **kwargs: {"input_ids": [[0] * 5 for _ in texts]}
+    return mock
+
+
+def test_tokenizer_loads_once(mock_tokenizer):
+    with patch(
+        "app.llm.tokenizer.AutoTokenizer.from_pretrained",
+        return_value=mock_tokenizer,
+    ) as from_pretrained:
+        tokenizer = HuggingFaceTokenizer(name="codellama", path="/models/codellama")
+        for _ in range(3):
+            assert tokenizer.count_tokens("Hello world") == 5
+        from_pretrained.assert_called_once_with(
+            "/models/codellama", local_files_only=True
+        )
+
+
+def test_tokenizer_load_exports_metrics(mock_tokenizer):
+    metrics.reset()
+    with patch(
+        "app.llm.tokenizer.AutoTokenizer.from_pretrained",
+        return_value=mock_tokenizer,
+    ):
+        HuggingFaceTokenizer(name="codellama", path="/models/codellama").load()
+    gauges = metrics.snapshot()["gauges"]
+    assert "tokenizer_load_seconds{tokenizer=codellama}" in gauges
+    assert "tokenizer_memory_bytes{tokenizer=codellama}" in gauges
+
+
+def test_tokenizer_load_failure():
+    with patch(
+        "app.llm.tokenizer.AutoTokenizer.from_pretrained",
+        side_effect=OSError("missing files"),
+    ):
+        tokenizer = HuggingFaceTokenizer(name="codellama", path="/models/missing")
+        with pytest.raises(OSError):
+            tokenizer.load()
+        assert not tokenizer.is_loaded
+
+
+def test_tokenizer_load_failure_explains_how_to_download_files():
+    with patch(
+        "app.llm.tokenizer.AutoTokenizer.from_pretrained",
+        side_effect=OSError("We couldn't connect to 'https://huggingface.co'"),
+    ):
+        tokenizer = HuggingFaceTokenizer(
+            name="codellama",
+            path="/models/missing",
+            download_hint="Set CODELLAMA_TOKENIZER_PATH.",
+        )
+        with pytest.raises(OSError) as exc_info:
+            tokenizer.load()
+    message = str(exc_info.value)
+    assert "/models/missing" in message
+    assert message.endswith("Set CODELLAMA_TOKENIZER_PATH.")
+
+
+def test_tiktoken_tokenizer_falls_back_to_available_encoding():
+    encoding = MagicMock()
+    encoding.encode_ordinary_batch.return_value = [[1, 2, 3], [4]]
+
+    def get_encoding(name):
+        if name == "o200k_base":
+            raise ValueError("Unknown encoding o200k_base")
+        return encoding
+
+    with patch("app.llm.tokenizer.tiktoken.get_encoding", side_effect=get_encoding):
+        tokenizer = TiktokenTokenizer(
+            name="o200k_base",
+            encoding_name="o200k_base",
+            fallback_encoding_name="cl100k_base",
+        )
+        assert tokenizer.count_tokens_batch(["Hello world", "Hi"]) == [3, 1]
@@ -0,0 +1,240 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+import pytest
+
+from app.config import InferenceConfig
+from app.exceptions.exception import CircuitOpen, DeadlineExceeded, LogicError
+from app.llm.anthropic import Anthropic
+from app.llm.base import LLMConfig
+from app.llm.circuit_breaker import CircuitBreakers
+from app.llm.model import LLMType
+from app.llm.router import Router, RoutingPolicy
+from app.models.content import Content
+from app.models.conversation import Conversation
+from app.process.generator import GeneratedNotes, Generator, _count_prompt_tokens
+
+PROMPT_TOKENS = 100
+
+
+@pytest.fixture
+def tokenizer():
+    mock = MagicMock()
+    mock.count_tokens.return_value = PROMPT_TOKENS
+    _count_prompt_tokens.cache_clear()
+    with patch("app.process.generator.get_tokenizer", return_value=mock):
+        yield mock
+    _count_prompt_tokens.cache_clear()
+
+
+def _make_generator(config: InferenceConfig) -> Generator:
+    with patch("app.process.generator.get_client_registry") as registry:
+        registry.return_value.get_model.return_value.model_config = LLMConfig(
+            temperature=1, max_tokens=3000
+        )
+        return Generator(config=config)
+
+
+def test_chunk_budget_uses_context_window(tokenizer):
+    generator = _make_generator(config=InferenceConfig(llm_type=LLMType.OPENAI_GPT4))
+    budget = generator.chunk_budget(title="Title", content_lst=[Content.MCQ])
+    # System message, function schema, user message template and title
+    assert budget == LLMType.OPENAI_GPT4.context_window() - 4 * PROMPT_TOKENS - 3000
+
+
+def test_chunk_budget_respects_max_chunk_tokens(tokenizer):
+    generator = _make_generator(
+        config=InferenceConfig(llm_type=LLMType.OPENAI_GPT4, max_chunk_tokens=2000)
+    )
+    assert generator.chunk_budget(title="Title", content_lst=[]) == 2000
+
+
+def test_chunk_budget_rejects_full_context_window(tokenizer):
+    tokenizer.count_tokens.return_value = LLMType.LLAMA3.context_window()
+    generator = _make_generator(config=InferenceConfig(llm_type=LLMType.LLAMA3))
+    with pytest.raises(LogicError):
+        generator.chunk_budget(title="Title", content_lst=[])
+
+
+def test_prompt_version_depends_on_prompts():
+    generator = _make_generator(config=InferenceConfig(llm_type=LLMType.OPENAI_GPT4))
+    version = generator.prompt_version(content_lst=[Content.MCQ])
+    assert generator.prompt_version(content_lst=[Content.MCQ]) == version
+    assert generator.prompt_version(content_lst=[Content.MCQ, Content.CODE]) != version
+    with patch(
+        "app.process.generator.generate_open_ai_summariser_system_message",
+        return_value="A new system message",
+    ):
+        assert generator.prompt_version(content_lst=[Content.MCQ]) != version
+
+
+def _server_error() -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://llm.test")
+    return httpx.HTTPStatusError(
+        "status error", request=request, response=httpx.Response(503, request=request)
+    )
+
+
+def _generate(generator: Generator):
+    return asyncio.run(
+        generator.generate(conversation=Conversation(title="Title"), content_lst=[])
+    )
+
+
+def test_generate_falls_back_to_next_healthy_model():
+    generator = _make_generator(
+        config=InferenceConfig(
+            llm_type=LLMType.OPENAI_GPT4,
+            fallback_llm_types=[LLMType.OPENAI_GPT3_5, LLMType.CLAUDE_3_SONNET],
+            hedge_percentile=None,
+        )
+    )
+    primary, fallback, last = generator, *generator._fallback_generators
+    primary._generate = AsyncMock(side_effect=_server_error())
+    fallback._generate = AsyncMock(return_value={"topic": "Fallback notes"})
+    last._generate = AsyncMock(return_value={"topic": "Last notes"})
+
+    breakers = CircuitBreakers()
+    with patch("app.process.generator.llm_circuit_breakers", breakers):
+        for _ in range(6):
+            assert _generate(generator) == GeneratedNotes(
+                notes={"topic": "Fallback notes"}, llm_type=LLMType.OPENAI_GPT3_5
+            )
+
+    # The primary model is no longer called once its breaker is open
+    assert primary._generate.await_count == 5
+    assert breakers.snapshot()[LLMType.OPENAI_GPT4.value]["state"] == "open"
+    last._generate.assert_not_awaited()
+
+
+def test_generate_falls_back_to_another_provider(tokenizer):
+    generator = _make_generator(
+        config=InferenceConfig(
+            llm_type=LLMType.OPENAI_GPT4,
+            fallback_llm_types=[LLMType.CLAUDE_3_SONNET],
+            hedge_percentile=None,
+        )
+    )
+    primary, fallback = generator, *generator._fallback_generators
+    primary._generate = AsyncMock(side_effect=_server_error())
+    fallback._model = Anthropic(
+        model_name=LLMType.CLAUDE_3_SONNET.value,
+        model_config=LLMType.CLAUDE_3_SONNET.default_config(),
+    )
+    notes = {
+        "topic": "Python list comprehensions",
+        "goal": "Goal",
+        "context": "Context",
+        "overview": "Overview",
+        "key_concepts": [
+            {"key_concept_title": "Title", "key_concept_explanation": "Explanation"}
+        ],
+    }
+    response = MagicMock(usage=None)
+    # The response continues the opening brace that the request is prefilled with
+    response.content = [MagicMock(text=json.dumps(notes)[1:])]
+    fallback._model._client.messages.create = AsyncMock(return_value=response)
+
+    with patch("app.process.generator.llm_circuit_breakers", CircuitBreakers()):
+        processed_summary, llm_type = _generate(generator)
+
+    assert llm_type == LLMType.CLAUDE_3_SONNET
+    assert processed_summary["topic"] == "Python list comprehensions"
+    assert processed_summary["key_concepts"] == notes["key_concepts"]
+    fallback._model._client.messages.create.assert_awaited_once()
+
+
+def test_config_rejects_fallback_model_without_notes_support():
+    with pytest.raises(ValueError):
+        InferenceConfig(fallback_llm_types=[LLMType.COHERE_COMMAND_R])
+
+
+def test_config_rejects_hedge_model_without_notes_support():
+    with pytest.raises(ValueError):
+        InferenceConfig(hedge_llm_type=LLMType.GEMINI_PRO)
+
+
+def test_config_rejects_routing_model_without_notes_support():
+    with pytest.raises(ValueError):
+        InferenceConfig(routing_llm_types=[LLMType.LLAMA3])
+
+
+def test_generate_fails_fast_when_every_breaker_is_open():
+    generator = _make_generator(
+        config=InferenceConfig(
+            llm_type=LLMType.OPENAI_GPT4, fallback_llm_types=[], hedge_percentile=None
+        )
+    )
+    generator._generate = AsyncMock(side_effect=_server_error())
+
+    with patch("app.process.generator.llm_circuit_breakers", CircuitBreakers()):
+        for _ in range(5):
+            with pytest.raises(httpx.HTTPStatusError):
+                _generate(generator)
+        with pytest.raises(CircuitOpen):
+            _generate(generator)
+    assert generator._generate.await_count == 5
+
+
+def test_generate_does_not_fall_back_past_deadline():
+    generator = _make_generator(
+        config=InferenceConfig(
+            llm_type=LLMType.OPENAI_GPT4,
+            fallback_llm_types=[LLMType.OPENAI_GPT3_5],
+            hedge_percentile=None,
+        )
+    )
+    primary, fallback = generator, *generator._fallback_generators
+    primary._generate = AsyncMock(
+        side_effect=DeadlineExceeded("Request deadline exceeded")
+    )
+    fallback._generate = AsyncMock(return_value={"topic": "Fallback notes"})
+
+    breakers = CircuitBreakers()
+    with patch("app.process.generator.llm_circuit_breakers", breakers):
+        with pytest.raises(DeadlineExceeded):
+            _generate(generator)
+    fallback._generate.assert_not_awaited()
+    # The deadline of the request says nothing about the health of the model
+    assert breakers.snapshot()[LLMType.OPENAI_GPT4.value]["error_rate"] == 0
+
+
+ROUTING_DATA = [
+    (1000, LLMType.OPENAI_GPT3_5),
+    # The chunk does not fit into the context window of GPT-3.5
+    (20000, LLMType.CLAUDE_3_SONNET),
+]
+
+
+@pytest.mark.parametrize("conversation_tokens, expected", ROUTING_DATA)
+def test_generate_routes_chunk_to_cheapest_model_that_fits(
+    tokenizer, conversation_tokens, expected
+):
+    generator = _make_generator(
+        config=InferenceConfig(
+            llm_type=LLMType.CLAUDE_3_SONNET,
+            routing_policy=RoutingPolicy.MIN_COST,
+            routing_llm_types=[LLMType.OPENAI_GPT3_5],
+            fallback_llm_types=[],
+            hedge_percentile=None,
+        )
+    )
+    (gpt3_5,) = generator._routing_generators
+    for candidate in (generator, gpt3_5):
+        candidate._generate = AsyncMock(
+            return_value={"topic": candidate.llm_type.value}
+        )
+
+    with patch("app.process.generator.llm_router", Router()), patch(
+        "app.process.generator.llm_circuit_breakers", CircuitBreakers()
+    ):
+        notes = asyncio.run(
+            generator.generate(
+                conversation=Conversation(title="Title"),
+                content_lst=[],
+                conversation_tokens=conversation_tokens,
+            )
+        )
+    assert notes == GeneratedNotes(notes={"topic": expected.value}, llm_type=expected)
@@ -0,0 +1,353 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+from app.cache.notes import CHUNK_NOTES_CACHE, get_notes_cache
+from app.control.pre.generator import ConversationChunk
+from app.control.pre.partition import group_turns
+from app.exceptions.exception import DeadlineExceeded, InferenceFailure, LogicError
+from app.llm.base import LLMConfig
+from app.llm.deadline import Deadline
+from app.llm.model import LLMType
+from app.llm.token_count import TokenCount
+from app.models.content import Content
+from app.models.conversation import Conversation
+from app.process.generator import GeneratedNotes
+from app.scripts.generate import (
+    _message_range,
+    _notes_cache_key,
+    generate,
+    generate_partial,
+    stream_generate,
+)
+
+
+class FakeGenerator:
+    """Splits the conversation into one chunk per turn and summarises a chunk into its first message."""
+
+    llm_type = LLMType.OPENAI_GPT4
+    model_config = LLMConfig(temperature=0, max_tokens=100)
+    calls = []
+    # Seconds to wait, and errors to raise, before summarising the chunk with the given first message
+    delays = {}
+    failures = {}
+    # Models other than `llm_type` that summarise the chunk with the given first message
+    answered_by = {}
+
+    def __init__(self, config, llm_type=LLMType.OPENAI_GPT4):
+        self.llm_type = llm_type
+
+    def prompt_version(self, content_lst):
+        return "v1"
+
+    def candidate_generators(self):
+        return [self, FakeGenerator(config=None, llm_type=LLMType.OPENAI_GPT3_5)]
+
+    async def stream_pre_process(self, conversation, content_lst):
+        keys = [key for key in conversation if key != "title"]
+        for turn in group_turns(keys):
+            yield ConversationChunk(
+                Conversation(
+                    title=conversation["title"],
+                    **{key: conversation[key] for key in turn},
+                ),
+                10,
+                TokenCount(tokens=10 * len(keys)),
+            )
+
+    async def generate(
+        self, conversation, content_lst, conversation_tokens, on_field, deadline=None
+    ):
+        FakeGenerator.calls.append(conversation)
+        topic = next(iter(conversation.model_extra.values()))
+        if on_field:
+            on_field("topic", topic)
+        await asyncio.sleep(FakeGenerator.delays.get(topic, 0))
+        if FakeGenerator.failures.get(topic):
+            raise FakeGenerator.failures[topic].pop(0)
+        return GeneratedNotes(
+            notes={"topic": topic},
+            llm_type=FakeGenerator.answered_by.get(topic, self.llm_type),
+        )
+
+
+@pytest.fixture
+def fake_generator():
+    FakeGenerator.calls = []
+    FakeGenerator.delays = {}
+    FakeGenerator.failures = {}
+    FakeGenerator.answered_by = {}
+    with patch("app.scripts.generate.Generator", FakeGenerator), patch.dict(
+        "app.cache.notes._notes_caches", clear=True
+    ):
+        yield FakeGenerator
+
+
+def _conversation(number_of_turns):
+    conversation = {"title": "Sorting"}
+    for i in range(1, number_of_turns + 1):
+        conversation[f"UserMessage{i}"] = f"Question {i}"
+        conversation[f"AssistantMessage{i}"] = f"Answer {i}"
+    return conversation
+
+
+def test_generate_only_summarises_new_chunks(fake_generator):
+    notes, _, cached_chunks = asyncio.run(
+        generate(conversation=_conversation(3), content_lst=[Content.MCQ])
+    )
+    assert len(fake_generator.calls) == 3
+    assert cached_chunks == []
+
+    # The same conversation is served from the conversation cache
+    assert asyncio.run(
+        generate(conversation=_conversation(3), content_lst=[Content.MCQ])
+    ) == (notes, TokenCount(tokens=60), [0, 1, 2])
+    assert len(fake_generator.calls) == 3
+
+    # Only the appended turn is summarised
+    notes, token_sum, cached_chunks = asyncio.run(
+        generate(conversation=_conversation(4), content_lst=[Content.MCQ])
+    )
+    assert len(fake_generator.calls) == 4
+    assert cached_chunks == [0, 1, 2]
+    assert [note["topic"] for note in notes] == [f"Question {i}" for i in range(1, 5)]
+    assert token_sum == TokenCount(tokens=80)
+
+
+def test_generate_caches_chunk_under_model_that_generated_it(fake_generator):
+    fake_generator.answered_by = {"Question 1": LLMType.OPENAI_GPT3_5}
+    asyncio.run(generate(conversation=_conversation(1), content_lst=[Content.MCQ]))
+
+    cache_key = _notes_cache_key(
+        generator=FakeGenerator(config=None), content_lst=[Content.MCQ]
+    )
+    chunk = _conversation(1)
+    chunk_notes_cache = get_notes_cache(name=CHUNK_NOTES_CACHE)
+    assert (
+        asyncio.run(chunk_notes_cache.get(cache_key(chunk, LLMType.OPENAI_GPT4)))
+        is None
+    )
+    assert (
+        asyncio.run(chunk_notes_cache.get(cache_key(chunk, LLMType.OPENAI_GPT3_5)))
+        is not None
+    )
+
+    # The chunk is still served from the cache
+    _, _, cached_chunks = asyncio.run(
+        generate(conversation=_conversation(2), content_lst=[Content.MCQ])
+    )
+    assert cached_chunks == [0]
+    assert len(fake_generator.calls) == 2
+
+
+def test_generate_coalesces_identical_requests(fake_generator):
+    async def _run():
+        return await asyncio.gather(
+            *(
+                generate(conversation=_conversation(2), content_lst=[Content.MCQ])
+                for _ in range(3)
+            )
+        )
+
+    results = asyncio.run(_run())
+    assert len(fake_generator.calls) == 2
+    assert results[0] == results[1] == results[2]
+
+
+def _rate_limit_error():
+    request = httpx.Request("POST", "http://llm.test")
+    return httpx.HTTPStatusError(
+        "rate limited",
+        request=request,
+        response=httpx.Response(429, headers={"retry-after-ms": "10"}, request=request),
+    )
+
+
+def test_stream_generate_emits_notes_in_completion_order(fake_generator):
+    fake_generator.delays = {"Question 1": 0.4, "Question 2": 0.1}
+    fake_generator.failures = {"Question 2": [_rate_limit_error()]}
+
+    async def _run():
+        return [
+            event
+            async for event in stream_generate(
+                conversation=_conversation(3), content_lst=[Content.MCQ]
+            )
+        ]
+
+    events = asyncio.run(_run())
+    assert [event["chunks"] for event in events[:3]] == [1, 2, 3]
+    assert all(event["stage"] == "pre_process" for event in events[:3])
+    assert [event["chunk"] for event in events if event["event"] == "note"] == [2, 1, 0]
+    retries = [event for event in events if event["event"] == "retry"]
+    assert [(event["chunk"], event["reason"]) for event in retries] == [
+        (1, "rate_limit")
+    ]
+    # Every field is sent before the notes of its chunk
+    for event in events:
+        if event["event"] == "note":
+            assert {
+                "event": "field",
+                "chunk": event["chunk"],
+                "field": "topic",
+                "value": event["notes"]["topic"],
+            } in events[: events.index(event)]
+    summary = events[-1]
+    assert summary["event"] == "summary"
+    assert summary["token_sum"] == 60
+    assert summary["failed_chunks"] == []
+    assert 0 < summary["time_to_first_note_seconds"] < 0.1
+
+
+def test_stream_generate_reports_failed_chunks(fake_generator):
+    fake_generator.failures = {"Question 1": [ValueError("invalid notes")]}
+
+    async def _run():
+        return [
+            event
+            async for event in stream_generate(
+                conversation=_conversation(2), content_lst=[Content.MCQ]
+            )
+        ]
+
+    events = asyncio.run(_run())
+    failed = [event for event in events if event["event"] == "chunk_failed"]
+    assert [event["chunk"] for event in failed] == [0]
+    assert events[-1]["failed_chunks"] == [0]
+    assert events[-2] == {
+        "event": "progress",
+        "stage": "generate",
+        "chunks": 2,
+        "completed": 1,
+        "failed": 1,
+    }
+
+
+def test_generate_cancels_chunks_at_deadline(fake_generator):
+    fake_generator.delays = {"Question 2": 5}
+
+    async def _run():
+        with pytest.raises(DeadlineExceeded):
+            await generate(
+                conversation=_conversation(2),
+                content_lst=[Content.MCQ],
+                deadline=Deadline(timeout_seconds=0.1),
+            )
+        await asyncio.sleep(0.01)
+        # Nothing is left running for the request that gave up
+        return [
+            task for task in asyncio.all_tasks() if task is not asyncio.current_task()
+        ]
+
+    start = time.perf_counter()
+    assert asyncio.run(_run()) == []
+    assert time.perf_counter() - start < 1
+
+
+def test_stream_generate_fails_chunks_still_running_at_deadline(fake_generator):
+    fake_generator.delays = {"Question 2": 5}
+
+    async def _run():
+        return [
+            event
+            async for event in stream_generate(
+                conversation=_conversation(2),
+                content_lst=[Content.MCQ],
+                deadline=Deadline(timeout_seconds=0.1),
+            )
+        ]
+
+    events = asyncio.run(_run())
+    assert [event["chunk"] for event in events if event["event"] == "note"] == [0]
+    assert [event for event in events if event["event"] == "chunk_failed"] == [
+        {
+            "event": "chunk_failed",
+            "chunk": 1,
+            "reason": "deadline_exceeded",
+            "messages": {"first": "UserMessage2", "last": "AssistantMessage2"},
+            "detail": "Request deadline exceeded",
+        }
+    ]
+    assert events[-1]["failed_chunks"] == [1]
+
+
+def test_generate_partial_returns_notes_of_succeeded_chunks(fake_generator):
+    fake_generator.failures = {
+        "Question 2": [LogicError("Topic is unlikely to be valid")] * 2
+    }
+    with pytest.raises(InferenceFailure):
+        asyncio.run(generate(conversation=_conversation(3), content_lst=[Content.MCQ]))
+
+    chunk_results, token_sum = asyncio.run(
+        generate_partial(conversation=_conversation(3), content_lst=[Content.MCQ])
+    )
+    assert token_sum == TokenCount(tokens=60)
+    assert [chunk_result.to_dict() for chunk_result in chunk_results] == [
+        {
+            "chunk": 0,
+            "status": "succeeded",
+            "cached": True,
+            "messages": {"first": "UserMessage1", "last": "AssistantMessage1"},
+            "reason": None,
+            "detail": None,
+        },
+        {
+            "chunk": 1,
+            "status": "failed",
+            "cached": False,
+            "messages": {"first": "UserMessage2", "last": "AssistantMessage2"},
+            "reason": "rejected_output",
+            "detail": "500: Topic is unlikely to be valid",
+        },
+        {
+            "chunk": 2,
+            "status": "succeeded",
+            "cached": True,
+            "messages": {"first": "UserMessage3", "last": "AssistantMessage3"},
+            "reason": None,
+            "detail": None,
+        },
+    ]
+    assert chunk_results[2].notes == {"topic": "Question 3"}
+
+    # Only the failed chunk is summarised again
+    notes, _, cached_chunks = asyncio.run(
+        generate(conversation=_conversation(3), content_lst=[Content.MCQ])
+    )
+    assert cached_chunks == [0, 2]
+    assert len(fake_generator.calls) == 5
+
+
+def test_generate_partial_drops_chunks_still_running_at_deadline(fake_generator):
+    fake_generator.delays = {"Question 2": 5}
+    start = time.perf_counter()
+    chunk_results, _ = asyncio.run(
+        generate_partial(
+            conversation=_conversation(3),
+            content_lst=[Content.MCQ],
+            deadline=Deadline(timeout_seconds=0.1),
+        )
+    )
+    assert time.perf_counter() - start < 1
+    assert [chunk_result.reason for chunk_result in chunk_results] == [
+        None,
+        "deadline_exceeded",
+        None,
+    ]
+
+
+def test_message_range_reports_parts_as_their_message():
+    conversation = Conversation(
+        title="Sorting",
+        UserMessage3_part2="the rest of a long question",
+        AssistantMessage3="Answer 3",
+        UserMessage4="Question 4",
+    )
+    assert _message_range(conversation) == {
+        "first": "UserMessage3",
+        "last": "UserMessage4",
+    }
+    assert _message_range(Conversation(title="Sorting")) is None